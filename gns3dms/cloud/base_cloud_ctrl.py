@@ -39,6 +39,23 @@ from .exceptions import Unauthorized, ApiError
 KeyPair = namedtuple("KeyPair", ['name'], verbose=False)
 log = logging.getLogger(__name__)
 
+# size of the chunks read from files and cloud storage
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_md5(file):
+    """
+    Computes the MD5 hash of a file without loading it in memory.
+
+    :param file: file object opened in binary mode (read from its current position)
+    :return: hexadecimal digest
+    """
+
+    md5 = hashlib.md5()
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+        md5.update(chunk)
+    return md5.hexdigest()
+
 
 def parse_exception(exception):
     """
@@ -229,7 +246,7 @@ class BaseCloudCtrl(object):
             gns3_container = self.storage_driver.get_container(self.GNS3_CONTAINER_NAME)
 
         with open(file_path, 'rb') as file:
-            local_file_hash = hashlib.md5(file.read()).hexdigest()
+            local_file_hash = file_md5(file)
 
             cloud_hash_name = cloud_object_name + '.md5'
             cloud_objects = [obj.name for obj in gns3_container.list_objects()]
@@ -237,12 +254,7 @@ class BaseCloudCtrl(object):
             # if the file and its hash are in object storage, and the local and storage file hashes match
             # do not upload the file, otherwise upload it
             if cloud_object_name in cloud_objects and cloud_hash_name in cloud_objects:
-                hash_object = gns3_container.get_object(cloud_hash_name)
-                cloud_object_hash = ''
-                for chunk in hash_object.as_stream():
-                    cloud_object_hash += chunk.decode('utf8')
-
-                if cloud_object_hash == local_file_hash:
+                if self.get_file_hash(cloud_object_name) == local_file_hash:
                     return False
 
             file.seek(0)
@@ -267,6 +279,32 @@ class BaseCloudCtrl(object):
         except ContainerDoesNotExistError:
             return []
 
+    def get_file_hash(self, file_name):
+        """
+        Returns the MD5 hash of a file in cloud storage (stored next to it when uploaded).
+        :param file_name: name of file in cloud storage
+        :return: hexadecimal digest or None if the hash is not in cloud storage
+        """
+
+        gns3_container = self.storage_driver.get_container(self.GNS3_CONTAINER_NAME)
+        try:
+            hash_object = gns3_container.get_object(file_name + '.md5')
+        except ObjectDoesNotExistError:
+            return None
+        return b''.join(hash_object.as_stream()).decode('utf8').strip()
+
+    def iter_file(self, file_name, chunk_size=CHUNK_SIZE):
+        """
+        Streams a file from cloud storage.
+        :param file_name: name of file in cloud storage
+        :param chunk_size: size of the chunks
+        :return: iterator of bytes chunks
+        """
+
+        gns3_container = self.storage_driver.get_container(self.GNS3_CONTAINER_NAME)
+        storage_object = gns3_container.get_object(file_name)
+        return storage_object.as_stream(chunk_size=chunk_size)
+
     def download_file(self, file_name, destination=None):
         """
         Downloads file from cloud storage. If a file exists at destination, and it is identical to the file in cloud
@@ -276,32 +314,27 @@ class BaseCloudCtrl(object):
         :return: A file-like object if file contents are returned, or None if file is saved to filesystem
         """
 
-        gns3_container = self.storage_driver.get_container(self.GNS3_CONTAINER_NAME)
-        storage_object = gns3_container.get_object(file_name)
-
         if destination is not None:
             if os.path.isfile(destination):
                 # if a file exists at destination and its hash matches that of the
                 # file in cloud storage, don't download it
                 with open(destination, 'rb') as f:
-                    local_file_hash = hashlib.md5(f.read()).hexdigest()
-
-                    hash_object = gns3_container.get_object(file_name + '.md5')
-                    cloud_object_hash = ''
-                    for chunk in hash_object.as_stream():
-                        cloud_object_hash += chunk.decode('utf8')
+                    local_file_hash = file_md5(f)
 
-                    if local_file_hash == cloud_object_hash:
-                        return
+                if local_file_hash == self.get_file_hash(file_name):
+                    return
 
-            storage_object.download(destination)
+            gns3_container = self.storage_driver.get_container(self.GNS3_CONTAINER_NAME)
+            storage_object = gns3_container.get_object(file_name)
+            storage_object.download(destination, overwrite_existing=True)
         else:
-            contents = b''
+            contents = BytesIO()
 
-            for chunk in storage_object.as_stream():
-                contents += chunk
+            for chunk in self.iter_file(file_name):
+                contents.write(chunk)
 
-            return BytesIO(contents)
+            contents.seek(0)
+            return contents
 
     def find_storage_image_names(self, images_to_find):
         """
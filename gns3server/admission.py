@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Admission control based on the host load, used to avoid boot storms
+when many nodes are started at once.
+"""
+
+import os
+import time
+import multiprocessing
+
+import logging
+log = logging.getLogger(__name__)
+
+# minimum time between two CPU usage samples (seconds)
+CPU_SAMPLE_INTERVAL = 0.25
+
+
+def _cpu_count():
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _read_proc_stat():
+    """
+    Returns the total and idle CPU times from /proc/stat (Linux only).
+
+    :returns: tuple (total, idle) or None
+    """
+
+    try:
+        with open("/proc/stat") as f:
+            fields = f.readline().split()
+    except OSError:
+        return None
+    if not fields or fields[0] != "cpu":
+        return None
+    times = [int(value) for value in fields[1:]]
+    # idle + iowait
+    idle = times[3] + (times[4] if len(times) > 4 else 0)
+    return sum(times), idle
+
+
+def host_available_memory():
+    """
+    Returns the memory available for new processes.
+
+    :returns: available memory in MB, None if unknown
+    """
+
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = {}
+            for line in f:
+                name, value = line.split(":", 1)
+                meminfo[name] = int(value.split()[0])
+    except (OSError, ValueError):
+        return None
+
+    if "MemAvailable" in meminfo:
+        available = meminfo["MemAvailable"]
+    else:
+        # kernels older than 3.14
+        available = meminfo.get("MemFree", 0) + meminfo.get("Buffers", 0) + meminfo.get("Cached", 0)
+    return available // 1024
+
+
+class AdmissionController(object):
+    """
+    Decides if a new node can be started now.
+
+    :param max_concurrency: maximum number of starts in progress
+    :param max_cpu_usage: CPU usage (percent) above which no start is admitted
+    :param min_available_memory: available memory (MB) under which no start is admitted
+    """
+
+    def __init__(self, max_concurrency=None, max_cpu_usage=90, min_available_memory=256):
+
+        self._max_concurrency = max_concurrency or _cpu_count()
+        self._max_cpu_usage = max_cpu_usage
+        self._min_available_memory = min_available_memory
+        self._last_sample = None
+        self._last_sample_time = 0
+        self._cpu_usage = None
+
+    @property
+    def max_concurrency(self):
+        """
+        Returns the maximum number of starts in progress.
+
+        :returns: integer
+        """
+
+        return self._max_concurrency
+
+    def cpu_usage(self):
+        """
+        Returns the host CPU usage since the previous call
+        (falls back to the load average where /proc/stat is not available).
+
+        :returns: CPU usage in percent, None if unknown
+        """
+
+        now = time.monotonic()
+        if self._cpu_usage is not None and now - self._last_sample_time < CPU_SAMPLE_INTERVAL:
+            return self._cpu_usage
+
+        sample = _read_proc_stat()
+        if sample is None:
+            try:
+                self._cpu_usage = min(100.0, os.getloadavg()[0] * 100.0 / _cpu_count())
+            except (AttributeError, OSError):
+                self._cpu_usage = None
+        elif self._last_sample is not None:
+            total = sample[0] - self._last_sample[0]
+            idle = sample[1] - self._last_sample[1]
+            if total > 0:
+                self._cpu_usage = 100.0 * (total - idle) / total
+        self._last_sample = sample
+        self._last_sample_time = now
+        return self._cpu_usage
+
+    def admit(self, in_progress):
+        """
+        Checks if a new start can be admitted.
+
+        :param in_progress: number of starts in progress
+
+        :returns: tuple (admitted, reason)
+        """
+
+        if in_progress >= self._max_concurrency:
+            return False, "{} starts in progress".format(in_progress)
+
+        cpu_usage = self.cpu_usage()
+        if cpu_usage is not None and cpu_usage > self._max_cpu_usage:
+            return False, "CPU usage is {:.0f}%".format(cpu_usage)
+
+        available_memory = host_available_memory()
+        if available_memory is not None and available_memory < self._min_available_memory:
+            return False, "only {} MB of memory available".format(available_memory)
+
+        return True, None
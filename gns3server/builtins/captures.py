@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sends the summary (time range, largest flows) of a packet capture to
+requesting clients in JSON-RPC Websocket handler. The packets are then
+retrieved with the /capture HTTP handler.
+"""
+
+import tornado.ioloop
+from jsonschema import validate, ValidationError
+
+from ..pcap_index import PcapIndexes, PcapIndexError
+from ..jsonrpc import JSONRPCResponse
+from ..jsonrpc import JSONRPCCustomError
+
+import logging
+log = logging.getLogger(__name__)
+
+CAPTURE_INDEX_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to get the summary of a packet capture",
+    "type": "object",
+    "properties": {
+        "path": {
+            "description": "path to the capture file (absolute or relative to the projects directory)",
+            "type": "string",
+            "minLength": 1,
+        },
+        "max_flows": {
+            "description": "maximum number of flows returned (the largest ones)",
+            "type": "integer",
+            "minimum": 0,
+        },
+    },
+    "additionalProperties": False,
+    "required": ["path"]
+}
+
+
+def capture_index(handler, request_id, params):
+    """
+    Builtin destination to return the summary of a packet capture
+    (indexed in a worker thread).
+
+    :param handler: JSONRPCWebSocket instance
+    :param request_id: JSON-RPC call identifier
+    :param params: JSON-RPC method params (path, max_flows)
+    """
+
+    try:
+        validate(params, CAPTURE_INDEX_SCHEMA)
+    except ValidationError as e:
+        handler.write_message(JSONRPCCustomError(-3200, "request validation error: {}".format(e), request_id)())
+        return
+
+    def done(future):
+        if handler not in handler.clients:
+            return
+        try:
+            summary = future.result()
+        except PcapIndexError as e:
+            handler.write_message(JSONRPCCustomError(-3200, str(e), request_id)())
+            return
+        handler.write_message(JSONRPCResponse(summary, request_id)())
+
+    future = PcapIndexes.instance().summary(params["path"], params.get("max_flows", 100))
+    tornado.ioloop.IOLoop.instance().add_future(future, done)
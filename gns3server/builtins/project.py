@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Starts or stops all the nodes of a project in parallel across the modules,
+with admission control to avoid boot storms.
+"""
+
+import collections
+import tornado.ioloop
+from jsonschema import validate, ValidationError
+
+from ..config import Config
+from ..admission import AdmissionController
+from ..jsonrpc import JSONRPCResponse
+from ..jsonrpc import JSONRPCNotification
+from ..jsonrpc import JSONRPCCustomError
+
+import logging
+log = logging.getLogger(__name__)
+
+PROJECT_NODES_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to start or stop the nodes of a project",
+    "type": "object",
+    "properties": {
+        "nodes": {
+            "description": "nodes to start or stop",
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "module": {
+                        "description": "module destination prefix (e.g. iou or dynamips.vm)",
+                        "type": "string",
+                        "minLength": 1,
+                    },
+                    "id": {
+                        "description": "node instance identifier",
+                        "type": "integer"
+                    },
+                },
+                "additionalProperties": False,
+                "required": ["module", "id"]
+            },
+        },
+        "max_concurrency": {
+            "description": "maximum number of nodes being started at the same time",
+            "type": "integer",
+            "minimum": 1,
+        },
+        "timeout": {
+            "description": "deadline for each node (seconds)",
+            "type": "number",
+            "minimum": 1,
+        },
+    },
+    "additionalProperties": False,
+    "required": ["nodes"]
+}
+
+# how long to wait before checking the host load again (seconds)
+ADMISSION_RETRY_DELAY = 0.5
+
+# a start is admitted anyway if nothing is in progress for that long (seconds)
+ADMISSION_MAX_WAIT = 30
+
+
+class ProjectOrchestrator(object):
+    """
+    Sends the start (or stop) requests of a set of nodes to their modules
+    in parallel and reports the progress to the client.
+
+    :param handler: JSONRPCWebSocket instance
+    :param request_id: JSON-RPC call identifier
+    :param action: "start" or "stop"
+    :param nodes: list of nodes ({"module": ..., "id": ...})
+    :param timeout: deadline for each node (seconds)
+    :param admission: AdmissionController instance (None to send all the requests at once)
+    """
+
+    def __init__(self, handler, request_id, action, nodes, timeout, admission=None):
+
+        self._handler = handler
+        self._request_id = request_id
+        self._action = action
+        self._pending = collections.deque(nodes)
+        self._total = len(nodes)
+        self._timeout = timeout
+        self._admission = admission
+        self._in_progress = {}  # JSON-RPC request ID -> (node, timeout handle)
+        self._succeeded = []
+        self._failed = []
+        self._blocked_since = None
+        self._retry = None
+        self._ioloop = tornado.ioloop.IOLoop.instance()
+
+    def run(self):
+        """
+        Starts sending the requests.
+        """
+
+        log.info("{} {} nodes".format("starting" if self._action == "start" else "stopping", self._total))
+        self._schedule()
+
+    def _write(self, message):
+
+        if self._handler in self._handler.clients:
+            self._handler.write_message(message)
+
+    def _schedule(self):
+        """
+        Sends as many requests as the admission controller allows.
+        """
+
+        if self._retry:
+            self._ioloop.remove_timeout(self._retry)
+            self._retry = None
+        while self._pending:
+            if self._admission:
+                admitted, reason = self._admission.admit(len(self._in_progress))
+                if not admitted:
+                    now = self._ioloop.time()
+                    if self._blocked_since is None:
+                        self._blocked_since = now
+                        log.info("delaying the next start: {}".format(reason))
+                    if self._in_progress or now - self._blocked_since < ADMISSION_MAX_WAIT:
+                        self._retry = self._ioloop.add_timeout(now + ADMISSION_RETRY_DELAY, self._schedule)
+                        return
+                    log.warning("starting the next node anyway: {}".format(reason))
+                self._blocked_since = None
+            self._send(self._pending.popleft())
+
+        if not self._in_progress:
+            self._finish()
+
+    def _send(self, node):
+        """
+        Sends the request for a node.
+
+        :param node: node ({"module": ..., "id": ...})
+        """
+
+        method = "{}.{}".format(node["module"], self._action)
+        if method not in self._handler.destinations or method.startswith("builtin"):
+            self._done(node, "Unknown destination {}".format(method))
+            return
+
+        request_id = None
+
+        def callback(response):
+            _, timeout = self._in_progress.pop(request_id)
+            self._ioloop.remove_timeout(timeout)
+            if "error" in response:
+                self._done(node, response["error"].get("message", "unknown error"))
+            else:
+                self._done(node)
+            self._schedule()
+
+        def expired():
+            self._handler.cancel_internal_request(request_id)
+            self._in_progress.pop(request_id)
+            self._done(node, "No response after {} seconds".format(self._timeout))
+            self._schedule()
+
+        request_id = self._handler.send_internal_request(method, {"id": node["id"]}, callback)
+        timeout = self._ioloop.add_timeout(self._ioloop.time() + self._timeout, expired)
+        self._in_progress[request_id] = (node, timeout)
+
+    def _done(self, node, error=None):
+        """
+        Records the result for a node and notifies the client.
+
+        :param node: node ({"module": ..., "id": ...})
+        :param error: error message (None on success)
+        """
+
+        progress = {"action": self._action,
+                    "module": node["module"],
+                    "id": node["id"]}
+        if error:
+            log.warning("could not {} {} {}: {}".format(self._action, node["module"], node["id"], error))
+            self._failed.append({"module": node["module"], "id": node["id"], "message": error})
+            progress["status"] = "failed"
+            progress["message"] = error
+        else:
+            self._succeeded.append({"module": node["module"], "id": node["id"]})
+            progress["status"] = "done"
+        progress["completed"] = len(self._succeeded) + len(self._failed)
+        progress["total"] = self._total
+        self._write(JSONRPCNotification("builtin.project.progress", progress)())
+
+    def _finish(self):
+        """
+        Sends the final response.
+        """
+
+        log.info("{} nodes {}, {} failed".format(len(self._succeeded),
+                                                 "started" if self._action == "start" else "stopped",
+                                                 len(self._failed)))
+        self._write(JSONRPCResponse({"action": self._action,
+                                     "succeeded": self._succeeded,
+                                     "failed": self._failed}, self._request_id)())
+
+
+def _run(handler, request_id, params, action):
+
+    try:
+        validate(params, PROJECT_NODES_SCHEMA)
+    except ValidationError as e:
+        handler.write_message(JSONRPCCustomError(-3200, "request validation error: {}".format(e), request_id)())
+        return
+
+    server_config = Config.instance().get_default_section()
+    if action == "start":
+        timeout = params.get("timeout", float(server_config.get("start_timeout", 300)))
+        admission = AdmissionController(params.get("max_concurrency", int(server_config.get("max_concurrent_starts", 0))),
+                                        float(server_config.get("max_cpu_usage", 90)),
+                                        int(server_config.get("min_available_memory", 256)))
+    else:
+        timeout = params.get("timeout", float(server_config.get("stop_timeout", 60)))
+        admission = None
+
+    ProjectOrchestrator(handler, request_id, action, params["nodes"], timeout, admission).run()
+
+
+def project_start_all(handler, request_id, params):
+    """
+    Builtin destination to start nodes of any module in parallel.
+
+    :param handler: JSONRPCWebSocket instance
+    :param request_id: JSON-RPC call identifier
+    :param params: JSON-RPC method params (nodes, max_concurrency, timeout)
+    """
+
+    _run(handler, request_id, params, "start")
+
+
+def project_stop_all(handler, request_id, params):
+    """
+    Builtin destination to stop nodes of any module in parallel.
+
+    :param handler: JSONRPCWebSocket instance
+    :param request_id: JSON-RPC call identifier
+    :param params: JSON-RPC method params (nodes, timeout)
+    """
+
+    _run(handler, request_id, params, "stop")
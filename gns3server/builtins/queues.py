@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sends the state of the module queues to requesting clients in JSON-RPC Websocket handler.
+"""
+
+from ..jsonrpc import JSONRPCResponse
+
+
+def module_queues(handler, request_id, params):
+    """
+    Builtin destination to return the requests in flight and waiting
+    for each module.
+
+    :param handler: JSONRPCWebSocket instance
+    :param request_id: JSON-RPC call identifier
+    :param params: JSON-RPC method params (not used here)
+    """
+
+    json_message = {module: queue.status() for module, queue in handler.queues.items()}
+    handler.write_message(JSONRPCResponse(json_message, request_id)())
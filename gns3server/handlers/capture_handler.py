@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Packet capture retrieval handler: returns the packets of a time range
+and/or flow of a capture as a PCAP file.
+"""
+
+import os
+import tornado.web
+import tornado.gen
+from .auth_handler import GNS3BaseHandler
+from ..pcap_index import PcapIndexes, PcapIndexError, FlowFilter
+
+import logging
+log = logging.getLogger(__name__)
+
+# size of the blocks read from the capture and sent to the client
+CHUNK_SIZE = 256 * 1024
+
+
+class CaptureHandler(GNS3BaseHandler):
+    """
+    Capture handler.
+
+    GET parameters:
+    - path (path to the capture file, absolute or relative to the projects directory)
+    - start, end (time range, seconds since the epoch)
+    - last (only the last seconds of the capture)
+    - protocol, host, port, peer_host, peer_port (flow)
+    - limit (maximum number of packets)
+
+    :param application: Tornado Application instance
+    :param request: Tornado Request instance
+    """
+
+    def _get_number(self, name, convert=float):
+
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        try:
+            return convert(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "invalid {} parameter: {}".format(name, value))
+
+    def _get_flow(self):
+
+        protocol = self.get_argument("protocol", None)
+        if protocol is not None and protocol.isdigit():
+            protocol = int(protocol)
+        host = self.get_argument("host", None)
+        port = self._get_number("port", int)
+        peer_host = self.get_argument("peer_host", None)
+        peer_port = self._get_number("peer_port", int)
+        if protocol is None and host is None and port is None and peer_host is None and peer_port is None:
+            return None
+        try:
+            return FlowFilter(protocol, host, port, peer_host, peer_port)
+        except PcapIndexError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+    @tornado.web.authenticated
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        Invoked on GET request.
+        """
+
+        path = self.get_argument("path")
+        start = self._get_number("start")
+        end = self._get_number("end")
+        last = self._get_number("last")
+        limit = self._get_number("limit", int)
+        flow = self._get_flow()
+
+        try:
+            header, ranges, count = yield PcapIndexes.instance().select(path,
+                                                                        start=start,
+                                                                        end=end,
+                                                                        last=last,
+                                                                        flow=flow,
+                                                                        limit=limit)
+        except PcapIndexError as e:
+            raise tornado.web.HTTPError(404, str(e))
+
+        log.info("sending {} packets of {}".format(count, path))
+        self.set_header("Content-Type", "application/vnd.tcpdump.pcap")
+        self.set_header("Content-Disposition", 'attachment; filename="{}"'.format(os.path.basename(path)))
+        self.write(header)
+        with open(PcapIndexes.capture_path(path), "rb") as f:
+            for range_start, range_end in ranges:
+                f.seek(range_start)
+                while range_start < range_end:
+                    data = f.read(min(CHUNK_SIZE, range_end - range_start))
+                    if not data:
+                        # the capture has been truncated since it was indexed
+                        return
+                    range_start += len(data)
+                    self.write(data)
+                    yield tornado.gen.Task(self.flush)
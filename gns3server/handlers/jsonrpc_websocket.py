@@ -21,19 +21,83 @@ JSON-RPC protocol over Websockets.
 
 import zmq
 import uuid
+import tornado.ioloop
 import tornado.websocket
 from .auth_handler import GNS3WebSocketBaseHandler
 from tornado.escape import json_decode
+from ..config import Config
+from ..module_queue import ModuleQueue
+from ..module_queue import is_control
+from ..module_queue import request_nodes
+from ..modules.sharding import ModuleShards
+from ..jsonrpc import dumps
+from ..jsonrpc import encode
+from ..jsonrpc import decode
+from ..jsonrpc import packb
+from ..jsonrpc import unpackb
+from ..jsonrpc import is_binary
+from ..jsonrpc import msgpack
+from ..jsonrpc import JSONRPC_VERSION
+from ..jsonrpc import MSGPACK_SUBPROTOCOL
 from ..jsonrpc import JSONRPCParseError
 from ..jsonrpc import JSONRPCInvalidRequest
 from ..jsonrpc import JSONRPCMethodNotFound
 from ..jsonrpc import JSONRPCNotification
+from ..jsonrpc import JSONRPCRequest
 from ..jsonrpc import JSONRPCCustomError
+from ..jsonrpc import JSONRPCServerBusy
 
 import logging
 log = logging.getLogger(__name__)
 
 
+class BatchCall(object):
+    """
+    Stands for the client when a built-in method is called in a batch:
+    the response is added to the batch response, the notifications
+    are sent to the client as usual.
+
+    :param client: JSONRPCWebSocket instance
+    :param batch_id: batch identifier
+    """
+
+    def __init__(self, client, batch_id):
+
+        self._client = client
+        self._batch_id = batch_id
+        self._replied = False
+
+    def __getattr__(self, name):
+
+        return getattr(self._client, name)
+
+    @property
+    def clients(self):
+        """
+        Connected clients, the built-in methods only reply to them.
+
+        :returns: set
+        """
+
+        if self._client in self._client.clients:
+            return {self}
+        return set()
+
+    def write_message(self, message, binary=False):
+        """
+        Adds the response to the batch response, sends the other messages.
+
+        :param message: JSON-RPC message (dictionary)
+        :param binary: send a binary frame
+        """
+
+        if isinstance(message, dict) and "method" not in message and not self._replied:
+            self._replied = True
+            self._client._collect_batch_responses(self._batch_id, [message])
+        else:
+            self._client.write_message(message, binary)
+
+
 class JSONRPCWebSocket(GNS3WebSocketBaseHandler):
     """
     STOMP protocol over Tornado Websockets with message
@@ -46,16 +110,118 @@ class JSONRPCWebSocket(GNS3WebSocketBaseHandler):
 
     clients = set()
     destinations = {}
-    version = 2.0  # only JSON-RPC version 2.0 is supported
+    internal_calls = {}
+    batches = {}
+    queues = {}
+    shards = {}
+    version = JSONRPC_VERSION  # only JSON-RPC version 2.0 is supported
 
     def __init__(self, application, request, zmq_router):
         tornado.websocket.WebSocketHandler.__init__(self, application, request)
         self._session_id = str(uuid.uuid4())
+        self._binary = False
         self.zmq_router = zmq_router
 
     def check_origin(self, origin):
         return True
 
+    def select_subprotocol(self, subprotocols):
+        """
+        Negotiates the binary (MessagePack) encoding, JSON text is
+        used if the client doesn't request it.
+
+        :param subprotocols: subprotocols requested by the client
+
+        :returns: selected subprotocol or None
+        """
+
+        if msgpack is not None and MSGPACK_SUBPROTOCOL in subprotocols:
+            self._binary = True
+            return MSGPACK_SUBPROTOCOL
+        return None
+
+    def get_compression_options(self):
+        """
+        Enables the permessage-deflate extension (Tornado >= 4.0)
+        for the clients supporting it.
+        """
+
+        return {}
+
+    def write_message(self, message, binary=False):
+        """
+        Sends a message to the client, messages that are not already
+        serialized are encoded with the negotiated encoding.
+
+        :param message: JSON-RPC message (dictionary or list), JSON string or MessagePack bytes
+        :param binary: send a binary frame
+        """
+
+        if isinstance(message, (dict, list)):
+            message = encode(message, self._binary)
+        binary = binary or isinstance(message, bytes)
+        tornado.websocket.WebSocketHandler.write_message(self, message, binary)
+
+    @classmethod
+    def module_queue(cls, module):
+        """
+        Returns the flow control of the requests sent to a module.
+
+        :param module: module name
+
+        :returns: ModuleQueue instance
+        """
+
+        queue = cls.queues.get(module)
+        if queue is None:
+            server_config = Config.instance().get_default_section()
+            queue = ModuleQueue(module,
+                                max_in_flight=int(server_config.get("module_max_in_flight", 32)),
+                                max_queued=int(server_config.get("module_max_queued", 256)))
+            cls.queues[module] = queue
+        return queue
+
+    @classmethod
+    def check_queues(cls):
+        """
+        Frees the slots of the requests without response for too long
+        and sends the requests waiting for them (called periodically).
+        """
+
+        for queue in cls.queues.values():
+            queue.check()
+
+    def _send_to_module(self, module, message, call_id=None, control=False, weight=1):
+        """
+        Sends a message to a module, encoded like the messages of the client.
+        Requests wait in the server while the module has too many requests in flight.
+
+        :param module: module name
+        :param message: array [session ID, JSON-RPC request or requests, ...]
+        :param call_id: identifier of the expected response (None for notifications)
+        :param control: control operation (overtakes the requests of the other nodes)
+        :param weight: number of requests (for a batch)
+
+        :returns: False if the module is busy (the message is not sent)
+        """
+
+        data = packb(message) if self._binary else dumps(message)
+        router = self.zmq_router
+
+        def send():
+            if router.closed:
+                return
+            # Route to the correct module
+            router.send_string(module, zmq.SNDMORE)
+            if isinstance(data, bytes):
+                router.send(data)
+            else:
+                router.send_string(data)
+
+        requests = message[1] if isinstance(message[1], list) else [message[1]]
+        key = None if call_id is None else (self.session_id, str(call_id))
+        return self.module_queue(module).submit(key, send, control, weight, request_nodes(requests))
+
     @property
     def session_id(self):
         """
@@ -77,23 +243,70 @@ class JSONRPCWebSocket(GNS3WebSocketBaseHandler):
         # Module name that is replying
         module = message[0].decode("utf-8")
 
-        # ZMQ responses are encoded in JSON
-        # format is a JSON array: [session ID, JSON-RPC response]
+        # ZMQ messages are multipart: [session ID, call ID, JSON-RPC message]
+        # the JSON-RPC message is forwarded to the client as it is
         try:
-            json_message = json_decode(message[1])
+            session_id, call_id, jsonrpc_message = message[1:]
+            session_id = session_id.decode("utf-8")
+            call_id = call_id.decode("utf-8")
+            if not is_binary(jsonrpc_message):
+                jsonrpc_message = jsonrpc_message.decode("utf-8")
         except ValueError as e:
             stream.send_string("Cannot decode message!")
             log.critical("Couldn't decode message: {}".format(e))
             return
 
-        session_id = json_message[0]
-        jsonrpc_response = json_message[1]
+        log.debug("Received message from module {}: {}".format(module, jsonrpc_message))
+
+        # a response frees a slot for the next request to this module
+        if call_id and module in cls.queues:
+            cls.queues[module].done((session_id, call_id))
+
+        # responses of a module to its part of a batch
+        if call_id in cls.batches:
+            try:
+                responses = decode(jsonrpc_message)
+            except ValueError as e:
+                log.critical("Couldn't decode message: {}".format(e))
+                responses = []
+            cls._collect_batch_responses(call_id, responses)
+            return
 
-        log.debug("Received message from module {}: {}".format(module, json_message))
+        # responses to requests sent by the server itself (e.g. builtin.project.start_all)
+        if call_id in cls.internal_calls:
+            callback = cls.internal_calls.pop(call_id)
+            try:
+                callback(decode(jsonrpc_message))
+            except ValueError as e:
+                log.critical("Couldn't decode message: {}".format(e))
+            return
 
         for client in cls.clients:
             if client.session_id == session_id:
-                client.write_message(jsonrpc_response)
+                client.write_message(jsonrpc_message)
+
+    @classmethod
+    def _collect_batch_responses(cls, batch_id, responses):
+        """
+        Adds the responses of a module or a built-in method to a pending batch,
+        the batch response is sent to the client once they have all replied.
+
+        :param batch_id: batch identifier
+        :param responses: list of responses
+        """
+
+        batch = cls.batches.get(batch_id)
+        if batch is None:
+            # the client has disconnected
+            return
+        batch["responses"].extend(responses)
+        batch["pending"] -= 1
+        if batch["pending"]:
+            return
+        del cls.batches[batch_id]
+        # there is no response if the batch only contains notifications
+        if batch["client"] in cls.clients and batch["responses"]:
+            batch["client"].write_message(batch["responses"])
 
     @classmethod
     def register_destination(cls, destination, module):
@@ -114,6 +327,88 @@ class JSONRPCWebSocket(GNS3WebSocketBaseHandler):
             log.debug("registering {} as a destination for the {} module".format(destination, module))
         cls.destinations[destination] = module
 
+    @classmethod
+    def register_shards(cls, module, identities):
+        """
+        Registers the processes (shards) of a module.
+
+        :param module: module name
+        :param identities: ZeroMQ identities of the shards
+        """
+
+        cls.shards[module] = ModuleShards(identities)
+
+    def _route(self, method, params):
+        """
+        Returns the module processes handling a request.
+
+        :param method: JSON-RPC method (a module destination)
+        :param params: JSON-RPC params
+
+        :returns: list of module identities, the first one replies to the requester
+        """
+
+        module = self.destinations[method]
+        shards = self.shards.get(module)
+        if shards is None:
+            return [module]
+        return shards.route(method, params)
+
+    def _send_copy(self, identity, request):
+        """
+        Sends a request applied to all the shards of a module (e.g. settings)
+        to another shard, its response is not sent to the client.
+
+        :param identity: module identity
+        :param request: JSON-RPC request
+        """
+
+        method = request["method"]
+        if request.get("id") is not None:
+            request = dict(request)
+            request["id"] = str(uuid.uuid4())
+
+            def callback(response):
+                if "error" in response:
+                    log.error("{} failed on {}: {}".format(method, identity, response["error"].get("message")))
+            self.internal_calls[request["id"]] = callback
+
+        if not self._send_to_module(identity, [self.session_id, request], request.get("id"), is_control(method)):
+            self.internal_calls.pop(request.get("id"), None)
+            log.warning("{} not sent to {}: too many requests waiting".format(method, identity))
+
+    def send_internal_request(self, method, params, callback):
+        """
+        Sends a request to a module on behalf of the server (in the session
+        of this client), the response is passed to the callback instead of
+        being sent to the client.
+
+        :param method: JSON-RPC method (a module destination)
+        :param params: JSON-RPC params
+        :param callback: callable receiving the JSON-RPC response
+
+        :returns: JSON-RPC request identifier
+        """
+
+        request = JSONRPCRequest(method, params)()
+        self.internal_calls[request["id"]] = callback
+        module = self._route(method, params)[0]
+        if not self._send_to_module(module, [self.session_id, request], request["id"], is_control(method)):
+            del self.internal_calls[request["id"]]
+            busy = JSONRPCServerBusy(request["id"], self.queues[module].retry_after())()
+            tornado.ioloop.IOLoop.instance().add_callback(callback, busy)
+        return request["id"]
+
+    @classmethod
+    def cancel_internal_request(cls, request_id):
+        """
+        Ignores the response to a request sent with send_internal_request().
+
+        :param request_id: JSON-RPC request identifier
+        """
+
+        cls.internal_calls.pop(request_id, None)
+
     def open(self):
         """
         Invoked when a new WebSocket is opened.
@@ -144,7 +439,18 @@ class JSONRPCWebSocket(GNS3WebSocketBaseHandler):
             return
 
         try:
-            request = json_decode(message)
+            if isinstance(message, bytes):
+                # binary frame
+                request = unpackb(message) if self._binary else json_decode(message)
+            else:
+                request = json_decode(message)
+        except ValueError:
+            return self.write_message(JSONRPCParseError()())
+
+        if isinstance(request, list):
+            return self._process_batch(request)
+
+        try:
             jsonrpc_version = request["jsonrpc"]
             method = request["method"]
             # This is a JSON-RPC notification if request_id is None
@@ -175,14 +481,84 @@ class JSONRPCWebSocket(GNS3WebSocketBaseHandler):
             self.destinations[method](self, request_id, request.get("params"))
             return
 
-        module = self.destinations[method]
-        # ZMQ requests are encoded in JSON
-        # format is a JSON array: [session ID, JSON-RPC request]
-        zmq_request = [self.session_id, request]
-        # Route to the correct module
-        self.zmq_router.send_string(module, zmq.SNDMORE)
-        # Send the JSON request
-        self.zmq_router.send_json(zmq_request)
+        # ZMQ requests are encoded like the client messages (JSON or MessagePack)
+        # format is an array: [session ID, JSON-RPC request]
+        modules = self._route(method, request.get("params"))
+        for module in modules[1:]:
+            self._send_copy(module, request)
+        module = modules[0]
+        if not self._send_to_module(module, [self.session_id, request], request_id, is_control(method)):
+            self.write_message(JSONRPCServerBusy(request_id, self.queues[module].retry_after())())
+
+    def _process_batch(self, requests):
+        """
+        Handles a JSON-RPC batch: the requests are grouped by module and sent
+        in one message per module, the responses are sent back to the client
+        in one batch response once all the modules and built-in methods
+        have replied.
+
+        :param requests: list of JSON-RPC requests
+        """
+
+        if not requests:
+            return self.write_message(JSONRPCInvalidRequest()())
+
+        if len(self.clients) > 1:
+            log.warn("GNS3 server doesn't support multiple clients yet")
+            return self.write_message(JSONRPCCustomError(-3200,
+                                                         "There are {} clients connected, the GNS3 server cannot handle multiple clients yet".format(len(self.clients)))())
+
+        errors = []
+        builtin_requests = []
+        module_requests = {}
+        for request in requests:
+            try:
+                jsonrpc_version = request["jsonrpc"]
+                method = request["method"]
+                request_id = request.get("id")
+            except (TypeError, KeyError, AttributeError):
+                errors.append(JSONRPCInvalidRequest()())
+                continue
+
+            if jsonrpc_version != self.version:
+                errors.append(JSONRPCInvalidRequest()())
+                continue
+
+            if method not in self.destinations:
+                if request_id:
+                    log.warn("JSON-RPC method not found: {}".format(method))
+                    errors.append(JSONRPCMethodNotFound(request_id)())
+                continue
+
+            if method.startswith("builtin"):
+                if request_id:
+                    builtin_requests.append(request)
+                continue
+
+            modules = self._route(method, request.get("params"))
+            for module in modules[1:]:
+                self._send_copy(module, request)
+            module_requests.setdefault(modules[0], []).append(request)
+
+        if not module_requests and not builtin_requests:
+            if errors:
+                self.write_message(errors)
+            return
+
+        batch_id = str(uuid.uuid4())
+        self.batches[batch_id] = {"client": self,
+                                  "pending": len(module_requests) + len(builtin_requests),
+                                  "responses": errors}
+        for module, batch_requests in module_requests.items():
+            # format is an array: [session ID, [JSON-RPC requests], batch ID]
+            control = all(is_control(request["method"]) for request in batch_requests)
+            if not self._send_to_module(module, [self.session_id, batch_requests, batch_id], batch_id, control, len(batch_requests)):
+                retry_after = self.queues[module].retry_after()
+                busy = [JSONRPCServerBusy(request["id"], retry_after)() for request in batch_requests if request.get("id")]
+                self._collect_batch_responses(batch_id, busy)
+        for request in builtin_requests:
+            log.info("calling built-in method {}".format(request["method"]))
+            self.destinations[request["method"]](BatchCall(self, batch_id), request["id"], request.get("params"))
 
     def on_close(self):
         """
@@ -191,14 +567,17 @@ class JSONRPCWebSocket(GNS3WebSocketBaseHandler):
 
         log.info("Websocket client {} disconnected".format(self.session_id))
         self.clients.remove(self)
+        for batch_id, batch in list(self.batches.items()):
+            if batch["client"] is self:
+                del self.batches[batch_id]
+        for queue in self.queues.values():
+            queue.cancel(self.session_id)
 
         # Reset the modules if there are no clients anymore
         # Modules must implement a reset destination
         if not self.clients and not self.zmq_router.closed:
-            for destination, module in self.destinations.items():
+            for destination in list(self.destinations):
                 if destination.endswith("reset"):
-                    # Route to the correct module
-                    self.zmq_router.send_string(module, zmq.SNDMORE)
-                    # Send the JSON request
                     notification = JSONRPCNotification(destination)()
-                    self.zmq_router.send_json([self.session_id, notification])
+                    for module in self._route(destination, None):
+                        self._send_to_module(module, [self.session_id, notification])
@@ -22,22 +22,205 @@ http://www.jsonrpc.org/specification
 
 import json
 import uuid
+import base64
+
+try:
+    # optional faster JSON backend
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    # optional binary encoding negotiated with the clients
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# only JSON-RPC version 2.0 is supported (sent as a number for compatibility with the clients)
+JSONRPC_VERSION = 2.0
+
+# Websocket subprotocol of the binary (MessagePack) encoding
+MSGPACK_SUBPROTOCOL = "gns3.msgpack"
+
+# suffix of the fields sent as raw bytes with the binary encoding
+BASE64_SUFFIX = "_base64"
+
+
+def dumps(message):
+    """
+    Serializes a JSON-RPC message (a dictionary or a list).
+
+    :param message: message to serialize
+
+    :returns: JSON string
+    """
+
+    if ujson is not None:
+        return ujson.dumps(message, ensure_ascii=False)
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(data):
+    """
+    Deserializes a JSON-RPC message.
+
+    :param data: JSON string or UTF-8 encoded bytes
+
+    :returns: message
+    """
+
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+def packb(message):
+    """
+    Serializes a JSON-RPC message with MessagePack.
+
+    :param message: message to serialize
+
+    :returns: bytes
+    """
+
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def unpackb(data):
+    """
+    Deserializes a JSON-RPC message encoded with MessagePack.
+
+    :param data: bytes
+
+    :returns: message
+    """
+
+    return msgpack.unpackb(data, raw=False)
+
+
+def is_binary(data):
+    """
+    Returns either a serialized message is encoded with MessagePack
+    (JSON messages are arrays or objects).
+
+    :param data: bytes
+
+    :returns: boolean
+    """
+
+    return data[:1] not in (b"[", b"{")
+
+
+def encode(message, binary=False):
+    """
+    Serializes a JSON-RPC message.
+
+    :param message: message to serialize
+    :param binary: use MessagePack instead of JSON
+
+    :returns: bytes (MessagePack) or JSON string
+    """
+
+    if binary:
+        return packb(message)
+    return dumps(message)
+
+
+def decode(data):
+    """
+    Deserializes a JSON-RPC message encoded with JSON or MessagePack.
+
+    :param data: JSON string or bytes
+
+    :returns: message
+    """
+
+    if isinstance(data, bytes) and is_binary(data):
+        return unpackb(data)
+    return loads(data)
+
+
+def _convert_fields(fields, binary):
+    """
+    Converts the base64 fields of a dictionary.
+
+    :param fields: dictionary (not modified)
+    :param binary: convert base64 text to bytes (or bytes to base64 text)
+
+    :returns: dictionary
+    """
+
+    converted = None
+    for name, value in fields.items():
+        if not name.endswith(BASE64_SUFFIX):
+            continue
+        if binary and isinstance(value, str):
+            value = base64.b64decode(value.encode("utf-8"))
+        elif not binary and isinstance(value, bytes):
+            value = base64.b64encode(value).decode("utf-8")
+        else:
+            continue
+        if converted is None:
+            converted = dict(fields)
+        converted[name] = value
+    return fields if converted is None else converted
+
+
+def to_binary_fields(message):
+    """
+    Replaces the base64 fields (e.g. "startup_config_base64") of the params
+    or result of messages by raw bytes, for the binary encoding.
+
+    :param message: JSON-RPC message or list of messages (not modified)
+
+    :returns: message or list of messages
+    """
+
+    if isinstance(message, list):
+        return [to_binary_fields(item) for item in message]
+    for member in ("params", "result"):
+        if isinstance(message.get(member), dict):
+            fields = _convert_fields(message[member], True)
+            if fields is not message[member]:
+                message = dict(message)
+                message[member] = fields
+    return message
+
+
+def to_base64_fields(message):
+    """
+    Replaces the raw bytes fields of the params of messages received with
+    the binary encoding by base64 text, as expected by the modules.
+
+    :param message: JSON-RPC message or list of messages (modified)
+
+    :returns: message or list of messages
+    """
+
+    if isinstance(message, list):
+        return [to_base64_fields(item) for item in message]
+    if isinstance(message, dict) and isinstance(message.get("params"), dict):
+        message["params"] = _convert_fields(message["params"], False)
+    return message
 
 
 class JSONRPCObject(object):
     """
     Base object for JSON-RPC requests, responses,
     notifications and errors.
+
+    Calling an instance returns the message as a dictionary.
     """
 
-    def __init__(self):
-        return JSONRPCEncoder().default(self)
+    __slots__ = ()
 
     def __str__(self, *args, **kwargs):
-        return json.dumps(self, cls=JSONRPCEncoder)
+        return dumps(self())
 
     def __call__(self):
-        return JSONRPCEncoder().default(self)
+        raise NotImplementedError()
 
 
 class JSONRPCEncoder(json.JSONEncoder):
@@ -51,77 +234,106 @@ class JSONRPCEncoder(json.JSONEncoder):
         """
 
         if isinstance(obj, JSONRPCObject):
-            message = {"jsonrpc": 2.0}
-            for field in dir(obj):
-                if not field.startswith('_'):
-                    value = getattr(obj, field)
-                    message[field] = value
-            return message
+            return obj()
         return json.JSONEncoder.default(self, obj)
 
 
-class JSONRPCInvalidRequest(JSONRPCObject):
+class JSONRPCError(JSONRPCObject):
+    """
+    Base object for JSON-RPC error responses.
+
+    :param code: JSON-RPC error code
+    :param message: JSON-RPC error message
+    :param request_id: JSON-RPC identifier (optional)
+    """
+
+    __slots__ = ("id", "error")
+
+    def __init__(self, code, message, request_id=None):
+        self.id = request_id
+        self.error = {"code": code, "message": message}
+
+    def __call__(self):
+        return {"jsonrpc": JSONRPC_VERSION, "id": self.id, "error": self.error}
+
+
+class JSONRPCInvalidRequest(JSONRPCError):
     """
     Error response for an invalid request.
     """
 
+    __slots__ = ()
+
     def __init__(self):
-        JSONRPCObject.__init__(self)
-        self.id = None
-        self.error = {"code": -32600, "message": "Invalid Request"}
+        JSONRPCError.__init__(self, -32600, "Invalid Request")
 
 
-class JSONRPCMethodNotFound(JSONRPCObject):
+class JSONRPCMethodNotFound(JSONRPCError):
     """
     Error response for an method not found.
 
     :param request_id: JSON-RPC identifier
     """
 
+    __slots__ = ()
+
     def __init__(self, request_id):
-        JSONRPCObject.__init__(self)
-        self.id = request_id
-        self.error = {"code": -32601, "message": "Method not found"}
+        JSONRPCError.__init__(self, -32601, "Method not found", request_id)
 
 
-class JSONRPCInvalidParams(JSONRPCObject):
+class JSONRPCInvalidParams(JSONRPCError):
     """
     Error response for invalid parameters.
 
     :param request_id: JSON-RPC identifier
     """
 
+    __slots__ = ()
+
     def __init__(self, request_id):
-        JSONRPCObject.__init__(self)
-        self.id = request_id
-        self.error = {"code": -32602, "message": "Invalid params"}
+        JSONRPCError.__init__(self, -32602, "Invalid params", request_id)
 
 
-class JSONRPCInternalError(JSONRPCObject):
+class JSONRPCInternalError(JSONRPCError):
     """
     Error response for an internal error.
 
     :param request_id: JSON-RPC identifier (optional)
     """
 
+    __slots__ = ()
+
     def __init__(self, request_id=None):
-        JSONRPCObject.__init__(self)
-        self.id = request_id
-        self.error = {"code": -32603, "message": "Internal error"}
+        JSONRPCError.__init__(self, -32603, "Internal error", request_id)
 
 
-class JSONRPCParseError(JSONRPCObject):
+class JSONRPCParseError(JSONRPCError):
     """
     Error response for parsing error.
     """
 
+    __slots__ = ()
+
     def __init__(self):
-        JSONRPCObject.__init__(self)
-        self.id = None
-        self.error = {"code": -32700, "message": "Parse error"}
+        JSONRPCError.__init__(self, -32700, "Parse error")
+
 
+class JSONRPCServerBusy(JSONRPCError):
+    """
+    Error response for a request rejected because a module is overloaded.
 
-class JSONRPCCustomError(JSONRPCObject):
+    :param request_id: JSON-RPC identifier
+    :param retry_after: delay before the client should retry (seconds)
+    """
+
+    __slots__ = ()
+
+    def __init__(self, request_id, retry_after):
+        JSONRPCError.__init__(self, -32000, "Server busy, retry after {} seconds".format(retry_after), request_id)
+        self.error["data"] = {"retry_after": retry_after}
+
+
+class JSONRPCCustomError(JSONRPCError):
     """
     Error response for an custom error.
 
@@ -130,10 +342,7 @@ class JSONRPCCustomError(JSONRPCObject):
     :param request_id: JSON-RPC identifier (optional)
     """
 
-    def __init__(self, code, message, request_id=None):
-        JSONRPCObject.__init__(self)
-        self.id = request_id
-        self.error = {"code": code, "message": message}
+    __slots__ = ()
 
 
 class JSONRPCResponse(JSONRPCObject):
@@ -144,11 +353,15 @@ class JSONRPCResponse(JSONRPCObject):
     :param request_id: JSON-RPC identifier
     """
 
+    __slots__ = ("id", "result")
+
     def __init__(self, result, request_id):
-        JSONRPCObject.__init__(self)
         self.id = request_id
         self.result = result
 
+    def __call__(self):
+        return {"jsonrpc": JSONRPC_VERSION, "id": self.id, "result": self.result}
+
 
 class JSONRPCRequest(JSONRPCObject):
     """
@@ -159,14 +372,20 @@ class JSONRPCRequest(JSONRPCObject):
     :param request_id: JSON-RPC identifier (generated by default)
     """
 
+    __slots__ = ("id", "method", "params")
+
     def __init__(self, method, params=None, request_id=None):
-        JSONRPCObject.__init__(self)
         if request_id is None:
             request_id = str(uuid.uuid4())
         self.id = request_id
         self.method = method
-        if params:
-            self.params = params
+        self.params = params
+
+    def __call__(self):
+        message = {"jsonrpc": JSONRPC_VERSION, "id": self.id, "method": self.method}
+        if self.params:
+            message["params"] = self.params
+        return message
 
 
 class JSONRPCNotification(JSONRPCObject):
@@ -177,8 +396,14 @@ class JSONRPCNotification(JSONRPCObject):
     :param params: JSON-RPC params for the corresponding method (optional)
     """
 
+    __slots__ = ("method", "params")
+
     def __init__(self, method, params=None):
-        JSONRPCObject.__init__(self)
         self.method = method
-        if params:
-            self.params = params
+        self.params = params
+
+    def __call__(self):
+        message = {"jsonrpc": JSONRPC_VERSION, "method": self.method}
+        if self.params:
+            message["params"] = self.params
+        return message
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Flow control of the requests sent to the modules: a module only has
+a bounded number of requests in flight, the others wait in the server
+(control operations first) and are rejected once too many are waiting.
+
+The requests of a node (module and params.id) are always sent in order:
+a control operation only overtakes the requests of the other nodes.
+"""
+
+import math
+import time
+import collections
+
+import logging
+log = logging.getLogger(__name__)
+
+# methods (last part of the destination) overtaking the other requests
+CONTROL_METHODS = frozenset(["stop", "suspend", "reload", "reset", "delete", "stop_capture", "console_unwatch"])
+
+# how often the requests without response are checked (seconds)
+CHECK_INTERVAL = 10
+
+# weight of the latest response time in the average
+LATENCY_SMOOTHING = 0.2
+
+
+def is_control(method):
+    """
+    Returns either a method is a control operation (e.g. "vpcs.stop").
+
+    :param method: JSON-RPC method
+
+    :returns: boolean
+    """
+
+    return method.rsplit(".", 1)[-1] in CONTROL_METHODS
+
+
+def request_nodes(requests):
+    """
+    Returns the nodes (params.id) the requests apply to.
+
+    :param requests: list of JSON-RPC requests
+
+    :returns: frozenset of IDs, None if a request applies to the whole module
+    """
+
+    nodes = set()
+    for request in requests:
+        params = request.get("params")
+        if not isinstance(params, dict) or params.get("id") is None:
+            return None
+        nodes.add(str(params["id"]))
+    return frozenset(nodes)
+
+
+def _overlap(nodes, other_nodes):
+
+    return nodes is None or other_nodes is None or not nodes.isdisjoint(other_nodes)
+
+
+class ModuleQueue(object):
+    """
+    Requests sent to a module.
+
+    :param name: module name
+    :param max_in_flight: maximum number of requests sent and not answered yet
+    :param max_queued: maximum number of requests waiting in each lane
+    :param control_reserve: extra requests in flight for the control operations
+    :param timeout: time after which a request without response is not counted anymore (seconds)
+    """
+
+    def __init__(self, name, max_in_flight=32, max_queued=256, control_reserve=4, timeout=600):
+
+        self._name = name
+        self._max_in_flight = max_in_flight
+        self._max_queued = max_queued
+        self._control_reserve = control_reserve
+        self._timeout = timeout
+        self._in_flight = {}  # (session ID, call ID) -> (sent time, weight)
+        self._load = 0  # sum of the weights in flight
+        self._control_lane = collections.deque()
+        self._bulk_lane = collections.deque()
+        self._latency = None
+
+    @property
+    def in_flight(self):
+        """
+        Returns the number of requests in flight (a batch counts for its requests).
+
+        :returns: integer
+        """
+
+        return self._load
+
+    @property
+    def queued(self):
+        """
+        Returns the number of requests waiting to be sent.
+
+        :returns: integer
+        """
+
+        return len(self._control_lane) + len(self._bulk_lane)
+
+    def status(self):
+        """
+        Returns the queue state.
+
+        :returns: dictionary
+        """
+
+        return {"in_flight": self._load,
+                "max_in_flight": self._max_in_flight,
+                "queued_control": len(self._control_lane),
+                "queued_bulk": len(self._bulk_lane),
+                "latency": round(self._latency, 3) if self._latency is not None else None}
+
+    def retry_after(self):
+        """
+        Estimates when a rejected request could be accepted.
+
+        :returns: delay in seconds
+        """
+
+        latency = self._latency if self._latency is not None else 1.0
+        return max(1, int(math.ceil(latency * (self.queued + self._load) / self._max_in_flight)))
+
+    def _has_capacity(self, control):
+
+        limit = self._max_in_flight
+        if control:
+            limit += self._control_reserve
+        return self._load < limit
+
+    def submit(self, key, send, control=False, weight=1, nodes=None):
+        """
+        Sends a request now if the module has capacity, queues it otherwise.
+
+        :param key: (session ID, call ID) of the expected response, None for notifications
+        :param send: callable sending the request
+        :param control: control operation (overtakes the requests of the other nodes)
+        :param weight: number of requests (for a batch)
+        :param nodes: IDs of the nodes the request applies to (None: the whole module)
+
+        :returns: False if the request is rejected (too many requests waiting)
+        """
+
+        # the requests without response for too long free their slot
+        self.check()
+        request = (key, send, weight, nodes)
+        if key is None:
+            # notifications have no response to wait for and are not counted,
+            # they only wait for the requests of the same nodes
+            if not self._queue_after(self._bulk_lane, request) and not self._queue_after(self._control_lane, request):
+                send()
+            return True
+
+        lane = self._control_lane if control else self._bulk_lane
+        if control and any(_overlap(nodes, waiting[3]) for waiting in self._bulk_lane):
+            # requests of the same node are waiting: the control operation
+            # goes right after them, ahead of the other nodes
+            lane = self._bulk_lane
+        elif not lane and self._has_capacity(control):
+            self._send(*request)
+            return True
+
+        if len(lane) >= self._max_queued:
+            log.warning("{} module is busy: {} requests in flight, {} waiting".format(self._name, self._load, self.queued))
+            return False
+        if lane is self._bulk_lane and control:
+            self._queue_after(lane, request)
+        else:
+            lane.append(request)
+        log.debug("{} module: request queued ({} waiting)".format(self._name, self.queued))
+        return True
+
+    @staticmethod
+    def _queue_after(lane, request):
+        """
+        Queues a request right after the last waiting request of the same nodes.
+
+        :param lane: control or bulk lane
+        :param request: (key, send, weight, nodes)
+
+        :returns: False if no request of the same nodes is waiting in this lane
+        """
+
+        nodes = request[3]
+        for index in range(len(lane) - 1, -1, -1):
+            if _overlap(nodes, lane[index][3]):
+                lane.rotate(-(index + 1))
+                lane.appendleft(request)
+                lane.rotate(index + 1)
+                return True
+        return False
+
+    def _send(self, key, send, weight, nodes):
+
+        if key is not None:
+            self._in_flight[key] = (time.monotonic(), weight)
+            self._load += weight
+        send()
+
+    def done(self, key):
+        """
+        Records the response to a request and sends the waiting requests.
+
+        :param key: (session ID, call ID) of the response
+
+        :returns: False if the request was not in flight
+        """
+
+        entry = self._in_flight.pop(key, None)
+        if entry is None:
+            return False
+        sent, weight = entry
+        self._load -= weight
+        latency = time.monotonic() - sent
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += LATENCY_SMOOTHING * (latency - self._latency)
+        self._drain()
+        return True
+
+    def check(self):
+        """
+        Stops counting the requests without response for too long
+        and sends the waiting requests the module has capacity for.
+        """
+
+        self._expire()
+        self._drain()
+
+    def _drain(self):
+        """
+        Sends the waiting requests, control operations first
+        (notifications do not need capacity).
+        """
+
+        control_lane = self._control_lane
+        while control_lane and (control_lane[0][0] is None or self._has_capacity(True)):
+            self._send(*control_lane.popleft())
+        bulk_lane = self._bulk_lane
+        while not control_lane and bulk_lane and (bulk_lane[0][0] is None or self._has_capacity(False)):
+            self._send(*bulk_lane.popleft())
+
+    def _expire(self):
+        """
+        Stops counting the requests without response for too long.
+        """
+
+        now = time.monotonic()
+        for key, (sent, weight) in list(self._in_flight.items()):
+            if now - sent > self._timeout:
+                log.warning("{} module: no response to request {} after {} seconds".format(self._name, key[1], self._timeout))
+                del self._in_flight[key]
+                self._load -= weight
+
+    def cancel(self, session_id):
+        """
+        Drops the waiting requests of a client (notifications are still sent).
+
+        :param session_id: client session ID
+        """
+
+        for lane in (self._control_lane, self._bulk_lane):
+            kept = [request for request in lane if request[0] is None or request[0][0] != session_id]
+            lane.clear()
+            lane.extend(kept)
@@ -26,6 +26,9 @@ import socket
 import stat
 import errno
 import time
+import concurrent.futures
+
+from .sharding import owns_port
 
 import logging
 log = logging.getLogger(__name__)
@@ -40,6 +43,8 @@ def find_unused_port(start_port, end_port, host='127.0.0.1', socket_type="TCP",
     :param host: host/address for bind()
     :param socket_type: TCP (default) or UDP
     :param ignore_ports: list of port to ignore within the range
+
+    The ports allocated by the other shards of the module are skipped.
     """
 
     if end_port < start_port:
@@ -52,7 +57,7 @@ def find_unused_port(start_port, end_port, host='127.0.0.1', socket_type="TCP",
 
     last_exception = None
     for port in range(start_port, end_port + 1):
-        if port in ignore_ports:
+        if port in ignore_ports or not owns_port(port):
             continue
         try:
             if ":" in host:
@@ -144,3 +149,37 @@ def has_privileged_access(executable):
             log.error("could not determine if CAP_NET_RAW capability is set for {}: {}".format(executable, e))
 
     return False
+
+
+def call_in_parallel(function, items, timeout=30, max_workers=16):
+    """
+    Calls a function for each item in parallel threads, used to stop
+    many instances at once instead of one after the other.
+
+    :param function: function to call with each item
+    :param items: iterable of items
+    :param timeout: deadline to wait for all the calls (seconds, None to wait forever)
+    :param max_workers: maximum number of threads
+
+    :returns: list of (item, exception) for the calls that failed or did not finish in time
+    """
+
+    items = list(items)
+    if not items:
+        return []
+
+    failures = []
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(items)))
+    try:
+        futures = {executor.submit(function, item): item for item in items}
+        done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        for future in done:
+            if future.exception() is not None:
+                failures.append((futures[future], future.exception()))
+        for future in not_done:
+            future.cancel()
+            failures.append((futures[future], TimeoutError("not finished after {} seconds".format(timeout))))
+    finally:
+        # do not wait for the calls that are still running after the deadline
+        executor.shutdown(wait=False)
+    return failures
@@ -28,6 +28,7 @@ import zmq
 import signal
 
 from gns3server.config import Config
+from gns3server.modules.sharding import set_local_shard
 from jsonschema import validate, ValidationError
 
 import logging
@@ -40,7 +41,7 @@ class IModule(multiprocessing.Process):
 
     :param name: module name
     :param args: arguments for the module
-    :param kwargs: named arguments for the module
+    :param kwargs: named arguments for the module (shard and shards for a sharded module)
     """
 
     modules = {}
@@ -57,17 +58,38 @@ class IModule(multiprocessing.Process):
         self._dealer = None
         self._zmq_host = args[0]  # ZeroMQ server address
         self._zmq_port = args[1]  # ZeroMQ server port
+        self._zmq_hwm = int(server_config.get("zmq_hwm", 1000))
+        self._shard = kwargs.get("shard", 0)
+        self._shards = kwargs.get("shards", 1)
         self._current_session = None
         self._current_destination = None
         self._current_call_id = None
+        self._batch = None  # batch whose responses are being collected
+        self._binary_sessions = set()
         self._stopping = False
         self._cloud_settings = config.cloud_settings()
 
+    @property
+    def identity(self):
+        """
+        Returns the ZeroMQ identity of this process: the module name
+        followed by the shard index if the module is sharded.
+
+        :returns: identity string
+        """
+
+        if self._shards > 1:
+            return "{}-{}".format(self.name, self._shard)
+        return self.name
+
     def _setup(self):
         """
         Sets up PyZMQ and creates the stream to handle requests
         """
 
+        # node identifiers and ports allocated by this shard
+        set_local_shard(self._shard, self._shards)
+
         self._context = zmq.Context()
         self._ioloop = zmq.eventloop.ioloop.IOLoop.instance()
         self._stream = self._create_stream(self._zmq_host, self._zmq_port, self._decode_request)
@@ -80,7 +102,9 @@ class IModule(multiprocessing.Process):
         """
 
         self._dealer = self._context.socket(zmq.DEALER)
-        self._dealer.setsockopt(zmq.IDENTITY, self.name.encode("utf-8"))
+        self._dealer.setsockopt(zmq.IDENTITY, self.identity.encode("utf-8"))
+        self._dealer.setsockopt(zmq.SNDHWM, self._zmq_hwm)
+        self._dealer.setsockopt(zmq.RCVHWM, self._zmq_hwm)
         if host and port:
             log.info("ZeroMQ client ({}) connecting to {}:{}".format(self.name, host, port))
             try:
@@ -129,7 +153,7 @@ class IModule(multiprocessing.Process):
         for sig in signals:
             signal.signal(sig, signal_handler)
 
-        log.info("{} module running with PID {}".format(self.name, self.pid))
+        log.info("{} module running with PID {}".format(self.identity, self.pid))
         self._setup()
         try:
             self._ioloop.start()
@@ -167,6 +191,32 @@ class IModule(multiprocessing.Process):
             else:
                 self._ioloop.add_callback(self._shutdown)
 
+    def _send(self, session, jsonrpc_message, call_id=None):
+        """
+        Sends a JSON-RPC message to the ZeroMQ server.
+
+        The message is sent with the session and call ID in separate frames
+        ([session ID, call ID, JSON-RPC message]) so that the server can
+        forward it to the client without decoding it, it is encoded like
+        the requests of the session (JSON or MessagePack).
+
+        :param session: client session
+        :param jsonrpc_message: JSON-RPC message (dictionary or list of responses for a batch)
+        :param call_id: JSON-RPC call identifier (None for notifications)
+        """
+
+        if self._batch is not None and call_id is not None:
+            # response to a request of the batch being processed
+            self._batch["responses"].append(jsonrpc_message)
+            return
+        if session in self._binary_sessions:
+            data = jsonrpc.packb(jsonrpc.to_binary_fields(jsonrpc_message))
+        else:
+            data = jsonrpc.dumps(jsonrpc_message).encode("utf-8")
+        self._stream.send_multipart([(session or "").encode("utf-8"),
+                                     ("" if call_id is None else str(call_id)).encode("utf-8"),
+                                     data])
+
     def send_response(self, results):
         """
         Sends a response back to the requester.
@@ -175,11 +225,8 @@ class IModule(multiprocessing.Process):
         """
 
         jsonrpc_response = jsonrpc.JSONRPCResponse(results, self._current_call_id)()
-
-        # add session to the response
-        response = [self._current_session, jsonrpc_response]
-        log.debug("ZeroMQ client ({}) sending: {}".format(self.name, response))
-        self._stream.send_json(response)
+        log.debug("ZeroMQ client ({}) sending: {}".format(self.name, jsonrpc_response))
+        self._send(self._current_session, jsonrpc_response, self._current_call_id)
 
     def send_param_error(self):
         """
@@ -187,23 +234,18 @@ class IModule(multiprocessing.Process):
         """
 
         jsonrpc_response = jsonrpc.JSONRPCInvalidParams(self._current_call_id)()
-
-        # add session to the response
-        response = [self._current_session, jsonrpc_response]
         log.info("ZeroMQ client ({}) sending JSON-RPC param error for call id {}".format(self.name, self._current_call_id))
-        self._stream.send_json(response)
+        self._send(self._current_session, jsonrpc_response, self._current_call_id)
 
     def send_internal_error(self):
         """
-        Sends a param error back to the requester.
+        Sends an internal error back to the requester.
         """
 
-        jsonrpc_response = jsonrpc.JSONRPCInternalError()()
-
-        # add session to the response
-        response = [self._current_session, jsonrpc_response]
-        log.critical("ZeroMQ client ({}) sending JSON-RPC internal error".format(self.name))
-        self._stream.send_json(response)
+        # with the call ID so that the server frees the slot of the request
+        jsonrpc_response = jsonrpc.JSONRPCInternalError(self._current_call_id)()
+        log.critical("ZeroMQ client ({}) sending JSON-RPC internal error for call id {}".format(self.name, self._current_call_id))
+        self._send(self._current_session, jsonrpc_response, self._current_call_id)
 
     def send_custom_error(self, message, code=-3200):
         """
@@ -211,28 +253,25 @@ class IModule(multiprocessing.Process):
         """
 
         jsonrpc_response = jsonrpc.JSONRPCCustomError(code, message, self._current_call_id)()
-
-        # add session to the response
-        response = [self._current_session, jsonrpc_response]
         log.info("ZeroMQ client ({}) sending JSON-RPC custom error: {} for call id {}".format(self.name,
                                                                                               message,
                                                                                               self._current_call_id))
-        self._stream.send_json(response)
+        self._send(self._current_session, jsonrpc_response, self._current_call_id)
 
-    def send_notification(self, destination, results):
+    def send_notification(self, destination, results, session=None):
         """
         Sends a notification
 
         :param destination: destination (or method)
         :param results: JSON results to the ZeroMQ router
+        :param session: client session (default is the session of the current request)
         """
 
         jsonrpc_response = jsonrpc.JSONRPCNotification(destination, results)()
-
-        # add session to the response
-        response = [self._current_session, jsonrpc_response]
-        log.debug("ZeroMQ client ({}) sending: {}".format(self.name, response))
-        self._stream.send_json(response)
+        log.debug("ZeroMQ client ({}) sending: {}".format(self.name, jsonrpc_response))
+        if session is None:
+            session = self._current_session
+        self._send(session, jsonrpc_response)
 
     def _decode_request(self, request):
         """
@@ -253,24 +292,45 @@ class IModule(multiprocessing.Process):
             self.stop()
             return
 
+        binary = jsonrpc.is_binary(request[0])
         try:
-            request = zmq.utils.jsonapi.loads(request[0])
+            request = jsonrpc.decode(request[0])
         except ValueError:
             self._current_session = None
+            self._current_call_id = None
             self.send_internal_error()
             return
 
         log.debug("ZeroMQ client ({}) received: {}".format(self.name, request))
         self._current_session = request[0]
-        self._current_call_id = request[1].get("id")
-        destination = request[1].get("method")
-        params = request[1].get("params")
+        # the responses and notifications are encoded like the requests of the session
+        if binary:
+            self._binary_sessions.add(request[0])
+            request[1] = jsonrpc.to_base64_fields(request[1])
+        else:
+            self._binary_sessions.discard(request[0])
+        if isinstance(request[1], list):
+            # batch format is a JSON array: [session ID, [JSON-RPC requests], batch ID]
+            self._process_batch(request[1], request[2])
+        else:
+            self._process_request(request[1])
+
+    def _process_request(self, request):
+        """
+        Routes a request to its handler.
+
+        :param request: JSON-RPC request (dictionary)
+        """
+
+        self._current_call_id = request.get("id")
+        destination = request.get("method")
+        params = request.get("params")
 
         if destination not in self.modules[self.name]:
             self.send_internal_error()
             return
 
-        log.debug("Routing request to {}: {}".format(destination, request[1]))
+        log.debug("Routing request to {}: {}".format(destination, request))
 
         try:
             self.modules[self.name][destination](self, params)
@@ -283,6 +343,83 @@ class IModule(multiprocessing.Process):
                                                                                       string=str(e),
                                                                                       tb=tb))
 
+    def _process_batch(self, requests, batch_id):
+        """
+        Processes the requests of a JSON-RPC batch in order and sends
+        all their responses in one message (with the batch ID as call ID).
+
+        When a request answers later (add_future, e.g. once an image has
+        been downloaded), the batch response is held until it has answered.
+
+        :param requests: list of JSON-RPC requests
+        :param batch_id: batch identifier
+        """
+
+        batch = {"id": batch_id,
+                 "session": self._current_session,
+                 "responses": [],
+                 "deferred": 0,
+                 "processed": False}
+        self._batch = batch
+        try:
+            for request in requests:
+                self._process_request(request)
+        finally:
+            self._batch = None
+            batch["processed"] = True
+        self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        """
+        Sends the responses of a batch once all its requests have answered.
+
+        :param batch: batch state
+        """
+
+        if not batch["processed"] or batch["deferred"]:
+            return
+        log.debug("ZeroMQ client ({}) sending {} responses for batch {}".format(self.name, len(batch["responses"]), batch["id"]))
+        self._send(batch["session"], batch["responses"], batch["id"])
+
+    def add_future(self, future, callback):
+        """
+        Calls a callback in the module loop once a future is done
+        (e.g. a download in a worker thread), the responses sent by
+        the callback go to the requester of the current request
+        (in the response of its batch if the request is part of one).
+
+        :param future: concurrent.futures.Future instance
+        :param callback: callable receiving the future
+        """
+
+        session = self._current_session
+        call_id = self._current_call_id
+        batch = self._batch if call_id is not None else None
+        if batch is not None:
+            batch["deferred"] += 1
+
+        def resume(future):
+            self._current_session = session
+            self._current_call_id = call_id
+            self._batch = batch
+            try:
+                callback(future)
+            except Exception as e:
+                log.error("uncaught exception {type}".format(type=type(e)), exc_info=1)
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                lines = traceback.format_exception(exc_type, exc_value, exc_tb)
+                tb = "".join(lines)
+                self.send_custom_error("uncaught exception {type}: {string}\n{tb}".format(type=type(e),
+                                                                                          string=str(e),
+                                                                                          tb=tb))
+            finally:
+                self._batch = None
+                if batch is not None:
+                    batch["deferred"] -= 1
+                    self._send_batch(batch)
+
+        future.add_done_callback(lambda future: self._ioloop.add_callback(resume, future))
+
     def validate_request(self, request, schema):
         """
         Validates a request.
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Resource control of the node processes with cgroups v2 (Linux only):
+each node process runs in its own cgroup with CPU, memory and cpuset limits.
+"""
+
+import os
+import errno
+import threading
+
+from gns3server.config import Config
+
+import logging
+log = logging.getLogger(__name__)
+
+# controllers used for the node cgroups
+CONTROLLERS = ("cpu", "memory", "cpuset")
+
+# cpu.max period (microseconds)
+CPU_PERIOD = 100000
+
+# JSON schema of the resource settings (used by the update routes)
+RESOURCES_SCHEMA = {
+    "description": "resource limits of the node process (cgroups v2)",
+    "type": "object",
+    "properties": {
+        "cpu_limit": {
+            "description": "maximum CPU usage in percent of one CPU (0 means no limit)",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 102400,
+        },
+        "cpu_weight": {
+            "description": "CPU share relative to the other processes (100 by default)",
+            "type": "integer",
+            "minimum": 1,
+            "maximum": 10000,
+        },
+        "memory_limit": {
+            "description": "maximum amount of memory in MB (0 means no limit)",
+            "type": "integer",
+            "minimum": 0,
+        },
+        "cpuset": {
+            "description": "CPUs the process can run on (e.g. 0-3,6), empty means all",
+            "type": "string",
+            "pattern": "^[0-9,\\-]*$",
+        },
+    },
+    "additionalProperties": False,
+}
+
+
+class CgroupError(Exception):
+
+    def __init__(self, message, original_exception=None):
+
+        Exception.__init__(self, message)
+        if isinstance(message, Exception):
+            message = str(message)
+        self._message = message
+        self._original_exception = original_exception
+
+    def __repr__(self):
+
+        return self._message
+
+    def __str__(self):
+
+        return self._message
+
+
+def _write(path, value):
+
+    try:
+        with open(path, "w") as f:
+            f.write(value)
+    except OSError as e:
+        raise CgroupError("Could not write {} to {}: {}".format(value, path, e), e)
+
+
+def _read(path):
+
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class Cgroup(object):
+    """
+    A cgroup containing the process of a node.
+
+    :param path: path to the cgroup directory
+    """
+
+    def __init__(self, path):
+
+        self._path = path
+
+    @property
+    def path(self):
+        """
+        Returns the path to the cgroup directory.
+
+        :returns: path
+        """
+
+        return self._path
+
+    def add_process(self, pid):
+        """
+        Moves a process (with all its threads) into this cgroup.
+
+        :param pid: process ID
+        """
+
+        _write(os.path.join(self._path, "cgroup.procs"), str(pid))
+
+    def apply(self, settings):
+        """
+        Applies resource settings.
+
+        :param settings: dictionary (see RESOURCES_SCHEMA)
+        """
+
+        if "cpu_limit" in settings:
+            cpu_limit = settings["cpu_limit"]
+            quota = str(cpu_limit * CPU_PERIOD // 100) if cpu_limit else "max"
+            _write(os.path.join(self._path, "cpu.max"), "{} {}".format(quota, CPU_PERIOD))
+        if "cpu_weight" in settings:
+            _write(os.path.join(self._path, "cpu.weight"), str(settings["cpu_weight"]))
+        if "memory_limit" in settings:
+            memory_limit = settings["memory_limit"]
+            _write(os.path.join(self._path, "memory.max"), str(memory_limit * 1024 * 1024) if memory_limit else "max")
+        if "cpuset" in settings:
+            _write(os.path.join(self._path, "cpuset.cpus"), settings["cpuset"])
+
+    def usage(self):
+        """
+        Returns the resource usage of the processes in this cgroup.
+
+        :returns: dictionary
+        """
+
+        usage = {}
+        cpu_stat = _read(os.path.join(self._path, "cpu.stat"))
+        if cpu_stat:
+            for line in cpu_stat.splitlines():
+                fields = line.split()
+                if len(fields) == 2 and fields[0] in ("usage_usec", "user_usec", "system_usec", "nr_throttled", "throttled_usec"):
+                    usage[fields[0]] = int(fields[1])
+        for name in ("memory.current", "memory.peak", "memory.swap.current"):
+            value = _read(os.path.join(self._path, name))
+            if value and value.strip().isdigit():
+                usage[name.replace(".", "_")] = int(value)
+        return usage
+
+    def delete(self):
+        """
+        Deletes this cgroup (once its processes have exited).
+        """
+
+        try:
+            os.rmdir(self._path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            if e.errno == errno.ENOTEMPTY and not os.path.exists(os.path.join(self._path, "cgroup.controllers")):
+                # not a cgroupfs (e.g. tests), remove the files we created
+                for name in os.listdir(self._path):
+                    os.remove(os.path.join(self._path, name))
+                os.rmdir(self._path)
+            else:
+                log.warning("could not delete cgroup {}: {}".format(self._path, e))
+
+
+class CgroupManager(object):
+    """
+    Creates the node cgroups below a parent cgroup.
+
+    :param root: cgroup v2 mount point
+    :param parent: parent cgroup of the node cgroups (relative to root)
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, root="/sys/fs/cgroup", parent="gns3"):
+
+        self._root = root
+        self._parent = os.path.join(root, parent)
+        self._controllers = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the cgroup manager of this process (created on first use).
+
+        :returns: CgroupManager instance
+        """
+
+        with cls._instance_lock:
+            if cls._instance is None:
+                config = Config.instance().get_section_config("CGROUPS")
+                cls._instance = cls(config.get("root", "/sys/fs/cgroup"), config.get("parent", "gns3"))
+            return cls._instance
+
+    @property
+    def available(self):
+        """
+        Returns either cgroups v2 can be used.
+
+        :returns: boolean
+        """
+
+        if not os.path.isfile(os.path.join(self._root, "cgroup.controllers")):
+            return False
+        if os.path.isdir(self._parent):
+            return os.access(self._parent, os.W_OK)
+        return os.access(os.path.dirname(self._parent), os.W_OK)
+
+    def _setup(self):
+        """
+        Creates the parent cgroup and enables the controllers for its children.
+        """
+
+        if self._controllers is not None:
+            return
+        available = (_read(os.path.join(self._root, "cgroup.controllers")) or "").split()
+        try:
+            os.makedirs(self._parent, exist_ok=True)
+        except OSError as e:
+            raise CgroupError("Could not create cgroup {}: {}".format(self._parent, e), e)
+
+        # every cgroup from the root to the parent must delegate the controllers
+        cgroups = [self._parent]
+        path = self._parent
+        while os.path.dirname(path) != path and os.path.normpath(path) != os.path.normpath(self._root):
+            path = os.path.dirname(path)
+            cgroups.insert(0, path)
+
+        self._controllers = []
+        for controller in CONTROLLERS:
+            if controller not in available:
+                continue
+            try:
+                for path in cgroups:
+                    enabled = (_read(os.path.join(path, "cgroup.subtree_control")) or "").split()
+                    if controller not in enabled:
+                        _write(os.path.join(path, "cgroup.subtree_control"), "+{}".format(controller))
+                self._controllers.append(controller)
+            except CgroupError as e:
+                log.warning("cgroup controller {} cannot be used: {}".format(controller, e))
+
+    def create(self, name):
+        """
+        Creates (or reuses) a node cgroup.
+
+        :param name: cgroup name (unique on this host)
+
+        :returns: Cgroup instance
+        """
+
+        with self._lock:
+            self._setup()
+        path = os.path.join(self._parent, name)
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as e:
+            raise CgroupError("Could not create cgroup {}: {}".format(path, e), e)
+        return Cgroup(path)
+
+
+class NodeResources(object):
+    """
+    Resource settings of a node, applied to the cgroup of its process
+    while it is running.
+
+    :param name: cgroup name (unique on this host)
+    :param manager: CgroupManager instance (the one of this process by default)
+    """
+
+    def __init__(self, name, manager=None):
+
+        self._name = name
+        self._manager = manager
+        self._settings = {}
+        self._defaults = {}
+        self._cgroups = []
+
+    def _get_manager(self):
+
+        if self._manager is None:
+            self._manager = CgroupManager.instance()
+        return self._manager
+
+    @property
+    def settings(self):
+        """
+        Returns the resource settings.
+
+        :returns: dictionary (see RESOURCES_SCHEMA)
+        """
+
+        return dict(self._settings)
+
+    @property
+    def controlled(self):
+        """
+        Returns either the settings are enforced with cgroups.
+
+        :returns: boolean
+        """
+
+        return self._get_manager().available
+
+    @property
+    def attached(self):
+        """
+        Returns either the node processes are in their cgroups.
+
+        :returns: boolean
+        """
+
+        return len(self._cgroups) > 0
+
+    def set_defaults(self, defaults):
+        """
+        Sets the values used for the settings that are not set explicitly
+        (e.g. derived from other node settings).
+
+        :param defaults: dictionary (see RESOURCES_SCHEMA)
+        """
+
+        self._defaults = dict(defaults)
+        settings = {name: value for name, value in self._defaults.items() if name not in self._settings}
+        for cgroup in self._cgroups:
+            cgroup.apply(settings)
+
+    def update(self, settings):
+        """
+        Updates the resource settings (applied immediately if the process is running).
+
+        :param settings: dictionary (see RESOURCES_SCHEMA)
+        """
+
+        self._settings.update(settings)
+        for cgroup in self._cgroups:
+            cgroup.apply(settings)
+
+    def attach(self, pid, suffix=None):
+        """
+        Moves a node process into its cgroup.
+
+        :param pid: process ID
+        :param suffix: optional cgroup name suffix (for nodes with several processes)
+
+        :returns: True if the process is in its cgroup
+        """
+
+        manager = self._get_manager()
+        if not manager.available:
+            if self._settings:
+                log.warning("cgroups v2 is not available, the resource settings of {} are ignored".format(self._name))
+            return False
+
+        name = self._name if suffix is None else "{}-{}".format(self._name, suffix)
+        try:
+            cgroup = manager.create(name)
+            settings = dict(self._defaults)
+            settings.update(self._settings)
+            cgroup.apply(settings)
+            cgroup.add_process(pid)
+        except CgroupError as e:
+            log.error("could not control the resources of {}: {}".format(name, e))
+            return False
+        self._cgroups.append(cgroup)
+        log.info("process {} in cgroup {}".format(pid, cgroup.path))
+        return True
+
+    def usage(self):
+        """
+        Returns the resource usage of the node processes.
+
+        :returns: dictionary (summed for nodes with several processes)
+        """
+
+        usage = {}
+        for cgroup in self._cgroups:
+            for name, value in cgroup.usage().items():
+                usage[name] = usage.get(name, 0) + value
+        return usage
+
+    def release(self):
+        """
+        Deletes the cgroups (once the node processes have exited).
+        """
+
+        for cgroup in self._cgroups:
+            cgroup.delete()
+        self._cgroups = []
@@ -0,0 +1,1093 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Console multiplexer: one thread and one poll object serving
+every Telnet console port of a module process.
+"""
+
+import os
+import time
+import heapq
+import errno
+import socket
+import select
+import threading
+import collections
+
+import logging
+log = logging.getLogger(__name__)
+
+# Telnet commands & options
+# Mostly from https://code.google.com/p/miniboa/source/browse/trunk/miniboa/telnet.py
+NOP = 241     # No operation
+AYT = 246     # Are you there
+WILL = 251    # Will; request or confirm option begin
+WONT = 252    # Wont; deny option request
+DO = 253      # Do = Request or confirm remote option
+DONT = 254    # Don't = Demand or confirm option halt
+IAC = 255     # Interpret as Command
+BINARY = 0    # Transmit Binary
+ECHO = 1      # Echo characters back to sender
+SGA = 3       # Suppress Go-Ahead
+
+# Size of the buffer used to read from a console device
+BUFFER_SIZE = 4096
+
+# Maximum amount of data waiting to be sent to a slow Telnet client
+MAX_CLIENT_BUFFER = 1024 * 1024
+
+# Default size of the console scrollback buffer of a node
+DEFAULT_SCROLLBACK_SIZE = 64 * 1024
+
+if hasattr(select, "epoll"):
+    POLLIN = select.EPOLLIN
+    POLLOUT = select.EPOLLOUT
+    POLLERR = select.EPOLLERR | select.EPOLLHUP
+elif hasattr(select, "poll"):
+    POLLIN = select.POLLIN
+    POLLOUT = select.POLLOUT
+    POLLERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+else:
+    POLLIN = POLLOUT = POLLERR = 0
+
+
+class ConsoleBuffer(object):
+    """
+    Fixed-size ring buffer keeping the most recent console output of a node.
+
+    The memory is allocated once, writes never allocate.
+
+    :param size: buffer size in bytes
+    """
+
+    def __init__(self, size=DEFAULT_SCROLLBACK_SIZE):
+
+        self._size = size
+        self._buffer = bytearray(size)
+        self._position = 0
+        self._full = False
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """
+        Returns the buffer size.
+
+        :returns: size in bytes
+        """
+
+        return self._size
+
+    def __len__(self):
+
+        return self._size if self._full else self._position
+
+    def write(self, data):
+        """
+        Appends console output, the oldest output is overwritten.
+
+        :param data: bytes, bytearray or memoryview
+        """
+
+        length = len(data)
+        if not length or not self._size:
+            return
+        with self._lock:
+            if length >= self._size:
+                self._buffer[:] = data[length - self._size:]
+                self._position = 0
+                self._full = True
+                return
+            first = min(length, self._size - self._position)
+            self._buffer[self._position:self._position + first] = data[:first]
+            if first < length:
+                self._buffer[:length - first] = data[first:]
+            self._position += length
+            if self._position >= self._size:
+                self._position -= self._size
+                self._full = True
+
+    def read(self, size=None):
+        """
+        Returns the most recent console output.
+
+        :param size: maximum number of bytes to return (everything by default)
+
+        :returns: bytes
+        """
+
+        with self._lock:
+            available = self._size if self._full else self._position
+            if size is None or size > available:
+                size = available
+            if size <= 0:
+                return b""
+            start = self._position - size
+            if start >= 0:
+                return bytes(self._buffer[start:self._position])
+            return bytes(self._buffer[start:]) + bytes(self._buffer[:self._position])
+
+    def clear(self):
+        """
+        Forgets the console output.
+        """
+
+        with self._lock:
+            self._position = 0
+            self._full = False
+
+
+class ConsoleHub(threading.Thread):
+    """
+    Event loop serving all the console connections of this process.
+
+    Handlers and timers are only manipulated from the hub thread,
+    other threads must go through call_soon().
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+
+        threading.Thread.__init__(self, name="ConsoleHub", daemon=True)
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._poll_timeout_unit = 1.0  # epoll timeout is in seconds
+        else:
+            self._poller = select.poll()
+            self._poll_timeout_unit = 1000.0  # poll timeout is in milliseconds
+        self._handlers = {}
+        self._timers = []
+        self._timer_sequence = 0
+        self._callbacks = collections.deque()
+        self._waker_read, self._waker_write = socket.socketpair()
+        self._waker_read.setblocking(False)
+        self._waker_write.setblocking(False)
+        self._handlers[self._waker_read.fileno()] = self._wake_up
+        self._poller.register(self._waker_read.fileno(), POLLIN)
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the console hub of this process (started on first use).
+
+        :returns: ConsoleHub instance
+        """
+
+        with cls._instance_lock:
+            if cls._instance is None or not cls._instance.is_alive():
+                cls._instance = ConsoleHub()
+                cls._instance.start()
+            return cls._instance
+
+    def in_hub_thread(self):
+        """
+        Returns either the caller runs in the hub thread.
+
+        :returns: boolean
+        """
+
+        return threading.current_thread() is self
+
+    def call_soon(self, callback, *args):
+        """
+        Schedules a callback to be run in the hub thread (thread-safe).
+
+        :param callback: callable
+        """
+
+        self._callbacks.append((callback, args))
+        try:
+            self._waker_write.send(b"\x00")
+        except OSError:
+            pass  # the waker is already full, the hub will wake up anyway
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedules a callback to be run after a delay (hub thread only).
+
+        :param delay: delay in seconds
+        :param callback: callable
+
+        :returns: timer handle (to be passed to cancel_timer)
+        """
+
+        self._timer_sequence += 1
+        timer = [time.time() + delay, self._timer_sequence, callback, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    @staticmethod
+    def cancel_timer(timer):
+        """
+        Cancels a timer returned by call_later.
+
+        :param timer: timer handle
+        """
+
+        if timer:
+            timer[2] = None
+
+    def register(self, fileno, events, handler):
+        """
+        Registers a file descriptor (hub thread only).
+
+        :param fileno: file descriptor
+        :param events: POLLIN and/or POLLOUT
+        :param handler: callable receiving the events
+        """
+
+        self._handlers[fileno] = handler
+        self._poller.register(fileno, events)
+
+    def modify(self, fileno, events):
+        """
+        Changes the events monitored for a file descriptor (hub thread only).
+
+        :param fileno: file descriptor
+        :param events: POLLIN and/or POLLOUT
+        """
+
+        self._poller.modify(fileno, events)
+
+    def unregister(self, fileno):
+        """
+        Unregisters a file descriptor (hub thread only).
+
+        :param fileno: file descriptor
+        """
+
+        if self._handlers.pop(fileno, None):
+            try:
+                self._poller.unregister(fileno)
+            except (OSError, KeyError, ValueError):
+                pass
+
+    def _wake_up(self, events):
+
+        try:
+            while self._waker_read.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def _run_timers(self):
+        """
+        Runs the expired timers and returns the poll timeout.
+
+        :returns: timeout in seconds (or None)
+        """
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self._timers)
+            if callback:
+                try:
+                    callback(*args)
+                except Exception as e:
+                    log.error("console hub timer error: {}".format(e), exc_info=1)
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if self._timers:
+            return max(0, self._timers[0][0] - time.time())
+        return None
+
+    def run(self):
+        """
+        Thread loop.
+        """
+
+        log.info("console hub started")
+        while True:
+            while self._callbacks:
+                callback, args = self._callbacks.popleft()
+                try:
+                    callback(*args)
+                except Exception as e:
+                    log.error("console hub callback error: {}".format(e), exc_info=1)
+
+            timeout = self._run_timers()
+            if self._callbacks:
+                timeout = 0
+            if timeout is None:
+                timeout = -1
+            else:
+                timeout *= self._poll_timeout_unit
+
+            try:
+                events = self._poller.poll(timeout)
+            except InterruptedError:
+                continue
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                log.critical("fatal console hub poll error: {}".format(e))
+                return
+
+            for fileno, event in events:
+                handler = self._handlers.get(fileno)
+                if handler:
+                    try:
+                        handler(event)
+                    except Exception as e:
+                        log.error("console hub handler error: {}".format(e), exc_info=1)
+
+
+class TelnetClient(object):
+    """
+    Telnet client connected to a console.
+
+    :param console: Console instance
+    :param sock: client socket
+    :param host: IP of the Telnet client
+    :param port: port of the Telnet client
+    """
+
+    def __init__(self, console, sock, host, port):
+
+        self._console = console
+        self._sock = sock
+        self._host = host
+        self._port = port
+        self._output = bytearray()
+        self._iac_pending = bytearray()
+
+    def fileno(self):
+
+        return self._sock.fileno()
+
+    def send(self, data):
+        """
+        Sends data, or queues it if the client cannot receive more yet.
+
+        :param data: bytes, bytearray or memoryview
+
+        :returns: False if the client must be disconnected
+        """
+
+        if self._output:
+            if len(self._output) + len(data) > MAX_CLIENT_BUFFER:
+                log.warn("Telnet client {}:{} is too slow, disconnecting".format(self._host, self._port))
+                return False
+            self._output.extend(data)
+            return True
+        try:
+            sent = self._sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            log.debug("Telnet client {}:{}: {}".format(self._host, self._port, e))
+            return False
+        if sent < len(data):
+            self._output.extend(data[sent:])
+            self._console.hub.modify(self.fileno(), POLLIN | POLLOUT)
+        return True
+
+    def flush(self):
+        """
+        Sends the queued data.
+
+        :returns: False if the client must be disconnected
+        """
+
+        try:
+            sent = self._sock.send(self._output)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        del self._output[:sent]
+        if not self._output:
+            self._console.hub.modify(self.fileno(), POLLIN)
+        return True
+
+    def close(self):
+
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+    def strip_telnet_commands(self, buf):
+        """
+        Processes and removes any Telnet commands from the buffer.
+        Incomplete commands are kept until the next read.
+
+        :param buf: bytearray received from the client
+
+        :returns: data without the Telnet commands
+        """
+
+        if self._iac_pending:
+            buf = self._iac_pending + buf
+            self._iac_pending = bytearray()
+        if IAC not in buf:
+            return buf
+
+        data = bytearray()
+        position = 0
+        length = len(buf)
+        while position < length:
+            iac_loc = buf.find(IAC, position)
+            if iac_loc < 0:
+                data.extend(buf[position:])
+                break
+            data.extend(buf[position:iac_loc])
+            if iac_loc + 1 >= length:
+                self._iac_pending = buf[iac_loc:]
+                break
+            command = buf[iac_loc + 1]
+            if command in (WILL, WONT, DO, DONT):
+                # this must be a 3-byte Telnet command
+                if iac_loc + 2 >= length:
+                    self._iac_pending = buf[iac_loc:]
+                    break
+                option = buf[iac_loc + 2]
+                # We do ECHO, SGA, and BINARY. Period.
+                if command == DO and option not in (ECHO, SGA, BINARY):
+                    self.send(bytes([IAC, WONT, option]))
+                    log.debug("Telnet WON'T {:#x}".format(option))
+                position = iac_loc + 3
+            else:
+                if command == IAC:
+                    # It's data, not an IAC
+                    data.append(IAC)
+                elif command == AYT:
+                    log.debug("Telnet server received Are-You-There (AYT)")
+                    self.send(b'\r\nYour Are-You-There received. I am here.\r\n')
+                elif command != NOP:
+                    log.debug("Unhandled telnet command: {0:#x} {1:#x}".format(IAC, command))
+                position = iac_loc + 2
+        return data
+
+
+class Console(object):
+    """
+    Telnet console relaying data between Telnet clients and a console device,
+    served by the console hub.
+
+    Subclasses implement the device side.
+
+    :param name: node name (for logging)
+    :param host: host/address to bind for Telnet connections
+    :param port: Telnet port
+    :param welcome: message sent to new Telnet clients (optional)
+    :param scrollback: ConsoleBuffer instance replayed to new Telnet clients (optional)
+    :param watcher: ConsoleWatcher instance fed with the console output (optional)
+    """
+
+    def __init__(self, name, host, port, welcome=None, scrollback=None, watcher=None):
+
+        self._name = name
+        self._host = host
+        self._port = port
+        self._welcome = welcome
+        self._scrollback = scrollback
+        self._watcher = watcher
+        self._hub = None
+        self._server_socket = None
+        self._clients = {}
+        self._read_buffer = bytearray(BUFFER_SIZE)
+        self._read_view = memoryview(self._read_buffer)
+        self._stopped = threading.Event()
+
+    @property
+    def name(self):
+
+        return self._name
+
+    @property
+    def hub(self):
+
+        return self._hub
+
+    def start(self, hub=None):
+        """
+        Binds the Telnet port and starts serving the console.
+        Bind errors are raised in the caller thread.
+
+        :param hub: ConsoleHub instance (default is the process hub)
+        """
+
+        if ":" in self._host:
+            # IPv6 address support
+            server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        else:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server_socket.bind((self._host, self._port))
+            server_socket.listen(socket.SOMAXCONN)
+        except OSError:
+            server_socket.close()
+            raise
+        server_socket.setblocking(False)
+        self._server_socket = server_socket
+        self._stopped.clear()
+        self._hub = hub or ConsoleHub.instance()
+        self._hub.call_soon(self._attach)
+        log.info("Telnet console for {} ready for connections on {}:{}".format(self._name, self._host, self._port))
+
+    def stop(self, timeout=3.0):
+        """
+        Stops serving the console. Waits for the Telnet port to be freed.
+
+        :param timeout: how long to wait
+        """
+
+        if not self._hub or self._stopped.is_set():
+            return
+        if self._hub.in_hub_thread():
+            self._detach()
+        else:
+            self._hub.call_soon(self._detach)
+            if not self._stopped.wait(timeout):
+                log.warn("Telnet console for {} could not be stopped".format(self._name))
+
+    def _attach(self):
+        """
+        Registers the console with the hub (hub thread).
+        """
+
+        self._hub.register(self._server_socket.fileno(), POLLIN, self._accept)
+        self.device_open()
+
+    def _detach(self):
+        """
+        Unregisters the console from the hub and closes everything (hub thread).
+        """
+
+        if self._stopped.is_set():
+            return
+        for fileno in list(self._clients.keys()):
+            self._disconnect(fileno)
+        if self._server_socket:
+            self._hub.unregister(self._server_socket.fileno())
+            self._server_socket.close()
+            self._server_socket = None
+        self.device_close()
+        self._stopped.set()
+        log.info("Telnet console for {} has stopped".format(self._name))
+
+    def _accept(self, events):
+
+        try:
+            sock, addr = self._server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            log.error("could not accept new client: {}".format(e))
+            return
+
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        host, port = addr[0], addr[1]
+        log.info("Telnet connection from {}:{} to {}".format(host, port, self._name))
+
+        client = TelnetClient(self, sock, host, port)
+        self._clients[sock.fileno()] = client
+        self._hub.register(sock.fileno(), POLLIN, lambda events, fileno=sock.fileno(): self._client_event(fileno, events))
+
+        # This is a one-way negotiation. This is very basic so there
+        # shouldn't be any problems with any decent client.
+        client.send(bytes([IAC, WILL, ECHO,
+                           IAC, WILL, SGA,
+                           IAC, WILL, BINARY,
+                           IAC, DO, BINARY]))
+        if self._welcome:
+            client.send(self._welcome.encode("utf-8"))
+        if self._scrollback is not None and len(self._scrollback):
+            # replay the recent output so that late clients don't miss the boot messages
+            client.send(self._scrollback.read())
+        self.client_connected(client)
+
+    def _disconnect(self, fileno):
+
+        client = self._clients.pop(fileno, None)
+        if client:
+            self._hub.unregister(fileno)
+            client.close()
+            log.info("Telnet client disconnected from {}".format(self._name))
+
+    def _client_event(self, fileno, events):
+
+        client = self._clients.get(fileno)
+        if not client:
+            return
+
+        if events & POLLOUT:
+            if not client.flush():
+                self._disconnect(fileno)
+                return
+
+        if events & (POLLIN | POLLERR):
+            try:
+                size = client._sock.recv_into(self._read_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                size = 0
+            if not size:
+                self._disconnect(fileno)
+                return
+            data = client.strip_telnet_commands(self._read_buffer[:size])
+            if data:
+                self.device_write(data)
+
+    def broadcast(self, data):
+        """
+        Sends data from the console device to all the Telnet clients.
+
+        :param data: bytes, bytearray or memoryview
+        """
+
+        if self._scrollback is not None:
+            self._scrollback.write(data)
+        if self._watcher is not None:
+            self._watcher.feed(data)
+        for fileno, client in list(self._clients.items()):
+            if not client.send(data):
+                self._disconnect(fileno)
+
+    def client_connected(self, client):
+        """
+        Called when a new Telnet client has connected.
+
+        :param client: TelnetClient instance
+        """
+
+        pass
+
+    def device_open(self):
+        """
+        Opens the console device (hub thread).
+        """
+
+        raise NotImplementedError()
+
+    def device_close(self):
+        """
+        Closes the console device (hub thread).
+        """
+
+        raise NotImplementedError()
+
+    def device_write(self, data):
+        """
+        Writes data received from a Telnet client to the console device.
+
+        :param data: bytearray
+        """
+
+        raise NotImplementedError()
+
+
+class SocketConsole(Console):
+    """
+    Console relaying to an already connected stream socket
+    (e.g. VirtualBox serial port pipe on Linux/UNIX).
+
+    :param name: node name (for logging)
+    :param sock: connected socket
+    :param host: host/address to bind for Telnet connections
+    :param port: Telnet port
+    :param welcome: message sent to new Telnet clients (optional)
+    :param crlf_to_lf: replace CR/LF sent by clients by LF
+    :param scrollback: ConsoleBuffer instance (optional)
+    :param watcher: ConsoleWatcher instance (optional)
+    """
+
+    def __init__(self, name, sock, host, port, welcome=None, crlf_to_lf=False, scrollback=None, watcher=None):
+
+        Console.__init__(self, name, host, port, welcome, scrollback, watcher)
+        self._sock = sock
+        self._crlf_to_lf = crlf_to_lf
+
+    def device_open(self):
+
+        self._sock.setblocking(False)
+        self._hub.register(self._sock.fileno(), POLLIN, self._device_event)
+
+    def device_close(self):
+
+        if self._sock:
+            self._hub.unregister(self._sock.fileno())
+            self._sock = None
+
+    def _device_event(self, events):
+
+        try:
+            size = self._sock.recv_into(self._read_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            log.debug("console device for {}: {}".format(self._name, e))
+            size = 0
+        if not size:
+            log.warning("console pipe for {} has been closed!".format(self._name))
+            self.device_close()
+            return
+        self.device_output(self._read_view[:size])
+
+    def device_output(self, data):
+        """
+        Handles data read from the console device.
+
+        :param data: memoryview
+        """
+
+        self.broadcast(data)
+
+    def device_write(self, data):
+
+        if not self._sock:
+            return
+        if self._crlf_to_lf:
+            # For some reason, windows likes to send "cr/lf" when you send a "cr".
+            # Strip that so we don't get a double prompt.
+            data = data.replace(b"\r\n", b"\n")
+        try:
+            self._sock.sendall(data)
+        except OSError as e:
+            log.debug("could not write to the console pipe of {}: {}".format(self._name, e))
+
+
+class IOUConsole(Console):
+    """
+    Console relaying to the IOU Unix datagram sockets (replaces the ioucon thread).
+
+    :param name: IOU device name (for logging)
+    :param appl_id: IOU instance identifier
+    :param host: host/address to bind for Telnet connections
+    :param port: Telnet port
+    :param scrollback: ConsoleBuffer instance (optional)
+    :param watcher: ConsoleWatcher instance (optional)
+    """
+
+    # How long to wait before retrying a connection (seconds)
+    RETRY_DELAY = 3
+
+    # How often to test an idle connection (seconds)
+    POLL_TIMEOUT = 3
+
+    def __init__(self, name, appl_id, host, port, scrollback=None, watcher=None):
+
+        Console.__init__(self, name, host, port, scrollback=scrollback, watcher=watcher)
+        netio = "/tmp/netio{}".format(os.getuid())
+        self._netio = netio
+        self._ttyC = "{}/ttyC{}".format(netio, appl_id)
+        self._ttyS = "{}/ttyS{}".format(netio, appl_id)
+        self._sock = None
+        self._connected = False
+        self._timer = None
+        self._last_activity = 0
+
+    def device_open(self):
+
+        try:
+            os.mkdir(self._netio)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            log.error("ioucon: couldn't create directory {}: {}".format(self._netio, e))
+            return
+
+        try:
+            os.unlink(self._ttyC)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.error("ioucon: couldn't unlink socket {}: {}".format(self._ttyC, e))
+            return
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        try:
+            self._sock.bind(self._ttyC)
+        except OSError as e:
+            log.error("ioucon: couldn't create socket {}: {}".format(self._ttyC, e))
+            self._sock.close()
+            self._sock = None
+            return
+        self._hub.register(self._sock.fileno(), POLLIN, self._device_event)
+        self._connect()
+
+    def _connect(self):
+        """
+        Connects to IOU, retries until IOU is ready.
+        """
+
+        self._timer = None
+        if not self._sock:
+            return
+        try:
+            self._sock.connect(self._ttyS)
+        except (FileNotFoundError, ConnectionRefusedError):
+            log.debug("Waiting to connect to {}".format(self._ttyS))
+            self._timer = self._hub.call_later(self.RETRY_DELAY, self._connect)
+            return
+        except OSError as e:
+            log.error("ioucon: couldn't connect to socket {}: {}".format(self._ttyS, e))
+            return
+        self._connected = True
+        self._last_activity = time.time()
+        self._timer = self._hub.call_later(self.POLL_TIMEOUT, self._keepalive)
+
+    def _keepalive(self):
+        """
+        Sends an empty datagram when the connection is idle
+        to detect that IOU has gone away.
+        """
+
+        self._timer = None
+        if not self._connected:
+            return
+        if time.time() - self._last_activity >= self.POLL_TIMEOUT:
+            self.device_write(b'')
+        if self._connected:
+            self._timer = self._hub.call_later(self.POLL_TIMEOUT, self._keepalive)
+
+    def _reconnect(self):
+        """
+        IOU has gone away, wait for it to be back.
+        """
+
+        self._connected = False
+        self._hub.cancel_timer(self._timer)
+        # a datagram socket can be connected again to the same address
+        self._timer = self._hub.call_later(self.RETRY_DELAY, self._connect)
+
+    def device_close(self):
+
+        self._connected = False
+        self._hub.cancel_timer(self._timer)
+        self._timer = None
+        if self._sock:
+            self._hub.unregister(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self._ttyC)
+            except OSError:
+                pass
+
+    def _device_event(self, events):
+
+        # IOU seems to only send *1* byte at a time, read everything available
+        while self._sock:
+            try:
+                size = self._sock.recv_into(self._read_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                self._reconnect()
+                return
+            except OSError as e:
+                log.debug("ioucon for {}: {}".format(self._name, e))
+                return
+            self._last_activity = time.time()
+            if size:
+                self.device_output(self._read_view[:size])
+
+    def device_output(self, data):
+        """
+        Handles data read from IOU.
+
+        :param data: memoryview
+        """
+
+        self.broadcast(data)
+
+    def device_write(self, data):
+
+        if not self._sock or not self._connected:
+            return
+        try:
+            self._sock.send(data)
+            self._last_activity = time.time()
+        except BlockingIOError:
+            return
+        except (ConnectionRefusedError, FileNotFoundError):
+            self._reconnect()
+        except OSError as e:
+            log.debug("ioucon for {}: {}".format(self._name, e))
+
+
+class ConsoleTap(object):
+    """
+    Telnet client reading the console of a node served by the emulator
+    itself (Dynamips, QEMU or VPCS) so the server can see its output.
+    Connects again whenever the console goes away until it is stopped.
+
+    :param name: node name (for logging)
+    :param host: console host/address
+    :param port: console port
+    :param callback: called with the console output (without Telnet commands), from the hub thread
+    """
+
+    # How long to wait before retrying a connection (seconds)
+    RETRY_DELAY = 3
+
+    def __init__(self, name, host, port, callback):
+
+        # the console is bound to all the addresses, use the loopback
+        if host in ("0.0.0.0", ""):
+            host = "127.0.0.1"
+        elif host == "::":
+            host = "::1"
+        self._name = name
+        self._host = host
+        self._port = port
+        self._callback = callback
+        self._hub = None
+        self._sock = None
+        self._connecting = False
+        self._timer = None
+        self._stopped = False
+        self._iac_pending = b""
+        self._read_buffer = bytearray(BUFFER_SIZE)
+        self._read_view = memoryview(self._read_buffer)
+
+    def start(self, hub=None):
+        """
+        Starts reading the console.
+
+        :param hub: ConsoleHub instance (default is the process hub)
+        """
+
+        self._stopped = False
+        self._hub = hub or ConsoleHub.instance()
+        self._hub.call_soon(self._connect)
+
+    def stop(self):
+        """
+        Stops reading the console.
+        """
+
+        self._stopped = True
+        if self._hub:
+            if self._hub.in_hub_thread():
+                self._close()
+            else:
+                self._hub.call_soon(self._close)
+
+    def _connect(self):
+
+        self._timer = None
+        if self._stopped or self._sock:
+            return
+        family = socket.AF_INET6 if ":" in self._host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        error = sock.connect_ex((self._host, self._port))
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self._timer = self._hub.call_later(self.RETRY_DELAY, self._connect)
+            return
+        self._sock = sock
+        self._connecting = True
+        self._hub.register(sock.fileno(), POLLOUT, self._event)
+
+    def _retry(self):
+
+        self._disconnect()
+        if not self._stopped:
+            self._timer = self._hub.call_later(self.RETRY_DELAY, self._connect)
+
+    def _disconnect(self):
+
+        if self._sock:
+            self._hub.unregister(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+            self._iac_pending = b""
+
+    def _close(self):
+
+        self._hub.cancel_timer(self._timer)
+        self._timer = None
+        self._disconnect()
+
+    def _event(self, events):
+
+        if self._connecting:
+            if self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                self._retry()
+                return
+            self._connecting = False
+            self._hub.modify(self._sock.fileno(), POLLIN)
+            log.info("console tap connected to {} on {}:{}".format(self._name, self._host, self._port))
+            return
+
+        try:
+            size = self._sock.recv_into(self._read_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            size = 0
+        if not size:
+            log.debug("console of {} has been closed".format(self._name))
+            self._retry()
+            return
+        data = self._strip_telnet_commands(self._read_view[:size])
+        if data:
+            self._callback(data)
+
+    def _strip_telnet_commands(self, data):
+        """
+        Removes the Telnet commands sent by the console server
+        (options are not negotiated, the defaults are fine to read output).
+
+        :param data: memoryview
+
+        :returns: data without the Telnet commands
+        """
+
+        buf = bytes(data)
+        if self._iac_pending:
+            buf = self._iac_pending + buf
+            self._iac_pending = b""
+        if IAC not in buf:
+            return buf
+
+        output = bytearray()
+        position = 0
+        length = len(buf)
+        while position < length:
+            iac_loc = buf.find(IAC, position)
+            if iac_loc < 0:
+                output.extend(buf[position:])
+                break
+            output.extend(buf[position:iac_loc])
+            if iac_loc + 1 >= length:
+                self._iac_pending = buf[iac_loc:]
+                break
+            command = buf[iac_loc + 1]
+            if command in (WILL, WONT, DO, DONT):
+                if iac_loc + 2 >= length:
+                    self._iac_pending = buf[iac_loc:]
+                    break
+                position = iac_loc + 3
+            else:
+                if command == IAC:
+                    output.append(IAC)
+                position = iac_loc + 2
+        return output
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Watches the console output of the nodes for registered patterns
+(e.g. "Press RETURN to get started") so clients can wait for events
+instead of polling the consoles.
+"""
+
+import threading
+import collections
+
+from .console_hub import ConsoleTap
+
+import logging
+log = logging.getLogger(__name__)
+
+# maximum size of a pattern (bytes)
+MAX_PATTERN_SIZE = 1024
+
+# JSON schema of the console watch requests (the "id" property is added by the modules)
+CONSOLE_WATCH_PROPERTIES = {
+    "pattern": {
+        "description": "text to look for in the console output",
+        "type": "string",
+        "minLength": 1,
+        "maxLength": MAX_PATTERN_SIZE,
+    },
+    "once": {
+        "description": "remove the watch after the first match (default is true)",
+        "type": "boolean",
+    },
+    "scrollback": {
+        "description": "also look for the pattern in the recent console output (default is true)",
+        "type": "boolean",
+    },
+    "take_console": {
+        "description": "read the console served by the emulator (Dynamips, QEMU or VPCS), no other client can connect to it while the pattern is watched (default is false)",
+        "type": "boolean",
+    },
+}
+
+
+class ConsoleWatchError(Exception):
+
+    def __init__(self, message, original_exception=None):
+
+        Exception.__init__(self, message)
+        if isinstance(message, Exception):
+            message = str(message)
+        self._message = message
+        self._original_exception = original_exception
+
+    def __repr__(self):
+
+        return self._message
+
+    def __str__(self):
+
+        return self._message
+
+
+class PatternMatcher(object):
+    """
+    Aho-Corasick automaton matching several patterns at once in a stream:
+    every byte is processed once whatever the number of patterns and
+    a pattern split across several reads is still matched.
+
+    :param patterns: dictionary of key -> pattern (bytes)
+    """
+
+    def __init__(self, patterns):
+
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._state = 0
+
+        for key, pattern in patterns.items():
+            state = 0
+            for byte in pattern:
+                next_state = self._goto[state].get(byte)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][byte] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append(key)
+
+        # breadth-first computation of the failure links
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for byte, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and byte not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(byte, 0)
+                self._output[next_state].extend(self._output[self._fail[next_state]])
+
+    def feed(self, data):
+        """
+        Processes data following the data already processed.
+
+        :param data: bytes, bytearray or memoryview
+
+        :returns: list of the keys of the matched patterns (in match order)
+        """
+
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = self._state
+        matches = []
+        for byte in data:
+            while state and byte not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(byte, 0)
+            if output[state]:
+                matches.extend(output[state])
+        self._state = state
+        return matches
+
+
+class ConsoleWatcher(object):
+    """
+    Console patterns registered for a node.
+
+    The watcher is fed with the console output by the console relays
+    (IOU and VirtualBox) or by a console tap for the consoles served by
+    the emulators. A tap is only connected while patterns are registered,
+    these consoles only accept one client so the patterns must be registered
+    with take_console.
+
+    :param name: node name (for logging)
+    :param callback: called with (watch ID, pattern, context) for every match
+    :param scrollback: ConsoleBuffer instance with the recent output (optional)
+    :param tapped: the console is served by the emulator and read with a tap
+    """
+
+    def __init__(self, name, callback, scrollback=None, tapped=False):
+
+        self._name = name
+        self._callback = callback
+        self._scrollback = scrollback
+        self._watches = {}  # watch ID -> (pattern, once, context)
+        self._watch_id = 0
+        self._matcher = None
+        self._tail = bytearray()  # end of the output, for the patterns registered later
+        self._lock = threading.Lock()
+        self._tapped = tapped
+        self._tap_address = None
+        self._tap = None
+
+    @property
+    def armed(self):
+        """
+        Returns either patterns are registered.
+
+        :returns: boolean
+        """
+
+        return len(self._watches) > 0
+
+    @property
+    def watches(self):
+        """
+        Returns the registered patterns.
+
+        :returns: dictionary of watch ID -> pattern
+        """
+
+        with self._lock:
+            return {watch_id: pattern.decode("utf-8", errors="replace") for watch_id, (pattern, _, _) in self._watches.items()}
+
+    def _rebuild(self):
+        """
+        Builds the matcher for the registered patterns (lock held).
+        The end of the output is processed again so that the patterns
+        already being matched are still matched.
+        """
+
+        self._matcher = PatternMatcher({watch_id: pattern for watch_id, (pattern, _, _) in self._watches.items()})
+        self._matcher.feed(self._tail)
+
+    def _disarm(self):
+        """
+        Drops the matcher once no pattern is registered (lock held).
+        """
+
+        if not self._watches:
+            self._matcher = None
+            self._tail.clear()
+
+    def add(self, pattern, once=True, scrollback=True, context=None, take_console=False):
+        """
+        Registers a pattern.
+
+        :param pattern: text to look for
+        :param once: remove the pattern after the first match
+        :param scrollback: also look for the pattern in the recent output
+        :param context: passed to the callback (e.g. the client session)
+        :param take_console: read the console served by the emulator
+
+        :returns: watch ID
+        """
+
+        if self._tapped and not take_console:
+            raise ConsoleWatchError("The console of {} is served by the emulator and only accepts one client, "
+                                    "watching it requires take_console".format(self._name))
+        pattern_bytes = pattern.encode("utf-8")
+        with self._lock:
+            self._watch_id += 1
+            watch_id = self._watch_id
+            already_matched = scrollback and self._scrollback is not None and pattern_bytes in self._scrollback.read()
+            if not (already_matched and once):
+                self._watches[watch_id] = (pattern_bytes, once, context)
+                self._rebuild()
+        log.info("{}: watching the console for '{}' [watch_id={}]".format(self._name, pattern, watch_id))
+        if already_matched:
+            self._callback(watch_id, pattern, context)
+        self._update_tap()
+        return watch_id
+
+    def remove(self, watch_id):
+        """
+        Removes a pattern.
+
+        :param watch_id: watch ID
+
+        :returns: False if the pattern is not registered
+        """
+
+        with self._lock:
+            if self._watches.pop(watch_id, None) is None:
+                return False
+            # the matcher ignores the removed patterns
+            self._disarm()
+        self._update_tap()
+        return True
+
+    def clear(self):
+        """
+        Removes all the patterns.
+        """
+
+        with self._lock:
+            self._watches.clear()
+            self._disarm()
+        self._update_tap()
+
+    def feed(self, data):
+        """
+        Looks for the patterns in console output.
+
+        :param data: bytes, bytearray or memoryview
+        """
+
+        if self._matcher is None:
+            return
+        with self._lock:
+            if self._matcher is None:
+                return
+            matches = []
+            for watch_id in self._matcher.feed(data):
+                if watch_id not in self._watches:
+                    continue  # removed or already matched once
+                pattern, once, context = self._watches[watch_id]
+                matches.append((watch_id, pattern.decode("utf-8", errors="replace"), context))
+                if once:
+                    del self._watches[watch_id]
+            if len(data) >= MAX_PATTERN_SIZE - 1:
+                self._tail[:] = data[len(data) - MAX_PATTERN_SIZE + 1:]
+            else:
+                self._tail += data
+                del self._tail[:-MAX_PATTERN_SIZE + 1]
+            self._disarm()
+
+        for watch_id, pattern, context in matches:
+            log.info("{}: console pattern '{}' matched [watch_id={}]".format(self._name, pattern, watch_id))
+            self._callback(watch_id, pattern, context)
+        if matches:
+            self._update_tap()
+
+    def tap(self, host, port):
+        """
+        Sets the address of a console served by the emulator, it is read
+        while patterns are registered.
+
+        :param host: console host/address
+        :param port: console port
+        """
+
+        if self._tap_address != (host, port):
+            self.untap()
+            self._tap_address = (host, port)
+        self._update_tap()
+
+    def untap(self):
+        """
+        Stops reading the console served by the emulator.
+        """
+
+        self._tap_address = None
+        self._update_tap()
+
+    def _update_tap(self):
+        """
+        Connects or disconnects the console tap.
+        """
+
+        with self._lock:
+            if self._watches and self._tap_address:
+                if self._tap is None:
+                    host, port = self._tap_address
+                    self._tap = ConsoleTap(self._name, host, port, self.feed)
+                    self._tap.start()
+            elif self._tap is not None:
+                self._tap.stop()
+                self._tap = None
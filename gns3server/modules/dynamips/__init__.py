@@ -26,13 +26,19 @@ import tempfile
 import shutil
 import glob
 import socket
+from jsonschema import validate, ValidationError
 from gns3server.modules import IModule
 from gns3server.config import Config
 from gns3server.builtins.interfaces import get_windows_interfaces
 
 from .hypervisor import Hypervisor
 from .hypervisor_manager import HypervisorManager
+from .remote_hypervisor import RemoteHypervisor
+from .native_hypervisor import NativeHypervisor
 from .dynamips_error import DynamipsError
+from ..attic import call_in_parallel
+from ..sharding import owns
+from .schemas.farm import REMOTE_HYPERVISORS_SCHEMA
 
 # Nodes
 from .nodes.router import Router
@@ -138,6 +144,9 @@ class Dynamips(IModule):
         self._working_dir = self._projects_dir
         self._host = dynamips_config.get("host", kwargs["host"])
         self._console_host = dynamips_config.get("console_host", kwargs["console_host"])
+        self._switching_engine = dynamips_config.get("switching_engine", "dynamips")
+        self._native_hypervisor = None
+        self._remote_hypervisors = self._parse_remote_hypervisors(dynamips_config.get("remote_hypervisors", ""))
 
         if not sys.platform.startswith("win32"):
             #FIXME: pickle issues Windows
@@ -155,28 +164,97 @@ class Dynamips(IModule):
             self._callback.stop()
 
         # automatically save configs for all router instances
-        for router_id in self._routers:
-            router = self._routers[router_id]
-            try:
-                router.save_configs()
-            except DynamipsError:
-                continue
+        self._save_all_configs()
 
         # stop all Dynamips hypervisors
         if self._hypervisor_manager:
             self._hypervisor_manager.stop_all_hypervisors()
 
+        # stop the native switching fabric
+        if self._native_hypervisor:
+            self._native_hypervisor.stop()
+
         self.delete_dynamips_files()
         IModule.stop(self, signum)  # this will stop the I/O loop
 
+    def _save_all_configs(self):
+        """
+        Saves the configs of all the routers (the routers of
+        different hypervisors are handled in parallel).
+        """
+
+        routers_per_hypervisor = {}
+        for router in self._routers.values():
+            routers_per_hypervisor.setdefault(router.hypervisor, []).append(router)
+
+        def save_configs(routers):
+            for router in routers:
+                try:
+                    router.save_configs()
+                except DynamipsError:
+                    continue
+
+        call_in_parallel(save_configs, routers_per_hypervisor.values())
+
+    @staticmethod
+    def _parse_remote_hypervisors(value):
+        """
+        Parses the remote_hypervisors setting: comma separated
+        host:port[:ram[:cpus]] entries.
+
+        :param value: setting value
+
+        :returns: list of remote hypervisors (dictionaries)
+        """
+
+        remote_hypervisors = []
+        for entry in value.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            fields = entry.split(":")
+            try:
+                remote_hypervisor = {"host": fields[0], "port": int(fields[1])}
+                if len(fields) > 2:
+                    remote_hypervisor["ram"] = int(fields[2])
+                if len(fields) > 3:
+                    remote_hypervisor["cpus"] = int(fields[3])
+            except (IndexError, ValueError):
+                log.error("invalid remote hypervisor '{}', expected host:port[:ram[:cpus]]".format(entry))
+                continue
+            remote_hypervisors.append(remote_hypervisor)
+        return remote_hypervisors
+
+    def _apply_remote_hypervisors(self):
+        """
+        Registers the remote hypervisors in the hypervisor manager.
+        A remote hypervisor is driven by one shard only (device names
+        are global to a Dynamips process).
+        """
+
+        farm = [remote_hypervisor for remote_hypervisor in self._remote_hypervisors
+                if owns("{}:{}".format(remote_hypervisor["host"], remote_hypervisor["port"]))]
+
+        for hypervisor in list(self._hypervisor_manager.farm):
+            if not any(hypervisor.host == remote_hypervisor["host"] and hypervisor.port == remote_hypervisor["port"] for remote_hypervisor in farm):
+                try:
+                    self._hypervisor_manager.remove_remote_hypervisor(hypervisor.host, hypervisor.port)
+                except DynamipsError as e:
+                    log.error("could not remove remote hypervisor: {}".format(e))
+
+        for remote_hypervisor in farm:
+            self._hypervisor_manager.add_remote_hypervisor(**remote_hypervisor)
+
     def _check_hypervisors(self):
         """
-        Periodic callback to check if Dynamips hypervisors are running.
+        Periodic callback to check if Dynamips hypervisors are running
+        and if the remote hypervisors are reachable.
 
         Sends a notification to the client if not.
         """
 
         if self._hypervisor_manager:
+            self._hypervisor_manager.check_farm(self.add_future)
             for hypervisor in self._hypervisor_manager.hypervisors:
                 if hypervisor.started and not hypervisor.is_running():
                     notification = {"module": self.name}
@@ -184,7 +262,10 @@ class Dynamips(IModule):
                     device_names = []
                     for device in hypervisor.devices:
                         device_names.append(device.name)
-                    notification["message"] = "Dynamips has stopped running"
+                    if isinstance(hypervisor, RemoteHypervisor):
+                        notification["message"] = "Remote hypervisor {}:{} is unreachable".format(hypervisor.host, hypervisor.port)
+                    else:
+                        notification["message"] = "Dynamips has stopped running"
                     notification["details"] = stdout
                     notification["devices"] = device_names
                     self.send_notification("{}.dynamips_stopped".format(self.name), notification)
@@ -233,17 +314,16 @@ class Dynamips(IModule):
         """
 
         # automatically save configs for all router instances
-        for router_id in self._routers:
-            router = self._routers[router_id]
-            try:
-                router.save_configs()
-            except DynamipsError:
-                continue
+        self._save_all_configs()
 
         # stop all Dynamips hypervisors
         if self._hypervisor_manager:
             self._hypervisor_manager.stop_all_hypervisors()
 
+        # delete all the devices running in the native switching fabric
+        if self._native_hypervisor:
+            self._native_hypervisor.reset()
+
         # resets the instance counters
         Router.reset()
         EthernetSwitch.reset()
@@ -277,13 +357,16 @@ class Dynamips(IModule):
         Starts the hypervisor manager.
         """
 
-        # check if Dynamips path exists
-        if not os.path.isfile(self._dynamips):
-            raise DynamipsError("Dynamips executable {} doesn't exist".format(self._dynamips))
+        # a local Dynamips is optional with remote hypervisors
+        if not self._remote_hypervisors:
 
-        # check if Dynamips is executable
-        if not os.access(self._dynamips, os.X_OK):
-            raise DynamipsError("Dynamips {} is not executable".format(self._dynamips))
+            # check if Dynamips path exists
+            if not self._dynamips or not os.path.isfile(self._dynamips):
+                raise DynamipsError("Dynamips executable {} doesn't exist".format(self._dynamips))
+
+            # check if Dynamips is executable
+            if not os.access(self._dynamips, os.X_OK):
+                raise DynamipsError("Dynamips {} is not executable".format(self._dynamips))
 
         workdir = os.path.join(self._working_dir, "dynamips")
         try:
@@ -304,6 +387,41 @@ class Dynamips(IModule):
             if hasattr(self._hypervisor_manager, name) and getattr(self._hypervisor_manager, name) != value:
                 setattr(self._hypervisor_manager, name, value)
 
+        self._apply_remote_hypervisors()
+
+    def allocate_hypervisor_for_simulated_device(self, engine=None):
+        """
+        Allocates a hypervisor for an Ethernet switch or hub.
+
+        :param engine: "dynamips" or "native" (default is the switching_engine setting)
+
+        :returns: hypervisor instance
+        """
+
+        if not engine:
+            engine = self._switching_engine
+
+        if engine == "native":
+            if not self._native_hypervisor:
+                workdir = os.path.join(self._working_dir, "dynamips")
+                log.info("starting the native switching engine with working directory set to '{}'".format(workdir))
+                self._native_hypervisor = NativeHypervisor(workdir, self._host)
+            return self._native_hypervisor
+
+        if not self._hypervisor_manager:
+            self.start_hypervisor_manager()
+        return self._hypervisor_manager.allocate_hypervisor_for_simulated_device()
+
+    def unallocate_hypervisor_for_simulated_device(self, device):
+        """
+        Unallocates the hypervisor of an Ethernet switch or hub.
+
+        :param device: device instance
+        """
+
+        if device.hypervisor is not self._native_hypervisor:
+            self._hypervisor_manager.unallocate_hypervisor_for_simulated_device(device)
+
     @IModule.route("dynamips.settings")
     def settings(self, request):
         """
@@ -313,6 +431,7 @@ class Dynamips(IModule):
         - path (path to the Dynamips executable)
         - working_dir (path to a working directory)
         - project_name
+        - remote_hypervisors (list of host, port, ram and cpus of the hypervisor farm)
 
         :param request: JSON request
         """
@@ -323,6 +442,17 @@ class Dynamips(IModule):
 
         log.debug("received request {}".format(request))
 
+        if "remote_hypervisors" in request:
+            remote_hypervisors = request.pop("remote_hypervisors")
+            try:
+                validate(remote_hypervisors, REMOTE_HYPERVISORS_SCHEMA)
+            except ValidationError as e:
+                log.error("invalid remote hypervisors: {}".format(e))
+            else:
+                self._remote_hypervisors = remote_hypervisors
+                if self._hypervisor_manager:
+                    self._apply_remote_hypervisors()
+
         #TODO: JSON schema validation
         if not self._hypervisor_manager:
 
@@ -376,6 +506,29 @@ class Dynamips(IModule):
                 if hasattr(self._hypervisor_manager, name) and getattr(self._hypervisor_manager, name) != value:
                     setattr(self._hypervisor_manager, name, value)
 
+        if self._native_hypervisor:
+            self._native_hypervisor.working_dir = os.path.join(self._working_dir, "dynamips")
+
+    @IModule.route("dynamips.farm")
+    def farm(self, request):
+        """
+        Returns the health and capacity reports of the remote hypervisors.
+
+        Response parameters:
+        - list of remote hypervisors (host, port, healthy, in_use, version,
+        ram, cpus, memory_load, devices, error)
+
+        :param request: JSON request (not used)
+        """
+
+        if not self._hypervisor_manager:
+            try:
+                self.start_hypervisor_manager()
+            except DynamipsError as e:
+                self.send_custom_error(str(e))
+                return
+        self.send_response(self._hypervisor_manager.farm_status())
+
     @IModule.route("dynamips.echo")
     def echo(self, request):
         """
@@ -402,10 +555,16 @@ class Dynamips(IModule):
         """
 
         nio = None
+        if isinstance(node.hypervisor, NativeHypervisor) and request["nio"]["type"] in ("nio_unix", "nio_vde"):
+            # the native switching fabric has no UNIX socket or VDE ports
+            raise DynamipsError("{} is not supported by the native switching engine".format(request["nio"]["type"]))
         if request["nio"]["type"] == "nio_udp":
             lport = request["nio"]["lport"]
             rhost = request["nio"]["rhost"]
             rport = request["nio"]["rport"]
+            if self._hypervisor_manager:
+                # tunnels between this server and the remote hypervisors
+                rhost = self._hypervisor_manager.udp_peer_address(node.hypervisor, rhost, rport)
             try:
                 #TODO: handle IPv6
                 with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
@@ -470,6 +629,9 @@ class Dynamips(IModule):
                                                                             port,
                                                                             host))
         response = {"lport": port}
+        if isinstance(node.hypervisor, RemoteHypervisor):
+            # the port is on a remote hypervisor
+            response["lhost"] = host
         return response
 
     def set_ghost_ios(self, router):
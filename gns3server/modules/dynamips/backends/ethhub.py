@@ -43,6 +43,9 @@ class ETHHUB(object):
         Mandatory request parameters:
         - name (hub name)
 
+        Optional request parameters:
+        - engine ("dynamips" or "native")
+
         Response parameters:
         - id (hub identifier)
         - name (hub name)
@@ -56,10 +59,7 @@ class ETHHUB(object):
 
         name = request["name"]
         try:
-            if not self._hypervisor_manager:
-                self.start_hypervisor_manager()
-
-            hypervisor = self._hypervisor_manager.allocate_hypervisor_for_simulated_device()
+            hypervisor = self.allocate_hypervisor_for_simulated_device(request.get("engine"))
             ethhub = Hub(hypervisor, name)
         except DynamipsError as e:
             self.send_custom_error(str(e))
@@ -97,7 +97,7 @@ class ETHHUB(object):
 
         try:
             ethhub.delete()
-            self._hypervisor_manager.unallocate_hypervisor_for_simulated_device(ethhub)
+            self.unallocate_hypervisor_for_simulated_device(ethhub)
             del self._ethernet_hubs[ethhub_id]
         except DynamipsError as e:
             self.send_custom_error(str(e))
@@ -43,6 +43,9 @@ class ETHSW(object):
         Mandatory request parameters:
         - name (switch name)
 
+        Optional request parameters:
+        - engine ("dynamips" or "native")
+
         Response parameters:
         - id (switch identifier)
         - name (switch name)
@@ -56,10 +59,7 @@ class ETHSW(object):
 
         name = request["name"]
         try:
-            if not self._hypervisor_manager:
-                self.start_hypervisor_manager()
-
-            hypervisor = self._hypervisor_manager.allocate_hypervisor_for_simulated_device()
+            hypervisor = self.allocate_hypervisor_for_simulated_device(request.get("engine"))
             ethsw = EthernetSwitch(hypervisor, name)
         except DynamipsError as e:
             self.send_custom_error(str(e))
@@ -97,7 +97,7 @@ class ETHSW(object):
 
         try:
             ethsw.delete()
-            self._hypervisor_manager.unallocate_hypervisor_for_simulated_device(ethsw)
+            self.unallocate_hypervisor_for_simulated_device(ethsw)
             del self._ethernet_switches[ethsw_id]
         except DynamipsError as e:
             self.send_custom_error(str(e))
@@ -134,20 +134,15 @@ class ETHSW(object):
         if "ports" in request:
             ports = request["ports"]
 
-            # update the port settings
+            # update the port settings (only what has changed is sent to Dynamips)
+            mapping = {}
             for port, info in ports.items():
-                vlan = info["vlan"]
-                port_type = info["type"]
-                try:
-                    if port_type == "access":
-                        ethsw.set_access_port(int(port), vlan)
-                    elif port_type == "dot1q":
-                        ethsw.set_dot1q_port(int(port), vlan)
-                    elif port_type == "qinq":
-                        ethsw.set_qinq_port(int(port), vlan)
-                except DynamipsError as e:
-                    self.send_custom_error(str(e))
-                    return
+                mapping[int(port)] = (info["type"], info["vlan"])
+            try:
+                ethsw.update_mapping(mapping)
+            except DynamipsError as e:
+                self.send_custom_error(str(e))
+                return
 
         response = {}
         # rename the switch if requested
@@ -19,8 +19,11 @@ import os
 import ntpath
 import time
 from gns3server.modules import IModule
-from gns3dms.cloud.rackspace_ctrl import get_provider
 from ..dynamips_error import DynamipsError
+from ..remote_hypervisor import RemoteHypervisor
+from ...image_cache import ImageCache, ImageCacheError
+from ...process_log import MAX_PAGE_SIZE
+from ...console_watcher import ConsoleWatchError
 
 from ..nodes.c1700 import C1700
 from ..nodes.c2600 import C2600
@@ -62,6 +65,10 @@ from ..schemas.vm import VM_START_CAPTURE_SCHEMA
 from ..schemas.vm import VM_STOP_CAPTURE_SCHEMA
 from ..schemas.vm import VM_SAVE_CONFIG_SCHEMA
 from ..schemas.vm import VM_EXPORT_CONFIG_SCHEMA
+from ..schemas.vm import VM_RESOURCE_USAGE_SCHEMA
+from ..schemas.vm import VM_PROCESS_LOG_SCHEMA
+from ..schemas.vm import VM_CONSOLE_WATCH_SCHEMA
+from ..schemas.vm import VM_CONSOLE_UNWATCH_SCHEMA
 from ..schemas.vm import VM_IDLEPCS_SCHEMA
 from ..schemas.vm import VM_AUTO_IDLEPC_SCHEMA
 from ..schemas.vm import VM_ALLOCATE_UDP_PORT_SCHEMA
@@ -105,6 +112,25 @@ PLATFORMS = {'c1700': C1700,
 
 class VM(object):
 
+    def _console_matched(self, router, watch_id, pattern, session):
+        """
+        Callback for the patterns found in the console output.
+        Called from the console hub thread, the notification is
+        sent from the I/O loop to the client that registered the watch.
+
+        :param router: Router instance
+        :param watch_id: watch identifier
+        :param pattern: pattern found
+        :param session: session of the client that registered the watch
+        """
+
+        notification = {"module": self.name,
+                        "id": router.id,
+                        "name": router.name,
+                        "watch_id": watch_id,
+                        "pattern": pattern}
+        self._ioloop.add_callback(self.send_notification, "{}.console_match".format(self.name), notification, session)
+
     @IModule.route("dynamips.vm.create")
     def vm_create(self, request):
         """
@@ -133,31 +159,54 @@ class VM(object):
         if not self.validate_request(request, VM_CREATE_SCHEMA):
             return
 
-        name = request["name"]
-        platform = request["platform"]
-        image = request["image"]
-        ram = request["ram"]
-        hypervisor = None
-        chassis = request.get("chassis")
-        router_id = request.get("router_id")
-
         # Locate the image
+        image = request["image"]
         updated_image_path = os.path.join(self.images_directory, image)
         if os.path.isfile(updated_image_path):
             image = updated_image_path
         else:
-            if not os.path.exists(self.images_directory):
-                os.mkdir(self.images_directory)
             cloud_path = request.get("cloud_path", None)
             if cloud_path is not None:
-                # Download the image from cloud files
+                # download the image from cloud files in the background
                 _, filename = ntpath.split(image)
                 src = '{}/{}'.format(cloud_path, filename)
-                provider = get_provider(self._cloud_settings)
                 log.debug("Downloading file from {} to {}...".format(src, updated_image_path))
-                provider.download_file(src, updated_image_path)
-                log.debug("Download of {} complete.".format(src))
-                image = updated_image_path
+                future = ImageCache.instance().fetch(src, updated_image_path)
+                self.add_future(future, lambda future: self._vm_image_fetched(request, future))
+                return
+
+        self._create_vm(request, image)
+
+    def _vm_image_fetched(self, request, future):
+        """
+        Creates a VM (router) once its image has been downloaded.
+
+        :param request: JSON request
+        :param future: Future with the path to the image
+        """
+
+        try:
+            image = future.result()
+        except ImageCacheError as e:
+            self.send_custom_error(str(e))
+            return
+        log.debug("Download of {} complete.".format(image))
+        self._create_vm(request, image)
+
+    def _create_vm(self, request, image):
+        """
+        Creates a VM (router) and sends the response.
+
+        :param request: JSON request
+        :param image: path to the IOS image
+        """
+
+        name = request["name"]
+        platform = request["platform"]
+        ram = request["ram"]
+        hypervisor = None
+        chassis = request.get("chassis")
+        router_id = request.get("router_id")
 
         try:
             if platform not in PLATFORMS:
@@ -219,6 +268,10 @@ class VM(object):
                     "id": router.id}
         defaults = router.defaults()
         response.update(defaults)
+        if isinstance(hypervisor, RemoteHypervisor):
+            # the consoles are served by the remote host
+            response["console_host"] = hypervisor.host
+        router.set_console_match_callback(self._console_matched)
         self._routers[router.id] = router
         self.send_response(response)
 
@@ -656,6 +709,149 @@ class VM(object):
         else:
             self.send_response(response)
 
+    @IModule.route("dynamips.vm.resource_usage")
+    def vm_resource_usage(self, request):
+        """
+        Gets the resource usage of the hypervisor process running a VM (router).
+
+        Mandatory request parameters:
+        - id (vm identifier)
+
+        Response parameters:
+        - id (vm identifier)
+        - controlled (either the resource limits are enforced with cgroups)
+        - usage (CPU time, throttling and memory counters of the hypervisor)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VM_RESOURCE_USAGE_SCHEMA):
+            return
+
+        # get the router instance
+        router = self.get_device_instance(request["id"], self._routers)
+        if not router:
+            return
+
+        self.send_response({"id": request["id"],
+                            "controlled": router.hypervisor.resources_controlled,
+                            "usage": router.hypervisor.resource_usage()})
+
+    @IModule.route("dynamips.vm.process_log")
+    def vm_process_log(self, request):
+        """
+        Reads a page of the log of the hypervisor process running a VM (router) (standard output
+        and error, rotated logs included).
+
+        Mandatory request parameters:
+        - id (vm identifier)
+
+        Optional request parameters:
+        - offset (position in the log, from the end if negative, the last page by default)
+        - size (maximum number of bytes to return)
+
+        Response parameters:
+        - id (vm identifier)
+        - log (text)
+        - offset (position of the page in the log)
+        - size (offset of the end of the log, the offsets are stable across rotations)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VM_PROCESS_LOG_SCHEMA):
+            return
+
+        # get the router instance
+        router = self.get_device_instance(request["id"], self._routers)
+        if not router:
+            return
+
+        text, offset, size = router.hypervisor.read_log(request.get("offset"), request.get("size", MAX_PAGE_SIZE))
+        self.send_response({"id": request["id"],
+                            "log": text,
+                            "offset": offset,
+                            "size": size})
+
+    @IModule.route("dynamips.vm.console_watch")
+    def vm_console_watch(self, request):
+        """
+        Watches the console output of a VM (router) for a pattern
+        (the dynamips.console_match notification is sent when it is found).
+
+        Mandatory request parameters:
+        - id (vm identifier)
+        - pattern (text to look for)
+
+        Optional request parameters:
+        - once (remove the watch after the first match, true by default)
+        - scrollback (also look in the recent console output, true by default)
+        - take_console (read the console, no other client can connect while watching, false by default)
+
+        Response parameters:
+        - id (vm identifier)
+        - watch_id (watch identifier)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VM_CONSOLE_WATCH_SCHEMA):
+            return
+
+        # get the router instance
+        router = self.get_device_instance(request["id"], self._routers)
+        if not router:
+            return
+
+        watcher = router.console_watcher
+        try:
+            watch_id = watcher.add(request["pattern"],
+                                   request.get("once", True),
+                                   request.get("scrollback", True),
+                                   self._current_session,
+                                   request.get("take_console", False))
+        except ConsoleWatchError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response({"id": request["id"],
+                            "watch_id": watch_id})
+
+    @IModule.route("dynamips.vm.console_unwatch")
+    def vm_console_unwatch(self, request):
+        """
+        Stops watching the console output of a VM (router).
+
+        Mandatory request parameters:
+        - id (vm identifier)
+
+        Optional request parameters:
+        - watch_id (watch identifier, all the watches by default)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VM_CONSOLE_UNWATCH_SCHEMA):
+            return
+
+        # get the router instance
+        router = self.get_device_instance(request["id"], self._routers)
+        if not router:
+            return
+
+        if "watch_id" not in request:
+            router.console_watcher.clear()
+        elif not router.console_watcher.remove(request["watch_id"]):
+            self.send_custom_error("Watch {} doesn't exist".format(request["watch_id"]))
+            return
+        self.send_response(True)
+
     @IModule.route("dynamips.vm.idlepcs")
     def vm_idlepcs(self, request):
         """
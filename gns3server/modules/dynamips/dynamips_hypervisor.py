@@ -25,6 +25,7 @@ import re
 import logging
 from .dynamips_error import DynamipsError
 from .nios.nio_udp_auto import NIO_UDP_auto
+from ..attic import find_unused_port
 
 log = logging.getLogger(__name__)
 
@@ -419,6 +420,20 @@ class DynamipsHypervisor(object):
         else:
             return None
 
+    def find_unused_port(self, start_port, end_port, ignore_ports=[]):
+        """
+        Finds an unused TCP port on the host of this hypervisor
+        (e.g. for a console).
+
+        :param start_port: first port in the range
+        :param end_port: last port in the range
+        :param ignore_ports: list of port to ignore within the range
+
+        :returns: port number (integer)
+        """
+
+        return find_unused_port(start_port, end_port, self._host, ignore_ports=ignore_ports)
+
     def allocate_udp_port(self):
         """
         Allocates a new UDP port for creating an UDP NIO Auto.
@@ -523,3 +538,64 @@ class DynamipsHypervisor(object):
 
         log.debug("returned result {}".format(data))
         return data
+
+    def send_batch(self, commands):
+        """
+        Sends several commands to this hypervisor in one go (pipelined)
+        and collects all the responses in one round trip.
+
+        Dynamips processes the commands in order, a failed command doesn't
+        prevent the next ones from being executed.
+
+        :param commands: list of Dynamips hypervisor commands
+
+        :returns: list with the result of each command (list of lines)
+        or a DynamipsError instance if the command has failed
+        """
+
+        if not commands:
+            return []
+
+        if not self._socket:
+            raise DynamipsError("Not connected")
+
+        payload = "".join(command.strip() + '\n' for command in commands)
+        try:
+            log.debug("sending batch of {} commands:\n{}".format(len(commands), payload))
+            self.socket.sendall(payload.encode('utf-8'))
+        except OSError as e:
+            raise DynamipsError("Lost communication with {host}:{port} :{error}, Dynamips process running: {run}"
+                                .format(host=self._host, port=self._port, error=e, run=self.is_running()))
+
+        results = []
+        data = []
+        buf = ''
+        while len(results) < len(commands):
+            try:
+                chunk = self.socket.recv(1024)  # match to Dynamips' buffer size
+            except OSError as e:
+                raise DynamipsError("Communication timed out with {host}:{port} :{error}, Dynamips process running: {run}"
+                                    .format(host=self._host, port=self._port, error=e, run=self.is_running()))
+            if not chunk:
+                raise DynamipsError("Could not communicate with {host}:{port}, Dynamips process running: {run}"
+                                    .format(host=self._host, port=self._port, run=self.is_running()))
+
+            buf += chunk.decode("utf-8")
+            lines = buf.split('\r\n')
+            buf = lines.pop()  # incomplete line (if any)
+            for line in lines:
+                if self.error_re.search(line):
+                    results.append(DynamipsError(line[4:]))
+                    data = []
+                elif line[:4] == '100-':
+                    if line[4:] != 'OK':
+                        data.append(line[4:])
+                    results.append(data)
+                    data = []
+                elif self.success_re.search(line):
+                    data.append(line[4:])
+                else:
+                    data.append(line)
+
+        log.debug("returned batch results {}".format(results))
+        return results
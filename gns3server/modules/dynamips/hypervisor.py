@@ -19,13 +19,14 @@
 Represents a Dynamips hypervisor and starts/stops the associated Dynamips process.
 """
 
-import os
 import time
 import subprocess
 import tempfile
 
 from .dynamips_hypervisor import DynamipsHypervisor
 from .dynamips_error import DynamipsError
+from ..cgroups import NodeResources, CgroupError
+from ..process_log import ProcessLog, MAX_PAGE_SIZE
 
 import logging
 log = logging.getLogger(__name__)
@@ -54,8 +55,9 @@ class Hypervisor(DynamipsHypervisor):
         self._path = path
         self._command = []
         self._process = None
-        self._stdout_file = ""
+        self._stdout_log = None
         self._started = False
+        self._resources = NodeResources("dynamips-{}".format(port))
 
         # settings used the load-balance hypervisors
         # (for the hypervisor manager)
@@ -195,6 +197,48 @@ class Hypervisor(DynamipsHypervisor):
 
         return self._memory_load
 
+    @property
+    def resources(self):
+        """
+        Returns the resource limits of the Dynamips process.
+
+        :returns: dictionary (cpu_limit, cpu_weight, memory_limit, cpuset)
+        """
+
+        return self._resources.settings
+
+    @resources.setter
+    def resources(self, resources):
+        """
+        Sets the resource limits of the Dynamips process (enforced with cgroups v2).
+
+        :param resources: dictionary (cpu_limit, cpu_weight, memory_limit, cpuset)
+        """
+
+        try:
+            self._resources.update(resources)
+        except CgroupError as e:
+            raise DynamipsError(str(e))
+
+    @property
+    def resources_controlled(self):
+        """
+        Returns either the Dynamips process is in a cgroup.
+
+        :returns: boolean
+        """
+
+        return self._resources.attached
+
+    def resource_usage(self):
+        """
+        Returns the resource usage of the Dynamips process.
+
+        :returns: dictionary (empty if the process is not in a cgroup)
+        """
+
+        return self._resources.usage()
+
     def start(self):
         """
         Starts the Dynamips hypervisor process.
@@ -204,14 +248,16 @@ class Hypervisor(DynamipsHypervisor):
         try:
             log.info("starting Dynamips: {}".format(self._command))
             with tempfile.NamedTemporaryFile(delete=False) as fd:
-                self._stdout_file = fd.name
-                log.info("Dynamips process logging to {}".format(fd.name))
+                self._stdout_log = ProcessLog(fd.name)
+            log.info("Dynamips process logging to {}".format(self._stdout_log.path))
+            with self._stdout_log.open() as fd:
                 self._process = subprocess.Popen(self._command,
                                                  stdout=fd,
                                                  stderr=subprocess.STDOUT,
                                                  cwd=self._working_dir)
             log.info("Dynamips started PID={}".format(self._process.pid))
             self._started = True
+            self._resources.attach(self._process.pid)
         except (OSError, subprocess.SubprocessError) as e:
             log.error("could not start Dynamips: {}".format(e))
             raise DynamipsError("could not start Dynamips: {}".format(e))
@@ -235,27 +281,34 @@ class Hypervisor(DynamipsHypervisor):
                 if self._process.poll() is None:
                     log.warn("Dynamips process {} is still running".format(self._process.pid))
 
-        if self._stdout_file and os.access(self._stdout_file, os.W_OK):
-            try:
-                os.remove(self._stdout_file)
-            except OSError as e:
-                log.warning("could not delete temporary Dynamips log file: {}".format(e))
+        if self._stdout_log:
+            self._stdout_log.delete()
         self._started = False
+        self._resources.release()
 
     def read_stdout(self):
         """
-        Reads the standard output of the Dynamips process.
+        Reads the end of the standard output of the Dynamips process.
         Only use when the process has been stopped or has crashed.
         """
 
-        output = ""
-        if self._stdout_file and os.access(self._stdout_file, os.R_OK):
-            try:
-                with open(self._stdout_file, errors="replace") as file:
-                    output = file.read()
-            except OSError as e:
-                log.warn("could not read {}: {}".format(self._stdout_file, e))
-        return output
+        if self._stdout_log:
+            return self._stdout_log.tail()
+        return ""
+
+    def read_log(self, offset=None, size=MAX_PAGE_SIZE):
+        """
+        Reads a page of the output of the Dynamips process.
+
+        :param offset: position in the log, from the end if negative (the last page by default)
+        :param size: maximum number of bytes
+
+        :returns: tuple (text, offset of the page, offset of the end of the log)
+        """
+
+        if self._stdout_log:
+            return self._stdout_log.read(offset, size)
+        return "", 0, 0
 
     def is_running(self):
         """
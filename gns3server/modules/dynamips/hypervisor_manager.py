@@ -21,14 +21,18 @@ Manages Dynamips hypervisors (load-balancing etc.)
 
 from gns3server.config import Config
 from .hypervisor import Hypervisor
+from .remote_hypervisor import RemoteHypervisor
 from .dynamips_error import DynamipsError
 from ..attic import find_unused_port
 from ..attic import wait_socket_is_ready
+from ..attic import call_in_parallel
 from pkg_resources import parse_version
 
 import os
 import time
+import socket
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 log = logging.getLogger(__name__)
 
@@ -46,6 +50,10 @@ class HypervisorManager(object):
     def __init__(self, path, working_dir, host='127.0.0.1', console_host='0.0.0.0'):
 
         self._hypervisors = []
+        self._farm = []
+        self._farm_addresses = {}
+        self._farm_checks = set()
+        self._farm_executor = None
         self._path = path
         self._working_dir = working_dir
         self._console_host = console_host
@@ -68,6 +76,7 @@ class HypervisorManager(object):
         self._allocate_hypervisor_per_device = dynamips_config.get("allocate_hypervisor_per_device", True)
         self._memory_usage_limit_per_hypervisor = dynamips_config.get("memory_usage_limit_per_hypervisor", 1024)
         self._allocate_hypervisor_per_ios_image = dynamips_config.get("allocate_hypervisor_per_ios_image", True)
+        self._farm_address = dynamips_config.get("farm_address")
 
     def __del__(self):
         """
@@ -86,6 +95,16 @@ class HypervisorManager(object):
 
         return self._hypervisors
 
+    @property
+    def farm(self):
+        """
+        Returns the remote hypervisors (hypervisor farm).
+
+        :returns: list of RemoteHypervisor instances
+        """
+
+        return self._farm
+
     @property
     def path(self):
         """
@@ -131,6 +150,9 @@ class HypervisorManager(object):
         # update all existing hypervisors with the new working directory
         for hypervisor in self._hypervisors:
             hypervisor.working_dir = self._working_dir
+        for hypervisor in self._farm:
+            if hypervisor not in self._hypervisors:
+                hypervisor.working_dir = self._working_dir
 
     @property
     def hypervisor_start_port_range(self):
@@ -561,6 +583,185 @@ class HypervisorManager(object):
         self._hypervisors.append(hypervisor)
         return hypervisor
 
+    def add_remote_hypervisor(self, host, port, ram=4096, cpus=1):
+        """
+        Registers an hypervisor running on another host (started outside of GNS3).
+
+        :param host: host/address of the remote hypervisor
+        :param port: port of the remote hypervisor
+        :param ram: amount of RAM available for the routers (MB)
+        :param cpus: number of CPUs available for the routers
+
+        :returns: the RemoteHypervisor instance
+        """
+
+        for hypervisor in self._farm:
+            if hypervisor.host == host and hypervisor.port == port:
+                hypervisor.ram = ram
+                hypervisor.cpus = cpus
+                return hypervisor
+
+        hypervisor = RemoteHypervisor(self._working_dir, host, port, ram, cpus)
+        hypervisor.console_start_port_range = self._console_start_port_range
+        hypervisor.console_end_port_range = self._console_end_port_range
+        hypervisor.aux_start_port_range = self._aux_start_port_range
+        hypervisor.aux_end_port_range = self._aux_end_port_range
+        hypervisor.udp_start_port_range = self._udp_start_port_range
+        hypervisor.udp_end_port_range = self._udp_end_port_range
+        try:
+            hypervisor.connect()
+            if parse_version(hypervisor.version) < parse_version('0.2.11'):
+                log.warning("remote hypervisor {}:{} runs Dynamips {}, version must be >= 0.2.11".format(host, port, hypervisor.version))
+        except DynamipsError as e:
+            # registered anyway, the health checks will try to connect again
+            log.error("could not connect to remote hypervisor {}:{}: {}".format(host, port, e))
+
+        log.info("remote hypervisor {}:{} added to the farm (RAM={}MB, CPUs={})".format(host, port, ram, cpus))
+        self._farm.append(hypervisor)
+        return hypervisor
+
+    def remove_remote_hypervisor(self, host, port):
+        """
+        Unregisters a remote hypervisor, the remote process keeps running.
+
+        :param host: host/address of the remote hypervisor
+        :param port: port of the remote hypervisor
+        """
+
+        for hypervisor in self._farm:
+            if hypervisor.host == host and hypervisor.port == port:
+                if hypervisor.devices:
+                    raise DynamipsError("Remote hypervisor {}:{} still has {} devices".format(host, port, len(hypervisor.devices)))
+                if hypervisor in self._hypervisors:
+                    hypervisor.stop()
+                    self._hypervisors.remove(hypervisor)
+                hypervisor.disconnect()
+                self._farm.remove(hypervisor)
+                log.info("remote hypervisor {}:{} removed from the farm".format(host, port))
+                return
+
+    def check_farm(self, add_future):
+        """
+        Checks the health of the remote hypervisors: the probes run
+        in worker threads and their results are applied by the module
+        loop (the lost connections are opened again there).
+
+        :param add_future: callable(future, callback) calling back in the module loop (IModule.add_future)
+        """
+
+        if self._farm_executor is None:
+            self._farm_executor = ThreadPoolExecutor(max_workers=8)
+        for hypervisor in self._farm:
+            if hypervisor in self._farm_checks or not hypervisor.probe_due():
+                continue
+            self._farm_checks.add(hypervisor)
+            future = self._farm_executor.submit(hypervisor.probe)
+            add_future(future, lambda future, hypervisor=hypervisor: self._farm_checked(hypervisor, future))
+
+    def _farm_checked(self, hypervisor, future):
+        """
+        Applies the result of a probe (module loop).
+
+        :param hypervisor: RemoteHypervisor instance
+        :param future: future of the probe
+        """
+
+        self._farm_checks.discard(hypervisor)
+        if hypervisor in self._farm:
+            hypervisor.probe_done(future.exception())
+
+    def unhealthy_hypervisors(self):
+        """
+        Returns the remote hypervisors which failed their last check.
+
+        :returns: list of RemoteHypervisor instances
+        """
+
+        return [hypervisor for hypervisor in self._farm if not hypervisor.healthy]
+
+    def farm_status(self):
+        """
+        Returns the health and capacity reports of the remote hypervisors.
+
+        :returns: list of dictionaries
+        """
+
+        return [hypervisor.status() for hypervisor in self._farm]
+
+    def _allocate_remote_hypervisor(self, ram):
+        """
+        Places a router on the least loaded remote hypervisor
+        with enough RAM left (the highest of the RAM and CPU loads is compared).
+
+        :param ram: amount of RAM (integer)
+
+        :returns: RemoteHypervisor instance or None if the farm is full
+        """
+
+        candidates = [hypervisor for hypervisor in self._farm if hypervisor.can_host(ram)]
+        if not candidates:
+            return None
+
+        hypervisor = min(candidates, key=lambda hypervisor: hypervisor.load_with(ram))
+        if not hypervisor.started:
+            hypervisor.start()
+        if hypervisor not in self._hypervisors:
+            self._hypervisors.append(hypervisor)
+        current_memory_load = hypervisor.memory_load
+        hypervisor.increase_memory_load(ram)
+        log.info("allocating remote hypervisor {}:{}, RAM={}+{}".format(hypervisor.host,
+                                                                        hypervisor.port,
+                                                                        current_memory_load,
+                                                                        ram))
+        return hypervisor
+
+    def _local_address_for(self, hypervisor):
+        """
+        Returns the address of this server as seen from a remote hypervisor
+        (farm_address setting or the address routing to the remote host).
+
+        :param hypervisor: RemoteHypervisor instance
+
+        :returns: host/address
+        """
+
+        if self._farm_address:
+            return self._farm_address
+        if hypervisor.host not in self._farm_addresses:
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.connect((hypervisor.host, hypervisor.port))
+                    self._farm_addresses[hypervisor.host] = sock.getsockname()[0]
+            except OSError as e:
+                raise DynamipsError("Could not find the address of this server for {}: {}".format(hypervisor.host, e))
+        return self._farm_addresses[hypervisor.host]
+
+    def udp_peer_address(self, hypervisor, rhost, rport):
+        """
+        Returns the address a NIO UDP must send to: the client knows the
+        UDP ports of the remote hypervisors with the address of this server.
+
+        :param hypervisor: hypervisor of the NIO
+        :param rhost: remote address given by the client
+        :param rport: remote port given by the client
+
+        :returns: host/address
+        """
+
+        if not self._farm:
+            return rhost
+
+        local_addresses = ("127.0.0.1", "::1", "localhost", "0.0.0.0", "::", self._host, self._console_host)
+        for remote in self._farm:
+            if remote.owns_udp_port(rport) and (rhost == remote.host or rhost in local_addresses):
+                # the other end is on a remote hypervisor
+                return remote.host
+
+        if isinstance(hypervisor, RemoteHypervisor) and rhost in local_addresses:
+            # the other end is on this server
+            return self._local_address_for(hypervisor)
+        return rhost
+
     def allocate_hypervisor_for_router(self, router_ios_image, router_ram):
         """
         Allocates a Dynamips hypervisor for a specific router
@@ -572,9 +773,19 @@ class HypervisorManager(object):
         :returns: the allocated hypervisor instance
         """
 
+        if self._farm:
+            hypervisor = self._allocate_remote_hypervisor(router_ram)
+            if hypervisor:
+                return hypervisor
+            if not self._path or not os.path.isfile(self._path):
+                raise DynamipsError("No remote hypervisor can host a router with {}MB of RAM".format(router_ram))
+            log.warning("the hypervisor farm is full, starting a local hypervisor")
+
         # allocate an hypervisor for each router by default
         if not self._allocate_hypervisor_per_device:
             for hypervisor in self._hypervisors:
+                if isinstance(hypervisor, RemoteHypervisor):
+                    continue
                 if self._allocate_hypervisor_per_ios_image:
                     if not hypervisor.image_ref:
                         hypervisor.image_ref = router_ios_image
@@ -629,6 +840,11 @@ class HypervisorManager(object):
         if self._hypervisors:
             return self._hypervisors[0]
 
+        if self._farm:
+            hypervisor = self._allocate_remote_hypervisor(0)
+            if hypervisor:
+                return hypervisor
+
         # no hypervisor, let's start one!
         return self.start_new_hypervisor()
 
@@ -646,9 +862,16 @@ class HypervisorManager(object):
 
     def stop_all_hypervisors(self):
         """
-        Stops all hypervisors.
+        Stops all hypervisors (in parallel), the remote hypervisors
+        are reset and keep running.
         """
 
-        for hypervisor in self._hypervisors:
-            hypervisor.stop()
+        for hypervisor, e in call_in_parallel(lambda hypervisor: hypervisor.stop(), self._hypervisors):
+            log.error("could not stop hypervisor {}:{}: {}".format(hypervisor.host, hypervisor.port, e))
         self._hypervisors = []
+        for hypervisor in self._farm:
+            hypervisor.disconnect()
+        if self._farm_executor is not None:
+            self._farm_executor.shutdown(wait=False)
+            self._farm_executor = None
+            self._farm_checks.clear()
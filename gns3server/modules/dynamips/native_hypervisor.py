@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stand-in for a Dynamips hypervisor running Ethernet switches and hubs
+in the native switching fabric (no Dynamips process involved).
+"""
+
+import shlex
+import threading
+
+from .dynamips_hypervisor import DynamipsHypervisor
+from .dynamips_error import DynamipsError
+from ..fabric import Fabric, FabricError, EthernetSwitch, Hub
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class NativeHypervisor(DynamipsHypervisor):
+    """
+    Executes the Dynamips hypervisor commands used by the Ethernet switch
+    and hub devices (modules "nio", "ethsw" and "nio_bridge") with the
+    native switching fabric, so these devices can be used unchanged.
+
+    :param working_dir: working directory
+    :param host: address to bind the UDP tunnels
+    :param shards: number of forwarding threads (see Fabric)
+    """
+
+    # Dynamips filter directions
+    _directions = {"0": "in", "1": "out", "2": "both"}
+
+    def __init__(self, working_dir, host, shards=1):
+
+        DynamipsHypervisor.__init__(self, working_dir, host, port=None)
+        self._fabric = Fabric(shards)
+        self._version = "native"
+        self._captures = {}
+        self._no_lock = threading.Lock()
+
+    @property
+    def fabric(self):
+        """
+        Returns the switching fabric.
+
+        :returns: Fabric instance
+        """
+
+        return self._fabric
+
+    @property
+    def started(self):
+
+        return True
+
+    def is_running(self):
+
+        return True
+
+    def connect(self):
+
+        pass
+
+    def close(self):
+
+        pass
+
+    def stop(self):
+        """
+        Stops the switching fabric.
+        """
+
+        self._fabric.stop()
+        self._captures.clear()
+        self._nio_udp_auto_instances.clear()
+
+    def reset(self):
+        """
+        Deletes all the devices and NIOs.
+        """
+
+        self._fabric.reset()
+        self._captures.clear()
+        self._nio_udp_auto_instances.clear()
+
+    def send(self, command):
+        """
+        Executes a Dynamips hypervisor command.
+
+        :param command: a Dynamips hypervisor command
+
+        :returns: results as a list
+        """
+
+        log.debug("native hypervisor: executing {}".format(command))
+        try:
+            args = shlex.split(command)
+        except ValueError:
+            args = command.split()
+        if len(args) < 2:
+            raise DynamipsError("Invalid command: {}".format(command))
+
+        handler = getattr(self, "_{}_{}".format(args[0], args[1]), None)
+        if handler is None:
+            raise DynamipsError("{} {} is not supported by the native switching engine".format(args[0], args[1]))
+        try:
+            result = handler(*args[2:])
+        except FabricError as e:
+            raise DynamipsError(str(e))
+        except (TypeError, ValueError) as e:
+            raise DynamipsError("Invalid command {}: {}".format(command, e))
+        return result if result is not None else []
+
+    def send_batch(self, commands):
+
+        results = []
+        for command in commands:
+            try:
+                results.append(self.send(command))
+            except DynamipsError as e:
+                results.append(e)
+        return results
+
+    def _port_lock(self, port):
+        """
+        Returns the lock protecting a port.
+
+        :param port: Port instance
+
+        :returns: lock
+        """
+
+        if port.node is not None:
+            return port.node.shard.lock
+        return self._no_lock
+
+    # "hypervisor" module
+
+    def _hypervisor_version(self):
+
+        return [self._version]
+
+    def _hypervisor_working_dir(self, working_dir):
+
+        pass
+
+    # "nio" module
+
+    def _nio_list(self):
+
+        return list(self._fabric.ports.keys())
+
+    def _nio_create_udp(self, name, lport, rhost, rport):
+
+        self._fabric.create_udp_port(name, self._host, int(lport), rhost, int(rport))
+
+    def _nio_create_udp_auto(self, name, laddr, lport_start, lport_end):
+
+        port = self._fabric.create_udp_auto_port(name, laddr, int(lport_start), int(lport_end))
+        return [str(port.lport)]
+
+    def _nio_connect_udp_auto(self, name, raddr, rport):
+
+        self._fabric.get_port(name).connect(raddr, int(rport))
+
+    def _nio_create_null(self, name):
+
+        self._fabric.create_null_port(name)
+
+    def _nio_create_tap(self, name, tap_device):
+
+        self._fabric.create_tap_port(name, tap_device)
+
+    def _nio_create_gen_eth(self, name, ethernet_device):
+
+        # raw packet socket, there is no pcap/WinPcap access in the fabric
+        self._fabric.create_ethernet_port(name, ethernet_device)
+
+    def _nio_create_linux_eth(self, name, ethernet_device):
+
+        self._fabric.create_ethernet_port(name, ethernet_device)
+
+    def _nio_delete(self, name):
+
+        self._fabric.delete_port(name)
+        self._captures.pop(name, None)
+
+    def _nio_rename(self, name, new_name):
+
+        self._fabric.rename_port(name, new_name)
+
+    def _nio_set_debug(self, name, debug):
+
+        self._fabric.get_port(name)
+
+    def _nio_bind_filter(self, name, direction, filter_name):
+
+        self._fabric.get_port(name)
+        if filter_name != "capture":
+            raise FabricError("Filter {} is not supported by the native switching engine".format(filter_name))
+        self._captures[name] = self._directions[direction]
+
+    def _nio_setup_filter(self, name, direction, data_link_type, *path):
+
+        port = self._fabric.get_port(name)
+        if name not in self._captures:
+            raise FabricError("No filter bound to NIO {}".format(name))
+        with self._port_lock(port):
+            port.start_capture(self._directions[direction], " ".join(path), data_link_type)
+
+    def _nio_unbind_filter(self, name, direction):
+
+        port = self._fabric.get_port(name)
+        with self._port_lock(port):
+            port.stop_capture(self._directions[direction])
+        self._captures.pop(name, None)
+
+    def _nio_get_stats(self, name):
+
+        port = self._fabric.get_port(name)
+        return ["{} {} {} {}".format(port.packets_in, port.packets_out, port.bytes_in, port.bytes_out)]
+
+    def _nio_reset_stats(self, name):
+
+        self._fabric.get_port(name).reset_stats()
+
+    # "ethsw" module
+
+    def _ethsw_list(self):
+
+        return [name for name, node in self._fabric.nodes.items() if isinstance(node, EthernetSwitch)]
+
+    def _ethsw_create(self, name):
+
+        self._fabric.add_node(EthernetSwitch(name))
+
+    def _ethsw_delete(self, name):
+
+        self._fabric.delete_node(name)
+
+    def _ethsw_rename(self, name, new_name):
+
+        self._fabric.rename_node(name, new_name)
+
+    def _ethsw_add_nio(self, name, nio):
+
+        self._fabric.bind(name, nio)
+
+    def _ethsw_remove_nio(self, name, nio):
+
+        self._fabric.unbind(name, nio)
+
+    def _set_port(self, name, nio, port_type, vlan):
+
+        node = self._fabric.get_node(name)
+        port = self._fabric.get_port(nio)
+        with node.shard.lock:
+            node.set_port(port, port_type, int(vlan))
+
+    def _ethsw_set_access_port(self, name, nio, vlan):
+
+        self._set_port(name, nio, "access", vlan)
+
+    def _ethsw_set_dot1q_port(self, name, nio, vlan):
+
+        self._set_port(name, nio, "dot1q", vlan)
+
+    def _ethsw_set_qinq_port(self, name, nio, vlan):
+
+        self._set_port(name, nio, "qinq", vlan)
+
+    def _ethsw_show_mac_addr_table(self, name):
+
+        node = self._fabric.get_node(name)
+        with node.shard.lock:
+            return ["{} {} {}".format(mac, vlan, port.name) for mac, vlan, port in node.mac_address_table()]
+
+    def _ethsw_clear_mac_addr_table(self, name):
+
+        node = self._fabric.get_node(name)
+        with node.shard.lock:
+            node.clear_mac_address_table()
+
+    # "nio_bridge" module (Ethernet hubs)
+
+    def _nio_bridge_list(self):
+
+        return [name for name, node in self._fabric.nodes.items() if isinstance(node, Hub)]
+
+    def _nio_bridge_create(self, name):
+
+        self._fabric.add_node(Hub(name))
+
+    def _nio_bridge_delete(self, name):
+
+        self._fabric.delete_node(name)
+
+    def _nio_bridge_rename(self, name, new_name):
+
+        self._fabric.rename_node(name, new_name)
+
+    def _nio_bridge_add_nio(self, name, nio):
+
+        self._fabric.bind(name, nio)
+
+    def _nio_bridge_remove_nio(self, name, nio):
+
+        self._fabric.unbind(name, nio)
@@ -22,6 +22,7 @@ http://github.com/GNS3/dynamips/blob/master/README.hypervisor#L558
 
 import os
 from ..dynamips_error import DynamipsError
+from ...sharding import owns
 
 import logging
 log = logging.getLogger(__name__)
@@ -42,7 +43,7 @@ class EthernetSwitch(object):
          # find an instance identifier (0 < id <= 4096)
         self._id = 0
         for identifier in range(1, 4097):
-            if identifier not in self._instances:
+            if identifier not in self._instances and owns(identifier):
                 self._id = identifier
                 self._instances.append(self._id)
                 break
@@ -273,6 +274,76 @@ class EthernetSwitch(object):
                                                                                                                        vlan_id=outer_vlan))
         self._mapping[port] = ("qinq", outer_vlan)
 
+    def _port_command(self, port, port_type, vlan):
+        """
+        Returns the hypervisor command to configure a port.
+
+        :param port: allocated port
+        :param port_type: "access", "dot1q" or "qinq"
+        :param vlan: VLAN number (access VLAN, native VLAN or outer VLAN)
+
+        :returns: hypervisor command (string)
+        """
+
+        if port_type not in ("access", "dot1q", "qinq"):
+            raise DynamipsError("Unknown port type {} for port {}".format(port_type, port))
+
+        return "ethsw set_{port_type}_port {name} {nio} {vlan}".format(port_type=port_type,
+                                                                       name=self._name,
+                                                                       nio=self._nios[port],
+                                                                       vlan=vlan)
+
+    def update_mapping(self, mapping):
+        """
+        Updates the port settings. Only the ports whose settings have changed
+        are configured, using a single batch of hypervisor commands.
+
+        The update is atomic: if a port cannot be configured, the ports
+        already changed by this update are restored to their previous settings.
+
+        :param mapping: dictionary of port -> (port type, VLAN number)
+
+        :returns: list of the ports that have been changed
+        """
+
+        changes = {}
+        for port, settings in mapping.items():
+            if port not in self._nios:
+                raise DynamipsError("Port {} is not allocated".format(port))
+            if self._mapping.get(port) != tuple(settings):
+                changes[port] = tuple(settings)
+
+        if not changes:
+            return []
+
+        ports = sorted(changes.keys())
+        commands = [self._port_command(port, *changes[port]) for port in ports]
+        results = self._hypervisor.send_batch(commands)
+
+        errors = [(port, result) for port, result in zip(ports, results) if isinstance(result, DynamipsError)]
+        if errors:
+            # restore the previous settings of the ports that have been changed
+            rollback = [port for port, result in zip(ports, results) if not isinstance(result, DynamipsError) and port in self._mapping]
+            rollback_commands = [self._port_command(port, *self._mapping[port]) for port in rollback]
+            for port, result in zip(rollback, self._hypervisor.send_batch(rollback_commands)):
+                if isinstance(result, DynamipsError):
+                    log.error("Ethernet switch {name} [id={id}]: could not restore the settings of port {port}: {error}".format(name=self._name,
+                                                                                                                               id=self._id,
+                                                                                                                               port=port,
+                                                                                                                               error=result))
+            port, error = errors[0]
+            raise DynamipsError("Could not configure port {}: {}".format(port, error))
+
+        for port in ports:
+            port_type, vlan = changes[port]
+            log.info("Ethernet switch {name} [id={id}]: port {port} set as {port_type} port with VLAN {vlan_id}".format(name=self._name,
+                                                                                                                       id=self._id,
+                                                                                                                       port=port,
+                                                                                                                       port_type=port_type,
+                                                                                                                       vlan_id=vlan))
+            self._mapping[port] = changes[port]
+        return ports
+
     def get_mac_addr_table(self):
         """
         Returns the MAC address table for this Ethernet switch.
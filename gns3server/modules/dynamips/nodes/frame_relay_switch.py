@@ -22,6 +22,7 @@ http://github.com/GNS3/dynamips/blob/master/README.hypervisor#L642
 
 import os
 from ..dynamips_error import DynamipsError
+from ...sharding import owns
 
 import logging
 log = logging.getLogger(__name__)
@@ -42,7 +43,7 @@ class FrameRelaySwitch(object):
         # find an instance identifier (0 < id <= 4096)
         self._id = 0
         for identifier in range(1, 4097):
-            if identifier not in self._instances:
+            if identifier not in self._instances and owns(identifier):
                 self._id = identifier
                 self._instances.append(self._id)
                 break
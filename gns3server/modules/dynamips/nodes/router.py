@@ -21,7 +21,8 @@ http://github.com/GNS3/dynamips/blob/master/README.hypervisor#L77
 """
 
 from ..dynamips_error import DynamipsError
-from ...attic import find_unused_port
+from ...console_watcher import ConsoleWatcher
+from ...sharding import owns
 
 import time
 import sys
@@ -59,7 +60,7 @@ class Router(object):
                 # find an instance identifier if none is provided (0 < id <= 4096)
                 self._id = 0
                 for identifier in range(1, 4097):
-                    if identifier not in self._instances:
+                    if identifier not in self._instances and owns(identifier):
                         self._id = identifier
                         self._instances.append(self._id)
                         break
@@ -102,6 +103,8 @@ class Router(object):
         self._disk1 = 0  # Megabytes
         self._confreg = "0x2102"
         self._console = None
+        self._console_watcher = ConsoleWatcher(name, self._console_matched, tapped=True)
+        self._console_match_callback = None
         self._aux = None
         self._mac_addr = None
         self._system_id = "FTX0945W0MY"  # processor board ID in IOS
@@ -118,20 +121,18 @@ class Router(object):
 
             try:
                 # allocate a console port
-                self._console = find_unused_port(self._hypervisor.console_start_port_range,
-                                                 self._hypervisor.console_end_port_range,
-                                                 self._hypervisor.host,
-                                                 ignore_ports=self._allocated_console_ports)
+                self._console = self._hypervisor.find_unused_port(self._hypervisor.console_start_port_range,
+                                                                  self._hypervisor.console_end_port_range,
+                                                                  ignore_ports=self._allocated_console_ports)
 
                 self._hypervisor.send("vm set_con_tcp_port {name} {console}".format(name=self._name,
                                                                                     console=self._console))
                 self._allocated_console_ports.append(self._console)
 
                 # allocate a auxiliary console port
-                self._aux = find_unused_port(self._hypervisor.aux_start_port_range,
-                                             self._hypervisor.aux_end_port_range,
-                                             self._hypervisor.host,
-                                             ignore_ports=self._allocated_aux_ports)
+                self._aux = self._hypervisor.find_unused_port(self._hypervisor.aux_start_port_range,
+                                                              self._hypervisor.aux_end_port_range,
+                                                              ignore_ports=self._allocated_aux_ports)
 
                 self._hypervisor.send("vm set_aux_tcp_port {name} {aux}".format(name=self._name,
                                                                                 aux=self._aux))
@@ -282,6 +283,55 @@ class Router(object):
 
         return self._hypervisor
 
+    @property
+    def resources(self):
+        """
+        Returns the resource limits of the hypervisor process running this router.
+
+        :returns: dictionary (cpu_limit, cpu_weight, memory_limit, cpuset)
+        """
+
+        return self._hypervisor.resources
+
+    @resources.setter
+    def resources(self, resources):
+        """
+        Sets the resource limits of the hypervisor process running this router
+        (shared with the other routers of the same hypervisor).
+
+        :param resources: dictionary (cpu_limit, cpu_weight, memory_limit, cpuset)
+        """
+
+        self._hypervisor.resources = resources
+        log.info("router {name} [id={id}]: resource limits set to {resources}".format(name=self._name,
+                                                                                    id=self._id,
+                                                                                    resources=resources))
+
+    @property
+    def console_watcher(self):
+        """
+        Returns the patterns watched in the console output.
+
+        :returns: ConsoleWatcher instance
+        """
+
+        return self._console_watcher
+
+    def set_console_match_callback(self, callback):
+        """
+        Sets a callback to be called when a watched pattern is found in the console output.
+        The callback is called from the console hub thread.
+
+        :param callback: callable receiving this router, the watch ID, the pattern and the watch context
+        """
+
+        self._console_match_callback = callback
+
+    def _console_matched(self, watch_id, pattern, context):
+
+        if self._console_match_callback:
+            self._console_match_callback(self, watch_id, pattern, context)
+
     def list(self):
         """
         Returns all VM instances
@@ -307,6 +357,7 @@ class Router(object):
 
         self._hypervisor.send("vm delete {}".format(self._name))
         self._hypervisor.devices.remove(self)
+        self._console_watcher.clear()
         log.info("router {name} [id={id}] has been deleted".format(name=self._name, id=self._id))
         if self._id in self._instances:
             self._instances.remove(self._id)
@@ -322,6 +373,7 @@ class Router(object):
 
         self._hypervisor.send("vm clean_delete {}".format(self._name))
         self._hypervisor.devices.remove(self)
+        self._console_watcher.clear()
 
         if self._startup_config:
             # delete the startup-config
@@ -373,6 +425,8 @@ class Router(object):
 
             self._hypervisor.send("vm start {}".format(self._name))
             log.info("router {name} [id={id}] has been started".format(name=self._name, id=self._id))
+            # the console is served by Dynamips, it is read only while patterns are watched
+            self._console_watcher.tap(self._hypervisor.host, self._console)
 
     def stop(self):
         """
@@ -383,6 +437,7 @@ class Router(object):
         if self.get_status() != "inactive":
             self._hypervisor.send("vm stop {}".format(self._name))
             log.info("router {name} [id={id}] has been stopped".format(name=self._name, id=self._id))
+        self._console_watcher.untap()
 
     def suspend(self):
         """
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Represents a Dynamips hypervisor running on another host (hypervisor farm).
+The Dynamips process is started and stopped outside of GNS3, this server
+keeps a connection to it and only creates and deletes devices.
+"""
+
+import time
+import select
+import socket
+
+from .hypervisor import Hypervisor
+from .dynamips_hypervisor import DynamipsHypervisor
+from .dynamips_error import DynamipsError
+
+import logging
+log = logging.getLogger(__name__)
+
+# maximum delay between two connection attempts to an unreachable hypervisor (seconds)
+MAX_RECONNECT_DELAY = 60
+
+# timeout of the health check connections (seconds)
+PROBE_TIMEOUT = 5.0
+
+
+class RemoteHypervisor(Hypervisor):
+    """
+    Remote hypervisor.
+
+    The remote host must see the images and the working directory
+    at the same paths as this server (shared storage).
+
+    :param working_dir: working directory
+    :param host: host/address of the remote hypervisor
+    :param port: port of the remote hypervisor
+    :param ram: amount of RAM available for the routers (MB)
+    :param cpus: number of CPUs available for the routers
+    :param timeout: timeout for the connection and the commands (seconds)
+    """
+
+    def __init__(self, working_dir, host, port, ram=4096, cpus=1, timeout=10.0):
+
+        Hypervisor.__init__(self, None, working_dir, host, port)
+        self._timeout = timeout
+        self._ram = ram
+        self._cpus = cpus
+        self._healthy = False
+        self._last_error = ""
+        self._reconnect_delay = 0
+        self._next_attempt = 0
+        self._udp_ports = set()
+
+    @property
+    def ram(self):
+        """
+        Returns the amount of RAM available for the routers.
+
+        :returns: amount of RAM (integer)
+        """
+
+        return self._ram
+
+    @ram.setter
+    def ram(self, ram):
+        """
+        Sets the amount of RAM available for the routers.
+
+        :param ram: amount of RAM (integer)
+        """
+
+        self._ram = ram
+
+    @property
+    def cpus(self):
+        """
+        Returns the number of CPUs available for the routers.
+
+        :returns: number of CPUs (integer)
+        """
+
+        return self._cpus
+
+    @cpus.setter
+    def cpus(self, cpus):
+        """
+        Sets the number of CPUs available for the routers.
+
+        :param cpus: number of CPUs (integer)
+        """
+
+        self._cpus = cpus
+
+    @property
+    def healthy(self):
+        """
+        Returns either the last health check has succeeded.
+
+        :returns: boolean
+        """
+
+        return self._healthy
+
+    @property
+    def working_dir(self):
+        """
+        Returns current working directory
+
+        :returns: path to the working directory
+        """
+
+        return self._working_dir
+
+    @working_dir.setter
+    def working_dir(self, working_dir):
+        """
+        Sets the working directory for this hypervisor
+        (sent on the next connection if disconnected).
+
+        :param working_dir: path to the working directory
+        """
+
+        if self._socket:
+            DynamipsHypervisor.working_dir.fset(self, working_dir)
+        else:
+            self._working_dir = working_dir
+
+    def can_host(self, ram):
+        """
+        Returns either a router fits in the remaining capacity.
+
+        :param ram: amount of RAM of the router (integer)
+
+        :returns: boolean
+        """
+
+        return self._healthy and self._memory_load + ram <= self._ram
+
+    def load_with(self, ram):
+        """
+        Returns the load of this hypervisor once a new router is added
+        (the highest of the RAM and CPU loads, 1.0 is the capacity).
+
+        :param ram: amount of RAM of the router (integer)
+
+        :returns: load (float)
+        """
+
+        routers = len([device for device in self._devices if hasattr(device, "ram")]) + 1
+        return max((self._memory_load + ram) / self._ram, routers / self._cpus)
+
+    def status(self):
+        """
+        Returns the health and capacity report of this hypervisor.
+
+        :returns: dictionary
+        """
+
+        return {"host": self._host,
+                "port": self._port,
+                "healthy": self._healthy,
+                "in_use": self._started,
+                "version": self._version,
+                "ram": self._ram,
+                "cpus": self._cpus,
+                "memory_load": self._memory_load,
+                "devices": len(self._devices),
+                "error": self._last_error}
+
+    def connect(self):
+        """
+        Connects to the remote hypervisor.
+        """
+
+        try:
+            DynamipsHypervisor.connect(self)
+        except DynamipsError as e:
+            self._connection_lost(e)
+            raise
+        self._healthy = True
+        self._last_error = ""
+        self._reconnect_delay = 0
+        log.info("connected to remote hypervisor {}:{} (Dynamips {})".format(self._host, self._port, self._version))
+
+    def _connection_lost(self, error):
+        """
+        Drops the connection after an error, the next
+        attempt to reconnect is delayed (exponential backoff).
+
+        :param error: exception
+        """
+
+        if self._socket:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+        if self._healthy:
+            log.warning("lost connection to remote hypervisor {}:{}: {}".format(self._host, self._port, error))
+        self._healthy = False
+        self._last_error = "Remote hypervisor {}:{} is unreachable: {}".format(self._host, self._port, error)
+        self._reconnect_delay = min(max(1, self._reconnect_delay * 2), MAX_RECONNECT_DELAY)
+        self._next_attempt = time.monotonic() + self._reconnect_delay
+
+    def probe_due(self):
+        """
+        Returns either the hypervisor should be probed now
+        (the attempts to reach a lost hypervisor are delayed).
+
+        :returns: boolean
+        """
+
+        return self._socket is not None or time.monotonic() >= self._next_attempt
+
+    def probe(self):
+        """
+        Checks that the remote hypervisor answers, on a short-lived
+        connection of its own: it can run in a worker thread and
+        leaves the state of this instance alone.
+
+        :raises: DynamipsError if the hypervisor does not answer
+        """
+
+        try:
+            with socket.create_connection((self._host, self._port), PROBE_TIMEOUT) as sock:
+                sock.settimeout(PROBE_TIMEOUT)
+                sock.sendall(b"hypervisor version\n")
+                reply = b""
+                while b"\n" not in reply:
+                    data = sock.recv(1024)
+                    if not data:
+                        raise DynamipsError("connection closed")
+                    reply += data
+        except OSError as e:
+            raise DynamipsError(e)
+        if not reply.startswith(b"100-"):
+            raise DynamipsError("unexpected reply {}".format(reply.decode("utf-8", errors="replace").strip()))
+
+    def probe_done(self, error):
+        """
+        Updates the health of the hypervisor with the result of a probe,
+        reconnects if the connection has been lost (module loop only).
+
+        :param error: exception raised by probe() or None
+
+        :returns: True if the hypervisor is healthy
+        """
+
+        if error is not None:
+            self._connection_lost(error)
+            return False
+
+        if self._socket is None:
+            if time.monotonic() < self._next_attempt:
+                return False
+            try:
+                self.connect()
+            except DynamipsError:
+                return False
+            return True
+
+        # the hypervisor never talks first: a readable idle
+        # connection has been closed or reset by the remote host
+        try:
+            readable = select.select([self._socket], [], [], 0)[0]
+        except (OSError, ValueError):
+            readable = True
+        if readable:
+            self._connection_lost("connection closed by the remote host")
+            return False
+        self._healthy = True
+        return True
+
+    def disconnect(self):
+        """
+        Closes the connection to the remote hypervisor (which keeps running).
+        """
+
+        if self._socket:
+            try:
+                DynamipsHypervisor.close(self)
+            except (DynamipsError, OSError) as e:
+                log.warning("could not close the connection to {}:{}: {}".format(self._host, self._port, e))
+                self._connection_lost(e)
+        self._healthy = False
+
+    def find_unused_port(self, start_port, end_port, ignore_ports=[]):
+        """
+        Finds a TCP port not allocated yet (the ports of the remote
+        host cannot be tested from this server).
+
+        :param start_port: first port in the range
+        :param end_port: last port in the range
+        :param ignore_ports: list of port to ignore within the range
+
+        :returns: port number (integer)
+        """
+
+        for port in range(start_port, end_port + 1):
+            if port not in ignore_ports:
+                return port
+        raise DynamipsError("Could not find a free port between {} and {} on remote hypervisor {}:{}".format(start_port,
+                                                                                                          end_port,
+                                                                                                          self._host,
+                                                                                                          self._port))
+
+    def allocate_udp_port(self):
+        """
+        Allocates a new UDP port for creating an UDP NIO Auto.
+
+        :returns: port number (integer)
+        """
+
+        port = Hypervisor.allocate_udp_port(self)
+        self._udp_ports.add(port)
+        return port
+
+    def owns_udp_port(self, port):
+        """
+        Returns either an UDP port has been allocated on this hypervisor.
+
+        :param port: port number (integer)
+
+        :returns: boolean
+        """
+
+        return port in self._udp_ports
+
+    def start(self):
+        """
+        Starts using the remote hypervisor (connects to it if needed).
+        """
+
+        if self._socket is None:
+            self.connect()
+        self._started = True
+
+    def stop(self):
+        """
+        Stops using the remote hypervisor: deletes all its devices
+        and keeps the connection for the next routers.
+        """
+
+        if self._socket:
+            try:
+                self.reset()
+            except DynamipsError as e:
+                log.warning("could not reset remote hypervisor {}:{}: {}".format(self._host, self._port, e))
+                self._connection_lost(e)
+        self._started = False
+        self._devices = []
+        self._ghosts = {}
+        self._jitsharing_groups = {}
+        self._nio_udp_auto_instances.clear()
+        self._udp_ports.clear()
+        self._memory_load = 0
+        self._ios_image_ref = ""
+
+    def read_stdout(self):
+        """
+        Returns the last error of the connection (the output
+        of the remote Dynamips process is not available).
+        """
+
+        return self._last_error
+
+    def is_running(self):
+        """
+        Checks if the remote hypervisor is reachable.
+
+        :returns: True or False
+        """
+
+        return self._socket is not None and self._healthy
@@ -25,6 +25,10 @@ ETHHUB_CREATE_SCHEMA = {
             "type": "string",
             "minLength": 1,
         },
+        "engine": {
+            "description": "Switching engine",
+            "enum": ["dynamips", "native"]
+        },
     },
     "additionalProperties": False,
     "required": ["name"]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+REMOTE_HYPERVISORS_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Validation of the remote hypervisors (hypervisor farm)",
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "host": {
+                "description": "Host/address of the remote hypervisor",
+                "type": "string",
+                "minLength": 1,
+            },
+            "port": {
+                "description": "Port of the remote hypervisor",
+                "type": "integer",
+                "minimum": 1,
+                "maximum": 65535
+            },
+            "ram": {
+                "description": "Amount of RAM available for the routers (MB)",
+                "type": "integer",
+                "minimum": 1
+            },
+            "cpus": {
+                "description": "Number of CPUs available for the routers",
+                "type": "integer",
+                "minimum": 1
+            },
+        },
+        "additionalProperties": False,
+        "required": ["host", "port"]
+    }
+}
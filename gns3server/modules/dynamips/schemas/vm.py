@@ -15,6 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from ...cgroups import RESOURCES_SCHEMA
+from ...console_watcher import CONSOLE_WATCH_PROPERTIES
+from ...process_log import PROCESS_LOG_PROPERTIES
+
 VM_CREATE_SCHEMA = {
     "$schema": "http://json-schema.org/draft-04/schema#",
     "description": "Request validation to create a new VM instance",
@@ -370,6 +374,7 @@ VM_UPDATE_SCHEMA = {
             "minimum": 0,
             "maximum": 100
         },
+        "resources": RESOURCES_SCHEMA,
     },
     "additionalProperties": False,
     "required": ["id"]
@@ -459,6 +464,62 @@ VM_SAVE_CONFIG_SCHEMA = {
     "required": ["id"]
 }
 
+VM_RESOURCE_USAGE_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to get the resource usage of a VM instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "VM instance ID",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+VM_PROCESS_LOG_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to read the log of the hypervisor process running a VM instance",
+    "type": "object",
+    "properties": dict(PROCESS_LOG_PROPERTIES, id={
+        "description": "VM instance ID",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+VM_CONSOLE_WATCH_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to watch the console output of a VM instance",
+    "type": "object",
+    "properties": dict(CONSOLE_WATCH_PROPERTIES, id={
+        "description": "VM instance ID",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id", "pattern"]
+}
+
+VM_CONSOLE_UNWATCH_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to stop watching the console output of a VM instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "VM instance ID",
+            "type": "integer"
+        },
+        "watch_id": {
+            "description": "watch identifier",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
 VM_EXPORT_CONFIG_SCHEMA = {
     "$schema": "http://json-schema.org/draft-04/schema#",
     "description": "Request validation to export the configs for VM instance",
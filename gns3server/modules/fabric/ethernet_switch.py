@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Learning Ethernet switch running in the fabric, with the same port
+types as the Dynamips Ethernet switch (access, 802.1Q and QinQ).
+"""
+
+import struct
+import time
+
+from .node import Node
+from .fabric_error import FabricError
+
+ETHERNET_HEADER_SIZE = 14
+ETH_P_8021Q = 0x8100
+
+# How long a learned MAC address is kept (seconds)
+DEFAULT_AGING_TIME = 300
+
+
+class EthernetSwitch(Node):
+    """
+    Ethernet switch with MAC address learning and aging.
+
+    :param name: switch name
+    :param aging_time: MAC address aging time in seconds
+    """
+
+    PORT_TYPES = ("access", "dot1q", "qinq")
+
+    def __init__(self, name, aging_time=DEFAULT_AGING_TIME):
+
+        Node.__init__(self, name)
+        self._aging_time = aging_time
+        self._settings = {}  # port -> (port type, VLAN)
+        self._mac_table = {}  # (VLAN, MAC address) -> [port, last seen]
+
+    @property
+    def aging_time(self):
+        """
+        Returns the MAC address aging time.
+
+        :returns: aging time in seconds
+        """
+
+        return self._aging_time
+
+    def set_port(self, port, port_type, vlan):
+        """
+        Configures a port.
+
+        :param port: Port instance
+        :param port_type: "access", "dot1q" or "qinq"
+        :param vlan: access VLAN, native VLAN or outer VLAN
+        """
+
+        if port not in self._ports:
+            raise FabricError("Port {} is not bound to {}".format(port.name, self._name))
+        if port_type not in self.PORT_TYPES:
+            raise FabricError("Unknown port type {}".format(port_type))
+        if not 1 <= vlan <= 4095:
+            raise FabricError("Invalid VLAN {}".format(vlan))
+        self._settings[port] = (port_type, vlan)
+        self._forget_port(port)
+
+    def remove_port(self, port):
+
+        Node.remove_port(self, port)
+        self._settings.pop(port, None)
+        self._forget_port(port)
+
+    def _forget_port(self, port):
+        """
+        Removes the MAC addresses learned on a port.
+
+        :param port: Port instance
+        """
+
+        for key in [key for key, entry in self._mac_table.items() if entry[0] is port]:
+            del self._mac_table[key]
+
+    def mac_address_table(self):
+        """
+        Returns the MAC address table.
+
+        :returns: list of (MAC address, VLAN, port) tuples
+        """
+
+        now = time.monotonic()
+        entries = []
+        for (vlan, mac), (port, last_seen) in sorted(self._mac_table.items(), key=lambda item: item[0]):
+            if now - last_seen < self._aging_time:
+                entries.append(("{:02x}{:02x}.{:02x}{:02x}.{:02x}{:02x}".format(*mac), vlan, port))
+        return entries
+
+    def clear_mac_address_table(self):
+        """
+        Clears the MAC address table.
+        """
+
+        self._mac_table.clear()
+
+    def expire(self, now):
+
+        for key in [key for key, entry in self._mac_table.items() if now - entry[1] >= self._aging_time]:
+            del self._mac_table[key]
+
+    def receive(self, port, frame):
+
+        settings = self._settings.get(port)
+        if settings is None or len(frame) < ETHERNET_HEADER_SIZE:
+            return
+
+        port_type, port_vlan = settings
+        if port_type == "dot1q":
+            if frame[12] == 0x81 and frame[13] == 0x00 and len(frame) >= ETHERNET_HEADER_SIZE + 4:
+                # tagged frame: remove the 802.1Q tag
+                vlan = ((frame[14] & 0x0f) << 8) | frame[15]
+                if vlan == 0:
+                    vlan = port_vlan  # priority tagged frame
+                frame = memoryview(bytes(frame[:12]) + bytes(frame[16:]))
+            else:
+                vlan = port_vlan
+        else:
+            # access port or QinQ port (the customer tags are kept as payload)
+            vlan = port_vlan
+
+        now = time.monotonic()
+        source = bytes(frame[6:12])
+        if not source[0] & 0x01:
+            self._mac_table[(vlan, source)] = [port, now]
+
+        destination = bytes(frame[0:6])
+        if not destination[0] & 0x01:
+            entry = self._mac_table.get((vlan, destination))
+            if entry and now - entry[1] < self._aging_time:
+                if entry[0] is not port:
+                    self._forward(entry[0], vlan, frame, None)
+                return
+
+        # flood to every port member of the VLAN
+        tagged = [None]
+        for egress in self._ports:
+            if egress is not port:
+                self._forward(egress, vlan, frame, tagged)
+
+    def _forward(self, egress, vlan, frame, tagged):
+        """
+        Sends a frame through a port if the port is member of the VLAN.
+
+        :param egress: Port instance
+        :param vlan: VLAN of the frame
+        :param frame: untagged frame
+        :param tagged: one element list caching the tagged frame when flooding (or None)
+        """
+
+        settings = self._settings.get(egress)
+        if settings is None:
+            return
+
+        port_type, port_vlan = settings
+        if port_type == "dot1q":
+            if vlan == port_vlan:
+                egress.send(frame)
+            else:
+                if tagged is None or tagged[0] is None:
+                    tagged_frame = bytes(frame[:12]) + struct.pack("!HH", ETH_P_8021Q, vlan) + bytes(frame[12:])
+                    if tagged is not None:
+                        tagged[0] = tagged_frame
+                else:
+                    tagged_frame = tagged[0]
+                egress.send(tagged_frame)
+        elif vlan == port_vlan:
+            egress.send(frame)
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process switching fabric: forwards frames between UDP tunnels
+for the switches and hubs, without any Dynamips process.
+"""
+
+import errno
+import select
+import threading
+import time
+
+from .fabric_error import FabricError
+from .ports import UDPPort, NullPort, RawPort
+from .pcap import FLUSH_INTERVAL
+from .timer_wheel import TimerWheel
+
+import logging
+log = logging.getLogger(__name__)
+
+# Maximum size of a frame received from a tunnel
+MAX_FRAME_SIZE = 65535
+
+# Maximum number of frames read from a port before serving the other ports
+BATCH_SIZE = 64
+
+# How often the nodes are aged (seconds)
+AGING_INTERVAL = 15
+
+
+class FabricShard(threading.Thread):
+    """
+    Forwarding loop serving the ports of a subset of the nodes.
+
+    :param index: shard index
+    """
+
+    def __init__(self, index):
+
+        threading.Thread.__init__(self, name="FabricShard-{}".format(index), daemon=True)
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._poll_timeout_unit = 1.0  # epoll timeout is in seconds
+        elif hasattr(select, "poll"):
+            self._poller = select.poll()
+            self._poll_timeout_unit = 1000.0  # poll timeout is in milliseconds
+        else:
+            raise FabricError("The switching fabric is not supported on this platform")
+        self.lock = threading.Lock()
+        self.wheel = TimerWheel()
+        self.nodes = []
+        self._ports = {}
+        self._buffer = bytearray(MAX_FRAME_SIZE)
+        self._view = memoryview(self._buffer)
+        self._running = True
+
+    def register(self, port):
+        """
+        Starts receiving the frames of a port (shard lock held).
+
+        :param port: Port instance
+        """
+
+        fileno = port.fileno()
+        if fileno is not None and fileno not in self._ports:
+            self._ports[fileno] = port
+            self._poller.register(fileno, select.POLLIN)
+
+    def unregister(self, port):
+        """
+        Stops receiving the frames of a port (shard lock held).
+
+        :param port: Port instance
+        """
+
+        fileno = port.fileno()
+        if fileno is not None and self._ports.pop(fileno, None):
+            try:
+                self._poller.unregister(fileno)
+            except (OSError, KeyError, ValueError):
+                pass
+
+    def stop(self):
+        """
+        Stops the forwarding loop.
+        """
+
+        self._running = False
+
+    def _drain(self, port):
+        """
+        Reads and forwards the frames waiting on a port.
+
+        :param port: Port instance
+        """
+
+        view = self._view
+        for _ in range(BATCH_SIZE):
+            try:
+                size = port.recv_into(self._buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. ICMP port unreachable reported on the socket
+                log.debug("{}: {}".format(port.name, e))
+                continue
+            frame = view[:size]
+            port.received(frame)
+            conditions = port.conditions_in
+            if conditions is not None:
+                conditions.submit(frame, port.deliver, self.wheel)
+                continue
+            node = port.node
+            if node is not None:
+                node.receive(port, frame)
+
+    def run(self):
+        """
+        Thread loop.
+        """
+
+        last_aging = last_flush = time.monotonic()
+        while self._running:
+            timeout = 1.0
+            wait = self.wheel.timeout()
+            if wait is not None:
+                # wake up to release the delayed frames on time
+                timeout = min(timeout, wait)
+            try:
+                events = self._poller.poll(timeout * self._poll_timeout_unit)
+            except InterruptedError:
+                continue
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                log.critical("fatal fabric poll error: {}".format(e))
+                return
+
+            with self.lock:
+                for fileno, event in events:
+                    port = self._ports.get(fileno)
+                    if port is not None:
+                        try:
+                            self._drain(port)
+                        except Exception as e:
+                            log.error("{}: forwarding error: {}".format(port.name, e), exc_info=1)
+
+                now = time.monotonic()
+                if len(self.wheel):
+                    try:
+                        self.wheel.advance(now)
+                    except Exception as e:
+                        log.error("{}: could not release delayed frames: {}".format(self.name, e), exc_info=1)
+                if now - last_aging >= AGING_INTERVAL:
+                    last_aging = now
+                    for node in self.nodes:
+                        node.expire(now)
+                if now - last_flush >= FLUSH_INTERVAL:
+                    # the captures of idle links are not flushed by the writes
+                    last_flush = now
+                    for node in self.nodes:
+                        for port in node.ports:
+                            port.flush_capture()
+
+
+class Fabric(object):
+    """
+    Switching fabric. Nodes are spread across shards (forwarding threads),
+    all the ports of a node are served by the shard of the node.
+
+    The shards share the interpreter lock: more than one shard only keeps
+    a busy node from delaying the others, it does not use more CPU cores
+    (run the module in several processes with its "shards" setting for that).
+
+    :param shards: number of shards
+    """
+
+    def __init__(self, shards=1):
+
+        self._shard_count = max(1, shards)
+        self._shards = []
+        self._ports = {}
+        self._nodes = {}
+        self._lock = threading.RLock()
+
+    @property
+    def ports(self):
+        """
+        Returns the ports.
+
+        :returns: dictionary of name -> Port instance
+        """
+
+        return self._ports
+
+    @property
+    def nodes(self):
+        """
+        Returns the nodes.
+
+        :returns: dictionary of name -> Node instance
+        """
+
+        return self._nodes
+
+    def _allocate_shard(self):
+        """
+        Returns the least loaded shard (starts a new one if possible).
+
+        :returns: FabricShard instance
+        """
+
+        for shard in self._shards:
+            if not shard.nodes:
+                return shard
+        if len(self._shards) < self._shard_count:
+            shard = FabricShard(len(self._shards))
+            shard.start()
+            self._shards.append(shard)
+            return shard
+        return min(self._shards, key=lambda s: len(s.nodes))
+
+    def get_port(self, name):
+        """
+        Returns a port.
+
+        :param name: port name
+
+        :returns: Port instance
+        """
+
+        if name not in self._ports:
+            raise FabricError("Unable to find port {}".format(name))
+        return self._ports[name]
+
+    def get_node(self, name):
+        """
+        Returns a node.
+
+        :param name: node name
+
+        :returns: Node instance
+        """
+
+        if name not in self._nodes:
+            raise FabricError("Unable to find node {}".format(name))
+        return self._nodes[name]
+
+    def add_port(self, port):
+        """
+        Adds a port created by the caller (closed if the name is taken).
+
+        :param port: Port instance
+
+        :returns: Port instance
+        """
+
+        with self._lock:
+            if port.name in self._ports:
+                port.close()
+                raise FabricError("Port {} already exists".format(port.name))
+            self._ports[port.name] = port
+        return port
+
+    def create_udp_port(self, name, laddr, lport, raddr, rport):
+        """
+        Creates an UDP tunnel port.
+
+        :param name: port name
+        :param laddr: local address
+        :param lport: local port
+        :param raddr: remote address
+        :param rport: remote port
+
+        :returns: UDPPort instance
+        """
+
+        return self.add_port(UDPPort(name, laddr, lport, raddr, rport))
+
+    def create_udp_auto_port(self, name, laddr, lport_start, lport_end):
+        """
+        Creates an UDP tunnel port bound to the first free local port of a range.
+
+        :param name: port name
+        :param laddr: local address
+        :param lport_start: start of the local port range
+        :param lport_end: end of the local port range
+
+        :returns: UDPPort instance
+        """
+
+        return self.add_port(UDPPort(name, laddr, 0, lport_start=lport_start, lport_end=lport_end))
+
+    def create_null_port(self, name):
+        """
+        Creates a port dropping everything.
+
+        :param name: port name
+
+        :returns: NullPort instance
+        """
+
+        return self.add_port(NullPort(name))
+
+    def create_tap_port(self, name, tap_device):
+        """
+        Creates a port attached to a TAP interface (through the raw relay helper).
+
+        :param name: port name
+        :param tap_device: TAP device name
+
+        :returns: RawPort instance
+        """
+
+        return self.add_port(RawPort(name, "tap", tap_device))
+
+    def create_ethernet_port(self, name, ethernet_device):
+        """
+        Creates a port attached to a host Ethernet interface (through the raw relay helper).
+
+        :param name: port name
+        :param ethernet_device: Ethernet device name
+
+        :returns: RawPort instance
+        """
+
+        return self.add_port(RawPort(name, "ethernet", ethernet_device))
+
+    def rename_port(self, name, new_name):
+        """
+        Renames a port.
+
+        :param name: port name
+        :param new_name: new port name
+        """
+
+        with self._lock:
+            port = self.get_port(name)
+            if new_name in self._ports:
+                raise FabricError("Port {} already exists".format(new_name))
+            del self._ports[name]
+            port.name = new_name
+            self._ports[new_name] = port
+
+    def delete_port(self, name):
+        """
+        Deletes a port (unbinds it from its node first).
+
+        :param name: port name
+        """
+
+        with self._lock:
+            port = self.get_port(name)
+            if port.node is not None:
+                self.unbind(port.node.name, name)
+            del self._ports[name]
+            port.close()
+
+    def add_node(self, node):
+        """
+        Adds a node to the fabric.
+
+        :param node: Node instance
+        """
+
+        with self._lock:
+            if node.name in self._nodes:
+                raise FabricError("Node {} already exists".format(node.name))
+            shard = self._allocate_shard()
+            with shard.lock:
+                node.shard = shard
+                shard.nodes.append(node)
+            self._nodes[node.name] = node
+            log.info("fabric node {} served by {}".format(node.name, shard.name))
+
+    def rename_node(self, name, new_name):
+        """
+        Renames a node.
+
+        :param name: node name
+        :param new_name: new node name
+        """
+
+        with self._lock:
+            node = self.get_node(name)
+            if new_name in self._nodes:
+                raise FabricError("Node {} already exists".format(new_name))
+            del self._nodes[name]
+            node.name = new_name
+            self._nodes[new_name] = node
+
+    def delete_node(self, name):
+        """
+        Deletes a node (its ports are unbound but not deleted).
+
+        :param name: node name
+        """
+
+        with self._lock:
+            node = self.get_node(name)
+            with node.shard.lock:
+                for port in list(node.ports):
+                    node.shard.unregister(port)
+                    node.remove_port(port)
+                node.shard.nodes.remove(node)
+            del self._nodes[name]
+
+    def bind(self, node_name, port_name):
+        """
+        Binds a port to a node.
+
+        :param node_name: node name
+        :param port_name: port name
+        """
+
+        with self._lock:
+            node = self.get_node(node_name)
+            port = self.get_port(port_name)
+            with node.shard.lock:
+                node.add_port(port)
+                node.shard.register(port)
+
+    def unbind(self, node_name, port_name):
+        """
+        Unbinds a port from a node.
+
+        :param node_name: node name
+        :param port_name: port name
+        """
+
+        with self._lock:
+            node = self.get_node(node_name)
+            port = self.get_port(port_name)
+            with node.shard.lock:
+                node.shard.unregister(port)
+                node.remove_port(port)
+
+    def reset(self):
+        """
+        Deletes all the nodes and ports.
+        """
+
+        with self._lock:
+            for name in list(self._nodes.keys()):
+                self.delete_node(name)
+            for name in list(self._ports.keys()):
+                self.delete_port(name)
+
+    def stop(self):
+        """
+        Deletes everything and stops the shards.
+        """
+
+        self.reset()
+        for shard in self._shards:
+            shard.stop()
+        for shard in self._shards:
+            shard.join(timeout=2)
+        self._shards = []
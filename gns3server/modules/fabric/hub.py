@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Ethernet hub running in the fabric.
+"""
+
+from .node import Node
+
+
+class Hub(Node):
+    """
+    Ethernet hub: every frame is repeated to all the other ports.
+
+    :param name: hub name
+    """
+
+    def receive(self, port, frame):
+
+        for egress in self._ports:
+            if egress is not port:
+                egress.send(frame)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Link conditions (WAN emulation) applied by the fabric ports: delay,
+jitter, loss, duplication and rate limit. Delayed frames are released
+by the timer wheel of the shard serving the port.
+"""
+
+import time
+import random
+
+# largest Ethernet frame (default token bucket size)
+MAX_FRAME_SIZE = 1514
+
+# frames waiting longer than this in the rate limiter are dropped (seconds)
+MAX_QUEUE_DELAY = 1.0
+
+# maximum number of delayed frames per direction of a link
+MAX_PENDING_FRAMES = 20000
+
+LINK_DIRECTION_SCHEMA = {
+    "description": "Conditions of one direction of a link (nothing set: no impairment)",
+    "type": "object",
+    "properties": {
+        "delay": {
+            "description": "Delay in milliseconds",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 10000
+        },
+        "jitter": {
+            "description": "Jitter in milliseconds (the delay varies by +/- jitter)",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 10000
+        },
+        "loss": {
+            "description": "Packet loss in percent",
+            "type": "number",
+            "minimum": 0,
+            "maximum": 100
+        },
+        "duplicate": {
+            "description": "Packet duplication in percent",
+            "type": "number",
+            "minimum": 0,
+            "maximum": 100
+        },
+        "rate": {
+            "description": "Rate limit in kbit/s (0 is unlimited)",
+            "type": "integer",
+            "minimum": 0
+        },
+        "burst": {
+            "description": "Token bucket size in bytes",
+            "type": "integer",
+            "minimum": MAX_FRAME_SIZE
+        },
+    },
+    "additionalProperties": False
+}
+
+# properties of the set_link_conditions requests
+LINK_CONDITIONS_PROPERTIES = {
+    "in": LINK_DIRECTION_SCHEMA,
+    "out": LINK_DIRECTION_SCHEMA,
+}
+
+
+class LinkConditions(object):
+    """
+    Conditions of one direction of a link.
+
+    Only accessed with the lock of the shard serving the port held.
+
+    :param delay: delay in milliseconds
+    :param jitter: jitter in milliseconds
+    :param loss: packet loss in percent
+    :param duplicate: packet duplication in percent
+    :param rate: rate limit in kbit/s (0 is unlimited)
+    :param burst: token bucket size in bytes (default is 10ms at the rate limit)
+    """
+
+    __slots__ = ("_settings", "_delay", "_jitter", "_loss", "_duplicate", "_rate", "_burst",
+                 "_tokens", "_last", "_pending", "dropped", "delayed")
+
+    def __init__(self, delay=0, jitter=0, loss=0, duplicate=0, rate=0, burst=None):
+
+        self._settings = {"delay": delay, "jitter": jitter, "loss": loss, "duplicate": duplicate, "rate": rate}
+        if burst:
+            self._settings["burst"] = burst
+        self._delay = delay / 1000
+        self._jitter = jitter / 1000
+        self._loss = loss / 100
+        self._duplicate = duplicate / 100
+        self._rate = rate * 1000 / 8  # bytes per second
+        self._burst = burst or max(MAX_FRAME_SIZE, int(self._rate / 100))
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        self._pending = 0
+        self.dropped = 0
+        self.delayed = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Creates conditions from a request.
+
+        :param settings: dictionary (LINK_DIRECTION_SCHEMA)
+
+        :returns: LinkConditions instance or None if there is no impairment
+        """
+
+        if not settings or not any(settings.get(name) for name in ("delay", "jitter", "loss", "duplicate", "rate")):
+            return None
+        return cls(**settings)
+
+    def settings(self):
+        """
+        Returns the settings and statistics.
+
+        :returns: dictionary
+        """
+
+        settings = dict(self._settings)
+        settings.update({"dropped": self.dropped, "delayed": self.delayed, "pending": self._pending})
+        return settings
+
+    def _shape(self, size, now):
+        """
+        Token bucket rate limit. The frames exceeding the bucket borrow
+        tokens and leave once the debt has been paid back.
+
+        :returns: departure time or None if the frame is dropped
+        """
+
+        self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        self._tokens -= size
+        if self._tokens >= 0:
+            return now
+        wait = -self._tokens / self._rate
+        if wait > MAX_QUEUE_DELAY:
+            self._tokens += size
+            return None
+        return now + wait
+
+    def submit(self, frame, deliver, wheel):
+        """
+        Applies the conditions to a frame.
+
+        :param frame: frame (memoryview, only valid during the call)
+        :param deliver: callable receiving the frame when it leaves
+        :param wheel: TimerWheel instance releasing the delayed frames
+        """
+
+        if self._loss and random.random() < self._loss:
+            self.dropped += 1
+            return
+        copies = 2 if self._duplicate and random.random() < self._duplicate else 1
+        now = time.monotonic()
+        for _ in range(copies):
+            departure = now
+            if self._rate:
+                departure = self._shape(len(frame), now)
+                if departure is None:
+                    self.dropped += 1
+                    continue
+            if self._delay or self._jitter:
+                departure += max(0.0, self._delay + random.uniform(-self._jitter, self._jitter))
+            if departure <= now:
+                deliver(frame)
+            elif self._pending >= MAX_PENDING_FRAMES:
+                self.dropped += 1
+            else:
+                self._pending += 1
+                self.delayed += 1
+                # the frame buffer is reused by the shard, keep a copy
+                wheel.schedule(departure, self._release, bytes(frame), deliver)
+
+    def _release(self, frame, deliver):
+
+        self._pending -= 1
+        deliver(frame)
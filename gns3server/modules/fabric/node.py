@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Base class for the nodes (switches, hubs...) running in the fabric.
+"""
+
+from .fabric_error import FabricError
+
+
+class Node(object):
+    """
+    Fabric node, forwards the frames received on its ports.
+
+    Nodes are only accessed with the lock of their shard held.
+
+    :param name: node name
+    """
+
+    def __init__(self, name):
+
+        self._name = name
+        self._ports = []
+        self.shard = None
+
+    @property
+    def name(self):
+        """
+        Returns the node name.
+
+        :returns: name
+        """
+
+        return self._name
+
+    @name.setter
+    def name(self, new_name):
+        """
+        Renames the node.
+
+        :param new_name: new name
+        """
+
+        self._name = new_name
+
+    @property
+    def ports(self):
+        """
+        Returns the ports bound to this node.
+
+        :returns: list of Port instances
+        """
+
+        return self._ports
+
+    def add_port(self, port):
+        """
+        Binds a port to this node.
+
+        :param port: Port instance
+        """
+
+        if port.node is not None:
+            raise FabricError("Port {} is already bound to {}".format(port.name, port.node.name))
+        port.node = self
+        self._ports.append(port)
+
+    def remove_port(self, port):
+        """
+        Unbinds a port from this node.
+
+        :param port: Port instance
+        """
+
+        if port not in self._ports:
+            raise FabricError("Port {} is not bound to {}".format(port.name, self._name))
+        self._ports.remove(port)
+        port.node = None
+
+    def receive(self, port, frame):
+        """
+        Handles a frame received on a port.
+
+        :param port: ingress Port instance
+        :param frame: frame (memoryview, only valid during the call)
+        """
+
+        raise NotImplementedError()
+
+    def expire(self, now):
+        """
+        Called periodically to age the node state.
+
+        :param now: current time (monotonic)
+        """
+
+        pass
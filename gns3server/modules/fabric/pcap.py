@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Minimal PCAP file writer.
+http://wiki.wireshark.org/Development/LibpcapFileFormat
+"""
+
+import struct
+import time
+
+from .fabric_error import FabricError
+
+# PCAP data link types (DLT_ prefix removed, lowercase like Dynamips)
+# http://www.tcpdump.org/linktypes.html
+DATA_LINK_TYPES = {"en10mb": 1,
+                   "atm_rfc1483": 11,
+                   "ppp_serial": 50,
+                   "c_hdlc": 104,
+                   "frelay": 107}
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_SNAPLEN = 65535
+PCAP_RECORD_HEADER = struct.Struct("<IIII")
+
+# packets are written to a buffer flushed to the file at least every FLUSH_INTERVAL seconds
+PCAP_BUFFER_SIZE = 256 * 1024
+FLUSH_INTERVAL = 1.0
+
+
+class PcapWriter(object):
+    """
+    Writes packets to a PCAP file.
+
+    :param path: path to the PCAP file
+    :param data_link_type: data link type name (e.g. en10mb)
+    """
+
+    def __init__(self, path, data_link_type="en10mb"):
+
+        data_link_type = data_link_type.lower()
+        if data_link_type.startswith("dlt_"):
+            data_link_type = data_link_type[4:]
+        if data_link_type not in DATA_LINK_TYPES:
+            raise FabricError("Unknown data link type {}".format(data_link_type))
+
+        self._path = path
+        self._last_flush = time.monotonic()
+        try:
+            self._file = open(path, "wb", buffering=PCAP_BUFFER_SIZE)
+            self._file.write(struct.pack("<IHHiIII", PCAP_MAGIC, 2, 4, 0, 0, PCAP_SNAPLEN, DATA_LINK_TYPES[data_link_type]))
+            self._file.flush()
+        except OSError as e:
+            raise FabricError("Could not create capture file {}: {}".format(path, e))
+
+    @property
+    def path(self):
+        """
+        Returns the path to the PCAP file.
+
+        :returns: path
+        """
+
+        return self._path
+
+    def write(self, packet):
+        """
+        Writes a packet.
+
+        :param packet: bytes, bytearray or memoryview
+        """
+
+        if not self._file:
+            return
+        now = time.time()
+        seconds = int(now)
+        length = len(packet)
+        captured = min(length, PCAP_SNAPLEN)
+        try:
+            self._file.write(PCAP_RECORD_HEADER.pack(seconds, int((now - seconds) * 1000000), captured, length))
+            self._file.write(packet[:captured])
+        except (OSError, ValueError):
+            self.close()
+            return
+        if time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered packets to the file.
+        """
+
+        self._last_flush = time.monotonic()
+        if self._file:
+            try:
+                self._file.flush()
+            except (OSError, ValueError):
+                self.close()
+
+    def close(self):
+        """
+        Closes the PCAP file.
+        """
+
+        if self._file:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
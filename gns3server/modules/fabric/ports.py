@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fabric ports: UDP tunnel endpoints (same encapsulation as the Dynamips,
+IOU, VPCS and QEMU UDP NIOs: one Ethernet frame per datagram), TAP
+interfaces and host Ethernet interfaces (through the raw relay helper).
+"""
+
+import socket
+
+from .fabric_error import FabricError
+from .pcap import PcapWriter
+from .raw_relay_client import RawRelayClient
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Port(object):
+    """
+    Base fabric port.
+
+    :param name: port name
+    """
+
+    def __init__(self, name):
+
+        self._name = name
+        self._node = None
+        self._capture_in = None
+        self._capture_out = None
+        self.conditions_in = None
+        self.conditions_out = None
+        self.packets_in = 0
+        self.packets_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def name(self):
+        """
+        Returns the port name.
+
+        :returns: name
+        """
+
+        return self._name
+
+    @name.setter
+    def name(self, new_name):
+        """
+        Renames the port.
+
+        :param new_name: new name
+        """
+
+        self._name = new_name
+
+    @property
+    def node(self):
+        """
+        Returns the node (switch or hub) this port is bound to.
+
+        :returns: node instance or None
+        """
+
+        return self._node
+
+    @node.setter
+    def node(self, node):
+
+        self._node = node
+
+    def fileno(self):
+        """
+        Returns the file descriptor to poll (None if the port receives nothing).
+        """
+
+        return None
+
+    def start_capture(self, direction, path, data_link_type="en10mb"):
+        """
+        Starts capturing the packets going through this port.
+
+        :param direction: "in", "out" or "both"
+        :param path: PCAP file path
+        :param data_link_type: PCAP data link type
+        """
+
+        writer = PcapWriter(path, data_link_type)
+        if direction in ("in", "both"):
+            self._capture_in = writer
+        if direction in ("out", "both"):
+            self._capture_out = writer
+
+    def stop_capture(self, direction="both"):
+        """
+        Stops capturing packets.
+
+        :param direction: "in", "out" or "both"
+        """
+
+        writers = {self._capture_in, self._capture_out}
+        if direction in ("in", "both"):
+            self._capture_in = None
+        if direction in ("out", "both"):
+            self._capture_out = None
+        for writer in writers:
+            if writer and writer not in (self._capture_in, self._capture_out):
+                writer.close()
+
+    def flush_capture(self):
+        """
+        Writes the buffered captured packets to the PCAP files.
+        """
+
+        for writer in {self._capture_in, self._capture_out}:
+            if writer:
+                writer.flush()
+
+    @property
+    def capturing(self):
+        """
+        Returns either the frames of this port are captured.
+
+        :returns: boolean
+        """
+
+        return self._capture_in is not None or self._capture_out is not None
+
+    def set_conditions(self, direction, conditions):
+        """
+        Sets the link conditions (delay, loss, rate limit...) of a direction.
+
+        :param direction: "in" (frames received by this port) or "out" (frames sent)
+        :param conditions: LinkConditions instance or None
+        """
+
+        if direction == "in":
+            self.conditions_in = conditions
+        else:
+            self.conditions_out = conditions
+
+    def get_conditions(self):
+        """
+        Returns the link conditions and statistics of both directions.
+
+        :returns: dictionary with the "in" and "out" settings (None: no impairment)
+        """
+
+        return {direction: conditions.settings() if conditions else None
+                for direction, conditions in (("in", self.conditions_in), ("out", self.conditions_out))}
+
+    def received(self, frame):
+        """
+        Accounts a frame received by this port.
+
+        :param frame: frame (memoryview)
+        """
+
+        self.packets_in += 1
+        self.bytes_in += len(frame)
+        if self._capture_in:
+            self._capture_in.write(frame)
+
+    def deliver(self, frame):
+        """
+        Passes a received frame to the node of this port.
+
+        :param frame: frame (memoryview or bytes)
+        """
+
+        node = self._node
+        if node is not None:
+            node.receive(self, frame)
+
+    def send(self, frame):
+        """
+        Sends a frame through this port (after the link conditions).
+
+        :param frame: bytes, bytearray or memoryview
+        """
+
+        conditions = self.conditions_out
+        if conditions is not None and self._node is not None and self._node.shard is not None:
+            conditions.submit(frame, self.transmit, self._node.shard.wheel)
+        else:
+            self.transmit(frame)
+
+    def transmit(self, frame):
+        """
+        Writes a frame to the port.
+
+        :param frame: bytes, bytearray or memoryview
+        """
+
+        self.packets_out += 1
+        self.bytes_out += len(frame)
+        if self._capture_out:
+            self._capture_out.write(frame)
+
+    def reset_stats(self):
+        """
+        Resets the statistics.
+        """
+
+        self.packets_in = self.packets_out = self.bytes_in = self.bytes_out = 0
+
+    def close(self):
+        """
+        Closes the port.
+        """
+
+        self.stop_capture()
+
+
+class NullPort(Port):
+    """
+    Port dropping everything.
+
+    :param name: port name
+    """
+
+    pass
+
+
+class UDPPort(Port):
+    """
+    UDP tunnel port.
+
+    :param name: port name
+    :param laddr: local address
+    :param lport: local port (0 to allocate one in the given range)
+    :param raddr: remote address (None if not connected yet)
+    :param rport: remote port
+    :param lport_start: start of the local port range (when lport is 0)
+    :param lport_end: end of the local port range (when lport is 0)
+    """
+
+    def __init__(self, name, laddr, lport, raddr=None, rport=None, lport_start=None, lport_end=None):
+
+        Port.__init__(self, name)
+        family = socket.AF_INET6 if ":" in laddr else socket.AF_INET
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        if lport:
+            candidates = [lport]
+        else:
+            candidates = range(lport_start, lport_end + 1)
+
+        last_exception = None
+        for port in candidates:
+            try:
+                self._socket.bind((laddr, port))
+                break
+            except OSError as e:
+                last_exception = e
+        else:
+            self._socket.close()
+            raise FabricError("Could not bind UDP port on {}: {}".format(laddr, last_exception))
+
+        self._socket.setblocking(False)
+        self._laddr = laddr
+        self._lport = self._socket.getsockname()[1]
+        self._destination = None
+        if raddr:
+            self.connect(raddr, rport)
+
+    @property
+    def lport(self):
+        """
+        Returns the local port.
+
+        :returns: port number
+        """
+
+        return self._lport
+
+    def fileno(self):
+
+        return self._socket.fileno() if self._socket else None
+
+    def recv_into(self, buffer):
+        """
+        Reads one datagram.
+
+        :param buffer: buffer to read into
+
+        :returns: size of the datagram
+        """
+
+        return self._socket.recv_into(buffer)
+
+    def connect(self, raddr, rport):
+        """
+        Sets the remote end of the tunnel.
+
+        :param raddr: remote address
+        :param rport: remote port
+        """
+
+        try:
+            info = socket.getaddrinfo(raddr, rport, self._socket.family, socket.SOCK_DGRAM)
+        except OSError as e:
+            raise FabricError("Could not resolve {}:{}: {}".format(raddr, rport, e))
+        self._destination = info[0][4]
+
+    def transmit(self, frame):
+
+        if not self._destination or not self._socket:
+            return
+        Port.transmit(self, frame)
+        try:
+            self._socket.sendto(frame, self._destination)
+        except (BlockingIOError, InterruptedError):
+            pass  # the socket buffer is full, drop the frame like a real link would do
+        except OSError as e:
+            log.debug("{}: could not send to {}: {}".format(self._name, self._destination, e))
+
+    def close(self):
+
+        Port.close(self)
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+
+
+class RawPort(UDPPort):
+    """
+    Port attached to a TAP or host Ethernet interface. The device is owned
+    by the privileged raw relay helper, frames are exchanged with it over
+    an UDP tunnel on the loopback interface.
+
+    :param name: port name
+    :param kind: "tap" or "ethernet"
+    :param device: device name (e.g. tap0 or eth0)
+    """
+
+    def __init__(self, name, kind, device):
+
+        UDPPort.__init__(self, name, "127.0.0.1", 0, lport_start=0, lport_end=0)
+        try:
+            self._link_id, helper_port = RawRelayClient.instance().open(kind, device, self._lport)
+        except FabricError:
+            UDPPort.close(self)
+            raise
+        self._device = device
+        self.connect("127.0.0.1", helper_port)
+
+    def close(self):
+
+        UDPPort.close(self)
+        if self._link_id is not None:
+            RawRelayClient.instance().close(self._link_id)
+            self._link_id = None
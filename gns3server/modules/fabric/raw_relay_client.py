@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Client of the privileged raw relay helper (gns3-raw-relay) owning the TAP
+and host Ethernet interfaces on behalf of the unprivileged server.
+"""
+
+import sys
+import shlex
+import shutil
+import threading
+import subprocess
+
+from gns3server.config import Config
+from .fabric_error import FabricError
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class RawRelayClient(object):
+    """
+    Talks to a single helper process shared by all the TAP and Ethernet
+    ports of the server. The helper is started on first use and restarted
+    if it died.
+
+    :param command: command line of the helper (list)
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, command):
+
+        self._command = command
+        self._process = None
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the helper client of this process (created on first use).
+
+        The helper command can be set with the raw_relay_command option
+        of the FABRIC section, e.g. "sudo -n gns3-raw-relay".
+
+        :returns: RawRelayClient instance
+        """
+
+        with cls._instance_lock:
+            if cls._instance is None:
+                fabric_config = Config.instance().get_section_config("FABRIC")
+                command = fabric_config.get("raw_relay_command")
+                if command:
+                    command = shlex.split(command)
+                elif shutil.which("gns3-raw-relay"):
+                    command = ["gns3-raw-relay"]
+                else:
+                    command = [sys.executable, "-m", "gns3server.raw_relay"]
+                cls._instance = cls(command)
+            return cls._instance
+
+    def _start(self):
+        """
+        Starts the helper if it is not running (lock held).
+        """
+
+        if self._process is not None and self._process.poll() is None:
+            return
+        if self._process is not None:
+            log.warning("raw relay helper exited with code {}, restarting it".format(self._process.returncode))
+        log.info("starting raw relay helper: {}".format(" ".join(self._command)))
+        try:
+            self._process = subprocess.Popen(self._command,
+                                             stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE,
+                                             universal_newlines=True,
+                                             bufsize=1)
+        except OSError as e:
+            self._process = None
+            raise FabricError("Could not start the raw relay helper {}: {}".format(self._command[0], e))
+
+    def _request(self, *args):
+        """
+        Sends a command to the helper and waits for its reply (lock held).
+
+        :returns: reply arguments after the link ID
+        """
+
+        self._start()
+        try:
+            self._process.stdin.write(" ".join(str(arg) for arg in args) + "\n")
+            self._process.stdin.flush()
+            reply = self._process.stdout.readline()
+        except OSError as e:
+            raise FabricError("Could not talk to the raw relay helper: {}".format(e))
+        if not reply:
+            raise FabricError("The raw relay helper has exited (is it allowed to access the devices?)")
+        fields = reply.rstrip("\n").split(" ", 2)
+        status = fields[0]
+        message = fields[2] if len(fields) > 2 else None
+        if status != "ok":
+            raise FabricError(message or "raw relay helper error")
+        return message
+
+    def open(self, kind, device, port):
+        """
+        Asks the helper to relay a device to a local UDP port.
+
+        :param kind: "tap" or "ethernet"
+        :param device: device name
+        :param port: local UDP port of the fabric
+
+        :returns: (link ID, UDP port of the helper)
+        """
+
+        if not device or any(c.isspace() for c in device):
+            raise FabricError("Invalid device name {!r}".format(device))
+        with self._lock:
+            link_id = self._next_id
+            self._next_id += 1
+            helper_port = self._request("open", link_id, kind, device, port)
+        return link_id, int(helper_port)
+
+    def close(self, link_id):
+        """
+        Stops relaying a device.
+
+        :param link_id: link ID returned by open()
+        """
+
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                return  # the links died with the helper
+            try:
+                self._request("close", link_id)
+            except FabricError as e:
+                log.warning("could not close raw relay link {}: {}".format(link_id, e))
+
+    def stop(self):
+        """
+        Stops the helper (it exits when its standard input is closed).
+        """
+
+        with self._lock:
+            if self._process is not None:
+                self._process.stdin.close()
+                try:
+                    self._process.wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+                self._process = None
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+UDP relays inserted in the UDP tunnels of the nodes without native
+packet capture (QEMU, VPCS). The relay takes over the local port of the
+tunnel and the node is moved to a loopback tunnel towards the relay.
+"""
+
+import threading
+
+from .fabric import Fabric
+from .fabric_error import FabricError
+from .node import Node
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class LinkRelay(Node):
+    """
+    Forwards the frames between the two ports of a link.
+
+    :param name: relay name
+    :param outer: port towards the other end of the link
+    :param inner: port towards the node
+    :param tunnel: (lport, rhost, rport) of the relayed tunnel
+    """
+
+    def __init__(self, name, outer, inner, tunnel):
+
+        Node.__init__(self, name)
+        self.outer = outer
+        self.inner = inner
+        self.tunnel = tunnel
+
+    def receive(self, port, frame):
+
+        if port is self.inner:
+            self.outer.send(frame)
+        else:
+            self.inner.send(frame)
+
+
+class UDPRelay(object):
+    """
+    Relays of this process, served by the switching fabric
+    (frames are read in batches into a reused buffer).
+
+    :param shards: number of forwarding threads (see Fabric)
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, shards=1):
+
+        self._fabric = Fabric(shards)
+        self._relays = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the relay of this process (created on first use).
+
+        :returns: UDPRelay instance
+        """
+
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def has_relay(self, name):
+        """
+        Returns either a relay exists.
+
+        :param name: relay name
+
+        :returns: boolean
+        """
+
+        return name in self._relays
+
+    def insert(self, name, laddr, lport, rhost, rport, inner_host, inner_port, node_port, rebind):
+        """
+        Inserts a relay in an UDP tunnel.
+
+        :param name: relay name
+        :param laddr: local address of the tunnel
+        :param lport: local port of the tunnel (taken over by the relay)
+        :param rhost: remote host of the tunnel
+        :param rport: remote port of the tunnel
+        :param inner_host: address of the loopback tunnel between the node and the relay
+        :param inner_port: port of the relay in the loopback tunnel
+        :param node_port: port of the node in the loopback tunnel
+        :param rebind: callable moving the node to another tunnel (lport, rhost, rport),
+        it must free the local port of the node before returning
+        """
+
+        with self._lock:
+            if name in self._relays:
+                raise FabricError("Relay {} already exists".format(name))
+            inner = self._fabric.create_udp_port("{}-inner".format(name), inner_host, inner_port, inner_host, node_port)
+            try:
+                rebind(node_port, inner_host, inner_port)
+            except Exception:
+                self._fabric.delete_port(inner.name)
+                raise
+            try:
+                outer = self._fabric.create_udp_port("{}-outer".format(name), laddr, lport, rhost, rport)
+            except FabricError:
+                self._fabric.delete_port(inner.name)
+                rebind(lport, rhost, rport)
+                raise
+            relay = LinkRelay(name, outer, inner, (lport, rhost, rport))
+            self._fabric.add_node(relay)
+            self._fabric.bind(name, outer.name)
+            self._fabric.bind(name, inner.name)
+            self._relays[name] = relay
+        log.info("UDP relay {} inserted between {}:{} and {}:{}".format(name, inner_host, node_port, rhost, rport))
+
+    def remove(self, name, rebind):
+        """
+        Removes a relay and moves the node back to its tunnel.
+
+        :param name: relay name
+        :param rebind: callable moving the node to its tunnel (lport, rhost, rport)
+
+        :returns: (lport, rhost, rport) of the tunnel
+        """
+
+        with self._lock:
+            relay = self._relays.pop(name, None)
+            if relay is None:
+                raise FabricError("Relay {} doesn't exist".format(name))
+            self._fabric.delete_node(name)
+            self._fabric.delete_port(relay.outer.name)
+            self._fabric.delete_port(relay.inner.name)
+        rebind(*relay.tunnel)
+        log.info("UDP relay {} removed".format(name))
+        return relay.tunnel
+
+    def start_capture(self, name, path, data_link_type="en10mb"):
+        """
+        Starts capturing the frames of a link (both directions).
+
+        :param name: relay name
+        :param path: PCAP file path
+        :param data_link_type: PCAP data link type
+        """
+
+        relay = self._relays.get(name)
+        if relay is None:
+            raise FabricError("Relay {} doesn't exist".format(name))
+        with relay.shard.lock:
+            relay.outer.start_capture("both", path, data_link_type)
+
+    def stop_capture(self, name):
+        """
+        Stops capturing the frames of a link.
+
+        :param name: relay name
+        """
+
+        relay = self._relays.get(name)
+        if relay is not None:
+            with relay.shard.lock:
+                relay.outer.stop_capture()
+
+    def set_conditions(self, name, conditions_in, conditions_out):
+        """
+        Sets the conditions of a link.
+
+        :param name: relay name
+        :param conditions_in: LinkConditions instance for the frames sent to the node (or None)
+        :param conditions_out: LinkConditions instance for the frames sent by the node (or None)
+        """
+
+        relay = self._relays.get(name)
+        if relay is None:
+            raise FabricError("Relay {} doesn't exist".format(name))
+        with relay.shard.lock:
+            relay.outer.set_conditions("in", conditions_in)
+            relay.outer.set_conditions("out", conditions_out)
+
+    def get_conditions(self, name):
+        """
+        Returns the conditions and statistics of a link.
+
+        :param name: relay name
+
+        :returns: dictionary with the "in" and "out" settings (None: no impairment)
+        """
+
+        relay = self._relays.get(name)
+        if relay is None:
+            raise FabricError("Relay {} doesn't exist".format(name))
+        with relay.shard.lock:
+            return relay.outer.get_conditions()
+
+    def is_idle(self, name):
+        """
+        Returns either a relay neither captures nor alters the frames
+        (and can be removed).
+
+        :param name: relay name
+
+        :returns: boolean
+        """
+
+        relay = self._relays.get(name)
+        if relay is None:
+            return True
+        outer = relay.outer
+        return not outer.capturing and outer.conditions_in is None and outer.conditions_out is None
+
+    def stop(self):
+        """
+        Deletes all the relays (the nodes are not moved back).
+        """
+
+        with self._lock:
+            self._relays.clear()
+            self._fabric.stop()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Hierarchical timer wheel: scheduling a timer costs O(1) whatever the
+number of pending timers (no heap), expired timers are found slot by slot.
+Level 0 has one slot per tick, each slot of level N covers all the
+slots of level N-1 and is cascaded to the lower levels when reached.
+"""
+
+import time
+
+# 256 slots per level
+SLOT_BITS = 8
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+
+
+class TimerWheel(object):
+    """
+    Timer wheel (not thread-safe, used by the thread owning it).
+
+    :param tick: resolution in seconds
+    :param levels: number of levels (range is tick * 256 ** levels)
+    """
+
+    def __init__(self, tick=0.001, levels=3):
+
+        self._tick = tick
+        self._levels = [[[] for _ in range(SLOTS)] for _ in range(levels)]
+        self._max_ticks = (1 << (SLOT_BITS * levels)) - 1
+        self._current = int(time.monotonic() / tick)
+        self._count = 0
+
+    def __len__(self):
+
+        return self._count
+
+    @property
+    def tick(self):
+        """
+        Returns the resolution of the wheel.
+
+        :returns: seconds
+        """
+
+        return self._tick
+
+    def _insert(self, expires, entry):
+
+        delta = expires - self._current
+        if delta <= 0:
+            # already expired: run on the next tick
+            expires = self._current + 1
+            delta = 1
+        elif delta > self._max_ticks:
+            expires = self._current + self._max_ticks
+            delta = self._max_ticks
+        level = 0
+        while delta >= SLOTS << (SLOT_BITS * level):
+            level += 1
+        self._levels[level][(expires >> (SLOT_BITS * level)) & SLOT_MASK].append((expires, entry))
+
+    def schedule(self, when, callback, *args):
+        """
+        Schedules a callback.
+
+        :param when: time of the callback (time.monotonic() clock)
+        :param callback: callable
+        """
+
+        self._insert(int(when / self._tick), (callback, args))
+        self._count += 1
+
+    def _cascade(self, level):
+        """
+        Moves the timers of the current slot of a level to the lower levels.
+        """
+
+        index = (self._current >> (SLOT_BITS * level)) & SLOT_MASK
+        slot = self._levels[level][index]
+        if slot:
+            self._levels[level][index] = []
+            for expires, entry in slot:
+                if expires == self._current:
+                    # the current slot of level 0 runs right after the cascade
+                    self._levels[0][expires & SLOT_MASK].append((expires, entry))
+                else:
+                    self._insert(expires, entry)
+
+    def advance(self, now=None):
+        """
+        Runs the expired callbacks.
+
+        :param now: current time (time.monotonic() clock)
+
+        :returns: number of callbacks run
+        """
+
+        if now is None:
+            now = time.monotonic()
+        target = int(now / self._tick)
+        if not self._count:
+            self._current = max(self._current, target)
+            return 0
+
+        run = 0
+        while self._current < target and self._count:
+            self._current += 1
+            index = self._current & SLOT_MASK
+            if index == 0:
+                level = 1
+                while level < len(self._levels):
+                    self._cascade(level)
+                    if (self._current >> (SLOT_BITS * level)) & SLOT_MASK:
+                        break
+                    level += 1
+            slot = self._levels[0][index]
+            if slot:
+                self._levels[0][index] = []
+                self._count -= len(slot)
+                for _, (callback, args) in slot:
+                    callback(*args)
+                run += len(slot)
+        self._current = max(self._current, target)
+        return run
+
+    def timeout(self):
+        """
+        Returns how long the owner can sleep before the next expiration
+        (or the next cascade of timers further in the future).
+
+        :returns: seconds or None if there is no timer
+        """
+
+        if not self._count:
+            return None
+        position = self._current & SLOT_MASK
+        level0 = self._levels[0]
+        for ticks in range(1, SLOTS - position):
+            if level0[position + ticks]:
+                return ticks * self._tick
+        return (SLOTS - position) * self._tick
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Content-addressed cache of the images fetched from cloud storage.
+
+Images are downloaded in worker threads by chunks (hashed on the fly)
+and stored once per content (MD5 hash) in an object directory,
+the destination paths are hard links to the stored objects.
+"""
+
+import os
+import stat
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from gns3server.config import Config
+
+import logging
+log = logging.getLogger(__name__)
+
+# size of the chunks read from the storage and from the files
+CHUNK_SIZE = 1024 * 1024
+
+
+class ImageCacheError(Exception):
+
+    def __init__(self, message, original_exception=None):
+
+        Exception.__init__(self, message)
+        if isinstance(message, Exception):
+            message = str(message)
+        self._message = message
+        self._original_exception = original_exception
+
+    def __repr__(self):
+
+        return self._message
+
+    def __str__(self):
+
+        return self._message
+
+
+def file_md5(path):
+    """
+    Computes the MD5 hash of a file without loading it in memory.
+
+    :param path: path to the file
+
+    :returns: hexadecimal digest
+    """
+
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def gather(futures):
+    """
+    Combines several futures.
+
+    :param futures: list of Future instances
+
+    :returns: Future with the list of results (or the first exception)
+    """
+
+    combined = Future()
+    if not futures:
+        combined.set_result([])
+        return combined
+
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for future in futures:
+            if future.exception() is not None:
+                combined.set_exception(future.exception())
+                return
+        combined.set_result([future.result() for future in futures])
+
+    for future in futures:
+        future.add_done_callback(done)
+    return combined
+
+
+class LocalStorage(object):
+    """
+    Image storage in a local directory (e.g. a shared mount), with the same
+    interface as the cloud providers: an optional "<name>.md5" file holds
+    the hash of an image.
+
+    :param root: storage directory
+    """
+
+    def __init__(self, root):
+
+        self._root = root
+
+    def _path(self, file_name):
+
+        path = os.path.normpath(os.path.join(self._root, file_name))
+        if os.path.commonprefix([path, os.path.normpath(self._root) + os.sep]) != os.path.normpath(self._root) + os.sep:
+            raise ImageCacheError("{} is not in the storage directory".format(file_name))
+        return path
+
+    def get_file_hash(self, file_name):
+        """
+        Returns the MD5 hash of a stored file.
+
+        :param file_name: file name in the storage
+
+        :returns: hexadecimal digest or None if unknown
+        """
+
+        try:
+            with open(self._path(file_name) + ".md5") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def iter_file(self, file_name, chunk_size=CHUNK_SIZE):
+        """
+        Streams a stored file.
+
+        :param file_name: file name in the storage
+        :param chunk_size: size of the chunks
+
+        :returns: iterator of bytes chunks
+        """
+
+        with open(self._path(file_name), "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                yield chunk
+
+
+class ImageCache(object):
+    """
+    Fetches images from a storage (cloud provider or LocalStorage).
+
+    Concurrent fetches of the same image to the same destination share
+    the same future, an image is downloaded only once whatever the number
+    of destinations.
+
+    :param objects_dir: directory of the stored objects (one file per content)
+    :param storage_factory: callable returning the storage (called in the worker threads)
+    :param workers: maximum number of concurrent downloads
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, objects_dir, storage_factory, workers=4):
+
+        self._objects_dir = objects_dir
+        self._storage_factory = storage_factory
+        self._storage = None
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._fetches = {}  # (file name, destination) -> Future
+        self._name_locks = {}  # file name -> Lock
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the image cache of this process (created on first use),
+        images are fetched from the cloud provider of the server settings.
+
+        :returns: ImageCache instance
+        """
+
+        with cls._instance_lock:
+            if cls._instance is None:
+                config = Config.instance()
+                server_config = config.get_default_section()
+                images_dir = os.path.expandvars(os.path.expanduser(server_config.get("upload_directory", "~/GNS3/images")))
+                cloud_settings = config.cloud_settings()
+
+                def cloud_provider():
+                    from gns3dms.cloud.rackspace_ctrl import get_provider
+                    provider = get_provider(cloud_settings)
+                    if provider is None:
+                        raise ImageCacheError("Could not connect to the cloud provider")
+                    return provider
+
+                cls._instance = cls(os.path.join(images_dir, ".objects"),
+                                    cloud_provider,
+                                    int(server_config.get("image_download_workers", 4)))
+            return cls._instance
+
+    def fetch(self, file_name, destination, executable=False):
+        """
+        Fetches an image unless it is already at the destination.
+
+        :param file_name: file name in the storage
+        :param destination: local path
+        :param executable: make the image executable (e.g. IOU)
+
+        :returns: Future with the destination path
+        """
+
+        key = (file_name, os.path.abspath(destination))
+        with self._lock:
+            future = self._fetches.get(key)
+            if future is None:
+                future = self._executor.submit(self._fetch, file_name, key[1], executable)
+                self._fetches[key] = future
+                future.add_done_callback(lambda _: self._fetch_done(key))
+            else:
+                log.debug("joining the fetch of {} to {}".format(file_name, destination))
+        return future
+
+    def _fetch_done(self, key):
+
+        with self._lock:
+            self._fetches.pop(key, None)
+
+    def _get_storage(self):
+
+        with self._lock:
+            if self._storage is None:
+                self._storage = self._storage_factory()
+            return self._storage
+
+    def _name_lock(self, file_name):
+
+        with self._lock:
+            return self._name_locks.setdefault(file_name, threading.Lock())
+
+    def _object_path(self, digest):
+
+        return os.path.join(self._objects_dir, digest)
+
+    def _fetch(self, file_name, destination, executable):
+        """
+        Fetches an image (in a worker thread).
+        """
+
+        try:
+            storage = self._get_storage()
+            # one download per image, the other fetches wait and use the stored object
+            with self._name_lock(file_name):
+                digest = storage.get_file_hash(file_name)
+                if digest:
+                    path = self._object_path(digest)
+                    if os.path.isfile(path):
+                        log.info("{} is already cached".format(file_name))
+                    elif os.path.isfile(destination) and file_md5(destination) == digest:
+                        # adopt the image already at the destination
+                        self._store(destination, path)
+                    else:
+                        path = self._download(storage, file_name, digest)
+                elif os.path.isfile(destination):
+                    # nothing to compare the existing image with
+                    return destination
+                else:
+                    path = self._download(storage, file_name, None)
+            self._link(path, destination)
+            if executable:
+                os.chmod(destination, os.stat(destination).st_mode | stat.S_IEXEC)
+        except ImageCacheError:
+            raise
+        except Exception as e:
+            raise ImageCacheError("Could not fetch {}: {}".format(file_name, e), e)
+        return destination
+
+    def _download(self, storage, file_name, expected_digest):
+        """
+        Downloads an image to the object directory.
+
+        :param storage: storage instance
+        :param file_name: file name in the storage
+        :param expected_digest: expected MD5 hash (None if unknown)
+
+        :returns: path to the stored object
+        """
+
+        os.makedirs(self._objects_dir, exist_ok=True)
+        log.info("downloading {}".format(file_name))
+        md5 = hashlib.md5()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self._objects_dir, prefix=".download-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in storage.iter_file(file_name, CHUNK_SIZE):
+                    md5.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            digest = md5.hexdigest()
+            if expected_digest and digest != expected_digest:
+                raise ImageCacheError("{} is corrupted (MD5 hash {} instead of {})".format(file_name, digest, expected_digest))
+            path = self._object_path(digest)
+            if os.path.isfile(path):
+                # same content as another image
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        log.info("{} downloaded ({} bytes, MD5 hash {})".format(file_name, size, digest))
+        return path
+
+    def _store(self, source, path):
+        """
+        Adds an existing file to the object directory.
+
+        :param source: path to the file
+        :param path: path to the stored object
+        """
+
+        os.makedirs(self._objects_dir, exist_ok=True)
+        self._link(source, path)
+
+    @staticmethod
+    def _link(source, destination):
+        """
+        Atomically makes destination a hard link to source (or a copy if
+        hard links are not supported, e.g. on another file system).
+
+        :param source: existing file
+        :param destination: path of the link
+        """
+
+        if os.path.isfile(destination) and os.path.samefile(source, destination):
+            return
+        directory = os.path.dirname(destination)
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, ".{}.{}.tmp".format(os.path.basename(destination), threading.get_ident()))
+        try:
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, destination)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
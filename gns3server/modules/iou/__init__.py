@@ -22,21 +22,22 @@ IOU server module.
 import os
 import base64
 import ntpath
-import stat
 import tempfile
 import socket
 import shutil
 
 from gns3server.modules import IModule
 from gns3server.config import Config
-from gns3dms.cloud.rackspace_ctrl import get_provider
 from .iou_device import IOUDevice
 from .iou_error import IOUError
 from .nios.nio_udp import NIO_UDP
 from .nios.nio_tap import NIO_TAP
 from .nios.nio_generic_ethernet import NIO_GenericEthernet
 from ..attic import find_unused_port
-from ..attic import has_privileged_access
+from ..attic import call_in_parallel
+from ..console_hub import DEFAULT_SCROLLBACK_SIZE
+from ..image_cache import ImageCache, ImageCacheError
+from ..process_log import MAX_PAGE_SIZE
 
 from .schemas import IOU_CREATE_SCHEMA
 from .schemas import IOU_DELETE_SCHEMA
@@ -49,7 +50,13 @@ from .schemas import IOU_ADD_NIO_SCHEMA
 from .schemas import IOU_DELETE_NIO_SCHEMA
 from .schemas import IOU_START_CAPTURE_SCHEMA
 from .schemas import IOU_STOP_CAPTURE_SCHEMA
+from .schemas import IOU_SET_LINK_CONDITIONS_SCHEMA
 from .schemas import IOU_EXPORT_CONFIG_SCHEMA
+from .schemas import IOU_CONSOLE_BUFFER_SCHEMA
+from .schemas import IOU_RESOURCE_USAGE_SCHEMA
+from .schemas import IOU_PROCESS_LOG_SCHEMA
+from .schemas import IOU_CONSOLE_WATCH_SCHEMA
+from .schemas import IOU_CONSOLE_UNWATCH_SCHEMA
 
 import logging
 log = logging.getLogger(__name__)
@@ -66,31 +73,19 @@ class IOU(IModule):
 
     def __init__(self, name, *args, **kwargs):
 
-        # get the iouyap location
         config = Config.instance()
         iou_config = config.get_section_config(name.upper())
-        self._iouyap = iou_config.get("iouyap_path")
-        if not self._iouyap or not os.path.isfile(self._iouyap):
-            paths = [os.getcwd()] + os.environ["PATH"].split(os.pathsep)
-            # look for iouyap in the current working directory and $PATH
-            for path in paths:
-                try:
-                    if "iouyap" in os.listdir(path) and os.access(os.path.join(path, "iouyap"), os.X_OK):
-                        self._iouyap = os.path.join(path, "iouyap")
-                        break
-                except OSError:
-                    continue
-
-        if not self._iouyap:
-            log.warning("iouyap binary couldn't be found!")
-        elif not os.access(self._iouyap, os.X_OK):
-            log.warning("iouyap is not executable")
+        if "iouyap_path" in iou_config:
+            # the links are relayed by the IOU bridge, TAP and Ethernet
+            # interfaces by the raw relay helper (gns3-raw-relay)
+            log.warning("the iouyap_path setting is deprecated and ignored")
 
         # a new process start when calling IModule
         IModule.__init__(self, name, *args, **kwargs)
         self._iou_instances = {}
         self._console_start_port_range = iou_config.get("console_start_port_range", 4001)
         self._console_end_port_range = iou_config.get("console_end_port_range", 4500)
+        self._console_scrollback_size = int(iou_config.get("console_scrollback_size", DEFAULT_SCROLLBACK_SIZE))
         self._allocated_udp_ports = []
         self._udp_start_port_range = iou_config.get("udp_start_port_range", 30001)
         self._udp_end_port_range = iou_config.get("udp_end_port_range", 35000)
@@ -115,38 +110,52 @@ class IOU(IModule):
         self._iou_callback.stop()
 
         # delete all IOU instances
-        for iou_id in self._iou_instances:
-            iou_instance = self._iou_instances[iou_id]
-            iou_instance.delete()
+        for iou_instance, e in call_in_parallel(lambda iou_instance: iou_instance.delete(), self._iou_instances.values()):
+            log.error("could not delete IOU instance {}: {}".format(iou_instance.name, e))
 
         self.delete_iourc_file()
 
         IModule.stop(self, signum)  # this will stop the I/O loop
 
+    def _console_matched(self, iou_instance, watch_id, pattern, session):
+        """
+        Callback for the patterns found in the console output.
+        Called from the console hub thread, the notification is
+        sent from the I/O loop to the client that registered the watch.
+
+        :param iou_instance: IOUDevice instance
+        :param watch_id: watch identifier
+        :param pattern: pattern found
+        :param session: session of the client that registered the watch
+        """
+
+        notification = {"module": self.name,
+                        "id": iou_instance.id,
+                        "name": iou_instance.name,
+                        "watch_id": watch_id,
+                        "pattern": pattern}
+        self._ioloop.add_callback(self.send_notification, "{}.console_match".format(self.name), notification, session)
+
     def _check_iou_is_alive(self):
         """
-        Periodic callback to check if IOU and iouyap are alive
+        Periodic callback to check if IOU is alive
         for each IOU instance.
 
-        Sends a notification to the client if not.
+        Sends a notification to the client if not (iou.iou_stopped, the
+        iou.iouyap_stopped notification is no longer sent since there
+        is no iouyap process any more).
         """
 
         for iou_id in self._iou_instances:
             iou_instance = self._iou_instances[iou_id]
-            if iou_instance.started and (not iou_instance.is_running() or not iou_instance.is_iouyap_running()):
+            if iou_instance.started and not iou_instance.is_running():
                 notification = {"module": self.name,
                                 "id": iou_id,
                                 "name": iou_instance.name}
-                if not iou_instance.is_running():
-                    stdout = iou_instance.read_iou_stdout()
-                    notification["message"] = "IOU has stopped running"
-                    notification["details"] = stdout
-                    self.send_notification("{}.iou_stopped".format(self.name), notification)
-                elif not iou_instance.is_iouyap_running():
-                    stdout = iou_instance.read_iouyap_stdout()
-                    notification["message"] = "iouyap has stopped running"
-                    notification["details"] = stdout
-                    self.send_notification("{}.iouyap_stopped".format(self.name), notification)
+                stdout = iou_instance.read_iou_stdout()
+                notification["message"] = "IOU has stopped running"
+                notification["details"] = stdout
+                self.send_notification("{}.iou_stopped".format(self.name), notification)
                 iou_instance.stop()
 
     def get_iou_instance(self, iou_id):
@@ -185,9 +194,8 @@ class IOU(IModule):
         """
 
         # delete all IOU instances
-        for iou_id in self._iou_instances:
-            iou_instance = self._iou_instances[iou_id]
-            iou_instance.delete()
+        for iou_instance, e in call_in_parallel(lambda iou_instance: iou_instance.delete(), self._iou_instances.values()):
+            log.error("could not delete IOU instance {}: {}".format(iou_instance.name, e))
 
         # resets the instance IDs
         IOUDevice.reset()
@@ -208,7 +216,6 @@ class IOU(IModule):
         - iourc (base64 encoded iourc file)
 
         Optional request parameters:
-        - iouyap (path to iouyap)
         - working_dir (path to a working directory)
         - project_name
         - console_start_port_range
@@ -216,6 +223,9 @@ class IOU(IModule):
         - udp_start_port_range
         - udp_end_port_range
 
+        Deprecated request parameters (ignored):
+        - iouyap (iouyap is replaced by the IOU bridge)
+
         :param request: JSON request
         """
 
@@ -223,6 +233,9 @@ class IOU(IModule):
             self.send_param_error()
             return
 
+        if request.get("iouyap"):
+            log.warning("the iouyap setting is deprecated and ignored")
+
         if "iourc" in request:
             iourc_content = base64.decodebytes(request["iourc"].encode("utf-8")).decode("utf-8")
             iourc_content = iourc_content.replace("\r\n", "\n")  # dos2unix
@@ -234,10 +247,6 @@ class IOU(IModule):
             except OSError as e:
                 raise IOUError("Could not create the iourc file: {}".format(e))
 
-        if "iouyap" in request and request["iouyap"]:
-            self._iouyap = request["iouyap"]
-            log.info("iouyap path set to {}".format(self._iouyap))
-
         if "working_dir" in request:
             new_working_dir = request["working_dir"]
             log.info("this server is local with working directory path to {}".format(new_working_dir))
@@ -295,30 +304,50 @@ class IOU(IModule):
         if not self.validate_request(request, IOU_CREATE_SCHEMA):
             return
 
-        name = request["name"]
         iou_path = request["path"]
-        console = request.get("console")
-        iou_id = request.get("iou_id")
-
         updated_iou_path = os.path.join(self.images_directory, iou_path)
         if os.path.isfile(updated_iou_path):
             iou_path = updated_iou_path
         else:
-            if not os.path.exists(self.images_directory):
-                os.mkdir(self.images_directory)
             cloud_path = request.get("cloud_path", None)
             if cloud_path is not None:
-                # Download the image from cloud files
+                # download the image from cloud files in the background
                 _, filename = ntpath.split(iou_path)
                 src = '{}/{}'.format(cloud_path, filename)
-                provider = get_provider(self._cloud_settings)
                 log.debug("Downloading file from {} to {}...".format(src, updated_iou_path))
-                provider.download_file(src, updated_iou_path)
-                log.debug("Download of {} complete.".format(src))
-                # Make file executable
-                st = os.stat(updated_iou_path)
-                os.chmod(updated_iou_path, st.st_mode | stat.S_IEXEC)
-                iou_path = updated_iou_path
+                future = ImageCache.instance().fetch(src, updated_iou_path, executable=True)
+                self.add_future(future, lambda future: self._iou_image_fetched(request, future))
+                return
+
+        self._create_iou_instance(request, iou_path)
+
+    def _iou_image_fetched(self, request, future):
+        """
+        Creates an IOU instance once its image has been downloaded.
+
+        :param request: JSON request
+        :param future: Future with the path to the image
+        """
+
+        try:
+            iou_path = future.result()
+        except ImageCacheError as e:
+            self.send_custom_error(str(e))
+            return
+        log.debug("Download of {} complete.".format(iou_path))
+        self._create_iou_instance(request, iou_path)
+
+    def _create_iou_instance(self, request, iou_path):
+        """
+        Creates an IOU instance and sends the response.
+
+        :param request: JSON request
+        :param iou_path: path to the IOU image
+        """
+
+        name = request["name"]
+        console = request.get("console")
+        iou_id = request.get("iou_id")
 
         try:
             iou_instance = IOUDevice(name,
@@ -328,7 +357,8 @@ class IOU(IModule):
                                      console,
                                      self._console_host,
                                      self._console_start_port_range,
-                                     self._console_end_port_range)
+                                     self._console_end_port_range,
+                                     self._console_scrollback_size)
 
         except IOUError as e:
             self.send_custom_error(str(e))
@@ -339,6 +369,7 @@ class IOU(IModule):
 
         defaults = iou_instance.defaults()
         response.update(defaults)
+        iou_instance.set_console_match_callback(self._console_matched)
         self._iou_instances[iou_instance.id] = iou_instance
         self.send_response(response)
 
@@ -472,7 +503,6 @@ class IOU(IModule):
             return
 
         try:
-            iou_instance.iouyap = self._iouyap
             iou_instance.iourc = self._iourc
             iou_instance.start()
         except IOUError as e:
@@ -637,14 +667,11 @@ class IOU(IModule):
                     raise IOUError("Could not create an UDP connection to {}:{}: {}".format(rhost, rport, e))
                 nio = NIO_UDP(lport, rhost, rport)
             elif request["nio"]["type"] == "nio_tap":
+                # the device is opened by the privileged raw relay helper
                 tap_device = request["nio"]["tap_device"]
-                if not has_privileged_access(self._iouyap):
-                    raise IOUError("{} has no privileged access to {}.".format(self._iouyap, tap_device))
                 nio = NIO_TAP(tap_device)
             elif request["nio"]["type"] == "nio_generic_ethernet":
                 ethernet_device = request["nio"]["ethernet_device"]
-                if not has_privileged_access(self._iouyap):
-                    raise IOUError("{} has no privileged access to {}.".format(self._iouyap, ethernet_device))
                 nio = NIO_GenericEthernet(ethernet_device)
             if not nio:
                 raise IOUError("Requested NIO does not exist or is not supported: {}".format(request["nio"]["type"]))
@@ -781,6 +808,52 @@ class IOU(IModule):
         response = {"port_id": request["port_id"]}
         self.send_response(response)
 
+    @IModule.route("iou.set_link_conditions")
+    def set_link_conditions(self, request):
+        """
+        Sets the conditions (delay, jitter, loss, rate limit) of a link.
+        Applied by the IOU bridge, the instance doesn't need to be restarted.
+
+        Mandatory request parameters:
+        - id (vm identifier)
+        - slot (slot number)
+        - port (port number)
+        - port_id (port identifier)
+
+        Optional request parameters:
+        - in (conditions of the frames received by the port)
+        - out (conditions of the frames sent by the port)
+
+        Response parameters:
+        - port_id (port identifier)
+        - in (settings and statistics or None)
+        - out (settings and statistics or None)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, IOU_SET_LINK_CONDITIONS_SCHEMA):
+            return
+
+        # get the instance
+        iou_instance = self.get_iou_instance(request["id"])
+        if not iou_instance:
+            return
+
+        slot = request["slot"]
+        port = request["port"]
+        try:
+            conditions = iou_instance.set_link_conditions(slot, port, request.get("in"), request.get("out"))
+        except IOUError as e:
+            self.send_custom_error(str(e))
+            return
+
+        response = {"port_id": request["port_id"],
+                    "in": conditions["in"],
+                    "out": conditions["out"]}
+        self.send_response(response)
+
     @IModule.route("iou.export_config")
     def export_config(self, request):
         """
@@ -822,6 +895,175 @@ class IOU(IModule):
         else:
             self.send_response(response)
 
+    @IModule.route("iou.console_buffer")
+    def console_buffer(self, request):
+        """
+        Gets the recent console output (scrollback buffer).
+
+        Mandatory request parameters:
+        - id (IOU device identifier)
+
+        Optional request parameters:
+        - size (maximum number of bytes to return)
+
+        Response parameters:
+        - id (IOU device identifier)
+        - console_output_base64 (console output base64 encoded)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, IOU_CONSOLE_BUFFER_SCHEMA):
+            return
+
+        # get the instance
+        iou_instance = self.get_iou_instance(request["id"])
+        if not iou_instance:
+            return
+
+        output = iou_instance.console_buffer.read(request.get("size"))
+        response = {"id": request["id"],
+                    "console_output_base64": base64.encodebytes(output).decode("utf-8")}
+        self.send_response(response)
+
+    @IModule.route("iou.console_watch")
+    def console_watch(self, request):
+        """
+        Watches the console output of an IOU instance for a pattern
+        (the iou.console_match notification is sent when it is found).
+
+        Mandatory request parameters:
+        - id (IOU device identifier)
+        - pattern (text to look for)
+
+        Optional request parameters:
+        - once (remove the watch after the first match, true by default)
+        - scrollback (also look in the recent console output, true by default)
+
+        Response parameters:
+        - id (IOU device identifier)
+        - watch_id (watch identifier)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, IOU_CONSOLE_WATCH_SCHEMA):
+            return
+
+        # get the instance
+        iou_instance = self.get_iou_instance(request["id"])
+        if not iou_instance:
+            return
+
+        watcher = iou_instance.console_watcher
+        watch_id = watcher.add(request["pattern"],
+                               request.get("once", True),
+                               request.get("scrollback", True),
+                               self._current_session)
+        self.send_response({"id": request["id"],
+                            "watch_id": watch_id})
+
+    @IModule.route("iou.console_unwatch")
+    def console_unwatch(self, request):
+        """
+        Stops watching the console output of an IOU instance.
+
+        Mandatory request parameters:
+        - id (IOU device identifier)
+
+        Optional request parameters:
+        - watch_id (watch identifier, all the watches by default)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, IOU_CONSOLE_UNWATCH_SCHEMA):
+            return
+
+        # get the instance
+        iou_instance = self.get_iou_instance(request["id"])
+        if not iou_instance:
+            return
+
+        if "watch_id" not in request:
+            iou_instance.console_watcher.clear()
+        elif not iou_instance.console_watcher.remove(request["watch_id"]):
+            self.send_custom_error("Watch {} doesn't exist".format(request["watch_id"]))
+            return
+        self.send_response(True)
+
+    @IModule.route("iou.resource_usage")
+    def resource_usage(self, request):
+        """
+        Gets the resource usage of an IOU instance.
+
+        Mandatory request parameters:
+        - id (IOU device identifier)
+
+        Response parameters:
+        - id (IOU device identifier)
+        - controlled (either the resource limits are enforced with cgroups)
+        - usage (CPU time, throttling and memory counters)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, IOU_RESOURCE_USAGE_SCHEMA):
+            return
+
+        # get the instance
+        iou_instance = self.get_iou_instance(request["id"])
+        if not iou_instance:
+            return
+
+        self.send_response({"id": request["id"],
+                            "controlled": iou_instance.resources_controlled,
+                            "usage": iou_instance.resource_usage()})
+
+    @IModule.route("iou.process_log")
+    def process_log(self, request):
+        """
+        Reads a page of the log of the IOU process (standard output
+        and error, rotated logs included).
+
+        Mandatory request parameters:
+        - id (IOU device identifier)
+
+        Optional request parameters:
+        - offset (position in the log, from the end if negative, the last page by default)
+        - size (maximum number of bytes to return)
+
+        Response parameters:
+        - id (IOU device identifier)
+        - log (text)
+        - offset (position of the page in the log)
+        - size (offset of the end of the log, the offsets are stable across rotations)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, IOU_PROCESS_LOG_SCHEMA):
+            return
+
+        # get the instance
+        iou_instance = self.get_iou_instance(request["id"])
+        if not iou_instance:
+            return
+
+        text, offset, size = iou_instance.read_log(request.get("offset"), request.get("size", MAX_PAGE_SIZE))
+        self.send_response({"id": request["id"],
+                            "log": text,
+                            "offset": offset,
+                            "size": size})
+
     @IModule.route("iou.echo")
     def echo(self, request):
         """
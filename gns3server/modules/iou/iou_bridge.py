@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Bridge relaying the frames of all the IOU instances to their UDP tunnels,
+TAP and Ethernet interfaces (replaces one iouyap process per IOU instance).
+
+IOU instances exchange frames over UNIX datagram sockets named after their
+application ID in /tmp/netio<uid>. Each frame starts with an 8-byte header:
+destination ID, source ID (16-bit, network order), destination port, source
+port (unit << 4 | bay), message type and channel. Like iouyap, the bridge
+talks to an IOU instance using the application ID + 512 and the NETMAP file
+maps every interface of the instance to the same interface on that ID.
+"""
+
+import os
+import socket
+import struct
+import threading
+
+from .iou_error import IOUError
+from .nios.nio_udp import NIO_UDP
+from .nios.nio_tap import NIO_TAP
+from .nios.nio_generic_ethernet import NIO_GenericEthernet
+from ..fabric import Fabric, FabricError, LinkConditions
+from ..fabric.node import Node
+from ..fabric.ports import Port
+
+import logging
+log = logging.getLogger(__name__)
+
+# the bridge always uses the IOU application ID + 512 (like iouyap)
+BRIDGE_ID_OFFSET = 512
+
+IOU_HEADER = struct.Struct("!HHBBBB")
+IOU_HEADER_SIZE = IOU_HEADER.size
+IOU_MSG_DATA = 1
+
+
+def iou_port_number(bay, unit):
+    """
+    Returns the port number used in the IOU headers for an interface.
+
+    :param bay: bay (slot) number
+    :param unit: unit (port) number
+
+    :returns: port number
+    """
+
+    return (unit << 4) | bay
+
+
+class IOUSocketPort(Port):
+    """
+    UNIX datagram socket used to exchange frames with an IOU instance.
+
+    :param name: port name
+    :param netio: directory of the IOU sockets
+    :param iou_id: IOU application ID
+    """
+
+    def __init__(self, name, netio, iou_id):
+
+        Port.__init__(self, name)
+        self._iou_id = iou_id
+        self._bridge_id = iou_id + BRIDGE_ID_OFFSET
+        self._path = os.path.join(netio, str(self._bridge_id))
+        self._destination = os.path.join(netio, str(iou_id))
+
+        try:
+            os.makedirs(netio, exist_ok=True)
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+        except OSError as e:
+            raise FabricError("Could not prepare {}: {}".format(self._path, e))
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self._socket.bind(self._path)
+        except OSError as e:
+            self._socket.close()
+            self._socket = None
+            raise FabricError("Could not bind {}: {}".format(self._path, e))
+        self._socket.setblocking(False)
+
+    def header(self, bay, unit):
+        """
+        Returns the header of the frames sent to an interface of the IOU instance.
+
+        :param bay: bay (slot) number
+        :param unit: unit (port) number
+
+        :returns: header (bytes)
+        """
+
+        port = iou_port_number(bay, unit)
+        return IOU_HEADER.pack(self._iou_id, self._bridge_id, port, port, IOU_MSG_DATA, 0)
+
+    def fileno(self):
+
+        return self._socket.fileno() if self._socket else None
+
+    def recv_into(self, buffer):
+        """
+        Reads one frame (including the IOU header).
+
+        :param buffer: buffer to read into
+
+        :returns: size of the frame
+        """
+
+        return self._socket.recv_into(buffer)
+
+    def send_frame(self, header, frame):
+        """
+        Sends a frame to the IOU instance.
+
+        :param header: IOU header (see header())
+        :param frame: Ethernet or serial frame
+        """
+
+        if not self._socket:
+            return
+        Port.transmit(self, frame)
+        try:
+            self._socket.sendmsg([header, frame], [], 0, self._destination)
+        except (BlockingIOError, InterruptedError, FileNotFoundError, ConnectionRefusedError):
+            pass  # IOU is busy or not listening (yet), drop the frame
+        except OSError as e:
+            log.debug("{}: could not send to {}: {}".format(self._name, self._destination, e))
+
+    def close(self):
+
+        Port.close(self)
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+
+
+class IOUInstanceNode(Node):
+    """
+    Fabric node relaying the frames between an IOU instance and the
+    ports connected to its interfaces.
+
+    :param name: node name
+    :param iou_port: IOUSocketPort instance
+    """
+
+    def __init__(self, name, iou_port):
+
+        Node.__init__(self, name)
+        self._iou_port = iou_port
+        self._links = {}    # IOU port number -> Port instance
+        self._headers = {}  # Port instance -> IOU header
+
+    @property
+    def iou_port(self):
+        """
+        Returns the socket port of the IOU instance.
+
+        :returns: IOUSocketPort instance
+        """
+
+        return self._iou_port
+
+    def get_link(self, bay, unit):
+        """
+        Returns the port connected to an interface.
+
+        :param bay: bay (slot) number
+        :param unit: unit (port) number
+
+        :returns: Port instance or None
+        """
+
+        return self._links.get(iou_port_number(bay, unit))
+
+    def set_link(self, bay, unit, port):
+        """
+        Connects a port to an interface (the port must also be bound to this node).
+
+        :param bay: bay (slot) number
+        :param unit: unit (port) number
+        :param port: Port instance
+        """
+
+        self._links[iou_port_number(bay, unit)] = port
+        self._headers[port] = self._iou_port.header(bay, unit)
+
+    def remove_link(self, bay, unit):
+        """
+        Disconnects the port connected to an interface.
+
+        :param bay: bay (slot) number
+        :param unit: unit (port) number
+
+        :returns: Port instance or None
+        """
+
+        port = self._links.pop(iou_port_number(bay, unit), None)
+        if port is not None:
+            del self._headers[port]
+        return port
+
+    def receive(self, port, frame):
+
+        if port is self._iou_port:
+            if len(frame) <= IOU_HEADER_SIZE:
+                return
+            # the source port is the IOU interface that sent the frame
+            link = self._links.get(frame[5])
+            if link is not None:
+                link.send(frame[IOU_HEADER_SIZE:])
+        else:
+            header = self._headers.get(port)
+            if header is not None:
+                self._iou_port.send_frame(header, frame)
+
+
+class IOUBridge(object):
+    """
+    Relays the frames of all the IOU instances of this process. The links
+    are changed in memory (no configuration file, no signal) and the
+    packet captures are written by the relay itself.
+
+    :param shards: number of forwarding threads (see Fabric)
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, shards=1):
+
+        self._fabric = Fabric(shards)
+        self._netio = "/tmp/netio{}".format(os.getuid())
+        self._nodes = {}
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the bridge of this process (created on first use).
+
+        :returns: IOUBridge instance
+        """
+
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def _get_node(self, iou_id):
+
+        if iou_id not in self._nodes:
+            raise IOUError("IOU instance {} is not connected to the bridge".format(iou_id))
+        return self._nodes[iou_id]
+
+    def has_instance(self, iou_id):
+        """
+        Returns either an IOU instance is connected to the bridge.
+
+        :param iou_id: IOU application ID
+
+        :returns: boolean
+        """
+
+        return iou_id in self._nodes
+
+    def add_instance(self, iou_id):
+        """
+        Connects an IOU instance to the bridge.
+
+        :param iou_id: IOU application ID
+        """
+
+        if iou_id in self._nodes:
+            return
+        name = "IOU{}".format(iou_id)
+        try:
+            iou_port = self._fabric.add_port(IOUSocketPort(name, self._netio, iou_id))
+            node = IOUInstanceNode(name, iou_port)
+            try:
+                self._fabric.add_node(node)
+                self._fabric.bind(name, name)
+            except FabricError:
+                if name in self._fabric.nodes:
+                    self._fabric.delete_node(name)
+                self._fabric.delete_port(name)
+                raise
+        except FabricError as e:
+            raise IOUError("Could not connect IOU instance {} to the bridge: {}".format(iou_id, e))
+        self._nodes[iou_id] = node
+        log.info("IOU instance {} connected to the bridge".format(iou_id))
+
+    def remove_instance(self, iou_id):
+        """
+        Disconnects an IOU instance and deletes all its links.
+
+        :param iou_id: IOU application ID
+        """
+
+        node = self._nodes.pop(iou_id, None)
+        if node is None:
+            return
+        ports = [port.name for port in node.ports]
+        try:
+            self._fabric.delete_node(node.name)
+            for name in ports:
+                self._fabric.delete_port(name)
+        except FabricError as e:
+            log.error("could not disconnect IOU instance {} from the bridge: {}".format(iou_id, e))
+        log.info("IOU instance {} disconnected from the bridge".format(iou_id))
+
+    def add_link(self, iou_id, bay, unit, nio):
+        """
+        Connects an interface of an IOU instance to a NIO.
+
+        :param iou_id: IOU application ID
+        :param bay: bay (slot) number
+        :param unit: unit (port) number
+        :param nio: NIO instance
+        """
+
+        node = self._get_node(iou_id)
+        self.remove_link(iou_id, bay, unit)
+        name = "{}-{}/{}".format(node.name, bay, unit)
+        try:
+            if isinstance(nio, NIO_UDP):
+                laddr = "::" if ":" in nio.rhost else "0.0.0.0"
+                port = self._fabric.create_udp_port(name, laddr, nio.lport, nio.rhost, nio.rport)
+            elif isinstance(nio, NIO_TAP):
+                port = self._fabric.create_tap_port(name, nio.tap_device)
+            elif isinstance(nio, NIO_GenericEthernet):
+                port = self._fabric.create_ethernet_port(name, nio.ethernet_device)
+            else:
+                raise IOUError("NIO {} is not supported by the IOU bridge".format(nio))
+
+            if nio.capturing:
+                port.start_capture("both", nio.pcap_output_file, nio.pcap_data_link_type)
+            for direction, settings in nio.link_conditions.items():
+                port.set_conditions(direction, LinkConditions.from_settings(settings))
+            with node.shard.lock:
+                node.set_link(bay, unit, port)
+            self._fabric.bind(node.name, name)
+        except FabricError as e:
+            with node.shard.lock:
+                node.remove_link(bay, unit)
+            if name in self._fabric.ports:
+                self._fabric.delete_port(name)
+            raise IOUError("Could not connect {} to {}: {}".format(name, nio, e))
+        log.info("IOU bridge: {} connected to {}".format(name, nio))
+
+    def remove_link(self, iou_id, bay, unit):
+        """
+        Disconnects an interface of an IOU instance.
+
+        :param iou_id: IOU application ID
+        :param bay: bay (slot) number
+        :param unit: unit (port) number
+        """
+
+        node = self._nodes.get(iou_id)
+        if node is None:
+            return
+        with node.shard.lock:
+            port = node.remove_link(bay, unit)
+        if port is not None:
+            try:
+                self._fabric.delete_port(port.name)
+            except FabricError as e:
+                log.error("could not delete {}: {}".format(port.name, e))
+            log.info("IOU bridge: {} disconnected".format(port.name))
+
+    def _get_link(self, iou_id, bay, unit):
+
+        node = self._get_node(iou_id)
+        port = node.get_link(bay, unit)
+        if port is None:
+            raise IOUError("Interface {}/{} of IOU instance {} is not connected".format(bay, unit, iou_id))
+        return node, port
+
+    def start_capture(self, iou_id, bay, unit, output_file, data_link_type="DLT_EN10MB"):
+        """
+        Starts a packet capture on an interface.
+
+        :param iou_id: IOU application ID
+        :param bay: bay (slot) number
+        :param unit: unit (port) number
+        :param output_file: PCAP destination file for the capture
+        :param data_link_type: PCAP data link type (DLT_*)
+        """
+
+        node, port = self._get_link(iou_id, bay, unit)
+        try:
+            with node.shard.lock:
+                port.start_capture("both", output_file, data_link_type)
+        except FabricError as e:
+            raise IOUError(str(e))
+
+    def stop_capture(self, iou_id, bay, unit):
+        """
+        Stops a packet capture on an interface.
+
+        :param iou_id: IOU application ID
+        :param bay: bay (slot) number
+        :param unit: unit (port) number
+        """
+
+        node, port = self._get_link(iou_id, bay, unit)
+        with node.shard.lock:
+            port.stop_capture()
+
+    def set_link_conditions(self, iou_id, bay, unit, conditions_in, conditions_out):
+        """
+        Sets the conditions (delay, loss...) of the link of an interface.
+
+        :param iou_id: IOU application ID
+        :param bay: bay (slot) number
+        :param unit: unit (port) number
+        :param conditions_in: settings for the frames sent to the interface (or None)
+        :param conditions_out: settings for the frames sent by the interface (or None)
+
+        :returns: dictionary with the "in" and "out" settings and statistics
+        """
+
+        node, port = self._get_link(iou_id, bay, unit)
+        with node.shard.lock:
+            port.set_conditions("in", LinkConditions.from_settings(conditions_in))
+            port.set_conditions("out", LinkConditions.from_settings(conditions_out))
+            return port.get_conditions()
+
+    def get_link_conditions(self, iou_id, bay, unit):
+        """
+        Returns the conditions and statistics of the link of an interface.
+
+        :param iou_id: IOU application ID
+        :param bay: bay (slot) number
+        :param unit: unit (port) number
+
+        :returns: dictionary with the "in" and "out" settings and statistics
+        """
+
+        node, port = self._get_link(iou_id, bay, unit)
+        with node.shard.lock:
+            return port.get_conditions()
+
+    def stop(self):
+        """
+        Disconnects all the IOU instances and stops the relay.
+        """
+
+        self._nodes.clear()
+        self._fabric.stop()
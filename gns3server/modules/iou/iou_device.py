@@ -21,22 +21,20 @@ order to run an IOU instance.
 """
 
 import os
-import re
-import signal
 import subprocess
-import argparse
-import threading
-import configparser
 import shutil
 
-from .ioucon import start_ioucon
 from .iou_error import IOUError
 from .adapters.ethernet_adapter import EthernetAdapter
 from .adapters.serial_adapter import SerialAdapter
-from .nios.nio_udp import NIO_UDP
-from .nios.nio_tap import NIO_TAP
-from .nios.nio_generic_ethernet import NIO_GenericEthernet
+from .iou_bridge import IOUBridge, BRIDGE_ID_OFFSET
+from .iou_image_cache import IOUImageCache
 from ..attic import find_unused_port
+from ..cgroups import NodeResources, CgroupError
+from ..console_hub import IOUConsole, ConsoleBuffer, DEFAULT_SCROLLBACK_SIZE
+from ..console_watcher import ConsoleWatcher
+from ..process_log import ProcessLog, MAX_PAGE_SIZE
+from ..sharding import owns
 
 import logging
 log = logging.getLogger(__name__)
@@ -54,6 +52,7 @@ class IOUDevice(object):
     :param console_host: IP address to bind for console connections
     :param console_start_port_range: TCP console port range start
     :param console_end_port_range: TCP console port range end
+    :param console_scrollback_size: size of the console scrollback buffer
     """
 
     _instances = []
@@ -67,13 +66,14 @@ class IOUDevice(object):
                  console=None,
                  console_host="0.0.0.0",
                  console_start_port_range=4001,
-                 console_end_port_range=4512):
+                 console_end_port_range=4512,
+                 console_scrollback_size=DEFAULT_SCROLLBACK_SIZE):
 
         if not iou_id:
             # find an instance identifier if none is provided (0 < id <= 512)
             self._id = 0
             for identifier in range(1, 513):
-                if identifier not in self._instances:
+                if identifier not in self._instances and owns(identifier):
                     self._id = identifier
                     self._instances.append(self._id)
                     break
@@ -89,16 +89,16 @@ class IOUDevice(object):
         self._name = name
         self._path = path
         self._iourc = ""
-        self._iouyap = ""
         self._console = console
         self._working_dir = None
         self._command = []
         self._process = None
-        self._iouyap_process = None
-        self._iou_stdout_file = ""
-        self._iouyap_stdout_file = ""
-        self._ioucon_thead = None
-        self._ioucon_thread_stop_event = None
+        self._iou_stdout_log = None
+        self._ioucon = None
+        self._bridge = None
+        self._console_buffer = ConsoleBuffer(console_scrollback_size)
+        self._console_watcher = ConsoleWatcher(name, self._console_matched, self._console_buffer)
+        self._console_match_callback = None
         self._started = False
         self._console_host = console_host
         self._console_start_port_range = console_start_port_range
@@ -113,6 +113,7 @@ class IOUDevice(object):
         self._initial_config = ""
         self._ram = 256  # Megabytes
         self._l1_keepalives = False  # used to overcome the always-up Ethernet interfaces (not supported by all IOSes).
+        self._resources = NodeResources("iou-{}".format(self._id))
 
         working_dir_path = os.path.join(working_dir, "iou", "device-{}".format(self._id))
 
@@ -260,29 +261,6 @@ class IOUDevice(object):
                                                                               id=self._id,
                                                                               path=self._iourc))
 
-    @property
-    def iouyap(self):
-        """
-        Returns the path to iouyap
-
-        :returns: path to iouyap
-        """
-
-        return self._iouyap
-
-    @iouyap.setter
-    def iouyap(self, iouyap):
-        """
-        Sets the path to iouyap.
-
-        :param iouyap: path to iouyap
-        """
-
-        self._iouyap = iouyap
-        log.info("IOU {name} [id={id}]: iouyap path set to {path}".format(name=self._name,
-                                                                          id=self._id,
-                                                                          path=self._iouyap))
-
     @property
     def working_dir(self):
         """
@@ -341,6 +319,41 @@ class IOUDevice(object):
                                                                            id=self._id,
                                                                            port=console))
 
+    @property
+    def console_buffer(self):
+        """
+        Returns the console scrollback buffer (recent console output).
+
+        :returns: ConsoleBuffer instance
+        """
+
+        return self._console_buffer
+
+    @property
+    def console_watcher(self):
+        """
+        Returns the patterns watched in the console output.
+
+        :returns: ConsoleWatcher instance
+        """
+
+        return self._console_watcher
+
+    def set_console_match_callback(self, callback):
+        """
+        Sets a callback to be called when a watched pattern is found in the console output.
+        The callback is called from the console hub thread.
+
+        :param callback: callable receiving this device, the watch ID, the pattern and the watch context
+        """
+
+        self._console_match_callback = callback
+
+    def _console_matched(self, watch_id, pattern, context):
+
+        if self._console_match_callback:
+            self._console_match_callback(self, watch_id, pattern, context)
+
     def command(self):
         """
         Returns the IOU command line.
@@ -356,6 +369,7 @@ class IOUDevice(object):
         """
 
         self.stop()
+        self._console_watcher.clear()
         if self._id in self._instances:
             self._instances.remove(self._id)
 
@@ -371,6 +385,7 @@ class IOUDevice(object):
         """
 
         self.stop()
+        self._console_watcher.clear()
         if self._id in self._instances:
             self._instances.remove(self._id)
 
@@ -398,81 +413,30 @@ class IOUDevice(object):
 
         return self._started
 
-    def _update_iouyap_config(self):
-        """
-        Updates the iouyap.ini file.
-        """
-
-        iouyap_ini = os.path.join(self._working_dir, "iouyap.ini")
-
-        config = configparser.ConfigParser()
-        config["default"] = {"netmap": "NETMAP",
-                             "base_port": "49000"}
-
-        bay_id = 0
-        for adapter in self._slots:
-            unit_id = 0
-            for unit in adapter.ports.keys():
-                nio = adapter.get_nio(unit)
-                if nio:
-                    connection = None
-                    if isinstance(nio, NIO_UDP):
-                        # UDP tunnel
-                        connection = {"tunnel_udp": "{lport}:{rhost}:{rport}".format(lport=nio.lport,
-                                                                                     rhost=nio.rhost,
-                                                                                     rport=nio.rport)}
-                    elif isinstance(nio, NIO_TAP):
-                        # TAP interface
-                        connection = {"tap_dev": "{tap_device}".format(tap_device=nio.tap_device)}
-
-                    elif isinstance(nio, NIO_GenericEthernet):
-                        # Ethernet interface
-                        connection = {"eth_dev": "{ethernet_device}".format(ethernet_device=nio.ethernet_device)}
-
-                    if connection:
-                        interface = "{iouyap_id}:{bay}/{unit}".format(iouyap_id=str(self._id + 512), bay=bay_id, unit=unit_id)
-                        config[interface] = connection
-
-                        if nio.capturing:
-                            pcap_data_link_type = nio.pcap_data_link_type.upper()
-                            if pcap_data_link_type == "DLT_PPP_SERIAL":
-                                pcap_protocol = "ppp"
-                            elif pcap_data_link_type == "DLT_C_HDLC":
-                                pcap_protocol = "hdlc"
-                            elif pcap_data_link_type == "DLT_FRELAY":
-                                pcap_protocol = "fr"
-                            else:
-                                pcap_protocol = "ethernet"
-                            capture_info = {"pcap_file": "{pcap_file}".format(pcap_file=nio.pcap_output_file),
-                                            "pcap_protocol": pcap_protocol,
-                                            "pcap_overwrite": "y"}
-                            config[interface].update(capture_info)
-
-                unit_id += 1
-            bay_id += 1
-
-        try:
-            with open(iouyap_ini, "w") as config_file:
-                config.write(config_file)
-            log.info("IOU {name} [id={id}]: iouyap.ini updated".format(name=self._name,
-                                                                       id=self._id))
-        except OSError as e:
-            raise IOUError("Could not create {}: {}".format(iouyap_ini, e))
-
     def _create_netmap_config(self):
         """
-        Creates the NETMAP file.
+        Creates the NETMAP file (only written if its content has changed).
         """
 
         netmap_path = os.path.join(self._working_dir, "NETMAP")
+        lines = []
+        for bay in range(0, 16):
+            for unit in range(0, 4):
+                lines.append("{bridge_id}:{bay}/{unit}{iou_id:>5d}:{bay}/{unit}\n".format(bridge_id=self._id + BRIDGE_ID_OFFSET,
+                                                                                        bay=bay,
+                                                                                        unit=unit,
+                                                                                        iou_id=self._id))
+        netmap = "".join(lines)
+        try:
+            with open(netmap_path) as f:
+                if f.read() == netmap:
+                    return
+        except OSError:
+            pass
+
         try:
             with open(netmap_path, "w") as f:
-                for bay in range(0, 16):
-                    for unit in range(0, 4):
-                        f.write("{iouyap_id}:{bay}/{unit}{iou_id:>5d}:{bay}/{unit}\n".format(iouyap_id=str(self._id + 512),
-                                                                                             bay=bay,
-                                                                                             unit=unit,
-                                                                                             iou_id=self._id))
+                f.write(netmap)
             log.info("IOU {name} [id={id}]: NETMAP file created".format(name=self._name,
                                                                         id=self._id))
         except OSError as e:
@@ -480,53 +444,43 @@ class IOUDevice(object):
 
     def _start_ioucon(self):
         """
-        Starts ioucon thread (for console connections).
+        Starts the IOU console (served by the console hub of this process).
         """
 
-        if not self._ioucon_thead:
-            telnet_server = "{}:{}".format(self._console_host, self.console)
-            log.info("starting ioucon for IOU instance {} to accept Telnet connections on {}".format(self._name, telnet_server))
-            args = argparse.Namespace(appl_id=str(self._id), debug=False, escape='^^', telnet_limit=0, telnet_server=telnet_server)
-            self._ioucon_thread_stop_event = threading.Event()
-            self._ioucon_thead = threading.Thread(target=start_ioucon, args=(args, self._ioucon_thread_stop_event))
-            self._ioucon_thead.start()
+        if not self._ioucon:
+            log.info("starting ioucon for IOU instance {} to accept Telnet connections on {}:{}".format(self._name,
+                                                                                                          self._console_host,
+                                                                                                          self.console))
+            self._console_buffer.clear()
+            ioucon = IOUConsole(self._name, self._id, self._console_host, self.console,
+                                scrollback=self._console_buffer, watcher=self._console_watcher)
+            try:
+                ioucon.start()
+            except OSError as e:
+                raise IOUError("Could not start the console on {}:{}: {}".format(self._console_host, self.console, e))
+            self._ioucon = ioucon
 
-    def _start_iouyap(self):
+    def _connect_bridge(self):
         """
-        Starts iouyap (handles connections to and from this IOU device).
+        Connects this IOU device and its NIOs to the IOU bridge
+        (handles connections to and from this IOU device).
         """
 
-        try:
-            self._update_iouyap_config()
-            command = [self._iouyap, "-q", str(self._id + 512)]  # iouyap has always IOU ID + 512
-            log.info("starting iouyap: {}".format(command))
-            self._iouyap_stdout_file = os.path.join(self._working_dir, "iouyap.log")
-            log.info("logging to {}".format(self._iouyap_stdout_file))
-            with open(self._iouyap_stdout_file, "w") as fd:
-                self._iouyap_process = subprocess.Popen(command,
-                                                        stdout=fd,
-                                                        stderr=subprocess.STDOUT,
-                                                        cwd=self._working_dir)
-
-            log.info("iouyap started PID={}".format(self._iouyap_process.pid))
-        except (OSError, subprocess.SubprocessError) as e:
-            iouyap_stdout = self.read_iouyap_stdout()
-            log.error("could not start iouyap: {}\n{}".format(e, iouyap_stdout))
-            raise IOUError("Could not start iouyap: {}\n{}".format(e, iouyap_stdout))
+        bridge = IOUBridge.instance()
+        bridge.add_instance(self._id)
+        self._bridge = bridge
+        for slot_id, adapter in enumerate(self._slots):
+            for port_id in adapter.ports.keys():
+                nio = adapter.get_nio(port_id)
+                if nio:
+                    bridge.add_link(self._id, slot_id, port_id, nio)
 
     def _library_check(self):
         """
         Checks for missing shared library dependencies in the IOU image.
         """
 
-        try:
-            output = subprocess.check_output(["ldd", self._path])
-        except (FileNotFoundError, subprocess.SubprocessError) as e:
-            log.warn("could not determine the shared library dependencies for {}: {}".format(self._path, e))
-            return
-
-        p = re.compile("([\.\w]+)\s=>\s+not found")
-        missing_libs = p.findall(output.decode("utf-8"))
+        missing_libs = IOUImageCache.instance().missing_libraries(self._path)
         if missing_libs:
             raise IOUError("The following shared library dependencies cannot be found for IOU image {}: {}".format(self._path,
                                                                                                                    ", ".join(missing_libs)))
@@ -545,15 +499,13 @@ class IOUDevice(object):
                     raise IOUError("IOU image '{}' is not accessible".format(self._path))
 
             try:
-                with open(self._path, "rb") as f:
-                    # read the first 7 bytes of the file.
-                    elf_header_start = f.read(7)
+                elf_header_valid = IOUImageCache.instance().elf_header_valid(self._path)
             except OSError as e:
                 raise IOUError("Cannot read ELF header for IOU image '{}': {}".format(self._path, e))
 
             # IOU images must start with the ELF magic number, be 32-bit, little endian
             # and have an ELF version of 1 normal IOS image are big endian!
-            if elf_header_start != b'\x7fELF\x01\x01\x01':
+            if not elf_header_valid:
                 raise IOUError("'{}' is not a valid IOU image".format(self._path))
 
             if not os.access(self._path, os.X_OK):
@@ -564,9 +516,6 @@ class IOUDevice(object):
             if not self._iourc or not os.path.isfile(self._iourc):
                 raise IOUError("A iourc file is necessary to start IOU")
 
-            if not self._iouyap or not os.path.isfile(self._iouyap):
-                raise IOUError("iouyap is necessary to start IOU")
-
             self._create_netmap_config()
             # created a environment variable pointing to the iourc file.
             env = os.environ.copy()
@@ -574,9 +523,9 @@ class IOUDevice(object):
             self._command = self._build_command()
             try:
                 log.info("starting IOU: {}".format(self._command))
-                self._iou_stdout_file = os.path.join(self._working_dir, "iou.log")
-                log.info("logging to {}".format(self._iou_stdout_file))
-                with open(self._iou_stdout_file, "w") as fd:
+                self._iou_stdout_log = ProcessLog(os.path.join(self._working_dir, "iou.log"))
+                log.info("logging to {}".format(self._iou_stdout_log.path))
+                with self._iou_stdout_log.open() as fd:
                     self._process = subprocess.Popen(self._command,
                                                      stdout=fd,
                                                      stderr=subprocess.STDOUT,
@@ -584,6 +533,7 @@ class IOUDevice(object):
                                                      env=env)
                 log.info("IOU instance {} started PID={}".format(self._id, self._process.pid))
                 self._started = True
+                self._resources.attach(self._process.pid)
             except FileNotFoundError as e:
                 raise IOUError("could not start IOU: {}: 32-bit binary support is probably not installed".format(e))
             except (OSError, subprocess.SubprocessError) as e:
@@ -594,7 +544,11 @@ class IOUDevice(object):
             # start console support
             self._start_ioucon()
             # connections support
-            self._start_iouyap()
+            try:
+                self._connect_bridge()
+            except IOUError:
+                self.stop()
+                raise
 
     def stop(self):
         """
@@ -602,24 +556,14 @@ class IOUDevice(object):
         """
 
         # stop console support
-        if self._ioucon_thead:
-            self._ioucon_thread_stop_event.set()
-            if self._ioucon_thead.is_alive():
-                self._ioucon_thead.join(timeout=3.0)  # wait for the thread to free the console port
-            self._ioucon_thead = None
-
-        # stop iouyap
-        if self.is_iouyap_running():
-            log.info("stopping iouyap PID={} for IOU instance {}".format(self._iouyap_process.pid, self._id))
-            try:
-                self._iouyap_process.terminate()
-                self._iouyap_process.wait(1)
-            except subprocess.TimeoutExpired:
-                self._iouyap_process.kill()
-                if self._iouyap_process.poll() is None:
-                    log.warn("iouyap PID={} for IOU instance {} is still running".format(self._iouyap_process.pid,
-                                                                                         self._id))
-        self._iouyap_process = None
+        if self._ioucon:
+            self._ioucon.stop(timeout=3.0)  # wait for the console port to be freed
+            self._ioucon = None
+
+        # disconnect from the bridge
+        if self._bridge:
+            self._bridge.remove_instance(self._id)
+            self._bridge = None
 
         # stop the IOU process
         if self.is_running():
@@ -634,36 +578,31 @@ class IOUDevice(object):
                                                                               self._process.pid))
         self._process = None
         self._started = False
+        self._resources.release()
 
     def read_iou_stdout(self):
         """
-        Reads the standard output of the IOU process.
+        Reads the end of the standard output of the IOU process.
         Only use when the process has been stopped or has crashed.
         """
 
-        output = ""
-        if self._iou_stdout_file:
-            try:
-                with open(self._iou_stdout_file, errors="replace") as file:
-                    output = file.read()
-            except OSError as e:
-                log.warn("could not read {}: {}".format(self._iou_stdout_file, e))
-        return output
+        if self._iou_stdout_log:
+            return self._iou_stdout_log.tail()
+        return ""
 
-    def read_iouyap_stdout(self):
+    def read_log(self, offset=None, size=MAX_PAGE_SIZE):
         """
-        Reads the standard output of the iouyap process.
-        Only use when the process has been stopped or has crashed.
+        Reads a page of the output of the IOU process.
+
+        :param offset: position in the log, from the end if negative (the last page by default)
+        :param size: maximum number of bytes
+
+        :returns: tuple (text, offset of the page, offset of the end of the log)
         """
 
-        output = ""
-        if self._iouyap_stdout_file:
-            try:
-                with open(self._iouyap_stdout_file, errors="replace") as file:
-                    output = file.read()
-            except OSError as e:
-                log.warn("could not read {}: {}".format(self._iouyap_stdout_file, e))
-        return output
+        if self._iou_stdout_log:
+            return self._iou_stdout_log.read(offset, size)
+        return "", 0, 0
 
     def is_running(self):
         """
@@ -676,17 +615,6 @@ class IOUDevice(object):
             return True
         return False
 
-    def is_iouyap_running(self):
-        """
-        Checks if the iouyap process is running
-
-        :returns: True or False
-        """
-
-        if self._iouyap_process and self._iouyap_process.poll() is None:
-            return True
-        return False
-
     def slot_add_nio_binding(self, slot_id, port_id, nio):
         """
         Adds a slot NIO binding.
@@ -712,9 +640,8 @@ class IOUDevice(object):
                                                                                    nio=nio,
                                                                                    slot_id=slot_id,
                                                                                    port_id=port_id))
-        if self.is_iouyap_running():
-            self._update_iouyap_config()
-            os.kill(self._iouyap_process.pid, signal.SIGHUP)
+        if self._bridge:
+            self._bridge.add_link(self._id, slot_id, port_id, nio)
 
     def slot_remove_nio_binding(self, slot_id, port_id):
         """
@@ -743,9 +670,8 @@ class IOUDevice(object):
                                                                                        nio=nio,
                                                                                        slot_id=slot_id,
                                                                                        port_id=port_id))
-        if self.is_iouyap_running():
-            self._update_iouyap_config()
-            os.kill(self._iouyap_process.pid, signal.SIGHUP)
+        if self._bridge:
+            self._bridge.remove_link(self._id, slot_id, port_id)
 
         return nio
 
@@ -759,13 +685,15 @@ class IOUDevice(object):
         env = os.environ.copy()
         env["IOURC"] = self._iourc
         try:
-            output = subprocess.check_output([self._path, "-h"], stderr=subprocess.STDOUT, cwd=self._working_dir, env=env)
-            if re.search("-l\s+Enable Layer 1 keepalive messages", output.decode("utf-8")):
+            options = IOUImageCache.instance().options(self._path, env=env, cwd=self._working_dir)
+        except OSError as e:
+            options = None
+            log.warn("could not determine if layer 1 keepalive messages are supported by {}: {}".format(os.path.basename(self._path), e))
+        if options is not None:
+            if options.get("-l", "").startswith("Enable Layer 1 keepalive messages"):
                 command.extend(["-l"])
             else:
                 raise IOUError("layer 1 keepalive messages are not supported by {}".format(os.path.basename(self._path)))
-        except (OSError, subprocess.SubprocessError) as e:
-            log.warn("could not determine if layer 1 keepalive messages are supported by {}: {}".format(os.path.basename(self._path), e))
 
     def _build_command(self):
         """
@@ -861,6 +789,51 @@ class IOUDevice(object):
         else:
             log.info("IOU {name} [id={id}]: has deactivated layer 1 keepalive messages".format(name=self._name, id=self._id))
 
+    @property
+    def resources(self):
+        """
+        Returns the resource limits of the IOU process.
+
+        :returns: dictionary (cpu_limit, cpu_weight, memory_limit, cpuset)
+        """
+
+        return self._resources.settings
+
+    @resources.setter
+    def resources(self, resources):
+        """
+        Sets the resource limits of the IOU process (enforced with cgroups v2).
+
+        :param resources: dictionary (cpu_limit, cpu_weight, memory_limit, cpuset)
+        """
+
+        try:
+            self._resources.update(resources)
+        except CgroupError as e:
+            raise IOUError(str(e))
+        log.info("IOU {name} [id={id}]: resource limits set to {resources}".format(name=self._name,
+                                                                                 id=self._id,
+                                                                                 resources=resources))
+
+    @property
+    def resources_controlled(self):
+        """
+        Returns either the IOU process is in a cgroup.
+
+        :returns: boolean
+        """
+
+        return self._resources.attached
+
+    def resource_usage(self):
+        """
+        Returns the resource usage of the IOU process.
+
+        :returns: dictionary (empty if the process is not in a cgroup)
+        """
+
+        return self._resources.usage()
+
     @property
     def ram(self):
         """
@@ -1035,9 +1008,12 @@ class IOUDevice(object):
                                                                                                slot_id=slot_id,
                                                                                                port_id=port_id))
 
-        if self.is_iouyap_running():
-            self._update_iouyap_config()
-            os.kill(self._iouyap_process.pid, signal.SIGHUP)
+        if self._bridge:
+            try:
+                self._bridge.start_capture(self._id, slot_id, port_id, output_file, data_link_type)
+            except IOUError:
+                nio.stopPacketCapture()
+                raise
 
     def stop_capture(self, slot_id, port_id):
         """
@@ -1063,6 +1039,42 @@ class IOUDevice(object):
                                                                                                id=self._id,
                                                                                                slot_id=slot_id,
                                                                                                port_id=port_id))
-        if self.is_iouyap_running():
-            self._update_iouyap_config()
-            os.kill(self._iouyap_process.pid, signal.SIGHUP)
+        if self._bridge:
+            self._bridge.stop_capture(self._id, slot_id, port_id)
+
+    def set_link_conditions(self, slot_id, port_id, conditions_in=None, conditions_out=None):
+        """
+        Sets the conditions (delay, jitter, loss, rate limit) of a link.
+
+        :param slot_id: slot ID
+        :param port_id: port ID
+        :param conditions_in: settings for the frames received by the port (None: no impairment)
+        :param conditions_out: settings for the frames sent by the port (None: no impairment)
+
+        :returns: dictionary with the "in" and "out" settings (and statistics when running)
+        """
+
+        try:
+            adapter = self._slots[slot_id]
+        except IndexError:
+            raise IOUError("Slot {slot_id} doesn't exist on IOU {name}".format(name=self._name,
+                                                                               slot_id=slot_id))
+
+        if not adapter.port_exists(port_id):
+            raise IOUError("Port {port_id} doesn't exist in adapter {adapter}".format(adapter=adapter,
+                                                                                      port_id=port_id))
+
+        nio = adapter.get_nio(port_id)
+        if not nio:
+            raise IOUError("Port {slot_id}/{port_id} is not connected".format(slot_id=slot_id,
+                                                                              port_id=port_id))
+
+        nio.link_conditions = {"in": conditions_in or None, "out": conditions_out or None}
+        log.info("IOU {name} [id={id}]: link conditions of {slot_id}/{port_id} set to {conditions}".format(name=self._name,
+                                                                                                           id=self._id,
+                                                                                                           slot_id=slot_id,
+                                                                                                           port_id=port_id,
+                                                                                                           conditions=nio.link_conditions))
+        if self._bridge:
+            return self._bridge.set_link_conditions(self._id, slot_id, port_id, conditions_in, conditions_out)
+        return dict(nio.link_conditions)
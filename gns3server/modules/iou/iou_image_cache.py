@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cache of the IOU image probes (ELF header, shared libraries and command
+line options) so identical images are only probed once.
+"""
+
+import os
+import re
+import json
+import threading
+import subprocess
+
+from gns3server.config import Config
+
+import logging
+log = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+# changes when shared libraries are installed or removed
+LD_SO_CACHE = "/etc/ld.so.cache"
+
+
+class IOUImageCache(object):
+    """
+    Probe results per IOU image, persisted to a JSON file.
+
+    An entry is identified by the image real path and is only valid
+    as long as the image size, modification time and inode are the same.
+
+    :param path: path to the cache file (None to keep it in memory only)
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, path=None):
+
+        self._path = path
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._entries = {}
+        self._load()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the image cache of this process (created on first use).
+
+        :returns: IOUImageCache instance
+        """
+
+        with cls._instance_lock:
+            if cls._instance is None:
+                iou_config = Config.instance().get_section_config("IOU")
+                path = iou_config.get("image_cache_path",
+                                      os.path.join(os.path.expanduser("~"), ".config", "GNS3", "iou_image_cache.json"))
+                cls._instance = cls(path)
+            return cls._instance
+
+    def _load(self):
+        """
+        Loads the cache file.
+        """
+
+        if not self._path or not os.path.isfile(self._path):
+            return
+        try:
+            with open(self._path) as f:
+                content = json.load(f)
+            if content.get("version") == CACHE_VERSION:
+                self._entries = content.get("images", {})
+        except (OSError, ValueError, AttributeError) as e:
+            log.warning("could not load the IOU image cache {}: {}".format(self._path, e))
+
+    def _save(self):
+        """
+        Saves the cache file (lock held).
+        """
+
+        if not self._path:
+            return
+        tmp_path = self._path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump({"version": CACHE_VERSION, "images": self._entries}, f)
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            log.warning("could not save the IOU image cache {}: {}".format(self._path, e))
+
+    def _entry(self, path):
+        """
+        Returns the cache entry of an image, a stale entry is replaced by an empty one.
+
+        :param path: path to the image
+
+        :returns: dictionary (lock held by the caller)
+        """
+
+        realpath = os.path.realpath(path)
+        st = os.stat(realpath)
+        key = [st.st_size, st.st_mtime_ns, st.st_ino]
+        entry = self._entries.get(realpath)
+        if entry is None or entry.get("key") != key:
+            entry = {"key": key}
+            self._entries[realpath] = entry
+        return entry
+
+    def _lookup(self, path, name, is_valid):
+
+        with self._lock:
+            entry = self._entry(path)
+            if name in entry and (is_valid is None or is_valid(entry[name])):
+                return True, entry[name]
+        return False, None
+
+    def _get(self, path, name, probe, is_valid=None):
+        """
+        Returns a cached probe result, probes the image if needed.
+        Probes are serialized so concurrent starts of the same image
+        only probe it once.
+
+        :param path: path to the image
+        :param name: entry field
+        :param probe: callable returning the result (None if it failed)
+        :param is_valid: optional callable checking a cached result is still valid
+
+        :returns: probe result
+        """
+
+        found, value = self._lookup(path, name, is_valid)
+        if found:
+            return value
+
+        with self._probe_lock:
+            # another thread may have probed the image in the meantime
+            found, value = self._lookup(path, name, is_valid)
+            if found:
+                return value
+            value = probe()
+            if value is not None:
+                with self._lock:
+                    self._entry(path)[name] = value
+                    self._save()
+            return value
+
+    def elf_header_valid(self, path):
+        """
+        Checks the image starts with the ELF header of a IOU image:
+        32-bit, little endian and ELF version 1 (normal IOS images are big endian).
+
+        :param path: path to the image
+
+        :returns: boolean
+        """
+
+        def probe():
+            with open(path, "rb") as f:
+                # read the first 7 bytes of the file.
+                return f.read(7) == b'\x7fELF\x01\x01\x01'
+
+        return self._get(path, "elf_valid", probe)
+
+    def missing_libraries(self, path):
+        """
+        Returns the shared libraries the image needs and cannot be found.
+
+        :param path: path to the image
+
+        :returns: list of library names, None if this cannot be determined
+        """
+
+        try:
+            ld_so_cache = os.stat(LD_SO_CACHE).st_mtime_ns
+        except OSError:
+            ld_so_cache = 0
+
+        def probe():
+            try:
+                output = subprocess.check_output(["ldd", path])
+            except (FileNotFoundError, subprocess.SubprocessError) as e:
+                log.warn("could not determine the shared library dependencies for {}: {}".format(path, e))
+                return None
+            p = re.compile("([\.\w]+)\s=>\s+not found")
+            return {"ld_so_cache": ld_so_cache, "missing": p.findall(output.decode("utf-8"))}
+
+        libraries = self._get(path, "libraries", probe, lambda value: value["ld_so_cache"] == ld_so_cache)
+        if libraries is None:
+            return None
+        return libraries["missing"]
+
+    def options(self, path, env=None, cwd=None):
+        """
+        Returns the command line options supported by the image
+        (from the output of the image run with -h).
+
+        :param path: path to the image
+        :param env: environment to run the image (must have IOURC)
+        :param cwd: working directory to run the image
+
+        :returns: dictionary of option -> description, None if this cannot be determined
+        """
+
+        def probe():
+            try:
+                output = subprocess.check_output([path, "-h"], stderr=subprocess.STDOUT, cwd=cwd, env=env)
+            except (OSError, subprocess.SubprocessError) as e:
+                log.warn("could not get the options supported by {}: {}".format(os.path.basename(path), e))
+                return None
+            options = {}
+            for option, description in re.findall("^\s*(-\w)(?:\s+<[^>]*>)?\s+(.+?)\s*$", output.decode("utf-8", errors="replace"), re.M):
+                options[option] = description
+            return options
+
+        return self._get(path, "options", probe)
@@ -30,6 +30,7 @@ class NIO(object):
         self._capturing = False
         self._pcap_output_file = ""
         self._pcap_data_link_type = ""
+        self._link_conditions = {"in": None, "out": None}
 
     def startPacketCapture(self, pcap_output_file, pcap_data_link_type="DLT_EN10MB"):
         """
@@ -77,3 +78,23 @@ class NIO(object):
         """
 
         return self._pcap_data_link_type
+
+    @property
+    def link_conditions(self):
+        """
+        Returns the link conditions (delay, loss...) of this NIO.
+
+        :returns: dictionary with the "in" and "out" settings (None: no impairment)
+        """
+
+        return self._link_conditions
+
+    @link_conditions.setter
+    def link_conditions(self, link_conditions):
+        """
+        Sets the link conditions of this NIO.
+
+        :param link_conditions: dictionary with the "in" and "out" settings
+        """
+
+        self._link_conditions = link_conditions
@@ -15,6 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from ..cgroups import RESOURCES_SCHEMA
+from ..console_watcher import CONSOLE_WATCH_PROPERTIES
+from ..fabric.link_conditions import LINK_CONDITIONS_PROPERTIES
+from ..process_log import PROCESS_LOG_PROPERTIES
 
 IOU_CREATE_SCHEMA = {
     "$schema": "http://json-schema.org/draft-04/schema#",
@@ -126,11 +130,68 @@ IOU_UPDATE_SCHEMA = {
             "description": "initial configuration base64 encoded",
             "type": "string"
         },
+        "resources": RESOURCES_SCHEMA,
     },
     "additionalProperties": False,
     "required": ["id"]
 }
 
+IOU_CONSOLE_WATCH_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to watch the console output of an IOU instance",
+    "type": "object",
+    "properties": dict(CONSOLE_WATCH_PROPERTIES, id={
+        "description": "IOU device instance ID",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id", "pattern"]
+}
+
+IOU_CONSOLE_UNWATCH_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to stop watching the console output of an IOU instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "IOU device instance ID",
+            "type": "integer"
+        },
+        "watch_id": {
+            "description": "watch identifier",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+IOU_RESOURCE_USAGE_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to get the resource usage of an IOU instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "IOU device instance ID",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+IOU_PROCESS_LOG_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to read the log of an IOU instance process",
+    "type": "object",
+    "properties": dict(PROCESS_LOG_PROPERTIES, id={
+        "description": "IOU device instance ID",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
 IOU_START_SCHEMA = {
     "$schema": "http://json-schema.org/draft-04/schema#",
     "description": "Request validation to start an IOU instance",
@@ -457,6 +518,31 @@ IOU_STOP_CAPTURE_SCHEMA = {
     "required": ["id", "slot", "port", "port_id"]
 }
 
+IOU_SET_LINK_CONDITIONS_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to set the conditions (delay, loss...) of the link of an IOU instance port",
+    "type": "object",
+    "properties": dict(LINK_CONDITIONS_PROPERTIES, id={
+        "description": "IOU device instance ID",
+        "type": "integer"
+    }, slot={
+        "description": "Slot number",
+        "type": "integer",
+        "minimum": 0,
+        "maximum": 15
+    }, port={
+        "description": "Port number",
+        "type": "integer",
+        "minimum": 0,
+        "maximum": 3
+    }, port_id={
+        "description": "Unique port identifier for the IOU instance",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id", "slot", "port", "port_id"]
+}
+
 IOU_EXPORT_CONFIG_SCHEMA = {
     "$schema": "http://json-schema.org/draft-04/schema#",
     "description": "Request validation to export an initial-config from an IOU instance",
@@ -470,3 +556,22 @@ IOU_EXPORT_CONFIG_SCHEMA = {
     "additionalProperties": False,
     "required": ["id"]
 }
+
+IOU_CONSOLE_BUFFER_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to get the recent console output of an IOU instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "IOU device instance ID",
+            "type": "integer"
+        },
+        "size": {
+            "description": "Maximum number of bytes to return (the whole scrollback buffer by default)",
+            "type": "integer",
+            "minimum": 1
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
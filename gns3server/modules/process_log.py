@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Log files of the node processes (standard output and error) with
+size-based rotation. The crash notifications only carry the end of
+the log, the rest can be read page by page.
+"""
+
+import os
+import time
+import weakref
+import threading
+
+from ..config import Config
+
+import logging
+log = logging.getLogger(__name__)
+
+# default maximum size of a log before rotation (KB) and number of rotated logs kept
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_BACKUPS = 2
+
+# size of the end of the log sent with the crash notifications (bytes)
+DEFAULT_TAIL_SIZE = 8192
+
+# maximum size of a page of log (bytes)
+MAX_PAGE_SIZE = 65536
+
+# how often the size of the logs is checked (seconds)
+ROTATE_INTERVAL = 2
+
+# size of the chunks copied to the rotated log (bytes)
+COPY_SIZE = 65536
+
+# properties of the process_log requests
+PROCESS_LOG_PROPERTIES = {
+    "offset": {
+        "description": "Position in the log, from the end if negative (the last page by default)",
+        "type": "integer"
+    },
+    "size": {
+        "description": "Maximum number of bytes to return",
+        "type": "integer",
+        "minimum": 1,
+        "maximum": MAX_PAGE_SIZE
+    },
+}
+
+
+class ProcessLog(object):
+    """
+    Log of a node process. The process writes to the log in append mode,
+    the log is rotated by copying it to <path>.1 and truncating it
+    (the process doesn't need to reopen it).
+
+    The copy catches up with the process until the end of the log and the
+    log is truncated right away, but what the process writes between these
+    two system calls is lost: this is the price of not restarting the
+    process, the logs are checked often so that the copies stay short.
+
+    Offsets count the bytes written since the log was opened: they are
+    stable across rotations, the data of the dropped logs cannot be read
+    anymore.
+
+    :param path: path to the log file
+    :param max_size: size triggering a rotation in KB (from the configuration by default)
+    :param backups: number of rotated logs kept (from the configuration by default)
+    """
+
+    _logs = weakref.WeakSet()
+    _watcher = None
+    _watcher_lock = threading.Lock()
+
+    def __init__(self, path, max_size=None, backups=None):
+
+        server_config = Config.instance().get_default_section()
+        if max_size is None:
+            max_size = int(server_config.get("process_log_max_size", DEFAULT_MAX_SIZE))
+        if backups is None:
+            backups = int(server_config.get("process_log_backups", DEFAULT_BACKUPS))
+        self._path = path
+        self._max_size = max_size * 1024
+        self._backups = backups
+        self._start = 0  # offset of the oldest data kept
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        """
+        Returns the path to the log file.
+
+        :returns: path
+        """
+
+        return self._path
+
+    def _backup_path(self, number):
+
+        return "{}.{}".format(self._path, number)
+
+    def open(self):
+        """
+        Creates an empty log (the previous logs are deleted).
+
+        :returns: file object to pass as the output of the process
+        """
+
+        self.delete()
+        with self._lock:
+            self._start = 0
+            open(self._path, "wb").close()
+            # append mode: the process keeps writing at the end after a truncation
+            fd = open(self._path, "ab")
+        self._watch()
+        return fd
+
+    def delete(self):
+        """
+        Deletes the log and the rotated logs.
+        """
+
+        with ProcessLog._watcher_lock:
+            ProcessLog._logs.discard(self)
+        with self._lock:
+            for path in [self._path] + [self._backup_path(number) for number in range(1, self._backups + 1)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    log.warning("could not delete {}: {}".format(path, e))
+
+    def rotate(self, force=False):
+        """
+        Rotates the log if it is too large.
+
+        :param force: rotate whatever the size
+
+        :returns: True if the log has been rotated
+        """
+
+        with self._lock:
+            try:
+                if not force and os.path.getsize(self._path) < self._max_size:
+                    return False
+                with open(self._path, "r+b") as f:
+                    if self._backups:
+                        oldest = self._backup_path(self._backups)
+                        if os.path.exists(oldest):
+                            self._start += os.path.getsize(oldest)
+                        for number in range(self._backups - 1, 0, -1):
+                            if os.path.exists(self._backup_path(number)):
+                                os.replace(self._backup_path(number), self._backup_path(number + 1))
+                        self._copy(f, self._backup_path(1))
+                    else:
+                        self._start += os.fstat(f.fileno()).st_size
+                    f.truncate(0)
+            except OSError as e:
+                log.warning("could not rotate {}: {}".format(self._path, e))
+                return False
+        log.debug("{} rotated".format(self._path))
+        return True
+
+    @staticmethod
+    def _copy(f, path):
+        """
+        Copies the log, including what the process writes during the copy.
+
+        :param f: log file object
+        :param path: path to the copy
+
+        :returns: number of bytes copied
+        """
+
+        copied = 0
+        with open(path, "wb") as copy:
+            while True:
+                chunk = f.read(COPY_SIZE)
+                if not chunk:
+                    return copied
+                copy.write(chunk)
+                copied += len(chunk)
+
+    def _files(self):
+        """
+        Returns the logs, the oldest first.
+
+        :returns: list of (path, size)
+        """
+
+        files = []
+        for path in [self._backup_path(number) for number in range(self._backups, 0, -1)] + [self._path]:
+            try:
+                files.append((path, os.path.getsize(path)))
+            except OSError:
+                continue
+        return files
+
+    def read(self, offset=None, size=MAX_PAGE_SIZE):
+        """
+        Reads a page of the log (the rotated logs are read first).
+
+        :param offset: position in the log, from the end if negative (the last page by default)
+        :param size: maximum number of bytes
+
+        :returns: tuple (text, offset of the page, offset of the end of the log)
+        """
+
+        size = min(size, MAX_PAGE_SIZE)
+        chunks = []
+        with self._lock:
+            files = self._files()
+            total = self._start + sum(file_size for _, file_size in files)
+            if offset is None:
+                offset = total - size
+            elif offset < 0:
+                offset += total
+            offset = max(self._start, min(offset, total))
+            end = min(total, offset + size)
+            position = self._start
+            for path, file_size in files:
+                if position < end and position + file_size > offset:
+                    start = max(0, offset - position)
+                    try:
+                        with open(path, "rb") as f:
+                            f.seek(start)
+                            chunks.append(f.read(min(file_size, end - position) - start))
+                    except OSError as e:
+                        log.warning("could not read {}: {}".format(path, e))
+                position += file_size
+        return b"".join(chunks).decode("utf-8", errors="replace"), offset, total
+
+    def tail(self, size=DEFAULT_TAIL_SIZE):
+        """
+        Returns the end of the log (seeking from the end, the log is
+        never read entirely).
+
+        :param size: maximum number of bytes
+
+        :returns: text
+        """
+
+        text, offset, _ = self.read(None, size)
+        if offset > 0:
+            # starts with the first complete line
+            text = text.partition("\n")[2] or text
+        return text
+
+    def _watch(self):
+        """
+        Checks the size of this log periodically.
+        """
+
+        with ProcessLog._watcher_lock:
+            ProcessLog._logs.add(self)
+            if ProcessLog._watcher is None:
+                ProcessLog._watcher = threading.Thread(target=ProcessLog._rotate_logs, name="ProcessLog", daemon=True)
+                ProcessLog._watcher.start()
+
+    @classmethod
+    def _rotate_logs(cls):
+        """
+        Thread rotating the logs of the node processes.
+        """
+
+        while True:
+            time.sleep(ROTATE_INTERVAL)
+            with cls._watcher_lock:
+                logs = list(cls._logs)
+            for process_log in logs:
+                process_log.rotate()
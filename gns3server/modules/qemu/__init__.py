@@ -32,6 +32,11 @@ from .qemu_vm import QemuVM
 from .qemu_error import QemuError
 from .nios.nio_udp import NIO_UDP
 from ..attic import find_unused_port
+from ..attic import call_in_parallel
+from ..image_cache import ImageCacheError
+from ..fabric import UDPRelay, FabricError, LinkConditions
+from ..process_log import MAX_PAGE_SIZE
+from ..console_watcher import ConsoleWatchError
 
 from .schemas import QEMU_CREATE_SCHEMA
 from .schemas import QEMU_DELETE_SCHEMA
@@ -39,10 +44,19 @@ from .schemas import QEMU_UPDATE_SCHEMA
 from .schemas import QEMU_START_SCHEMA
 from .schemas import QEMU_STOP_SCHEMA
 from .schemas import QEMU_SUSPEND_SCHEMA
+from .schemas import QEMU_RESOURCE_USAGE_SCHEMA
+from .schemas import QEMU_PROCESS_LOG_SCHEMA
+from .schemas import QEMU_SNAPSHOT_SCHEMA
+from .schemas import QEMU_SNAPSHOT_LIST_SCHEMA
+from .schemas import QEMU_CONSOLE_WATCH_SCHEMA
+from .schemas import QEMU_CONSOLE_UNWATCH_SCHEMA
 from .schemas import QEMU_RELOAD_SCHEMA
 from .schemas import QEMU_ALLOCATE_UDP_PORT_SCHEMA
 from .schemas import QEMU_ADD_NIO_SCHEMA
 from .schemas import QEMU_DELETE_NIO_SCHEMA
+from .schemas import QEMU_START_CAPTURE_SCHEMA
+from .schemas import QEMU_STOP_CAPTURE_SCHEMA
+from .schemas import QEMU_SET_LINK_CONDITIONS_SCHEMA
 
 import logging
 log = logging.getLogger(__name__)
@@ -70,6 +84,7 @@ class Qemu(IModule):
         self._monitor_start_port_range = qemu_config.get("monitor_start_port_range", 5501)
         self._monitor_end_port_range = qemu_config.get("monitor_end_port_range", 6000)
         self._allocated_udp_ports = []
+        self._relays = {}  # relay name -> ports of the loopback tunnel
         self._udp_start_port_range = qemu_config.get("udp_start_port_range", 40001)
         self._udp_end_port_range = qemu_config.get("udp_end_port_range", 45500)
         self._host = qemu_config.get("host", kwargs["host"])
@@ -87,12 +102,50 @@ class Qemu(IModule):
         """
 
         # delete all QEMU instances
-        for qemu_id in self._qemu_instances:
-            qemu_instance = self._qemu_instances[qemu_id]
-            qemu_instance.delete()
+        for qemu_instance, e in call_in_parallel(lambda qemu_instance: qemu_instance.delete(), self._qemu_instances.values()):
+            log.error("could not delete QEMU instance {}: {}".format(qemu_instance.name, e))
+
+        if self._relays:
+            UDPRelay.instance().stop()
+            self._relays.clear()
 
         IModule.stop(self, signum)  # this will stop the I/O loop
 
+    def _vm_state_changed(self, qemu_instance, status):
+        """
+        Callback for the VM state changes pushed by QMP.
+        Called from a QMP reader thread, the notification is
+        sent from the I/O loop.
+
+        :param qemu_instance: QemuVM instance
+        :param status: new VM status (running|paused|shutdown)
+        """
+
+        notification = {"module": self.name,
+                        "id": qemu_instance.id,
+                        "name": qemu_instance.name,
+                        "status": status}
+        self._ioloop.add_callback(self.send_notification, "{}.vm_state_changed".format(self.name), notification)
+
+    def _console_matched(self, qemu_instance, watch_id, pattern, session):
+        """
+        Callback for the patterns found in the console output.
+        Called from the console hub thread, the notification is
+        sent from the I/O loop to the client that registered the watch.
+
+        :param qemu_instance: QemuVM instance
+        :param watch_id: watch identifier
+        :param pattern: pattern found
+        :param session: session of the client that registered the watch
+        """
+
+        notification = {"module": self.name,
+                        "id": qemu_instance.id,
+                        "name": qemu_instance.name,
+                        "watch_id": watch_id,
+                        "pattern": pattern}
+        self._ioloop.add_callback(self.send_notification, "{}.console_match".format(self.name), notification, session)
+
     def get_qemu_instance(self, qemu_id):
         """
         Returns a QEMU VM instance.
@@ -117,13 +170,16 @@ class Qemu(IModule):
         """
 
         # delete all QEMU instances
-        for qemu_id in self._qemu_instances:
-            qemu_instance = self._qemu_instances[qemu_id]
-            qemu_instance.delete()
+        for qemu_instance, e in call_in_parallel(lambda qemu_instance: qemu_instance.delete(), self._qemu_instances.values()):
+            log.error("could not delete QEMU instance {}: {}".format(qemu_instance.name, e))
 
         # resets the instance IDs
         QemuVM.reset()
 
+        if self._relays:
+            UDPRelay.instance().stop()
+            self._relays.clear()
+
         self._qemu_instances.clear()
         self._allocated_udp_ports.clear()
 
@@ -239,6 +295,8 @@ class Qemu(IModule):
             self.send_custom_error(str(e))
             return
 
+        qemu_instance.set_state_change_callback(self._vm_state_changed)
+        qemu_instance.set_console_match_callback(self._console_matched)
         response = {"name": qemu_instance.name,
                     "id": qemu_instance.id}
 
@@ -271,6 +329,8 @@ class Qemu(IModule):
             return
 
         try:
+            for port in range(qemu_instance.adapters):
+                self._remove_relay(qemu_instance, port, rebind=False)
             qemu_instance.clean_delete()
             del self._qemu_instances[request["id"]]
         except QemuError as e:
@@ -341,6 +401,38 @@ class Qemu(IModule):
         if not qemu_instance:
             return
 
+        future = qemu_instance.fetch_cloud_images()
+        if not future.done():
+            # the VM is started once its images have been downloaded
+            self.add_future(future, lambda future: self._qemu_images_fetched(qemu_instance, future))
+            return
+        self._start_qemu_instance(qemu_instance)
+
+    def _qemu_images_fetched(self, qemu_instance, future):
+        """
+        Starts a QEMU VM instance once its images have been downloaded.
+
+        :param qemu_instance: QemuVM instance
+        :param future: Future of the downloads
+        """
+
+        try:
+            future.result()
+        except ImageCacheError as e:
+            self.send_custom_error(str(e))
+            return
+        if qemu_instance.id not in self._qemu_instances:
+            self.send_custom_error("QEMU VM instance {} has been deleted".format(qemu_instance.id))
+            return
+        self._start_qemu_instance(qemu_instance)
+
+    def _start_qemu_instance(self, qemu_instance):
+        """
+        Starts a QEMU VM instance and sends the response.
+
+        :param qemu_instance: QemuVM instance
+        """
+
         try:
             qemu_instance.start()
         except QemuError as e:
@@ -468,6 +560,278 @@ class Qemu(IModule):
             return
         self.send_response(True)
 
+    @IModule.route("qemu.snapshot_save")
+    def qemu_snapshot_save(self, request):
+        """
+        Saves the state of a QEMU VM instance in a snapshot
+        (the VM must be running, an existing snapshot is replaced).
+
+        Mandatory request parameters:
+        - id (QEMU VM instance identifier)
+        - name (snapshot name)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_SNAPSHOT_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        try:
+            qemu_instance.snapshot_save(request["name"])
+        except QemuError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response(True)
+
+    @IModule.route("qemu.snapshot_restore")
+    def qemu_snapshot_restore(self, request):
+        """
+        Restores a snapshot of a QEMU VM instance
+        (the VM is started from the snapshot if it is not running).
+
+        Mandatory request parameters:
+        - id (QEMU VM instance identifier)
+        - name (snapshot name)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_SNAPSHOT_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        try:
+            qemu_instance.snapshot_restore(request["name"])
+        except QemuError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response(True)
+
+    @IModule.route("qemu.snapshot_delete")
+    def qemu_snapshot_delete(self, request):
+        """
+        Deletes a snapshot of a QEMU VM instance.
+
+        Mandatory request parameters:
+        - id (QEMU VM instance identifier)
+        - name (snapshot name)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_SNAPSHOT_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        try:
+            qemu_instance.snapshot_delete(request["name"])
+        except QemuError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response(True)
+
+    @IModule.route("qemu.snapshot_list")
+    def qemu_snapshot_list(self, request):
+        """
+        Lists the snapshots of a QEMU VM instance.
+
+        Mandatory request parameters:
+        - id (QEMU VM instance identifier)
+
+        Response parameters:
+        - id (QEMU VM instance identifier)
+        - snapshots (list of snapshot names)
+        - boot_snapshot (snapshot the VM is started from)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_SNAPSHOT_LIST_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        try:
+            snapshots = qemu_instance.snapshots()
+        except QemuError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response({"id": qemu_instance.id,
+                            "snapshots": snapshots,
+                            "boot_snapshot": qemu_instance.boot_snapshot})
+
+    @IModule.route("qemu.resource_usage")
+    def qemu_resource_usage(self, request):
+        """
+        Gets the resource usage of a QEMU VM instance.
+
+        Mandatory request parameters:
+        - id (QEMU VM instance identifier)
+
+        Response parameters:
+        - id (QEMU VM instance identifier)
+        - controlled (either the resource limits are enforced with cgroups)
+        - usage (CPU time, throttling and memory counters)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_RESOURCE_USAGE_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        self.send_response({"id": qemu_instance.id,
+                            "controlled": qemu_instance.resources_controlled,
+                            "usage": qemu_instance.resource_usage()})
+
+    @IModule.route("qemu.process_log")
+    def qemu_process_log(self, request):
+        """
+        Reads a page of the log of the QEMU process (standard output
+        and error, rotated logs included).
+
+        Mandatory request parameters:
+        - id (QEMU VM identifier)
+
+        Optional request parameters:
+        - offset (position in the log, from the end if negative, the last page by default)
+        - size (maximum number of bytes to return)
+
+        Response parameters:
+        - id (QEMU VM identifier)
+        - log (text)
+        - offset (position of the page in the log)
+        - size (offset of the end of the log, the offsets are stable across rotations)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_PROCESS_LOG_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        text, offset, size = qemu_instance.read_log(request.get("offset"), request.get("size", MAX_PAGE_SIZE))
+        self.send_response({"id": request["id"],
+                            "log": text,
+                            "offset": offset,
+                            "size": size})
+
+    @IModule.route("qemu.console_watch")
+    def qemu_console_watch(self, request):
+        """
+        Watches the console output of a QEMU VM instance for a pattern
+        (the qemu.console_match notification is sent when it is found).
+
+        Mandatory request parameters:
+        - id (QEMU VM instance identifier)
+        - pattern (text to look for)
+
+        Optional request parameters:
+        - once (remove the watch after the first match, true by default)
+        - scrollback (also look in the recent console output, true by default)
+        - take_console (read the console, no other client can connect while watching, false by default)
+
+        Response parameters:
+        - id (QEMU VM instance identifier)
+        - watch_id (watch identifier)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_CONSOLE_WATCH_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        watcher = qemu_instance.console_watcher
+        try:
+            watch_id = watcher.add(request["pattern"],
+                                   request.get("once", True),
+                                   request.get("scrollback", True),
+                                   self._current_session,
+                                   request.get("take_console", False))
+        except ConsoleWatchError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response({"id": request["id"],
+                            "watch_id": watch_id})
+
+    @IModule.route("qemu.console_unwatch")
+    def qemu_console_unwatch(self, request):
+        """
+        Stops watching the console output of a QEMU VM instance.
+
+        Mandatory request parameters:
+        - id (QEMU VM instance identifier)
+
+        Optional request parameters:
+        - watch_id (watch identifier, all the watches by default)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_CONSOLE_UNWATCH_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        if "watch_id" not in request:
+            qemu_instance.console_watcher.clear()
+        elif not qemu_instance.console_watcher.remove(request["watch_id"]):
+            self.send_custom_error("Watch {} doesn't exist".format(request["watch_id"]))
+            return
+        self.send_response(True)
+
     @IModule.route("qemu.allocate_udp_port")
     def allocate_udp_port(self, request):
         """
@@ -597,7 +961,11 @@ class Qemu(IModule):
 
         port = request["port"]
         try:
+            tunnel = self._remove_relay(qemu_instance, port, rebind=False)
             nio = qemu_instance.port_remove_nio_binding(port)
+            if tunnel:
+                # the NIO of the VM was the loopback tunnel towards the relay
+                nio = NIO_UDP(*tunnel)
             if isinstance(nio, NIO_UDP) and nio.lport in self._allocated_udp_ports:
                 self._allocated_udp_ports.remove(nio.lport)
         except QemuError as e:
@@ -606,6 +974,242 @@ class Qemu(IModule):
 
         self.send_response(True)
 
+    def _insert_relay(self, qemu_instance, port):
+        """
+        Inserts a relay in the UDP tunnel of a port. The VM is moved
+        to a loopback tunnel towards the relay (even when running).
+
+        :param qemu_instance: QemuVM instance
+        :param port: port number
+
+        :returns: relay name
+        """
+
+        name = "QEMU{}-{}".format(qemu_instance.id, port)
+        if name in self._relays:
+            return name
+
+        nio = qemu_instance.get_nio(port)
+        if not isinstance(nio, NIO_UDP):
+            raise QemuError("Port {} of QEMU VM {} is not connected to an UDP tunnel".format(port, qemu_instance.name))
+
+        inner_host = "127.0.0.1" if self._host in ("0.0.0.0", "::") else self._host
+        ports = []
+        try:
+            for _ in range(2):
+                ports.append(find_unused_port(self._udp_start_port_range,
+                                              self._udp_end_port_range,
+                                              host=inner_host,
+                                              socket_type="UDP",
+                                              ignore_ports=self._allocated_udp_ports + ports))
+        except Exception as e:
+            raise QemuError("Could not allocate UDP ports for the relay: {}".format(e))
+
+        inner_port, node_port = ports
+        try:
+            UDPRelay.instance().insert(name,
+                                       self._host,
+                                       nio.lport,
+                                       nio.rhost,
+                                       nio.rport,
+                                       inner_host,
+                                       inner_port,
+                                       node_port,
+                                       lambda lport, rhost, rport: qemu_instance.port_add_nio_binding(port, NIO_UDP(lport, rhost, rport)))
+        except FabricError as e:
+            raise QemuError("Could not insert a relay in {}: {}".format(nio, e))
+
+        self._allocated_udp_ports.extend(ports)
+        self._relays[name] = ports
+        return name
+
+    def _remove_relay(self, qemu_instance, port, rebind=True):
+        """
+        Removes the relay of a port.
+
+        :param qemu_instance: QemuVM instance
+        :param port: port number
+        :param rebind: move the VM back to the UDP tunnel
+
+        :returns: (lport, rhost, rport) of the tunnel or None if there is no relay
+        """
+
+        name = "QEMU{}-{}".format(qemu_instance.id, port)
+        ports = self._relays.pop(name, None)
+        if ports is None:
+            return None
+        for udp_port in ports:
+            if udp_port in self._allocated_udp_ports:
+                self._allocated_udp_ports.remove(udp_port)
+
+        if rebind:
+            callback = lambda lport, rhost, rport: qemu_instance.port_add_nio_binding(port, NIO_UDP(lport, rhost, rport))
+        else:
+            callback = lambda lport, rhost, rport: None
+        try:
+            return UDPRelay.instance().remove(name, callback)
+        except FabricError as e:
+            raise QemuError("Could not remove relay {}: {}".format(name, e))
+
+    @IModule.route("qemu.start_capture")
+    def start_capture(self, request):
+        """
+        Starts a packet capture. A relay is inserted in the UDP tunnel
+        of the port, the VM doesn't need to be restarted.
+
+        Mandatory request parameters:
+        - id (QEMU VM identifier)
+        - port (port number)
+        - port_id (port identifier)
+        - capture_file_name
+
+        Optional request parameters:
+        - data_link_type (PCAP DLT_* value)
+
+        Response parameters:
+        - port_id (port identifier)
+        - capture_file_path (path to the capture file)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_START_CAPTURE_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        port = request["port"]
+        capture_file_name = request["capture_file_name"]
+        data_link_type = request.get("data_link_type", "DLT_EN10MB")
+
+        try:
+            capture_file_path = os.path.join(self._working_dir, "captures", capture_file_name)
+            os.makedirs(os.path.dirname(capture_file_path), exist_ok=True)
+            name = self._insert_relay(qemu_instance, port)
+            UDPRelay.instance().start_capture(name, capture_file_path, data_link_type)
+        except OSError as e:
+            self.send_custom_error("Could not create the capture directory: {}".format(e))
+            return
+        except FabricError as e:
+            try:
+                self._remove_relay(qemu_instance, port)
+            except QemuError as error:
+                log.error(error)
+            self.send_custom_error(str(e))
+            return
+        except QemuError as e:
+            self.send_custom_error(str(e))
+            return
+
+        response = {"port_id": request["port_id"],
+                    "capture_file_path": capture_file_path}
+        self.send_response(response)
+
+    @IModule.route("qemu.stop_capture")
+    def stop_capture(self, request):
+        """
+        Stops a packet capture (the relay is removed from the UDP tunnel
+        unless the link has conditions).
+
+        Mandatory request parameters:
+        - id (QEMU VM identifier)
+        - port (port number)
+        - port_id (port identifier)
+
+        Response parameters:
+        - port_id (port identifier)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_STOP_CAPTURE_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        port = request["port"]
+        name = "QEMU{}-{}".format(qemu_instance.id, port)
+        try:
+            if name not in self._relays:
+                raise QemuError("No capture running on port {} of QEMU VM {}".format(port, qemu_instance.name))
+            relay = UDPRelay.instance()
+            relay.stop_capture(name)
+            if relay.is_idle(name):
+                self._remove_relay(qemu_instance, port)
+        except QemuError as e:
+            self.send_custom_error(str(e))
+            return
+
+        response = {"port_id": request["port_id"]}
+        self.send_response(response)
+
+    @IModule.route("qemu.set_link_conditions")
+    def set_link_conditions(self, request):
+        """
+        Sets the conditions (delay, jitter, loss, rate limit) of a link.
+        A relay is inserted in the UDP tunnel of the port, the VM doesn't
+        need to be restarted.
+
+        Mandatory request parameters:
+        - id (QEMU VM identifier)
+        - port (port number)
+        - port_id (port identifier)
+
+        Optional request parameters:
+        - in (conditions of the frames received by the VM)
+        - out (conditions of the frames sent by the VM)
+
+        Response parameters:
+        - port_id (port identifier)
+        - in (settings and statistics or None)
+        - out (settings and statistics or None)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, QEMU_SET_LINK_CONDITIONS_SCHEMA):
+            return
+
+        # get the instance
+        qemu_instance = self.get_qemu_instance(request["id"])
+        if not qemu_instance:
+            return
+
+        port = request["port"]
+        conditions_in = LinkConditions.from_settings(request.get("in"))
+        conditions_out = LinkConditions.from_settings(request.get("out"))
+        relay = UDPRelay.instance()
+        try:
+            if conditions_in is None and conditions_out is None:
+                # back to an unaltered link
+                name = "QEMU{}-{}".format(qemu_instance.id, port)
+                conditions = {"in": None, "out": None}
+                if name in self._relays:
+                    relay.set_conditions(name, None, None)
+                    if relay.is_idle(name):
+                        self._remove_relay(qemu_instance, port)
+            else:
+                name = self._insert_relay(qemu_instance, port)
+                relay.set_conditions(name, conditions_in, conditions_out)
+                conditions = relay.get_conditions(name)
+        except (QemuError, FabricError) as e:
+            self.send_custom_error(str(e))
+            return
+
+        response = {"port_id": request["port_id"],
+                    "in": conditions["in"],
+                    "out": conditions["out"]}
+        self.send_response(response)
+
     def _get_qemu_version(self, qemu_path):
         """
         Gets the Qemu version.
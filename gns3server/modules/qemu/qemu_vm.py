@@ -30,17 +30,32 @@ import telnetlib
 import time
 import re
 
-from gns3server.config import Config
-from gns3dms.cloud.rackspace_ctrl import get_provider
 
 from .qemu_error import QemuError
 from .adapters.ethernet_adapter import EthernetAdapter
 from .nios.nio_udp import NIO_UDP
+from .qmp import QMPClient
 from ..attic import find_unused_port
+from ..cgroups import NodeResources, CgroupError
+from ..console_watcher import ConsoleWatcher
+from ..process_log import ProcessLog, MAX_PAGE_SIZE
+from ..image_cache import ImageCache, ImageCacheError, gather
+from ..sharding import owns
 
 import logging
 log = logging.getLogger(__name__)
 
+# cgroup CPU weight for each process priority (100 is the default weight)
+CGROUP_CPU_WEIGHTS = {"realtime": 1000,
+                      "very high": 500,
+                      "high": 200,
+                      "normal": 100,
+                      "low": 50,
+                      "very low": 10}
+
+# how long savevm/loadvm can take (the whole RAM is written or read)
+SNAPSHOT_TIMEOUT = 600
+
 
 class QemuVM(object):
     """
@@ -83,7 +98,7 @@ class QemuVM(object):
         if not qemu_id:
             self._id = 0
             for identifier in range(1, 1024):
-                if identifier not in self._instances:
+                if identifier not in self._instances and owns(identifier):
                     self._id = identifier
                     self._instances.append(self._id)
                     break
@@ -103,7 +118,7 @@ class QemuVM(object):
         self._started = False
         self._process = None
         self._cpulimit_process = None
-        self._stdout_file = ""
+        self._stdout_log = None
         self._console_host = console_host
         self._console_start_port_range = console_start_port_range
         self._console_end_port_range = console_end_port_range
@@ -111,6 +126,12 @@ class QemuVM(object):
         self._monitor_start_port_range = monitor_start_port_range
         self._monitor_end_port_range = monitor_end_port_range
         self._cloud_path = None
+        self._qmp_port = None
+        self._qmp_client = None
+        self._vm_status = None
+        self._state_change_callback = None
+        self._console_watcher = ConsoleWatcher(name, self._console_matched, tapped=True)
+        self._console_match_callback = None
 
         # QEMU settings
         self._qemu_path = qemu_path
@@ -128,6 +149,9 @@ class QemuVM(object):
         self._legacy_networking = False
         self._cpu_throttling = 0  # means no CPU throttling
         self._process_priority = "low"
+        self._boot_snapshot = ""
+        self._resources = NodeResources("qemu-vm-{}".format(self._id))
+        self._update_resource_defaults()
 
         working_dir_path = os.path.join(working_dir, "qemu", "vm-{}".format(self._id))
 
@@ -191,7 +215,8 @@ class QemuVM(object):
                          "kernel_command_line": self._kernel_command_line,
                          "legacy_networking": self._legacy_networking,
                          "cpu_throttling": self._cpu_throttling,
-                         "process_priority": self._process_priority
+                         "process_priority": self._process_priority,
+                         "boot_snapshot": self._boot_snapshot
                          }
 
         return qemu_defaults
@@ -334,6 +359,7 @@ class QemuVM(object):
         """
 
         self.stop()
+        self._console_watcher.clear()
         if self._id in self._instances:
             self._instances.remove(self._id)
 
@@ -352,6 +378,7 @@ class QemuVM(object):
         """
 
         self.stop()
+        self._console_watcher.clear()
         if self._id in self._instances:
             self._instances.remove(self._id)
 
@@ -559,9 +586,11 @@ class QemuVM(object):
                                                                                                   id=self._id,
                                                                                                   cpu=cpu_throttling))
         self._cpu_throttling = cpu_throttling
-        self._stop_cpulimit()
-        if cpu_throttling:
-            self._set_cpu_throttling()
+        self._update_resource_defaults()
+        if not self._resources.attached:
+            self._stop_cpulimit()
+            if cpu_throttling:
+                self._set_cpu_throttling()
 
     @property
     def process_priority(self):
@@ -585,7 +614,64 @@ class QemuVM(object):
                                                                                               id=self._id,
                                                                                               priority=process_priority))
         self._process_priority = process_priority
+        self._update_resource_defaults()
+
+    @property
+    def resources(self):
+        """
+        Returns the resource limits of the QEMU process.
 
+        :returns: dictionary (cpu_limit, cpu_weight, memory_limit, cpuset)
+        """
+
+        return self._resources.settings
+
+    @resources.setter
+    def resources(self, resources):
+        """
+        Sets the resource limits of the QEMU process (enforced with cgroups v2,
+        take precedence over the CPU throttling and process priority).
+
+        :param resources: dictionary (cpu_limit, cpu_weight, memory_limit, cpuset)
+        """
+
+        try:
+            self._resources.update(resources)
+        except CgroupError as e:
+            raise QemuError(str(e))
+        log.info("QEMU VM {name} [id={id}] has set its resource limits to {resources}".format(name=self._name,
+                                                                                             id=self._id,
+                                                                                             resources=resources))
+
+    @property
+    def resources_controlled(self):
+        """
+        Returns either the QEMU process is in a cgroup.
+
+        :returns: boolean
+        """
+
+        return self._resources.attached
+
+    def resource_usage(self):
+        """
+        Returns the resource usage of the QEMU process.
+
+        :returns: dictionary (empty if the process is not in a cgroup)
+        """
+
+        return self._resources.usage()
+
+    def _update_resource_defaults(self):
+        """
+        Maps the CPU throttling and process priority to cgroup settings.
+        """
+
+        try:
+            self._resources.set_defaults({"cpu_limit": self._cpu_throttling,
+                                          "cpu_weight": CGROUP_CPU_WEIGHTS.get(self._process_priority, 100)})
+        except CgroupError as e:
+            raise QemuError(str(e))
 
     @property
     def ram(self):
@@ -702,6 +788,29 @@ class QemuVM(object):
                                                                                                                  kernel_command_line=kernel_command_line))
         self._kernel_command_line = kernel_command_line
 
+    @property
+    def boot_snapshot(self):
+        """
+        Returns the snapshot this QEMU VM is started from.
+
+        :returns: snapshot name (empty to cold boot)
+        """
+
+        return self._boot_snapshot
+
+    @boot_snapshot.setter
+    def boot_snapshot(self, boot_snapshot):
+        """
+        Sets the snapshot this QEMU VM is started from.
+
+        :param boot_snapshot: snapshot name (empty to cold boot)
+        """
+
+        log.info("QEMU VM {name} [id={id}] has set the boot snapshot to {boot_snapshot}".format(name=self._name,
+                                                                                              id=self._id,
+                                                                                              boot_snapshot=boot_snapshot))
+        self._boot_snapshot = boot_snapshot
+
     def _set_process_priority(self):
         """
         Changes the process priority
@@ -748,6 +857,97 @@ class QemuVM(object):
             except (OSError, subprocess.SubprocessError) as e:
                 log.error("could not change process priority for QEMU VM {}: {}".format(self._name, e))
 
+    @property
+    def console_watcher(self):
+        """
+        Returns the patterns watched in the console output.
+
+        :returns: ConsoleWatcher instance
+        """
+
+        return self._console_watcher
+
+    def set_console_match_callback(self, callback):
+        """
+        Sets a callback to be called when a watched pattern is found in the console output.
+        The callback is called from the console hub thread.
+
+        :param callback: callable receiving this VM, the watch ID, the pattern and the watch context
+        """
+
+        self._console_match_callback = callback
+
+    def _console_matched(self, watch_id, pattern, context):
+
+        if self._console_match_callback:
+            self._console_match_callback(self, watch_id, pattern, context)
+
+    def set_state_change_callback(self, callback):
+        """
+        Sets a callback to be called when QEMU reports a VM state change.
+        The callback is called from the QMP reader thread.
+
+        :param callback: callable receiving this VM and the new status (running|paused|shutdown)
+        """
+
+        self._state_change_callback = callback
+
+    def _qmp_event(self, event, data):
+        """
+        Handles the VM state change events pushed by QMP.
+
+        :param event: QMP event name
+        :param data: QMP event data
+        """
+
+        if event == "STOP":
+            self._vm_status = "paused"
+        elif event == "RESUME":
+            self._vm_status = "running"
+        elif event == "SHUTDOWN":
+            self._vm_status = "shutdown"
+        else:
+            return
+
+        log.info("QEMU VM {name} [id={id}]: status changed to {status}".format(name=self._name,
+                                                                             id=self._id,
+                                                                             status=self._vm_status))
+        if self._state_change_callback:
+            self._state_change_callback(self, self._vm_status)
+
+    def _connect_qmp(self):
+        """
+        Opens the persistent QMP connection to the running QEMU process.
+        """
+
+        self._qmp_client = QMPClient(self._name, self._monitor_host, self._qmp_port)
+        for event in ("STOP", "RESUME", "SHUTDOWN"):
+            self._qmp_client.subscribe(event, self._qmp_event)
+        try:
+            self._qmp_client.connect()
+            status = self._qmp_client.execute("query-status")
+            self._vm_status = "running" if status.get("running") else "paused"
+        except QemuError as e:
+            # the human monitor is used as a fallback
+            log.warn("QEMU VM {name} [id={id}]: could not use QMP: {error}".format(name=self._name,
+                                                                                 id=self._id,
+                                                                                 error=e))
+            self._qmp_client.close()
+            self._qmp_client = None
+
+    def _release_qmp(self):
+        """
+        Closes the QMP connection and releases the QMP port.
+        """
+
+        if self._qmp_client:
+            self._qmp_client.close()
+            self._qmp_client = None
+        if self._qmp_port and self._qmp_port in self._allocated_monitor_ports:
+            self._allocated_monitor_ports.remove(self._qmp_port)
+        self._qmp_port = None
+        self._vm_status = None
+
     def _stop_cpulimit(self):
         """
         Stops the cpulimit process.
@@ -756,9 +956,10 @@ class QemuVM(object):
         if self._cpulimit_process and self._cpulimit_process.poll() is None:
             self._cpulimit_process.kill()
             try:
-                self._process.wait(3)
+                self._cpulimit_process.wait(3)
             except subprocess.TimeoutExpired:
                 log.error("could not kill cpulimit process {}".format(self._cpulimit_process.pid))
+        self._cpulimit_process = None
 
     def _set_cpu_throttling(self):
         """
@@ -773,16 +974,55 @@ class QemuVM(object):
                 cpulimit_exec = os.path.join(os.path.dirname(os.path.abspath(sys.executable)), "cpulimit", "cpulimit.exe")
             else:
                 cpulimit_exec = "cpulimit"
-            subprocess.Popen([cpulimit_exec, "--lazy", "--pid={}".format(self._process.pid), "--limit={}".format(self._cpu_throttling)], cwd=self._working_dir)
+            self._cpulimit_process = subprocess.Popen([cpulimit_exec,
+                                                       "--lazy",
+                                                       "--pid={}".format(self._process.pid),
+                                                       "--limit={}".format(self._cpu_throttling)],
+                                                      cwd=self._working_dir)
             log.info("CPU throttled to {}%".format(self._cpu_throttling))
         except FileNotFoundError:
             raise QemuError("cpulimit could not be found, please install it or deactivate CPU throttling")
         except (OSError, subprocess.SubprocessError) as e:
             raise QemuError("Could not throttle CPU: {}".format(e))
 
-    def start(self):
+    def _cloud_images(self):
+        """
+        Returns the images of this QEMU VM to download from cloud files.
+
+        :returns: list of (attribute, file in cloud files, local path)
+        """
+
+        images = []
+        for attribute in ("hda_disk_image", "hdb_disk_image", "initrd", "kernel_image"):
+            path = getattr(self, attribute)
+            if path != "":
+                _, filename = ntpath.split(path)
+                images.append((attribute,
+                               '{}/{}'.format(self.cloud_path, filename),
+                               os.path.join(self.working_dir, filename)))
+        return images
+
+    def fetch_cloud_images(self):
+        """
+        Downloads the missing images of this QEMU VM from cloud files
+        in the background.
+
+        :returns: Future done once the images are downloaded
+        """
+
+        futures = []
+        if self.cloud_path is not None:
+            for _, src, dst in self._cloud_images():
+                if not os.path.isfile(dst):
+                    log.debug("Downloading file from {} to {}...".format(src, dst))
+                    futures.append(ImageCache.instance().fetch(src, dst))
+        return gather(futures)
+
+    def start(self, snapshot=None):
         """
         Starts this QEMU VM.
+
+        :param snapshot: snapshot to restore instead of the boot snapshot (empty to cold boot)
         """
 
         if self.is_running():
@@ -810,73 +1050,126 @@ class QemuVM(object):
                     raise QemuError("QEMU binary '{}' is not accessible".format(self._qemu_path))
 
             if self.cloud_path is not None:
-                # Download from Cloud Files
-                if self.hda_disk_image != "":
-                    _, filename = ntpath.split(self.hda_disk_image)
-                    src = '{}/{}'.format(self.cloud_path, filename)
-                    dst = os.path.join(self.working_dir, filename)
-                    if not os.path.isfile(dst):
-                        cloud_settings = Config.instance().cloud_settings()
-                        provider = get_provider(cloud_settings)
-                        log.debug("Downloading file from {} to {}...".format(src, dst))
-                        provider.download_file(src, dst)
-                        log.debug("Download of {} complete.".format(src))
-                    self.hda_disk_image = dst
-                if self.hdb_disk_image != "":
-                    _, filename = ntpath.split(self.hdb_disk_image)
-                    src = '{}/{}'.format(self.cloud_path, filename)
-                    dst = os.path.join(self.working_dir, filename)
-                    if not os.path.isfile(dst):
-                        cloud_settings = Config.instance().cloud_settings()
-                        provider = get_provider(cloud_settings)
-                        log.debug("Downloading file from {} to {}...".format(src, dst))
-                        provider.download_file(src, dst)
-                        log.debug("Download of {} complete.".format(src))
-                    self.hdb_disk_image = dst
-
-                if self.initrd != "":
-                    _, filename = ntpath.split(self.initrd)
-                    src = '{}/{}'.format(self.cloud_path, filename)
-                    dst = os.path.join(self.working_dir, filename)
+                # download from cloud files (usually already fetched by fetch_cloud_images)
+                for attribute, src, dst in self._cloud_images():
                     if not os.path.isfile(dst):
-                        cloud_settings = Config.instance().cloud_settings()
-                        provider = get_provider(cloud_settings)
-                        log.debug("Downloading file from {} to {}...".format(src, dst))
-                        provider.download_file(src, dst)
-                        log.debug("Download of {} complete.".format(src))
-                    self.initrd = dst
-                if self.kernel_image != "":
-                    _, filename = ntpath.split(self.kernel_image)
-                    src = '{}/{}'.format(self.cloud_path, filename)
-                    dst = os.path.join(self.working_dir, filename)
-                    if not os.path.isfile(dst):
-                        cloud_settings = Config.instance().cloud_settings()
-                        provider = get_provider(cloud_settings)
-                        log.debug("Downloading file from {} to {}...".format(src, dst))
-                        provider.download_file(src, dst)
-                        log.debug("Download of {} complete.".format(src))
-                    self.kernel_image = dst
-
-            self._command = self._build_command()
-            try:
-                log.info("starting QEMU: {}".format(self._command))
-                self._stdout_file = os.path.join(self._working_dir, "qemu.log")
-                log.info("logging to {}".format(self._stdout_file))
-                with open(self._stdout_file, "w") as fd:
-                    self._process = subprocess.Popen(self._command,
-                                                     stdout=fd,
-                                                     stderr=subprocess.STDOUT,
-                                                     cwd=self._working_dir)
-                log.info("QEMU VM instance {} started PID={}".format(self._id, self._process.pid))
-                self._started = True
-            except (OSError, subprocess.SubprocessError) as e:
+                        try:
+                            ImageCache.instance().fetch(src, dst).result()
+                        except ImageCacheError as e:
+                            raise QemuError(str(e))
+                    setattr(self, attribute, dst)
+
+            if not self._qmp_port:
+                # allocate a port for the QMP control channel
+                try:
+                    self._qmp_port = find_unused_port(self._monitor_start_port_range,
+                                                      self._monitor_end_port_range,
+                                                      self._monitor_host,
+                                                      ignore_ports=self._allocated_monitor_ports)
+                except Exception as e:
+                    raise QemuError(e)
+                self._allocated_monitor_ports.append(self._qmp_port)
+
+            boot_snapshot = snapshot is None
+            if snapshot:
+                if snapshot not in self.snapshots():
+                    raise QemuError("Snapshot {} doesn't exist".format(snapshot))
+            elif boot_snapshot and self._boot_snapshot:
+                snapshot = self._boot_snapshot
+                if snapshot not in self.snapshots():
+                    log.warn("QEMU VM {name} [id={id}]: boot snapshot {snapshot} doesn't exist, cold booting".format(name=self._name,
+                                                                                                                  id=self._id,
+                                                                                                                  snapshot=snapshot))
+                    snapshot = None
+
+            if not self._start_process(snapshot):
+                # the snapshot doesn't match the VM settings anymore (e.g. RAM or adapters)
                 stdout = self.read_stdout()
-                log.error("could not start QEMU {}: {}\n{}".format(self._qemu_path, e, stdout))
-                raise QemuError("could not start QEMU {}: {}\n{}".format(self._qemu_path, e, stdout))
+                self.stop()
+                if not boot_snapshot:
+                    raise QemuError("Could not restore snapshot {}:\n{}".format(snapshot, stdout))
+                log.warn("QEMU VM {name} [id={id}]: could not restore boot snapshot {snapshot}, cold booting:\n{stdout}".format(name=self._name,
+                                                                                                                             id=self._id,
+                                                                                                                             snapshot=snapshot,
+                                                                                                                             stdout=stdout))
+                self.start(snapshot="")
+
+    def _start_process(self, snapshot=None):
+        """
+        Starts the QEMU process.
+
+        :param snapshot: snapshot to restore (optional)
 
+        :returns: False if the snapshot could not be restored
+        """
+
+        self._command = self._build_command()
+        if snapshot:
+            self._command.extend(["-loadvm", snapshot])
+        try:
+            log.info("starting QEMU: {}".format(self._command))
+            self._stdout_log = ProcessLog(os.path.join(self._working_dir, "qemu.log"))
+            log.info("logging to {}".format(self._stdout_log.path))
+            with self._stdout_log.open() as fd:
+                self._process = subprocess.Popen(self._command,
+                                                 stdout=fd,
+                                                 stderr=subprocess.STDOUT,
+                                                 cwd=self._working_dir)
+            log.info("QEMU VM instance {} started PID={}".format(self._id, self._process.pid))
+            self._started = True
+        except (OSError, subprocess.SubprocessError) as e:
+            stdout = self.read_stdout()
+            log.error("could not start QEMU {}: {}\n{}".format(self._qemu_path, e, stdout))
+            raise QemuError("could not start QEMU {}: {}\n{}".format(self._qemu_path, e, stdout))
+
+        # cgroups enforce the CPU throttling and priority without extra processes
+        if not self._resources.attach(self._process.pid):
             self._set_process_priority()
             if self._cpu_throttling:
                 self._set_cpu_throttling()
+        self._connect_qmp()
+        loaded = True
+        if snapshot:
+            if self._qmp_client:
+                loaded = self._wait_snapshot_loaded()
+            else:
+                # QEMU exits if the snapshot cannot be loaded
+                try:
+                    self._process.wait(1)
+                except subprocess.TimeoutExpired:
+                    pass
+                loaded = self.is_running()
+        # the console is served by QEMU, it is read only while patterns are watched
+        self._console_watcher.tap(self._console_host, self._console)
+        return loaded
+
+    def _wait_snapshot_loaded(self):
+        """
+        Waits for QEMU to leave the incoming states while the snapshot
+        of -loadvm is loaded (QEMU exits if it cannot be loaded).
+
+        :returns: True if the snapshot has been loaded
+        """
+
+        deadline = time.time() + SNAPSHOT_TIMEOUT
+        while self.is_running() and time.time() < deadline:
+            try:
+                status = self._qmp_client.execute("query-status")
+            except QemuError as e:
+                # the connection is closed when QEMU exits
+                log.warn("QEMU VM {name} [id={id}]: could not query the status: {error}".format(name=self._name,
+                                                                                              id=self._id,
+                                                                                              error=e))
+                break
+            if status.get("status") not in ("inmigrate", "restore-vm"):
+                self._vm_status = "running" if status.get("running") else "paused"
+                return True
+            time.sleep(0.5)
+        try:
+            self._process.wait(1)
+        except subprocess.TimeoutExpired:
+            pass
+        return False
 
     def stop(self):
         """
@@ -896,7 +1189,10 @@ class QemuVM(object):
                                                                                   self._process.pid))
         self._process = None
         self._started = False
+        self._console_watcher.untap()
+        self._release_qmp()
         self._stop_cpulimit()
+        self._resources.release()
 
     def _control_vm(self, command, expected=None, timeout=30):
         """
@@ -909,7 +1205,20 @@ class QemuVM(object):
         """
 
         result = None
-        if self.is_running() and self._monitor:
+        if self.is_running() and self._qmp_client and self._qmp_client.connected:
+            log.debug("Execute QEMU monitor command through QMP: {}".format(command))
+            try:
+                output = self._qmp_client.human_monitor_command(command, timeout=timeout)
+            except QemuError as e:
+                log.warn("Could not execute QEMU monitor command: {}".format(e))
+                return result
+            if expected:
+                for pattern in expected:
+                    match = re.search(pattern, output.encode("utf-8"))
+                    if match:
+                        result = match
+                        break
+        elif self.is_running() and self._monitor:
             log.debug("Execute QEMU monitor command: {}".format(command))
             tn = telnetlib.Telnet(self._monitor_host, self._monitor, timeout=timeout)
             try:
@@ -938,11 +1247,31 @@ class QemuVM(object):
 
         result = None
 
+        if self._qmp_client and self._qmp_client.connected and self._vm_status:
+            # the status is kept up to date by the QMP events
+            return self._vm_status
+
         match = self._control_vm("info status", [b"running", b"paused"])
         if match:
             result = match.group(0).decode('ascii')
         return result
 
+    def _execute_vm_command(self, command):
+        """
+        Executes a command having the same name in QMP and in the human monitor
+        (stop, cont, system_reset).
+
+        :param command: command name
+        """
+
+        if self.is_running() and self._qmp_client and self._qmp_client.connected:
+            try:
+                self._qmp_client.execute(command)
+                return
+            except QemuError as e:
+                log.warn("Could not execute QMP command {}: {}".format(command, e))
+        self._control_vm(command)
+
     def suspend(self):
         """
         Suspends this QEMU VM.
@@ -950,7 +1279,7 @@ class QemuVM(object):
 
         vm_status = self._get_vm_status()
         if vm_status == "running":
-            self._control_vm("stop")
+            self._execute_vm_command("stop")
             log.debug("QEMU VM has been suspended")
         else:
             log.info("QEMU VM is not running to be suspended, current status is {}".format(vm_status))
@@ -960,7 +1289,7 @@ class QemuVM(object):
         Reloads this QEMU VM.
         """
 
-        self._control_vm("system_reset")
+        self._execute_vm_command("system_reset")
         log.debug("QEMU VM has been reset")
 
     def resume(self):
@@ -970,11 +1299,162 @@ class QemuVM(object):
 
         vm_status = self._get_vm_status()
         if vm_status == "paused":
-            self._control_vm("cont")
+            self._execute_vm_command("cont")
             log.debug("QEMU VM has been resumed")
         else:
             log.info("QEMU VM is not paused to be resumed, current status is {}".format(vm_status))
 
+    def _disk_files(self):
+        """
+        Returns the disks of this QEMU VM (in the working directory),
+        the snapshots are stored in them.
+
+        :returns: list of paths to the qcow2 disks
+        """
+
+        disks = []
+        for filename in ("hda_disk.qcow2", "flash.qcow2", "hdb_disk.qcow2"):
+            path = os.path.join(self._working_dir, filename)
+            if os.path.isfile(path):
+                disks.append(path)
+        return disks
+
+    def _monitor_command(self, command, timeout=30):
+        """
+        Executes a QEMU monitor command through QMP.
+
+        :param command: QEMU monitor command
+        :param timeout: how long to wait for the command to complete
+
+        :returns: command output (string)
+        """
+
+        if not self.is_running() or not self._qmp_client or not self._qmp_client.connected:
+            raise QemuError("QEMU VM {} is not running or cannot be controlled".format(self._name))
+        return self._qmp_client.human_monitor_command(command, timeout=timeout)
+
+    def _snapshot_command(self, command, name):
+        """
+        Executes a snapshot command (savevm, loadvm or delvm),
+        these commands only output something on error.
+
+        :param command: QEMU monitor command name
+        :param name: snapshot name
+        """
+
+        output = self._monitor_command("{} {}".format(command, name), timeout=SNAPSHOT_TIMEOUT)
+        errors = [line for line in output.splitlines() if line.strip() and not line.lower().startswith("warning")]
+        if errors:
+            raise QemuError("{} {} failed: {}".format(command, name, " ".join(errors)))
+
+    @staticmethod
+    def _parse_snapshots(output):
+        """
+        Parses the snapshot list of "info snapshots" or "qemu-img snapshot -l".
+
+        :param output: command output
+
+        :returns: list of snapshot names
+        """
+
+        snapshots = []
+        loadable = True
+        in_table = False
+        for line in output.splitlines():
+            fields = line.split()
+            if not fields:
+                in_table = False
+            elif line.startswith("List of"):
+                # the partial snapshots (not on all the disks) cannot be loaded
+                loadable = not line.startswith("List of partial")
+            elif fields[0] == "ID" and len(fields) > 1 and fields[1] == "TAG":
+                in_table = loadable
+            elif in_table and len(fields) > 1 and fields[1] not in snapshots:
+                snapshots.append(fields[1])
+        return snapshots
+
+    def snapshots(self):
+        """
+        Returns the snapshots of this QEMU VM.
+
+        :returns: list of snapshot names
+        """
+
+        if self.is_running() and self._qmp_client and self._qmp_client.connected:
+            return self._parse_snapshots(self._monitor_command("info snapshots"))
+
+        disks = self._disk_files()
+        if not disks:
+            return []
+        try:
+            output = subprocess.check_output([self._get_qemu_img(), "snapshot", "-l", disks[0]],
+                                             stderr=subprocess.STDOUT,
+                                             timeout=30)
+        except subprocess.CalledProcessError as e:
+            raise QemuError("Could not list the snapshots of {}: {}".format(disks[0], e.output.decode("utf-8", errors="replace")))
+        except (OSError, subprocess.SubprocessError) as e:
+            raise QemuError("Could not list the snapshots of {}: {}".format(disks[0], e))
+        return self._parse_snapshots(output.decode("utf-8", errors="replace"))
+
+    def snapshot_save(self, name):
+        """
+        Saves the state of this QEMU VM (RAM, devices and disks) in its disks,
+        an existing snapshot with the same name is replaced.
+
+        :param name: snapshot name
+        """
+
+        log.info("QEMU VM {name} [id={id}]: saving snapshot {snapshot}".format(name=self._name,
+                                                                              id=self._id,
+                                                                              snapshot=name))
+        self._snapshot_command("savevm", name)
+        log.info("QEMU VM {name} [id={id}]: snapshot {snapshot} saved".format(name=self._name,
+                                                                             id=self._id,
+                                                                             snapshot=name))
+
+    def snapshot_restore(self, name):
+        """
+        Restores a snapshot, the VM is started from it if it is not running.
+
+        :param name: snapshot name
+        """
+
+        if not self.is_running():
+            self.start(snapshot=name)
+            return
+
+        if name not in self.snapshots():
+            raise QemuError("Snapshot {} doesn't exist".format(name))
+        self._snapshot_command("loadvm", name)
+        log.info("QEMU VM {name} [id={id}]: snapshot {snapshot} restored".format(name=self._name,
+                                                                                id=self._id,
+                                                                                snapshot=name))
+
+    def snapshot_delete(self, name):
+        """
+        Deletes a snapshot.
+
+        :param name: snapshot name
+        """
+
+        if name not in self.snapshots():
+            raise QemuError("Snapshot {} doesn't exist".format(name))
+
+        if self.is_running():
+            self._snapshot_command("delvm", name)
+        else:
+            qemu_img_path = self._get_qemu_img()
+            for disk in self._disk_files():
+                # the snapshot may not exist on every disk (e.g. hdb added later)
+                retcode = subprocess.call([qemu_img_path, "snapshot", "-d", name, disk])
+                log.info("{} returned with {}".format(qemu_img_path, retcode))
+
+        if self._boot_snapshot == name:
+            self._boot_snapshot = ""
+        log.info("QEMU VM {name} [id={id}]: snapshot {snapshot} deleted".format(name=self._name,
+                                                                               id=self._id,
+                                                                               snapshot=name))
+
     def port_add_nio_binding(self, adapter_id, nio):
         """
         Adds a port NIO binding.
@@ -1014,6 +1494,22 @@ class QemuVM(object):
                                                                                         nio=nio,
                                                                                         adapter_id=adapter_id))
 
+    def get_nio(self, adapter_id):
+        """
+        Returns the NIO of an adapter.
+
+        :param adapter_id: adapter ID
+
+        :returns: NIO instance or None
+        """
+
+        try:
+            adapter = self._ethernet_adapters[adapter_id]
+        except IndexError:
+            raise QemuError("Adapter {adapter_id} doesn't exist on QEMU VM {name}".format(name=self._name,
+                                                                                          adapter_id=adapter_id))
+        return adapter.get_nio(0)
+
     def port_remove_nio_binding(self, adapter_id):
         """
         Removes a port NIO binding.
@@ -1054,18 +1550,27 @@ class QemuVM(object):
 
     def read_stdout(self):
         """
-        Reads the standard output of the QEMU process.
+        Reads the end of the standard output of the QEMU process.
         Only use when the process has been stopped or has crashed.
         """
 
-        output = ""
-        if self._stdout_file:
-            try:
-                with open(self._stdout_file, errors="replace") as file:
-                    output = file.read()
-            except OSError as e:
-                log.warn("could not read {}: {}".format(self._stdout_file, e))
-        return output
+        if self._stdout_log:
+            return self._stdout_log.tail()
+        return ""
+
+    def read_log(self, offset=None, size=MAX_PAGE_SIZE):
+        """
+        Reads a page of the output of the QEMU process.
+
+        :param offset: position in the log, from the end if negative (the last page by default)
+        :param size: maximum number of bytes
+
+        :returns: tuple (text, offset of the page, offset of the end of the log)
+        """
+
+        if self._stdout_log:
+            return self._stdout_log.read(offset, size)
+        return "", 0, 0
 
     def is_running(self):
         """
@@ -1101,9 +1606,20 @@ class QemuVM(object):
         else:
             return []
 
-    def _disk_options(self):
+    def _qmp_options(self):
+
+        if self._qmp_port:
+            return ["-qmp", "tcp:{}:{},server,nowait".format(self._monitor_host, self._qmp_port)]
+        else:
+            return []
+
+    def _get_qemu_img(self):
+        """
+        Returns the path to qemu-img (located next to the QEMU binary).
+
+        :returns: path to qemu-img
+        """
 
-        options = []
         qemu_img_path = ""
         qemu_path_dir = os.path.dirname(self._qemu_path)
         try:
@@ -1115,7 +1631,12 @@ class QemuVM(object):
 
         if not qemu_img_path:
             raise QemuError("Could not find qemu-img in {}".format(qemu_path_dir))
+        return qemu_img_path
 
+    def _disk_options(self):
+
+        options = []
+        qemu_img_path = self._get_qemu_img()
         try:
             if self._hda_disk_image:
                 if not os.path.isfile(self._hda_disk_image) or not os.path.exists(self._hda_disk_image):
@@ -1223,6 +1744,7 @@ class QemuVM(object):
         command.extend(self._linux_boot_options())
         command.extend(self._serial_options())
         command.extend(self._monitor_options())
+        command.extend(self._qmp_options())
         additional_options = self._options.strip()
         if additional_options:
             command.extend(shlex.split(additional_options))
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Persistent QEMU Machine Protocol (QMP) client.
+http://wiki.qemu.org/QMP
+"""
+
+import json
+import socket
+import threading
+import time
+
+from .qemu_error import QemuError
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class QMPClient(object):
+    """
+    QMP client keeping one connection open for the lifetime of a QEMU process.
+
+    Commands are correlated with their responses using the QMP "id" field,
+    asynchronous events (STOP, RESUME, SHUTDOWN...) are dispatched to the
+    subscribed callbacks from a reader thread.
+
+    :param name: name of the QEMU VM (for logging)
+    :param host: QMP server host
+    :param port: QMP server port
+    """
+
+    def __init__(self, name, host, port):
+
+        self._name = name
+        self._host = host
+        self._port = port
+        self._socket = None
+        self._reader_thread = None
+        self._write_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._subscriptions = {}
+        self._command_id = 0
+        self._connected = False
+
+    @property
+    def connected(self):
+        """
+        Returns either the client is connected to QEMU.
+
+        :returns: boolean
+        """
+
+        return self._connected
+
+    def connect(self, wait=5.0, timeout=30):
+        """
+        Connects to the QMP server and negotiates the capabilities.
+
+        :param wait: maximum time to wait for QEMU to accept the connection
+        :param timeout: timeout for the negotiation
+        """
+
+        host = self._host
+        if host == "0.0.0.0":
+            host = "127.0.0.1"
+        elif host == "::":
+            host = "::1"
+
+        begin = time.time()
+        last_exception = None
+        while True:
+            try:
+                self._socket = socket.create_connection((host, self._port), timeout)
+                break
+            except OSError as e:
+                last_exception = e
+                if time.time() - begin >= wait:
+                    raise QemuError("Could not connect to QMP on {}:{}: {}".format(host, self._port, last_exception))
+                time.sleep(0.01)
+
+        try:
+            # QEMU sends a greeting before anything else
+            buffer = b""
+            while b"\n" not in buffer:
+                data = self._socket.recv(4096)
+                if not data:
+                    raise QemuError("QMP connection closed by QEMU during the greeting")
+                buffer += data
+            greeting, buffer = buffer.split(b"\n", 1)
+            if "QMP" not in json.loads(greeting.decode("utf-8")):
+                raise QemuError("Unexpected QMP greeting: {}".format(greeting))
+        except (OSError, ValueError) as e:
+            self._socket.close()
+            raise QemuError("Could not read the QMP greeting: {}".format(e))
+
+        self._socket.settimeout(None)
+        self._connected = True
+        self._reader_thread = threading.Thread(target=self._reader, args=(buffer,), daemon=True)
+        self._reader_thread.start()
+        self.execute("qmp_capabilities", timeout=timeout)
+        log.info("QEMU VM {}: QMP connection established on {}:{}".format(self._name, host, self._port))
+
+    def close(self):
+        """
+        Closes the QMP connection.
+        """
+
+        self._connected = False
+        if self._socket:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+            self._socket = None
+        self._fail_pending()
+
+    def subscribe(self, event, callback):
+        """
+        Subscribes to a QMP event.
+
+        :param event: event name (e.g. STOP, RESUME, SHUTDOWN) or None for all events
+        :param callback: callable receiving the event name and its data
+        """
+
+        self._subscriptions.setdefault(event, []).append(callback)
+
+    def execute(self, command, arguments=None, timeout=30):
+        """
+        Executes a QMP command and waits for its response.
+
+        :param command: QMP command name
+        :param arguments: QMP command arguments (dictionary)
+        :param timeout: how long to wait for the response
+
+        :returns: QMP "return" value
+        """
+
+        if not self._connected:
+            raise QemuError("QMP is not connected")
+
+        with self._pending_lock:
+            self._command_id += 1
+            command_id = self._command_id
+            pending = [threading.Event(), None]
+            self._pending[command_id] = pending
+
+        message = {"execute": command, "id": command_id}
+        if arguments:
+            message["arguments"] = arguments
+        log.debug("QEMU VM {}: sending QMP command: {}".format(self._name, message))
+
+        try:
+            with self._write_lock:
+                self._socket.sendall(json.dumps(message).encode("utf-8") + b"\r\n")
+        except (OSError, AttributeError) as e:
+            with self._pending_lock:
+                self._pending.pop(command_id, None)
+            raise QemuError("Could not send QMP command {}: {}".format(command, e))
+
+        if not pending[0].wait(timeout):
+            with self._pending_lock:
+                self._pending.pop(command_id, None)
+            raise QemuError("Timeout while waiting for QMP command {}".format(command))
+
+        response = pending[1]
+        if response is None:
+            raise QemuError("QMP connection lost while executing {}".format(command))
+        if "error" in response:
+            raise QemuError("QMP command {} failed: {}".format(command, response["error"].get("desc")))
+        return response.get("return")
+
+    def human_monitor_command(self, command_line, timeout=30):
+        """
+        Executes a human monitor command through QMP.
+
+        :param command_line: human monitor command (e.g. host_net_add ...)
+        :param timeout: how long to wait for the response
+
+        :returns: command output (string)
+        """
+
+        return self.execute("human-monitor-command", {"command-line": command_line}, timeout=timeout)
+
+    def _fail_pending(self):
+        """
+        Wakes up every command waiting for a response.
+        """
+
+        with self._pending_lock:
+            for pending in self._pending.values():
+                pending[0].set()
+            self._pending.clear()
+
+    def _dispatch(self, message):
+        """
+        Dispatches a QMP message to a waiting command or to event subscribers.
+
+        :param message: decoded QMP message
+        """
+
+        if "event" in message:
+            event = message["event"]
+            log.debug("QEMU VM {}: received QMP event {}".format(self._name, event))
+            for callback in self._subscriptions.get(event, []) + self._subscriptions.get(None, []):
+                try:
+                    callback(event, message.get("data", {}))
+                except Exception as e:
+                    log.error("QEMU VM {}: error in QMP event callback: {}".format(self._name, e), exc_info=1)
+        elif "id" in message:
+            with self._pending_lock:
+                pending = self._pending.pop(message["id"], None)
+            if pending:
+                pending[1] = message
+                pending[0].set()
+
+    def _reader(self, buffer):
+        """
+        Thread reading the QMP messages sent by QEMU.
+
+        :param buffer: data already received after the greeting
+        """
+
+        sock = self._socket
+        while True:
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._dispatch(json.loads(line.decode("utf-8")))
+                except ValueError as e:
+                    log.warn("QEMU VM {}: could not decode QMP message: {}".format(self._name, e))
+            try:
+                data = sock.recv(4096)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            buffer += data
+
+        log.info("QEMU VM {}: QMP connection closed".format(self._name))
+        self._connected = False
+        self._fail_pending()
@@ -15,6 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from ..cgroups import RESOURCES_SCHEMA
+from ..console_watcher import CONSOLE_WATCH_PROPERTIES
+from ..fabric.link_conditions import LINK_CONDITIONS_PROPERTIES
+from ..process_log import PROCESS_LOG_PROPERTIES
 
 QEMU_CREATE_SCHEMA = {
     "$schema": "http://json-schema.org/draft-04/schema#",
@@ -159,6 +163,13 @@ QEMU_UPDATE_SCHEMA = {
             "description": "Additional QEMU options",
             "type": "string",
         },
+        "boot_snapshot": {
+            "description": "snapshot to start the QEMU VM from (empty to cold boot)",
+            "type": "string",
+            "pattern": "^([A-Za-z0-9][A-Za-z0-9_.-]*)?$",
+            "maxLength": 64,
+        },
+        "resources": RESOURCES_SCHEMA,
     },
     "additionalProperties": False,
     "required": ["id"]
@@ -192,6 +203,96 @@ QEMU_STOP_SCHEMA = {
     "required": ["id"]
 }
 
+QEMU_CONSOLE_WATCH_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to watch the console output of a QEMU VM instance",
+    "type": "object",
+    "properties": dict(CONSOLE_WATCH_PROPERTIES, id={
+        "description": "QEMU VM instance ID",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id", "pattern"]
+}
+
+QEMU_CONSOLE_UNWATCH_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to stop watching the console output of a QEMU VM instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "QEMU VM instance ID",
+            "type": "integer"
+        },
+        "watch_id": {
+            "description": "watch identifier",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+QEMU_SNAPSHOT_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to save, restore or delete a snapshot of a QEMU VM instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "QEMU VM instance ID",
+            "type": "integer"
+        },
+        "name": {
+            "description": "snapshot name",
+            "type": "string",
+            "pattern": "^[A-Za-z0-9][A-Za-z0-9_.-]*$",
+            "maxLength": 64,
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id", "name"]
+}
+
+QEMU_SNAPSHOT_LIST_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to list the snapshots of a QEMU VM instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "QEMU VM instance ID",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+QEMU_RESOURCE_USAGE_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to get the resource usage of a QEMU VM instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "QEMU VM instance ID",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+QEMU_PROCESS_LOG_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to read the log of a QEMU VM instance process",
+    "type": "object",
+    "properties": dict(PROCESS_LOG_PROPERTIES, id={
+        "description": "QEMU VM instance ID",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
 QEMU_SUSPEND_SCHEMA = {
     "$schema": "http://json-schema.org/draft-04/schema#",
     "description": "Request validation to suspend a QEMU VM instance",
@@ -421,3 +522,81 @@ QEMU_DELETE_NIO_SCHEMA = {
     "additionalProperties": False,
     "required": ["id", "port"]
 }
+
+QEMU_START_CAPTURE_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to start a packet capture on a QEMU VM instance port",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "QEMU VM instance ID",
+            "type": "integer"
+        },
+        "port": {
+            "description": "Port number",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 8
+        },
+        "port_id": {
+            "description": "Unique port identifier for the QEMU VM instance",
+            "type": "integer"
+        },
+        "capture_file_name": {
+            "description": "Capture file name",
+            "type": "string",
+            "minLength": 1,
+        },
+        "data_link_type": {
+            "description": "PCAP data link type",
+            "type": "string",
+            "minLength": 1,
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id", "port", "port_id", "capture_file_name"]
+}
+
+QEMU_STOP_CAPTURE_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to stop a packet capture on a QEMU VM instance port",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "QEMU VM instance ID",
+            "type": "integer"
+        },
+        "port": {
+            "description": "Port number",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 8
+        },
+        "port_id": {
+            "description": "Unique port identifier for the QEMU VM instance",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id", "port", "port_id"]
+}
+
+QEMU_SET_LINK_CONDITIONS_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to set the conditions (delay, loss...) of the link of a QEMU VM instance port",
+    "type": "object",
+    "properties": dict(LINK_CONDITIONS_PROPERTIES, id={
+        "description": "QEMU VM instance ID",
+        "type": "integer"
+    }, port={
+        "description": "Port number",
+        "type": "integer",
+        "minimum": 0,
+        "maximum": 8
+    }, port_id={
+        "description": "Unique port identifier for the QEMU VM instance",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id", "port", "port_id"]
+}
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sharding of a module across several processes (shards).
+
+Node identifiers are assigned to the shards by consistent hashing:
+a shard only allocates the identifiers it owns and the server routes
+the requests for a node to the owner of its identifier. The ports
+(consoles, UDP tunnels) are also split between the shards so that
+two shards never allocate the same port.
+"""
+
+import bisect
+import hashlib
+
+# number of points of each shard on the hash ring
+RING_REPLICAS = 64
+
+# destinations (last part) applied to all the shards of a module
+BROADCAST_METHODS = frozenset(["reset", "settings"])
+
+# parameters of the create requests with an identifier chosen by the client (e.g. loading a project)
+NODE_ID_PARAMS = ("vpcs_id", "iou_id", "qemu_id", "vbox_id", "router_id")
+
+_local_shard = None  # (ShardRing instance, shard index) in a shard process
+
+
+def _hash(key):
+
+    return int(hashlib.md5(str(key).encode("utf-8")).hexdigest()[:16], 16)
+
+
+class ShardRing(object):
+    """
+    Consistent hash ring: changing the number of shards only moves
+    a small part of the identifiers to other shards.
+
+    :param shards: number of shards
+    """
+
+    def __init__(self, shards):
+
+        self._shards = shards
+        points = sorted((_hash("{}-{}".format(shard, replica)), shard) for shard in range(shards) for replica in range(RING_REPLICAS))
+        self._hashes = [point[0] for point in points]
+        self._owners = [point[1] for point in points]
+
+    @property
+    def shards(self):
+        """
+        Returns the number of shards.
+
+        :returns: integer
+        """
+
+        return self._shards
+
+    def owner(self, node_id):
+        """
+        Returns the shard owning a node identifier.
+
+        :param node_id: node identifier
+
+        :returns: shard index
+        """
+
+        if self._shards == 1:
+            return 0
+        index = bisect.bisect(self._hashes, _hash(node_id))
+        return self._owners[index % len(self._owners)]
+
+
+def set_local_shard(shard, shards):
+    """
+    Sets the shard of this process (called in the module processes).
+
+    :param shard: shard index
+    :param shards: number of shards of the module
+    """
+
+    global _local_shard
+    if shards > 1:
+        _local_shard = (ShardRing(shards), shard)
+    else:
+        _local_shard = None
+
+
+def owns(node_id):
+    """
+    Returns either a node identifier can be allocated by this process.
+
+    :param node_id: node identifier
+
+    :returns: boolean
+    """
+
+    if _local_shard is None:
+        return True
+    ring, shard = _local_shard
+    return ring.owner(node_id) == shard
+
+
+def owns_port(port):
+    """
+    Returns either a port can be allocated by this process
+    (the ports of a range are interleaved between the shards).
+
+    :param port: port number
+
+    :returns: boolean
+    """
+
+    if _local_shard is None:
+        return True
+    ring, shard = _local_shard
+    return port % ring.shards == shard
+
+
+class ModuleShards(object):
+    """
+    Routes the requests for a module to its shards (used by the server).
+
+    :param identities: ZeroMQ identities of the shards (in shard order)
+    """
+
+    def __init__(self, identities):
+
+        self._identities = list(identities)
+        self._ring = ShardRing(len(self._identities))
+        self._next = 0
+
+    @property
+    def identities(self):
+        """
+        Returns the identities of the shards.
+
+        :returns: list of identities
+        """
+
+        return self._identities
+
+    def route(self, method, params):
+        """
+        Returns the shards handling a request.
+
+        :param method: JSON-RPC method
+        :param params: JSON-RPC params
+
+        :returns: list of identities, the first shard replies to the requester
+        """
+
+        if len(self._identities) == 1:
+            return self._identities
+
+        if method.rsplit(".", 1)[-1] in BROADCAST_METHODS:
+            return self._identities
+
+        if isinstance(params, dict):
+            node_id = params.get("id")
+            if node_id is None and method.endswith(".create"):
+                for name in NODE_ID_PARAMS:
+                    if params.get(name) is not None:
+                        node_id = params[name]
+                        break
+            if node_id is not None:
+                return [self._identities[self._ring.owner(node_id)]]
+
+        if method.endswith(".create"):
+            # the shard allocates an identifier it owns
+            identity = self._identities[self._next]
+            self._next = (self._next + 1) % len(self._identities)
+            return [identity]
+
+        # module wide requests (e.g. echo, image lists)
+        return self._identities[:1]
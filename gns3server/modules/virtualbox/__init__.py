@@ -21,16 +21,19 @@ VirtualBox server module.
 
 import sys
 import os
+import base64
 import socket
 import shutil
-import subprocess
 
 from gns3server.modules import IModule
 from gns3server.config import Config
 from .virtualbox_vm import VirtualBoxVM
 from .virtualbox_error import VirtualBoxError
+from .inventory import VirtualBoxInventory
 from .nios.nio_udp import NIO_UDP
 from ..attic import find_unused_port
+from ..attic import call_in_parallel
+from ..console_hub import DEFAULT_SCROLLBACK_SIZE
 
 from .schemas import VBOX_CREATE_SCHEMA
 from .schemas import VBOX_DELETE_SCHEMA
@@ -44,6 +47,11 @@ from .schemas import VBOX_ADD_NIO_SCHEMA
 from .schemas import VBOX_DELETE_NIO_SCHEMA
 from .schemas import VBOX_START_CAPTURE_SCHEMA
 from .schemas import VBOX_STOP_CAPTURE_SCHEMA
+from .schemas import VBOX_CONSOLE_BUFFER_SCHEMA
+from .schemas import VBOX_CONSOLE_WATCH_SCHEMA
+from .schemas import VBOX_CONSOLE_UNWATCH_SCHEMA
+from .schemas import VBOX_SNAPSHOT_SCHEMA
+from .schemas import VBOX_SNAPSHOT_LIST_SCHEMA
 
 import logging
 log = logging.getLogger(__name__)
@@ -92,11 +100,13 @@ class VirtualBox(IModule):
         # a new process start when calling IModule
         IModule.__init__(self, name, *args, **kwargs)
         self._vbox_instances = {}
+        self._inventory = VirtualBoxInventory(self._vboxmanage_path)
 
         config = Config.instance()
         vbox_config = config.get_section_config(name.upper())
         self._console_start_port_range = vbox_config.get("console_start_port_range", 3501)
         self._console_end_port_range = vbox_config.get("console_end_port_range", 4000)
+        self._console_scrollback_size = int(vbox_config.get("console_scrollback_size", DEFAULT_SCROLLBACK_SIZE))
         self._allocated_udp_ports = []
         self._udp_start_port_range = vbox_config.get("udp_start_port_range", 35001)
         self._udp_end_port_range = vbox_config.get("udp_end_port_range", 35500)
@@ -114,15 +124,30 @@ class VirtualBox(IModule):
         """
 
         # delete all VirtualBox instances
-        for vbox_id in self._vbox_instances:
-            vbox_instance = self._vbox_instances[vbox_id]
-            try:
-                vbox_instance.delete()
-            except VirtualBoxError:
-                continue
+        for vbox_instance, e in call_in_parallel(lambda vbox_instance: vbox_instance.delete(), self._vbox_instances.values()):
+            log.error("could not delete VirtualBox VM {}: {}".format(vbox_instance.name, e))
 
         IModule.stop(self, signum)  # this will stop the I/O loop
 
+    def _console_matched(self, vbox_instance, watch_id, pattern, session):
+        """
+        Callback for the patterns found in the console output.
+        Called from the console hub thread, the notification is
+        sent from the I/O loop to the client that registered the watch.
+
+        :param vbox_instance: VirtualBoxVM instance
+        :param watch_id: watch identifier
+        :param pattern: pattern found
+        :param session: session of the client that registered the watch
+        """
+
+        notification = {"module": self.name,
+                        "id": vbox_instance.id,
+                        "name": vbox_instance.name,
+                        "watch_id": watch_id,
+                        "pattern": pattern}
+        self._ioloop.add_callback(self.send_notification, "{}.console_match".format(self.name), notification, session)
+
     def get_vbox_instance(self, vbox_id):
         """
         Returns a VirtualBox VM instance.
@@ -147,9 +172,8 @@ class VirtualBox(IModule):
         """
 
         # delete all VirtualBox instances
-        for vbox_id in self._vbox_instances:
-            vbox_instance = self._vbox_instances[vbox_id]
-            vbox_instance.delete()
+        for vbox_instance, e in call_in_parallel(lambda vbox_instance: vbox_instance.delete(), self._vbox_instances.values()):
+            log.error("could not delete VirtualBox VM {}: {}".format(vbox_instance.name, e))
 
         # resets the instance IDs
         VirtualBoxVM.reset()
@@ -206,6 +230,10 @@ class VirtualBox(IModule):
 
         if "vboxmanage_path" in request:
             self._vboxmanage_path = request["vboxmanage_path"]
+            self._inventory.vboxmanage_path = self._vboxmanage_path
+
+        # fill the VirtualBox inventory in the background
+        self._inventory.warm_up()
 
         if "console_start_port_range" in request and "console_end_port_range" in request:
             self._console_start_port_range = request["console_start_port_range"]
@@ -262,7 +290,9 @@ class VirtualBox(IModule):
                                          console,
                                          self._console_host,
                                          self._console_start_port_range,
-                                         self._console_end_port_range)
+                                         self._console_end_port_range,
+                                         self._inventory,
+                                         self._console_scrollback_size)
 
         except VirtualBoxError as e:
             self.send_custom_error(str(e))
@@ -273,6 +303,7 @@ class VirtualBox(IModule):
 
         defaults = vbox_instance.defaults()
         response.update(defaults)
+        vbox_instance.set_console_match_callback(self._console_matched)
         self._vbox_instances[vbox_instance.id] = vbox_instance
         self.send_response(response)
 
@@ -711,20 +742,237 @@ class VirtualBox(IModule):
         response = {"port_id": request["port_id"]}
         self.send_response(response)
 
-    def _execute_vboxmanage(self, command):
+    @IModule.route("virtualbox.console_buffer")
+    def console_buffer(self, request):
+        """
+        Gets the recent console output (scrollback buffer).
+
+        Mandatory request parameters:
+        - id (VirtualBox VM identifier)
+
+        Optional request parameters:
+        - size (maximum number of bytes to return)
+
+        Response parameters:
+        - id (VirtualBox VM identifier)
+        - console_output_base64 (console output base64 encoded)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VBOX_CONSOLE_BUFFER_SCHEMA):
+            return
+
+        # get the instance
+        vbox_instance = self.get_vbox_instance(request["id"])
+        if not vbox_instance:
+            return
+
+        output = vbox_instance.console_buffer.read(request.get("size"))
+        response = {"id": request["id"],
+                    "console_output_base64": base64.encodebytes(output).decode("utf-8")}
+        self.send_response(response)
+
+    @IModule.route("virtualbox.console_watch")
+    def console_watch(self, request):
+        """
+        Watches the console output of a VirtualBox VM instance for a pattern
+        (the virtualbox.console_match notification is sent when it is found).
+
+        Mandatory request parameters:
+        - id (VirtualBox VM identifier)
+        - pattern (text to look for)
+
+        Optional request parameters:
+        - once (remove the watch after the first match, true by default)
+        - scrollback (also look in the recent console output, true by default)
+
+        Response parameters:
+        - id (VirtualBox VM identifier)
+        - watch_id (watch identifier)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VBOX_CONSOLE_WATCH_SCHEMA):
+            return
+
+        # get the instance
+        vbox_instance = self.get_vbox_instance(request["id"])
+        if not vbox_instance:
+            return
+
+        watcher = vbox_instance.console_watcher
+        watch_id = watcher.add(request["pattern"],
+                               request.get("once", True),
+                               request.get("scrollback", True),
+                               self._current_session)
+        self.send_response({"id": request["id"],
+                            "watch_id": watch_id})
+
+    @IModule.route("virtualbox.console_unwatch")
+    def console_unwatch(self, request):
+        """
+        Stops watching the console output of a VirtualBox VM instance.
+
+        Mandatory request parameters:
+        - id (VirtualBox VM identifier)
+
+        Optional request parameters:
+        - watch_id (watch identifier, all the watches by default)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VBOX_CONSOLE_UNWATCH_SCHEMA):
+            return
+
+        # get the instance
+        vbox_instance = self.get_vbox_instance(request["id"])
+        if not vbox_instance:
+            return
+
+        if "watch_id" not in request:
+            vbox_instance.console_watcher.clear()
+        elif not vbox_instance.console_watcher.remove(request["watch_id"]):
+            self.send_custom_error("Watch {} doesn't exist".format(request["watch_id"]))
+            return
+        self.send_response(True)
+
+    @IModule.route("virtualbox.snapshot_save")
+    def vbox_snapshot_save(self, request):
+        """
+        Takes a snapshot of a VirtualBox VM instance
+        (including its state if it is running, an existing snapshot is replaced).
+
+        Mandatory request parameters:
+        - id (VirtualBox VM instance identifier)
+        - name (snapshot name)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VBOX_SNAPSHOT_SCHEMA):
+            return
+
+        # get the instance
+        vbox_instance = self.get_vbox_instance(request["id"])
+        if not vbox_instance:
+            return
+
+        try:
+            vbox_instance.snapshot_save(request["name"])
+        except VirtualBoxError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response(True)
+
+    @IModule.route("virtualbox.snapshot_restore")
+    def vbox_snapshot_restore(self, request):
+        """
+        Restores a snapshot of a VirtualBox VM instance and starts it
+        (a running VM is powered off first).
+
+        Mandatory request parameters:
+        - id (VirtualBox VM instance identifier)
+        - name (snapshot name)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VBOX_SNAPSHOT_SCHEMA):
+            return
+
+        # get the instance
+        vbox_instance = self.get_vbox_instance(request["id"])
+        if not vbox_instance:
+            return
+
+        try:
+            vbox_instance.snapshot_restore(request["name"])
+        except VirtualBoxError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response(True)
+
+    @IModule.route("virtualbox.snapshot_delete")
+    def vbox_snapshot_delete(self, request):
+        """
+        Deletes a snapshot of a VirtualBox VM instance.
+
+        Mandatory request parameters:
+        - id (VirtualBox VM instance identifier)
+        - name (snapshot name)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VBOX_SNAPSHOT_SCHEMA):
+            return
+
+        # get the instance
+        vbox_instance = self.get_vbox_instance(request["id"])
+        if not vbox_instance:
+            return
+
+        try:
+            vbox_instance.snapshot_delete(request["name"])
+        except VirtualBoxError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response(True)
+
+    @IModule.route("virtualbox.snapshot_list")
+    def vbox_snapshot_list(self, request):
         """
-        Executes VBoxManage and return its result.
+        Lists the snapshots of a VirtualBox VM instance.
 
-        :param command: command to execute (list)
+        Mandatory request parameters:
+        - id (VirtualBox VM instance identifier)
 
-        :returns: VBoxManage output
+        Response parameters:
+        - id (VirtualBox VM instance identifier)
+        - snapshots (list of snapshot names)
+        - boot_snapshot (snapshot the VM is started from)
+
+        :param request: JSON request
         """
 
+        # validate the request
+        if not self.validate_request(request, VBOX_SNAPSHOT_LIST_SCHEMA):
+            return
+
+        # get the instance
+        vbox_instance = self.get_vbox_instance(request["id"])
+        if not vbox_instance:
+            return
+
         try:
-            result = subprocess.check_output(command, stderr=subprocess.STDOUT, timeout=60)
-        except (OSError, subprocess.SubprocessError) as e:
-            raise VirtualBoxError("Could not execute VBoxManage {}".format(e))
-        return result.decode("utf-8", errors="ignore")
+            snapshots = vbox_instance.snapshots()
+        except VirtualBoxError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response({"id": vbox_instance.id,
+                            "snapshots": snapshots,
+                            "boot_snapshot": vbox_instance.boot_snapshot})
 
     @IModule.route("virtualbox.vm_list")
     def vm_list(self, request):
@@ -746,26 +994,22 @@ class VirtualBox(IModule):
             if not vboxmanage_path or not os.path.exists(vboxmanage_path):
                 raise VirtualBoxError("Could not find VBoxManage, is VirtualBox correctly installed?")
 
-            command = [vboxmanage_path, "--nologo", "list", "vms"]
-            result = self._execute_vboxmanage(command)
+            if vboxmanage_path == self._inventory.vboxmanage_path:
+                inventory = self._inventory
+            else:
+                # another VBoxManage is being tested, do not pollute the cache
+                inventory = VirtualBoxInventory(vboxmanage_path)
+
+            vms = []
+            for vmname, uuid in inventory.vms():
+                if vmname == "<inaccessible>":
+                    continue  # ignore inaccessible VMs
+                if not inventory.is_gns3_clone(vmname, uuid):
+                    vms.append(vmname)
         except VirtualBoxError as e:
             self.send_custom_error(str(e))
             return
 
-        vms = []
-        for line in result.splitlines():
-            vmname, uuid = line.rsplit(' ', 1)
-            vmname = vmname.strip('"')
-            if vmname == "<inaccessible>":
-                continue  # ignore inaccessible VMs
-            try:
-                extra_data = self._execute_vboxmanage([vboxmanage_path, "getextradata", vmname, "GNS3/Clone"]).strip()
-            except VirtualBoxError as e:
-                self.send_custom_error(str(e))
-                return
-            if not extra_data == "Value: yes":
-                vms.append(vmname)
-
         response = {"vms": vms}
         self.send_response(response)
 
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cached inventory of the VirtualBox registered VMs, HDDs and system properties.
+"""
+
+import sys
+import os
+import subprocess
+import threading
+import xml.etree.ElementTree as ET
+
+from .virtualbox_error import VirtualBoxError
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def virtualbox_home():
+    """
+    Returns the VirtualBox home directory (where VirtualBox.xml is stored).
+
+    :returns: path to the VirtualBox home directory or None
+    """
+
+    if "VBOX_USER_HOME" in os.environ:
+        return os.environ["VBOX_USER_HOME"]
+
+    home = os.path.expanduser("~")
+    if sys.platform.startswith("darwin"):
+        paths = [os.path.join(home, "Library", "VirtualBox")]
+    else:
+        paths = [os.path.join(home, ".config", "VirtualBox"), os.path.join(home, ".VirtualBox")]
+
+    for path in paths:
+        if os.path.isfile(os.path.join(path, "VirtualBox.xml")):
+            return path
+    return None
+
+
+class VirtualBoxInventory(object):
+    """
+    Inventory of what is registered in VirtualBox, served from memory.
+
+    VBoxManage is only executed again when the VirtualBox XML configuration
+    files have changed (VirtualBox.xml for the registered VMs and the VM
+    .vbox files for the extra data and attached media). The lock is not
+    held while VBoxManage runs, only to read and publish the results.
+
+    :param vboxmanage_path: path to the VBoxManage tool
+    :param home: VirtualBox home directory (detected by default)
+    """
+
+    def __init__(self, vboxmanage_path, home=None):
+
+        self._vboxmanage_path = vboxmanage_path
+        self._home = home or virtualbox_home()
+        self._lock = threading.RLock()
+        self._generation = 0  # incremented when the inventory is invalidated
+        self._machines = None
+        self._machines_signature = None
+        self._system_properties = None
+        self._vms = None
+        self._vms_signature = None
+        self._clones = {}
+        self._hdds = None
+        self._hdds_signature = None
+
+    @property
+    def vboxmanage_path(self):
+        """
+        Returns the path to VBoxManage.
+
+        :returns: path
+        """
+
+        return self._vboxmanage_path
+
+    @vboxmanage_path.setter
+    def vboxmanage_path(self, vboxmanage_path):
+        """
+        Sets the path to VBoxManage (invalidates the inventory).
+
+        :param vboxmanage_path: path
+        """
+
+        if vboxmanage_path != self._vboxmanage_path:
+            self._vboxmanage_path = vboxmanage_path
+            self.invalidate()
+            with self._lock:
+                self._system_properties = None
+
+    def invalidate(self):
+        """
+        Forgets the cached VMs and HDDs.
+        """
+
+        with self._lock:
+            self._generation += 1
+            self._machines = None
+            self._machines_signature = None
+            self._vms = None
+            self._vms_signature = None
+            self._clones.clear()
+            self._hdds = None
+            self._hdds_signature = None
+
+    def _execute(self, args, timeout=60):
+        """
+        Executes VBoxManage.
+
+        :param args: VBoxManage arguments
+        :param timeout: how long to wait for VBoxManage
+
+        :returns: result (list of lines)
+        """
+
+        command = [self._vboxmanage_path, "--nologo"] + args
+        log.debug("Execute vboxmanage command: {}".format(command))
+        try:
+            result = subprocess.check_output(command, stderr=subprocess.STDOUT, timeout=timeout)
+        except (OSError, subprocess.SubprocessError) as e:
+            raise VirtualBoxError("Could not execute VBoxManage {}".format(e))
+        return result.decode("utf-8", errors="ignore").splitlines()
+
+    @staticmethod
+    def _file_signature(path):
+        """
+        Returns a signature telling if a file has changed.
+
+        :param path: file path
+
+        :returns: tuple or None if the file cannot be accessed
+        """
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (path, st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _machine_files(self):
+        """
+        Returns the .vbox files of the registered VMs, read from VirtualBox.xml
+        (parsed again only when it has changed).
+
+        :returns: dictionary of UUID -> .vbox file path
+        """
+
+        with self._lock:
+            signature = self._main_signature()
+            if signature is None:
+                return {}
+            if self._machines is None or signature != self._machines_signature:
+                self._machines = self._parse_machine_files()
+                self._machines_signature = signature
+            return self._machines
+
+    def _parse_machine_files(self):
+        """
+        Reads the .vbox files of the registered VMs from VirtualBox.xml.
+
+        :returns: dictionary of UUID -> .vbox file path
+        """
+
+        machines = {}
+        try:
+            tree = ET.parse(os.path.join(self._home, "VirtualBox.xml"))
+        except (OSError, ET.ParseError) as e:
+            log.debug("could not read VirtualBox.xml: {}".format(e))
+            return machines
+
+        for element in tree.iter():
+            if element.tag.endswith("MachineEntry"):
+                uuid = element.get("uuid", "").strip("{}")
+                src = element.get("src")
+                if uuid and src:
+                    if not os.path.isabs(src):
+                        src = os.path.join(self._home, src)
+                    machines[uuid] = src
+        return machines
+
+    def _main_signature(self):
+        """
+        Returns the signature of VirtualBox.xml, None if it cannot be
+        monitored (nothing is cached in that case).
+        """
+
+        if not self._home:
+            return None
+        return self._file_signature(os.path.join(self._home, "VirtualBox.xml"))
+
+    def system_properties(self):
+        """
+        Returns the VirtualBox system properties (they never change
+        for a given VirtualBox installation).
+
+        :returns: dictionary
+        """
+
+        with self._lock:
+            if self._system_properties is not None:
+                return dict(self._system_properties)
+            generation = self._generation
+
+        system_properties = {}
+        for prop in self._execute(["list", "systemproperties"]):
+            try:
+                name, value = prop.split(':', 1)
+            except ValueError:
+                continue
+            system_properties[name.strip()] = value.strip()
+        with self._lock:
+            if generation == self._generation:
+                self._system_properties = system_properties
+        return dict(system_properties)
+
+    def vms(self):
+        """
+        Returns the registered VMs.
+
+        :returns: list of (VM name, UUID) tuples
+        """
+
+        with self._lock:
+            signature = self._main_signature()
+            if self._vms is not None and signature is not None and signature == self._vms_signature:
+                return list(self._vms)
+            generation = self._generation
+
+        vms = []
+        for line in self._execute(["list", "vms"]):
+            try:
+                vmname, uuid = line.rsplit(' ', 1)
+            except ValueError:
+                continue
+            vms.append((vmname.strip('"'), uuid.strip("{}")))
+        with self._lock:
+            if generation == self._generation:
+                self._vms = vms
+                self._vms_signature = signature
+        return list(vms)
+
+    def is_gns3_clone(self, vmname, uuid=None):
+        """
+        Returns either a VM is a linked clone created by GNS3.
+
+        :param vmname: VM name
+        :param uuid: VM UUID (used to find the VM .vbox file)
+
+        :returns: boolean
+        """
+
+        with self._lock:
+            signature = None
+            if uuid:
+                vbox_file = self._machine_files().get(uuid)
+                if vbox_file:
+                    signature = self._file_signature(vbox_file)
+
+            key = uuid or vmname
+            if signature is not None and key in self._clones and self._clones[key][0] == signature:
+                return self._clones[key][1]
+            generation = self._generation
+
+        extra_data = "\n".join(self._execute(["getextradata", vmname, "GNS3/Clone"])).strip()
+        is_clone = extra_data == "Value: yes"
+        with self._lock:
+            if signature is not None and generation == self._generation:
+                self._clones[key] = (signature, is_clone)
+        return is_clone
+
+    def hdds(self):
+        """
+        Returns the location of all the HDDs registered in VirtualBox.
+
+        Media are registered in VirtualBox.xml and in the VM .vbox
+        files, all of them are part of the cache signature.
+
+        :returns: list of paths
+        """
+
+        with self._lock:
+            signature = self._main_signature()
+            if signature is not None:
+                files = sorted(self._machine_files().values())
+                signature = (signature,) + tuple(self._file_signature(path) for path in files)
+
+            if self._hdds is not None and signature is not None and signature == self._hdds_signature:
+                return list(self._hdds)
+            generation = self._generation
+
+        hdds = []
+        for prop in self._execute(["list", "hdds"]):
+            try:
+                name, value = prop.split(':', 1)
+            except ValueError:
+                continue
+            if name.strip() == "Location":
+                hdds.append(value.strip())
+        with self._lock:
+            if generation == self._generation:
+                self._hdds = hdds
+                self._hdds_signature = signature
+        return list(hdds)
+
+    def warm_up(self):
+        """
+        Fills the inventory in a background thread so that
+        the first requests are served from memory.
+        """
+
+        def refresh():
+            try:
+                self.system_properties()
+                for vmname, uuid in self.vms():
+                    if vmname != "<inaccessible>":
+                        self.is_gns3_clone(vmname, uuid)
+                self.hdds()
+            except VirtualBoxError as e:
+                log.warn("could not refresh the VirtualBox inventory: {}".format(e))
+
+        if self._vboxmanage_path and os.path.exists(self._vboxmanage_path):
+            threading.Thread(target=refresh, daemon=True).start()
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from ..console_watcher import CONSOLE_WATCH_PROPERTIES
 
 VBOX_CREATE_SCHEMA = {
     "$schema": "http://json-schema.org/draft-04/schema#",
@@ -114,6 +115,12 @@ VBOX_UPDATE_SCHEMA = {
             "description": "headless mode",
             "type": "boolean"
         },
+        "boot_snapshot": {
+            "description": "snapshot to start the VirtualBox VM from (empty to start from the current state)",
+            "type": "string",
+            "pattern": "^([A-Za-z0-9][A-Za-z0-9_.-]*)?$",
+            "maxLength": 64,
+        },
     },
     "additionalProperties": False,
     "required": ["id"]
@@ -430,3 +437,86 @@ VBOX_STOP_CAPTURE_SCHEMA = {
     "required": ["id", "port", "port_id"]
 }
 
+
+VBOX_CONSOLE_BUFFER_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to get the recent console output of a VirtualBox VM instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "VirtualBox VM instance ID",
+            "type": "integer"
+        },
+        "size": {
+            "description": "Maximum number of bytes to return (the whole scrollback buffer by default)",
+            "type": "integer",
+            "minimum": 1
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+VBOX_CONSOLE_WATCH_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to watch the console output of a VirtualBox VM instance",
+    "type": "object",
+    "properties": dict(CONSOLE_WATCH_PROPERTIES, id={
+        "description": "VirtualBox VM instance ID",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id", "pattern"]
+}
+
+VBOX_CONSOLE_UNWATCH_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to stop watching the console output of a VirtualBox VM instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "VirtualBox VM instance ID",
+            "type": "integer"
+        },
+        "watch_id": {
+            "description": "watch identifier",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+VBOX_SNAPSHOT_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to save, restore or delete a snapshot of a VirtualBox VM instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "VirtualBox VM instance ID",
+            "type": "integer"
+        },
+        "name": {
+            "description": "snapshot name",
+            "type": "string",
+            "pattern": "^[A-Za-z0-9][A-Za-z0-9_.-]*$",
+            "maxLength": 64,
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id", "name"]
+}
+
+VBOX_SNAPSHOT_LIST_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to list the snapshots of a VirtualBox VM instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "VirtualBox VM instance ID",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
@@ -38,14 +38,18 @@ class TelnetServer(threading.Thread):
     :param pipe_path: path to VM pipe (UNIX socket on Linux/UNIX, Named Pipe on Windows)
     :param host: server host
     :param port: server port
+    :param scrollback: ConsoleBuffer instance replayed to new clients (optional)
+    :param watcher: ConsoleWatcher instance fed with the console output (optional)
     """
 
-    def __init__(self, vm_name, pipe_path, host, port):
+    def __init__(self, vm_name, pipe_path, host, port, scrollback=None, watcher=None):
 
         self._vm_name = vm_name
         self._pipe = pipe_path
         self._host = host
         self._port = port
+        self._scrollback = scrollback
+        self._watcher = watcher
         self._reader_thread = None
         self._use_thread = False
         self._write_lock = threading.Lock()
@@ -121,7 +125,14 @@ class TelnetServer(threading.Thread):
                         continue
 
                     new_client = TelnetClient(self._vm_name, sock, host, port)
-                    self._clients[sock.fileno()] = new_client
+                    with self._write_lock:
+                        if self._scrollback is not None and len(self._scrollback):
+                            try:
+                                new_client.send(self._scrollback.read())
+                            except Exception as e:
+                                log.debug(e)
+                                new_client.deactivate()
+                        self._clients[sock.fileno()] = new_client
 
                     if self._use_thread and not self._reader_thread:
                         self._reader_thread = threading.Thread(target=self._reader, daemon=True)
@@ -133,6 +144,10 @@ class TelnetServer(threading.Thread):
                     if not data:
                         log.warning("pipe has been closed!")
                         return False
+                    if self._scrollback is not None:
+                        self._scrollback.write(data)
+                    if self._watcher is not None:
+                        self._watcher.feed(data)
                     for client in self._clients.values():
                         try:
                             client.send(data)
@@ -198,6 +213,10 @@ class TelnetServer(threading.Thread):
                     break
                 self._write_lock.acquire()
                 try:
+                    if self._scrollback is not None:
+                        self._scrollback.write(data)
+                    if self._watcher is not None:
+                        self._watcher.feed(data)
                     for client in self._clients.values():
                         client.send(data)
                 finally:
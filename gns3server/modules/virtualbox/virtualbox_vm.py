@@ -33,6 +33,9 @@ from .virtualbox_error import VirtualBoxError
 from .adapters.ethernet_adapter import EthernetAdapter
 from ..attic import find_unused_port
 from .telnet_server import TelnetServer
+from ..console_hub import SocketConsole, ConsoleBuffer, DEFAULT_SCROLLBACK_SIZE
+from ..console_watcher import ConsoleWatcher
+from ..sharding import owns
 
 if sys.platform.startswith('win'):
     import msvcrt
@@ -41,6 +44,9 @@ if sys.platform.startswith('win'):
 import logging
 log = logging.getLogger(__name__)
 
+# snapshot of the original VM the linked clones are created from
+LINKED_BASE_SNAPSHOT = "GNS3 Linked Base for clones"
+
 
 class VirtualBoxVM(object):
     """
@@ -56,6 +62,8 @@ class VirtualBoxVM(object):
     :param console_host: IP address to bind for console connections
     :param console_start_port_range: TCP console port range start
     :param console_end_port_range: TCP console port range end
+    :param inventory: VirtualBoxInventory instance (optional)
+    :param console_scrollback_size: size of the console scrollback buffer
     """
 
     _instances = []
@@ -71,12 +79,14 @@ class VirtualBoxVM(object):
                  console=None,
                  console_host="0.0.0.0",
                  console_start_port_range=4512,
-                 console_end_port_range=5000):
+                 console_end_port_range=5000,
+                 inventory=None,
+                 console_scrollback_size=DEFAULT_SCROLLBACK_SIZE):
 
         if not vbox_id:
             self._id = 0
             for identifier in range(1, 1024):
-                if identifier not in self._instances:
+                if identifier not in self._instances and owns(identifier):
                     self._id = identifier
                     self._instances.append(self._id)
                     break
@@ -100,7 +110,13 @@ class VirtualBoxVM(object):
         self._console_end_port_range = console_end_port_range
 
         self._telnet_server_thread = None
+        self._serial_console = None
+        self._console_buffer = ConsoleBuffer(console_scrollback_size)
+        self._console_watcher = ConsoleWatcher(name, self._console_matched, self._console_buffer)
+        self._console_match_callback = None
         self._serial_pipe = None
+        self._vm_info_cache = None
+        self._inventory = inventory
 
         # VirtualBox settings
         self._console = console
@@ -110,6 +126,7 @@ class VirtualBoxVM(object):
         self._vmname = vmname
         self._adapter_start_index = 0
         self._adapter_type = "Intel PRO/1000 MT Desktop (82540EM)"
+        self._boot_snapshot = ""
 
         working_dir_path = os.path.join(working_dir, "vbox")
 
@@ -134,13 +151,16 @@ class VirtualBoxVM(object):
         self._allocated_console_ports.append(self._console)
 
         self._system_properties = {}
-        properties = self._execute("list", ["systemproperties"])
-        for prop in properties:
-            try:
-                name, value = prop.split(':', 1)
-            except ValueError:
-                continue
-            self._system_properties[name.strip()] = value.strip()
+        if self._inventory:
+            self._system_properties = self._inventory.system_properties()
+        else:
+            properties = self._execute("list", ["systemproperties"])
+            for prop in properties:
+                try:
+                    name, value = prop.split(':', 1)
+                except ValueError:
+                    continue
+                self._system_properties[name.strip()] = value.strip()
 
         if linked_clone:
             if vbox_id and os.path.isdir(os.path.join(self.working_dir, self._vmname)):
@@ -170,7 +190,8 @@ class VirtualBoxVM(object):
                          "adapter_type": "Intel PRO/1000 MT Desktop (82540EM)",
                          "console": self._console,
                          "enable_remote_console": self._enable_remote_console,
-                         "headless": self._headless}
+                         "headless": self._headless,
+                         "boot_snapshot": self._boot_snapshot}
 
         return vbox_defaults
 
@@ -276,8 +297,46 @@ class VirtualBoxVM(object):
                                                                                      id=self._id,
                                                                                      port=console))
 
+    @property
+    def console_buffer(self):
+        """
+        Returns the console scrollback buffer (recent console output).
+
+        :returns: ConsoleBuffer instance
+        """
+
+        return self._console_buffer
+
+    @property
+    def console_watcher(self):
+        """
+        Returns the patterns watched in the console output.
+
+        :returns: ConsoleWatcher instance
+        """
+
+        return self._console_watcher
+
+    def set_console_match_callback(self, callback):
+        """
+        Sets a callback to be called when a watched pattern is found in the console output.
+        The callback is called from the console hub thread.
+
+        :param callback: callable receiving this VM, the watch ID, the pattern and the watch context
+        """
+
+        self._console_match_callback = callback
+
+    def _console_matched(self, watch_id, pattern, context):
+
+        if self._console_match_callback:
+            self._console_match_callback(self, watch_id, pattern, context)
+
     def _get_all_hdd_files(self):
 
+        if self._inventory:
+            return self._inventory.hdds()
+
         hdds = []
         properties = self._execute("list", ["hdds"])
         for prop in properties:
@@ -314,6 +373,7 @@ class VirtualBoxVM(object):
         """
 
         self.stop()
+        self._console_watcher.clear()
         if self._id in self._instances:
             self._instances.remove(self._id)
 
@@ -363,6 +423,7 @@ class VirtualBoxVM(object):
         """
 
         self.stop()
+        self._console_watcher.clear()
         if self._id in self._instances:
             self._instances.remove(self._id)
 
@@ -407,6 +468,29 @@ class VirtualBoxVM(object):
             log.info("VirtualBox VM {name} [id={id}] has disabled the headless mode".format(name=self._name, id=self._id))
         self._headless = headless
 
+    @property
+    def boot_snapshot(self):
+        """
+        Returns the snapshot this VirtualBox VM is started from.
+
+        :returns: snapshot name (empty to start from the current state)
+        """
+
+        return self._boot_snapshot
+
+    @boot_snapshot.setter
+    def boot_snapshot(self, boot_snapshot):
+        """
+        Sets the snapshot this VirtualBox VM is started from.
+
+        :param boot_snapshot: snapshot name (empty to start from the current state)
+        """
+
+        log.info("VirtualBox VM {name} [id={id}] has set the boot snapshot to {boot_snapshot}".format(name=self._name,
+                                                                                                    id=self._id,
+                                                                                                    boot_snapshot=boot_snapshot))
+        self._boot_snapshot = boot_snapshot
+
     @property
     def enable_remote_console(self):
         """
@@ -545,6 +629,10 @@ class VirtualBoxVM(object):
         :returns: result (list)
         """
 
+        if subcommand not in ("showvminfo", "list"):
+            # any other subcommand may change the VM info
+            self._vm_info_cache = None
+
         command = [self._vboxmanage_path, "--nologo", subcommand]
         command.extend(args)
         log.debug("Execute vboxmanage command: {}".format(command))
@@ -561,13 +649,21 @@ class VirtualBoxVM(object):
             raise VirtualBoxError("Could not execute VBoxManage: {}".format(e))
         return result.decode("utf-8", errors="ignore").splitlines()
 
-    def _get_vm_info(self):
+    def _get_vm_info(self, refresh=False):
         """
         Returns this VM info.
 
+        The result of showvminfo is cached until a VBoxManage
+        command that may change the VM is executed.
+
+        :param refresh: force to query VirtualBox
+
         :returns: dict of info
         """
 
+        if self._vm_info_cache is not None and not refresh:
+            return dict(self._vm_info_cache)
+
         vm_info = {}
         results = self._execute("showvminfo", [self._vmname, "--machinereadable"])
         for info in results:
@@ -576,20 +672,22 @@ class VirtualBoxVM(object):
             except ValueError:
                 continue
             vm_info[name.strip('"')] = value.strip('"')
-        return vm_info
+        self._vm_info_cache = vm_info
+        return dict(vm_info)
 
     def _get_vm_state(self):
         """
         Returns this VM state (e.g. running, paused etc.)
 
+        The state can be changed outside of GNS3, VirtualBox
+        is always queried (the cached VM info is refreshed).
+
         :returns: state (string)
         """
 
-        results = self._execute("showvminfo", [self._vmname, "--machinereadable"])
-        for info in results:
-            name, value = info.split('=', 1)
-            if name == "VMState":
-                return value.strip('"')
+        vm_info = self._get_vm_info(refresh=True)
+        if "VMState" in vm_info:
+            return vm_info["VMState"]
         raise VirtualBoxError("Could not get VM state for {}".format(self._vmname))
 
     def _get_maximum_supported_adapters(self):
@@ -622,18 +720,17 @@ class VirtualBoxVM(object):
             pipe_name = os.path.join(tempfile.gettempdir(), "pipe_{}".format(pipe_name))
         return pipe_name
 
-    def _set_serial_console(self):
-        """
-        Configures the first serial port to allow a serial console connection.
+    def _serial_console_options(self):
         """
+        Returns the modifyvm options to configure the first serial port
+        to allow a serial console connection.
 
-        # activate the first serial port
-        self._modify_vm("--uart1 0x3F8 4")
+        :returns: list of modifyvm arguments
+        """
 
-        # set server mode with a pipe on the first serial port
+        # activate the first serial port and set server mode with a pipe
         pipe_name = self._get_pipe_name()
-        args = [self._vmname, "--uartmode1", "server", pipe_name]
-        self._execute("modifyvm", args)
+        return ["--uart1", "0x3F8", "4", "--uartmode1", "server", pipe_name]
 
     def _modify_vm(self, params):
         """
@@ -645,6 +742,17 @@ class VirtualBoxVM(object):
         args = shlex.split(params)
         self._execute("modifyvm", [self._vmname] + args)
 
+    def _modify_vm_options(self, options):
+        """
+        Change several settings in this VM when not running,
+        using only one modifyvm invocation.
+
+        :param options: list of arguments for the sub-command modifyvm
+        """
+
+        if options:
+            self._execute("modifyvm", [self._vmname] + options)
+
     def _control_vm(self, params):
         """
         Change setting in this VM when running.
@@ -686,20 +794,24 @@ class VirtualBoxVM(object):
                 nics.append(None)
         return nics
 
-    def _set_network_options(self):
+    def _network_options(self):
         """
-        Configures network options.
+        Returns the modifyvm options to configure the network.
+
+        :returns: list of modifyvm arguments
         """
 
+        options = []
         nic_attachements = self._get_nic_attachements(self._maximum_adapters)
         for adapter_id in range(0, len(self._ethernet_adapters)):
+            nic = adapter_id + 1
             if self._ethernet_adapters[adapter_id] is None:
                 # force enable to avoid any discrepancy in the interface numbering inside the VM
                 # e.g. Ethernet2 in GNS3 becoming eth0 inside the VM when using a start index of 2.
                 attachement = nic_attachements[adapter_id]
                 if attachement:
                     # attachement can be none, null, nat, bridged, intnet, hostonly or generic
-                    self._modify_vm("--nic{} {}".format(adapter_id + 1, attachement))
+                    options.extend(["--nic{}".format(nic), attachement])
                 continue
 
             vbox_adapter_type = "82540EM"
@@ -716,31 +828,33 @@ class VirtualBoxVM(object):
             if self._adapter_type == "Paravirtualized Network (virtio-net)":
                 vbox_adapter_type = "virtio"
 
-            args = [self._vmname, "--nictype{}".format(adapter_id + 1), vbox_adapter_type]
-            self._execute("modifyvm", args)
-
-            self._modify_vm("--nictrace{} off".format(adapter_id + 1))
+            options.extend(["--nictype{}".format(nic), vbox_adapter_type])
             nio = self._ethernet_adapters[adapter_id].get_nio(0)
             if nio:
                 log.debug("setting UDP params on adapter {}".format(adapter_id))
-                self._modify_vm("--nic{} generic".format(adapter_id + 1))
-                self._modify_vm("--nicgenericdrv{} UDPTunnel".format(adapter_id + 1))
-                self._modify_vm("--nicproperty{} sport={}".format(adapter_id + 1, nio.lport))
-                self._modify_vm("--nicproperty{} dest={}".format(adapter_id + 1, nio.rhost))
-                self._modify_vm("--nicproperty{} dport={}".format(adapter_id + 1, nio.rport))
-                self._modify_vm("--cableconnected{} on".format(adapter_id + 1))
+                options.extend(["--nic{}".format(nic), "generic",
+                                "--nicgenericdrv{}".format(nic), "UDPTunnel",
+                                "--nicproperty{}".format(nic), "sport={}".format(nio.lport),
+                                "--nicproperty{}".format(nic), "dest={}".format(nio.rhost),
+                                "--nicproperty{}".format(nic), "dport={}".format(nio.rport),
+                                "--cableconnected{}".format(nic), "on"])
 
                 if nio.capturing:
-                    self._modify_vm("--nictrace{} on".format(adapter_id + 1))
-                    self._modify_vm("--nictracefile{} {}".format(adapter_id + 1, nio.pcap_output_file))
+                    options.extend(["--nictrace{}".format(nic), "on",
+                                    "--nictracefile{}".format(nic), nio.pcap_output_file])
+                else:
+                    options.extend(["--nictrace{}".format(nic), "off"])
             else:
                 # shutting down unused adapters...
-                self._modify_vm("--cableconnected{} off".format(adapter_id + 1))
-                self._modify_vm("--nic{} null".format(adapter_id + 1))
+                options.extend(["--nictrace{}".format(nic), "off",
+                                "--cableconnected{}".format(nic), "off",
+                                "--nic{}".format(nic), "null"])
 
         for adapter_id in range(len(self._ethernet_adapters), self._maximum_adapters):
             log.debug("disabling remaining adapter {}".format(adapter_id))
-            self._modify_vm("--nic{} none".format(adapter_id + 1))
+            options.extend(["--nic{}".format(adapter_id + 1), "none"])
+
+        return options
 
     def _create_linked_clone(self):
         """
@@ -750,16 +864,16 @@ class VirtualBoxVM(object):
         gns3_snapshot_exists = False
         vm_info = self._get_vm_info()
         for entry, value in vm_info.items():
-            if entry.startswith("SnapshotName") and value == "GNS3 Linked Base for clones":
+            if entry.startswith("SnapshotName") and value == LINKED_BASE_SNAPSHOT:
                 gns3_snapshot_exists = True
 
         if not gns3_snapshot_exists:
-            result = self._execute("snapshot", [self._vmname, "take", "GNS3 Linked Base for clones"])
+            result = self._execute("snapshot", [self._vmname, "take", LINKED_BASE_SNAPSHOT])
             log.debug("GNS3 snapshot created: {}".format(result))
 
         args = [self._vmname,
                 "--snapshot",
-                "GNS3 Linked Base for clones",
+                LINKED_BASE_SNAPSHOT,
                 "--options",
                 "link",
                 "--name",
@@ -773,9 +887,11 @@ class VirtualBoxVM(object):
         self._execute("setextradata", [self._vmname, "GNS3/Clone", "yes"])
         log.debug("cloned VirtualBox VM: {}".format(result))
 
-    def start(self):
+    def start(self, snapshot=None):
         """
         Starts this VirtualBox VM.
+
+        :param snapshot: snapshot to restore instead of the boot snapshot (optional)
         """
 
         # resume the VM if it is paused
@@ -788,8 +904,28 @@ class VirtualBoxVM(object):
         if vm_state != "poweroff" and vm_state != "saved":
             raise VirtualBoxError("VirtualBox VM not powered off or saved")
 
-        self._set_network_options()
-        self._set_serial_console()
+        if snapshot:
+            if snapshot not in self.snapshots():
+                raise VirtualBoxError("Snapshot {} doesn't exist".format(snapshot))
+        elif self._boot_snapshot:
+            snapshot = self._boot_snapshot
+            if snapshot not in self.snapshots():
+                log.warn("VirtualBox VM {name} [id={id}]: boot snapshot {snapshot} doesn't exist".format(name=self._name,
+                                                                                                         id=self._id,
+                                                                                                         snapshot=snapshot))
+                snapshot = None
+
+        if snapshot:
+            # a snapshot taken while the VM was running is restored in the saved state
+            self._execute("snapshot", [self._vmname, "restore", snapshot])
+            log.info("VirtualBox VM {name} [id={id}]: snapshot {snapshot} restored".format(name=self._name,
+                                                                                          id=self._id,
+                                                                                          snapshot=snapshot))
+            vm_state = self._get_vm_state()
+
+        if vm_state != "saved":
+            # network and serial console settings are applied with only one modifyvm
+            self._modify_vm_options(self._network_options() + self._serial_console_options())
 
         args = [self._vmname]
         if self._headless:
@@ -797,6 +933,12 @@ class VirtualBoxVM(object):
         result = self._execute("startvm", args)
         log.debug("started VirtualBox VM: {}".format(result))
 
+        if vm_state == "saved":
+            # the settings of a saved VM cannot be modified, the network is configured once it runs
+            for adapter_id, adapter in enumerate(self._ethernet_adapters):
+                if adapter is not None:
+                    self._set_running_nio(adapter_id, adapter.get_nio(0))
+
         # add a guest property to let the VM know about the GNS3 name
         self._execute("guestproperty", ["set", self._vmname, "NameInGNS3", self._name])
 
@@ -806,12 +948,18 @@ class VirtualBoxVM(object):
         if self._enable_remote_console:
             # starts the Telnet to pipe thread
             pipe_name = self._get_pipe_name()
+            self._console_buffer.clear()
             if sys.platform.startswith('win'):
                 try:
                     self._serial_pipe = open(pipe_name, "a+b")
                 except OSError as e:
                     raise VirtualBoxError("Could not open the pipe {}: {}".format(pipe_name, e))
-                self._telnet_server_thread = TelnetServer(self._vmname, msvcrt.get_osfhandle(self._serial_pipe.fileno()), self._console_host, self._console)
+                self._telnet_server_thread = TelnetServer(self._vmname,
+                                                          msvcrt.get_osfhandle(self._serial_pipe.fileno()),
+                                                          self._console_host,
+                                                          self._console,
+                                                          self._console_buffer,
+                                                          self._console_watcher)
                 self._telnet_server_thread.start()
             else:
                 try:
@@ -819,8 +967,14 @@ class VirtualBoxVM(object):
                     self._serial_pipe.connect(pipe_name)
                 except OSError as e:
                     raise VirtualBoxError("Could not connect to the pipe {}: {}".format(pipe_name, e))
-                self._telnet_server_thread = TelnetServer(self._vmname, self._serial_pipe, self._console_host, self._console)
-                self._telnet_server_thread.start()
+                welcome = "{} console is now available... Press RETURN to get started.\r\n".format(self._vmname)
+                self._serial_console = SocketConsole(self._vmname, self._serial_pipe, self._console_host, self._console, welcome,
+                                                     crlf_to_lf=True, scrollback=self._console_buffer, watcher=self._console_watcher)
+                try:
+                    self._serial_console.start()
+                except OSError as e:
+                    self._serial_console = None
+                    raise VirtualBoxError("Could not start the console on {}:{}: {}".format(self._console_host, self._console, e))
 
     def stop(self):
         """
@@ -834,6 +988,10 @@ class VirtualBoxVM(object):
                 log.warn("Serial pire thread is still alive!")
             self._telnet_server_thread = None
 
+        if self._serial_console:
+            self._serial_console.stop(timeout=3)
+            self._serial_console = None
+
         if self._serial_pipe:
             if sys.platform.startswith('win'):
                 win32file.CloseHandle(msvcrt.get_osfhandle(self._serial_pipe.fileno()))
@@ -854,12 +1012,14 @@ class VirtualBoxVM(object):
             except VirtualBoxError as e:
                 log.warn("Could not deactivate the first serial port: {}".format(e))
 
+            options = []
             for adapter_id in range(0, len(self._ethernet_adapters)):
                 if self._ethernet_adapters[adapter_id] is None:
                     continue
-                self._modify_vm("--nictrace{} off".format(adapter_id + 1))
-                self._modify_vm("--cableconnected{} off".format(adapter_id + 1))
-                self._modify_vm("--nic{} null".format(adapter_id + 1))
+                options.extend(["--nictrace{}".format(adapter_id + 1), "off",
+                                "--cableconnected{}".format(adapter_id + 1), "off",
+                                "--nic{}".format(adapter_id + 1), "null"])
+            self._modify_vm_options(options)
 
     def suspend(self):
         """
@@ -889,6 +1049,95 @@ class VirtualBoxVM(object):
         result = self._control_vm("reset")
         log.debug("VirtualBox VM has been reset: {}".format(result))
 
+    def _set_running_nio(self, adapter_id, nio):
+        """
+        Configures an adapter while this VM is running.
+
+        :param adapter_id: adapter ID
+        :param nio: NIO instance (None to disable the adapter)
+        """
+
+        if nio:
+            # dynamically configure an UDP tunnel on the VirtualBox adapter
+            self._control_vm("nic{} generic UDPTunnel".format(adapter_id + 1))
+            self._control_vm("nicproperty{} sport={}".format(adapter_id + 1, nio.lport))
+            self._control_vm("nicproperty{} dest={}".format(adapter_id + 1, nio.rhost))
+            self._control_vm("nicproperty{} dport={}".format(adapter_id + 1, nio.rport))
+            self._control_vm("setlinkstate{} on".format(adapter_id + 1))
+        else:
+            # dynamically disable the VirtualBox adapter
+            self._control_vm("setlinkstate{} off".format(adapter_id + 1))
+            self._control_vm("nic{} null".format(adapter_id + 1))
+
+    def snapshots(self):
+        """
+        Returns the snapshots of this VirtualBox VM.
+
+        :returns: list of snapshot names
+        """
+
+        snapshots = []
+        for entry, value in self._get_vm_info().items():
+            # SnapshotName, SnapshotName-1, SnapshotName-1-1 etc. (the snapshot tree)
+            if entry.startswith("SnapshotName") and value != LINKED_BASE_SNAPSHOT and value not in snapshots:
+                snapshots.append(value)
+        return snapshots
+
+    def snapshot_save(self, name):
+        """
+        Takes a snapshot of this VirtualBox VM (including its state if it is running),
+        an existing snapshot with the same name is replaced.
+
+        :param name: snapshot name
+        """
+
+        if name == LINKED_BASE_SNAPSHOT:
+            raise VirtualBoxError("Snapshot {} is reserved".format(name))
+
+        # VirtualBox allows several snapshots with the same name
+        for _ in range(self.snapshots().count(name)):
+            self._execute("snapshot", [self._vmname, "delete", name], timeout=600)
+
+        log.info("VirtualBox VM {name} [id={id}]: taking snapshot {snapshot}".format(name=self._name,
+                                                                                    id=self._id,
+                                                                                    snapshot=name))
+        self._execute("snapshot", [self._vmname, "take", name], timeout=600)
+        log.info("VirtualBox VM {name} [id={id}]: snapshot {snapshot} taken".format(name=self._name,
+                                                                                   id=self._id,
+                                                                                   snapshot=name))
+
+    def snapshot_restore(self, name):
+        """
+        Restores a snapshot and starts this VirtualBox VM from it
+        (a running VM is powered off first).
+
+        :param name: snapshot name
+        """
+
+        if name not in self.snapshots():
+            raise VirtualBoxError("Snapshot {} doesn't exist".format(name))
+
+        if self._get_vm_state() in ("running", "paused", "stuck"):
+            self.stop()
+        self.start(snapshot=name)
+
+    def snapshot_delete(self, name):
+        """
+        Deletes a snapshot.
+
+        :param name: snapshot name
+        """
+
+        if name not in self.snapshots():
+            raise VirtualBoxError("Snapshot {} doesn't exist".format(name))
+
+        self._execute("snapshot", [self._vmname, "delete", name], timeout=600)
+        if self._boot_snapshot == name:
+            self._boot_snapshot = ""
+        log.info("VirtualBox VM {name} [id={id}]: snapshot {snapshot} deleted".format(name=self._name,
+                                                                                     id=self._id,
+                                                                                     snapshot=name))
+
     def port_add_nio_binding(self, adapter_id, nio):
         """
         Adds a port NIO binding.
@@ -905,12 +1154,7 @@ class VirtualBoxVM(object):
 
         vm_state = self._get_vm_state()
         if vm_state == "running":
-            # dynamically configure an UDP tunnel on the VirtualBox adapter
-            self._control_vm("nic{} generic UDPTunnel".format(adapter_id + 1))
-            self._control_vm("nicproperty{} sport={}".format(adapter_id + 1, nio.lport))
-            self._control_vm("nicproperty{} dest={}".format(adapter_id + 1, nio.rhost))
-            self._control_vm("nicproperty{} dport={}".format(adapter_id + 1, nio.rport))
-            self._control_vm("setlinkstate{} on".format(adapter_id + 1))
+            self._set_running_nio(adapter_id, nio)
 
         adapter.add_nio(0, nio)
         log.info("VirtualBox VM {name} [id={id}]: {nio} added to adapter {adapter_id}".format(name=self._name,
@@ -935,9 +1179,7 @@ class VirtualBoxVM(object):
 
         vm_state = self._get_vm_state()
         if vm_state == "running":
-            # dynamically disable the VirtualBox adapter
-            self._control_vm("setlinkstate{} off".format(adapter_id + 1))
-            self._control_vm("nic{} null".format(adapter_id + 1))
+            self._set_running_nio(adapter_id, None)
 
         nio = adapter.get_nio(0)
         adapter.remove_nio(0)
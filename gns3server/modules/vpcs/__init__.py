@@ -31,6 +31,10 @@ from .vpcs_error import VPCSError
 from .nios.nio_udp import NIO_UDP
 from .nios.nio_tap import NIO_TAP
 from ..attic import find_unused_port
+from ..attic import call_in_parallel
+from ..fabric import UDPRelay, FabricError, LinkConditions
+from ..process_log import MAX_PAGE_SIZE
+from ..console_watcher import ConsoleWatchError
 
 from .schemas import VPCS_CREATE_SCHEMA
 from .schemas import VPCS_DELETE_SCHEMA
@@ -41,7 +45,14 @@ from .schemas import VPCS_RELOAD_SCHEMA
 from .schemas import VPCS_ALLOCATE_UDP_PORT_SCHEMA
 from .schemas import VPCS_ADD_NIO_SCHEMA
 from .schemas import VPCS_DELETE_NIO_SCHEMA
+from .schemas import VPCS_START_CAPTURE_SCHEMA
+from .schemas import VPCS_STOP_CAPTURE_SCHEMA
+from .schemas import VPCS_SET_LINK_CONDITIONS_SCHEMA
 from .schemas import VPCS_EXPORT_CONFIG_SCHEMA
+from .schemas import VPCS_RESOURCE_USAGE_SCHEMA
+from .schemas import VPCS_PROCESS_LOG_SCHEMA
+from .schemas import VPCS_CONSOLE_WATCH_SCHEMA
+from .schemas import VPCS_CONSOLE_UNWATCH_SCHEMA
 
 import logging
 log = logging.getLogger(__name__)
@@ -84,10 +95,12 @@ class VPCS(IModule):
         self._console_start_port_range = vpcs_config.get("console_start_port_range", 4501)
         self._console_end_port_range = vpcs_config.get("console_end_port_range", 5000)
         self._allocated_udp_ports = []
+        self._relays = {}  # relay name -> ports of the loopback tunnel
         self._udp_start_port_range = vpcs_config.get("udp_start_port_range", 20501)
         self._udp_end_port_range = vpcs_config.get("udp_end_port_range", 21000)
         self._host = vpcs_config.get("host", kwargs["host"])
         self._console_host = vpcs_config.get("console_host", kwargs["console_host"])
+        self._engine = vpcs_config.get("engine", "vpcs")
         self._projects_dir = kwargs["projects_dir"]
         self._tempdir = kwargs["temp_dir"]
         self._working_dir = self._projects_dir
@@ -100,12 +113,34 @@ class VPCS(IModule):
         """
 
         # delete all VPCS instances
-        for vpcs_id in self._vpcs_instances:
-            vpcs_instance = self._vpcs_instances[vpcs_id]
-            vpcs_instance.delete()
+        for vpcs_instance, e in call_in_parallel(lambda vpcs_instance: vpcs_instance.delete(), self._vpcs_instances.values()):
+            log.error("could not delete VPCS instance {}: {}".format(vpcs_instance.name, e))
+
+        if self._relays:
+            UDPRelay.instance().stop()
+            self._relays.clear()
 
         IModule.stop(self, signum)  # this will stop the I/O loop
 
+    def _console_matched(self, vpcs_instance, watch_id, pattern, session):
+        """
+        Callback for the patterns found in the console output.
+        Called from the console hub thread, the notification is
+        sent from the I/O loop to the client that registered the watch.
+
+        :param vpcs_instance: VPCSDevice instance
+        :param watch_id: watch identifier
+        :param pattern: pattern found
+        :param session: session of the client that registered the watch
+        """
+
+        notification = {"module": self.name,
+                        "id": vpcs_instance.id,
+                        "name": vpcs_instance.name,
+                        "watch_id": watch_id,
+                        "pattern": pattern}
+        self._ioloop.add_callback(self.send_notification, "{}.console_match".format(self.name), notification, session)
+
     def get_vpcs_instance(self, vpcs_id):
         """
         Returns a VPCS device instance.
@@ -130,13 +165,16 @@ class VPCS(IModule):
         """
 
         # delete all vpcs instances
-        for vpcs_id in self._vpcs_instances:
-            vpcs_instance = self._vpcs_instances[vpcs_id]
-            vpcs_instance.delete()
+        for vpcs_instance, e in call_in_parallel(lambda vpcs_instance: vpcs_instance.delete(), self._vpcs_instances.values()):
+            log.error("could not delete VPCS instance {}: {}".format(vpcs_instance.name, e))
 
         # resets the instance IDs
         VPCSDevice.reset()
 
+        if self._relays:
+            UDPRelay.instance().stop()
+            self._relays.clear()
+
         self._vpcs_instances.clear()
         self._allocated_udp_ports.clear()
 
@@ -214,6 +252,7 @@ class VPCS(IModule):
 
         Optional request parameters:
         - console (VPCS console port)
+        - engine ("vpcs" or "builtin")
 
         Response parameters:
         - id (VPCS instance identifier)
@@ -230,10 +269,11 @@ class VPCS(IModule):
         name = request["name"]
         console = request.get("console")
         vpcs_id = request.get("vpcs_id")
+        engine = request.get("engine", self._engine)
 
         try:
 
-            if not self._vpcs:
+            if engine == "vpcs" and not self._vpcs:
                 raise VPCSError("No path to a VPCS executable has been set")
 
             vpcs_instance = VPCSDevice(name,
@@ -243,7 +283,8 @@ class VPCS(IModule):
                                        console,
                                        self._console_host,
                                        self._console_start_port_range,
-                                       self._console_end_port_range)
+                                       self._console_end_port_range,
+                                       engine)
 
         except VPCSError as e:
             self.send_custom_error(str(e))
@@ -254,6 +295,7 @@ class VPCS(IModule):
 
         defaults = vpcs_instance.defaults()
         response.update(defaults)
+        vpcs_instance.set_console_match_callback(self._console_matched)
         self._vpcs_instances[vpcs_instance.id] = vpcs_instance
         self.send_response(response)
 
@@ -281,6 +323,7 @@ class VPCS(IModule):
             return
 
         try:
+            self._remove_relay(vpcs_instance, rebind=False)
             vpcs_instance.clean_delete()
             del self._vpcs_instances[request["id"]]
         except VPCSError as e:
@@ -591,7 +634,11 @@ class VPCS(IModule):
 
         port = request["port"]
         try:
+            tunnel = self._remove_relay(vpcs_instance, rebind=False)
             nio = vpcs_instance.port_remove_nio_binding(port)
+            if tunnel:
+                # the NIO of the VPCS device was the loopback tunnel towards the relay
+                nio = NIO_UDP(*tunnel)
             if isinstance(nio, NIO_UDP) and nio.lport in self._allocated_udp_ports:
                 self._allocated_udp_ports.remove(nio.lport)
         except VPCSError as e:
@@ -600,6 +647,242 @@ class VPCS(IModule):
 
         self.send_response(True)
 
+    def _insert_relay(self, vpcs_instance):
+        """
+        Inserts a relay in the UDP tunnel of a VPCS device. The device
+        is moved to a loopback tunnel towards the relay (the VPCS process
+        cannot change its tunnel, the device must be stopped).
+
+        :param vpcs_instance: VPCSDevice instance
+
+        :returns: relay name
+        """
+
+        name = "VPCS{}".format(vpcs_instance.id)
+        if name in self._relays:
+            return name
+
+        nio = vpcs_instance.get_nio(0)
+        if not isinstance(nio, NIO_UDP):
+            raise VPCSError("VPCS {} is not connected to an UDP tunnel".format(vpcs_instance.name))
+        if vpcs_instance.is_running():
+            raise VPCSError("VPCS {} must be stopped to insert a relay in its link".format(vpcs_instance.name))
+
+        ports = []
+        try:
+            for _ in range(2):
+                ports.append(find_unused_port(self._udp_start_port_range,
+                                              self._udp_end_port_range,
+                                              host="127.0.0.1",
+                                              socket_type="UDP",
+                                              ignore_ports=self._allocated_udp_ports + ports))
+        except Exception as e:
+            raise VPCSError("Could not allocate UDP ports for the relay: {}".format(e))
+
+        inner_port, node_port = ports
+        try:
+            UDPRelay.instance().insert(name,
+                                       self._host,
+                                       nio.lport,
+                                       nio.rhost,
+                                       nio.rport,
+                                       "127.0.0.1",
+                                       inner_port,
+                                       node_port,
+                                       lambda lport, rhost, rport: vpcs_instance.port_add_nio_binding(0, NIO_UDP(lport, rhost, rport)))
+        except FabricError as e:
+            raise VPCSError("Could not insert a relay in {}: {}".format(nio, e))
+
+        self._allocated_udp_ports.extend(ports)
+        self._relays[name] = ports
+        return name
+
+    def _remove_relay(self, vpcs_instance, rebind=True):
+        """
+        Removes the relay of a VPCS device.
+
+        :param vpcs_instance: VPCSDevice instance
+        :param rebind: move the device back to the UDP tunnel
+
+        :returns: (lport, rhost, rport) of the tunnel or None if there is no relay
+        """
+
+        name = "VPCS{}".format(vpcs_instance.id)
+        ports = self._relays.pop(name, None)
+        if ports is None:
+            return None
+        for udp_port in ports:
+            if udp_port in self._allocated_udp_ports:
+                self._allocated_udp_ports.remove(udp_port)
+
+        if rebind:
+            callback = lambda lport, rhost, rport: vpcs_instance.port_add_nio_binding(0, NIO_UDP(lport, rhost, rport))
+        else:
+            callback = lambda lport, rhost, rport: None
+        try:
+            return UDPRelay.instance().remove(name, callback)
+        except FabricError as e:
+            raise VPCSError("Could not remove relay {}: {}".format(name, e))
+
+    @IModule.route("vpcs.start_capture")
+    def start_capture(self, request):
+        """
+        Starts a packet capture. The built-in engine writes the capture
+        itself, a relay is inserted in the link of the VPCS processes.
+
+        Mandatory request parameters:
+        - id (VPCS instance identifier)
+        - port (port number)
+        - port_id (port identifier)
+        - capture_file_name
+
+        Optional request parameters:
+        - data_link_type (PCAP DLT_* value)
+
+        Response parameters:
+        - port_id (port identifier)
+        - capture_file_path (path to the capture file)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VPCS_START_CAPTURE_SCHEMA):
+            return
+
+        # get the instance
+        vpcs_instance = self.get_vpcs_instance(request["id"])
+        if not vpcs_instance:
+            return
+
+        capture_file_name = request["capture_file_name"]
+        data_link_type = request.get("data_link_type", "DLT_EN10MB")
+
+        try:
+            capture_file_path = os.path.join(self._working_dir, "captures", capture_file_name)
+            os.makedirs(os.path.dirname(capture_file_path), exist_ok=True)
+            if vpcs_instance.engine == "builtin":
+                vpcs_instance.start_capture(capture_file_path, data_link_type)
+            else:
+                name = self._insert_relay(vpcs_instance)
+                try:
+                    UDPRelay.instance().start_capture(name, capture_file_path, data_link_type)
+                except FabricError as e:
+                    self._remove_relay(vpcs_instance)
+                    raise VPCSError(str(e))
+        except OSError as e:
+            self.send_custom_error("Could not create the capture directory: {}".format(e))
+            return
+        except VPCSError as e:
+            self.send_custom_error(str(e))
+            return
+
+        response = {"port_id": request["port_id"],
+                    "capture_file_path": capture_file_path}
+        self.send_response(response)
+
+    @IModule.route("vpcs.stop_capture")
+    def stop_capture(self, request):
+        """
+        Stops a packet capture.
+
+        Mandatory request parameters:
+        - id (VPCS instance identifier)
+        - port (port number)
+        - port_id (port identifier)
+
+        Response parameters:
+        - port_id (port identifier)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VPCS_STOP_CAPTURE_SCHEMA):
+            return
+
+        # get the instance
+        vpcs_instance = self.get_vpcs_instance(request["id"])
+        if not vpcs_instance:
+            return
+
+        try:
+            name = "VPCS{}".format(vpcs_instance.id)
+            if vpcs_instance.capturing:
+                vpcs_instance.stop_capture()
+            elif name not in self._relays:
+                raise VPCSError("No capture running on VPCS {}".format(vpcs_instance.name))
+            else:
+                relay = UDPRelay.instance()
+                relay.stop_capture(name)
+                # the VPCS process keeps sending to the relay until it is stopped
+                if not vpcs_instance.is_running() and relay.is_idle(name):
+                    self._remove_relay(vpcs_instance)
+        except VPCSError as e:
+            self.send_custom_error(str(e))
+            return
+
+        response = {"port_id": request["port_id"]}
+        self.send_response(response)
+
+    @IModule.route("vpcs.set_link_conditions")
+    def set_link_conditions(self, request):
+        """
+        Sets the conditions (delay, jitter, loss, rate limit) of a link.
+        A relay is inserted in the UDP tunnel of the device (the device
+        must be stopped the first time).
+
+        Mandatory request parameters:
+        - id (VPCS instance identifier)
+        - port (port number)
+        - port_id (port identifier)
+
+        Optional request parameters:
+        - in (conditions of the frames received by the device)
+        - out (conditions of the frames sent by the device)
+
+        Response parameters:
+        - port_id (port identifier)
+        - in (settings and statistics or None)
+        - out (settings and statistics or None)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VPCS_SET_LINK_CONDITIONS_SCHEMA):
+            return
+
+        # get the instance
+        vpcs_instance = self.get_vpcs_instance(request["id"])
+        if not vpcs_instance:
+            return
+
+        conditions_in = LinkConditions.from_settings(request.get("in"))
+        conditions_out = LinkConditions.from_settings(request.get("out"))
+        relay = UDPRelay.instance()
+        try:
+            if conditions_in is None and conditions_out is None:
+                # back to an unaltered link
+                name = "VPCS{}".format(vpcs_instance.id)
+                conditions = {"in": None, "out": None}
+                if name in self._relays:
+                    relay.set_conditions(name, None, None)
+                    if not vpcs_instance.is_running() and relay.is_idle(name):
+                        self._remove_relay(vpcs_instance)
+            else:
+                name = self._insert_relay(vpcs_instance)
+                relay.set_conditions(name, conditions_in, conditions_out)
+                conditions = relay.get_conditions(name)
+        except (VPCSError, FabricError) as e:
+            self.send_custom_error(str(e))
+            return
+
+        response = {"port_id": request["port_id"],
+                    "in": conditions["in"],
+                    "out": conditions["out"]}
+        self.send_response(response)
+
     @IModule.route("vpcs.export_config")
     def export_config(self, request):
         """
@@ -637,6 +920,149 @@ class VPCS(IModule):
         else:
             self.send_response(response)
 
+    @IModule.route("vpcs.resource_usage")
+    def resource_usage(self, request):
+        """
+        Gets the resource usage of a VPCS instance.
+
+        Mandatory request parameters:
+        - id (vm identifier)
+
+        Response parameters:
+        - id (vm identifier)
+        - controlled (either the resource limits are enforced with cgroups)
+        - usage (CPU time, throttling and memory counters)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VPCS_RESOURCE_USAGE_SCHEMA):
+            return
+
+        # get the instance
+        vpcs_instance = self.get_vpcs_instance(request["id"])
+        if not vpcs_instance:
+            return
+
+        self.send_response({"id": request["id"],
+                            "controlled": vpcs_instance.resources_controlled,
+                            "usage": vpcs_instance.resource_usage()})
+
+    @IModule.route("vpcs.process_log")
+    def process_log(self, request):
+        """
+        Reads a page of the log of the VPCS process (standard output
+        and error, rotated logs included).
+
+        Mandatory request parameters:
+        - id (VPCS instance identifier)
+
+        Optional request parameters:
+        - offset (position in the log, from the end if negative, the last page by default)
+        - size (maximum number of bytes to return)
+
+        Response parameters:
+        - id (VPCS instance identifier)
+        - log (text)
+        - offset (position of the page in the log)
+        - size (offset of the end of the log, the offsets are stable across rotations)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VPCS_PROCESS_LOG_SCHEMA):
+            return
+
+        # get the instance
+        vpcs_instance = self.get_vpcs_instance(request["id"])
+        if not vpcs_instance:
+            return
+
+        text, offset, size = vpcs_instance.read_log(request.get("offset"), request.get("size", MAX_PAGE_SIZE))
+        self.send_response({"id": request["id"],
+                            "log": text,
+                            "offset": offset,
+                            "size": size})
+
+    @IModule.route("vpcs.console_watch")
+    def console_watch(self, request):
+        """
+        Watches the console output of a VPCS instance for a pattern
+        (the vpcs.console_match notification is sent when it is found).
+
+        Mandatory request parameters:
+        - id (vm identifier)
+        - pattern (text to look for)
+
+        Optional request parameters:
+        - once (remove the watch after the first match, true by default)
+        - scrollback (also look in the recent console output, true by default)
+        - take_console (read the console, no other client can connect while watching, false by default)
+
+        Response parameters:
+        - id (vm identifier)
+        - watch_id (watch identifier)
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VPCS_CONSOLE_WATCH_SCHEMA):
+            return
+
+        # get the instance
+        vpcs_instance = self.get_vpcs_instance(request["id"])
+        if not vpcs_instance:
+            return
+
+        watcher = vpcs_instance.console_watcher
+        try:
+            watch_id = watcher.add(request["pattern"],
+                                   request.get("once", True),
+                                   request.get("scrollback", True),
+                                   self._current_session,
+                                   request.get("take_console", False))
+        except ConsoleWatchError as e:
+            self.send_custom_error(str(e))
+            return
+        self.send_response({"id": request["id"],
+                            "watch_id": watch_id})
+
+    @IModule.route("vpcs.console_unwatch")
+    def console_unwatch(self, request):
+        """
+        Stops watching the console output of a VPCS instance.
+
+        Mandatory request parameters:
+        - id (vm identifier)
+
+        Optional request parameters:
+        - watch_id (watch identifier, all the watches by default)
+
+        Response parameters:
+        - True on success
+
+        :param request: JSON request
+        """
+
+        # validate the request
+        if not self.validate_request(request, VPCS_CONSOLE_UNWATCH_SCHEMA):
+            return
+
+        # get the instance
+        vpcs_instance = self.get_vpcs_instance(request["id"])
+        if not vpcs_instance:
+            return
+
+        if "watch_id" not in request:
+            vpcs_instance.console_watcher.clear()
+        elif not vpcs_instance.console_watcher.remove(request["watch_id"]):
+            self.send_custom_error("Watch {} doesn't exist".format(request["watch_id"]))
+            return
+        self.send_response(True)
+
     @IModule.route("vpcs.echo")
     def echo(self, request):
         """
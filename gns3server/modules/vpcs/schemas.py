@@ -15,6 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from ..cgroups import RESOURCES_SCHEMA
+from ..console_watcher import CONSOLE_WATCH_PROPERTIES
+from ..fabric.link_conditions import LINK_CONDITIONS_PROPERTIES
+from ..process_log import PROCESS_LOG_PROPERTIES
 
 VPCS_CREATE_SCHEMA = {
     "$schema": "http://json-schema.org/draft-04/schema#",
@@ -36,6 +40,10 @@ VPCS_CREATE_SCHEMA = {
             "maximum": 65535,
             "type": "integer"
         },
+        "engine": {
+            "description": "VPCS process or virtual PC emulated by the server",
+            "enum": ["vpcs", "builtin"]
+        },
     },
     "additionalProperties": False,
     "required": ["name"]
@@ -84,6 +92,63 @@ VPCS_UPDATE_SCHEMA = {
             "description": "Script file base64 encoded",
             "type": "string"
         },
+        "resources": RESOURCES_SCHEMA,
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+VPCS_RESOURCE_USAGE_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to get the resource usage of a VPCS instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "VPCS device instance ID",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+VPCS_PROCESS_LOG_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to read the log of a VPCS instance process",
+    "type": "object",
+    "properties": dict(PROCESS_LOG_PROPERTIES, id={
+        "description": "VPCS device instance ID",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id"]
+}
+
+VPCS_CONSOLE_WATCH_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to watch the console output of a VPCS instance",
+    "type": "object",
+    "properties": dict(CONSOLE_WATCH_PROPERTIES, id={
+        "description": "VPCS device instance ID",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id", "pattern"]
+}
+
+VPCS_CONSOLE_UNWATCH_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to stop watching the console output of a VPCS instance",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "VPCS device instance ID",
+            "type": "integer"
+        },
+        "watch_id": {
+            "description": "watch identifier",
+            "type": "integer"
+        },
     },
     "additionalProperties": False,
     "required": ["id"]
@@ -332,6 +397,84 @@ VPCS_DELETE_NIO_SCHEMA = {
     "required": ["id", "port"]
 }
 
+VPCS_START_CAPTURE_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to start a packet capture on a VPCS instance port",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "VPCS device instance ID",
+            "type": "integer"
+        },
+        "port": {
+            "description": "Port number",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 0
+        },
+        "port_id": {
+            "description": "Unique port identifier for the VPCS instance",
+            "type": "integer"
+        },
+        "capture_file_name": {
+            "description": "Capture file name",
+            "type": "string",
+            "minLength": 1,
+        },
+        "data_link_type": {
+            "description": "PCAP data link type",
+            "type": "string",
+            "minLength": 1,
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id", "port", "port_id", "capture_file_name"]
+}
+
+VPCS_STOP_CAPTURE_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to stop a packet capture on a VPCS instance port",
+    "type": "object",
+    "properties": {
+        "id": {
+            "description": "VPCS device instance ID",
+            "type": "integer"
+        },
+        "port": {
+            "description": "Port number",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 0
+        },
+        "port_id": {
+            "description": "Unique port identifier for the VPCS instance",
+            "type": "integer"
+        },
+    },
+    "additionalProperties": False,
+    "required": ["id", "port", "port_id"]
+}
+
+VPCS_SET_LINK_CONDITIONS_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "description": "Request validation to set the conditions (delay, loss...) of the link of a VPCS instance port",
+    "type": "object",
+    "properties": dict(LINK_CONDITIONS_PROPERTIES, id={
+        "description": "VPCS device instance ID",
+        "type": "integer"
+    }, port={
+        "description": "Port number",
+        "type": "integer",
+        "minimum": 0,
+        "maximum": 0
+    }, port_id={
+        "description": "Unique port identifier for the VPCS instance",
+        "type": "integer"
+    }),
+    "additionalProperties": False,
+    "required": ["id", "port", "port_id"]
+}
+
 VPCS_EXPORT_CONFIG_SCHEMA = {
     "$schema": "http://json-schema.org/draft-04/schema#",
     "description": "Request validation to export the script file of a VPCS instance",
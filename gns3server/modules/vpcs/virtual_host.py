@@ -0,0 +1,903 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Built-in VPCS engine: virtual PCs emulated in the console hub of the
+module process (no VPCS process). Each virtual PC answers ARP and ICMP
+echo requests, configures its address statically or with DHCP and
+understands a subset of the VPCS console commands.
+"""
+
+import os
+import time
+import socket
+import struct
+import random
+
+from .vpcs_error import VPCSError
+from ..console_hub import Console, POLLIN
+from ..fabric.fabric_error import FabricError
+from ..fabric.pcap import PcapWriter, FLUSH_INTERVAL
+
+import logging
+log = logging.getLogger(__name__)
+
+ETH_P_IP = 0x0800
+ETH_P_ARP = 0x0806
+BROADCAST_MAC = b"\xff" * 6
+ZERO_IP = b"\x00" * 4
+BROADCAST_IP = b"\xff" * 4
+
+IPPROTO_ICMP = 1
+IPPROTO_UDP = 17
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+DHCP_SERVER_PORT = 67
+DHCP_CLIENT_PORT = 68
+DHCP_MAGIC = b"\x63\x82\x53\x63"
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPACK = 5
+DHCPNAK = 6
+
+# same MAC addresses as VPCS: 00:50:79:66:68:00 + instance ID
+MAC_PREFIX = b"\x00\x50\x79"
+MAC_BASE = 0x666800
+
+# lifetime of the ARP cache entries (seconds)
+ARP_CACHE_TIMEOUT = 120
+
+# packets waiting for an ARP reply (per virtual PC) and how long they wait (seconds)
+MAX_PENDING_PACKETS = 8
+ARP_RESOLVE_TIMEOUT = 1.0
+
+# delay between the echo requests of a ping (seconds)
+PING_INTERVAL = 1.0
+
+# DHCP retransmissions (seconds)
+DHCP_TIMEOUT = 1.0
+DHCP_RETRIES = 3
+
+# Maximum size of a frame received from a tunnel
+MAX_FRAME_SIZE = 65535
+
+VERSION = "0.6 (GNS3 built-in engine)"
+
+HELP = """
+arp                  Show the ARP table
+clear [ip|arp]       Clear the IP settings or the ARP table
+dhcp                 Get the IP settings with DHCP
+help                 Print this help
+ip ADDR[/MASK] [GATEWAY] [MASK]
+                     Set the IP address, the mask (bits or dotted) and the gateway
+ip dhcp              Same as dhcp
+ping HOST [-c COUNT] Send ICMP echo requests
+save                 Save the settings to the startup file
+set pcname NAME      Rename the virtual PC
+show [ip|arp]        Show the IP settings or the ARP table
+version              Print the version
+"""
+
+
+def mac_address(instance_id):
+    """
+    Returns the MAC address of a virtual PC (as VPCS started with -m instance_id).
+
+    :param instance_id: instance ID
+
+    :returns: MAC address (6 bytes)
+    """
+
+    return MAC_PREFIX + ((MAC_BASE + instance_id) & 0xffffff).to_bytes(3, "big")
+
+
+def format_mac(mac):
+
+    return ":".join("{:02x}".format(byte) for byte in mac)
+
+
+def prefix_to_mask(prefix):
+
+    return ((0xffffffff << (32 - prefix)) & 0xffffffff).to_bytes(4, "big")
+
+
+def mask_to_prefix(mask):
+    """
+    Converts a netmask (bits or dotted) to a prefix length.
+
+    :param mask: string
+
+    :returns: prefix length or None if invalid
+    """
+
+    if mask.isdigit():
+        prefix = int(mask)
+        return prefix if 0 < prefix <= 32 else None
+    try:
+        value = int.from_bytes(socket.inet_aton(mask), "big")
+    except OSError:
+        return None
+    prefix = bin(value).count("1")
+    if value != int.from_bytes(prefix_to_mask(prefix), "big") or prefix == 0:
+        return None
+    return prefix
+
+
+def parse_ip(address):
+    """
+    Parses a dotted IPv4 address.
+
+    :param address: string
+
+    :returns: address (4 bytes) or None if invalid
+    """
+
+    if address.count(".") != 3:
+        return None
+    try:
+        return socket.inet_aton(address)
+    except OSError:
+        return None
+
+
+def checksum(data):
+    """
+    Internet checksum (RFC 1071).
+
+    :param data: bytes
+
+    :returns: checksum (integer)
+    """
+
+    if len(data) % 2:
+        data = bytes(data) + b"\x00"
+    total = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class VirtualHost(object):
+    """
+    Network stack and console commands of a virtual PC.
+
+    Only accessed from the console hub thread. The state is kept small
+    (slots, lazily created tables) so that a process can serve thousands
+    of virtual PCs.
+
+    :param name: virtual PC name
+    :param mac: MAC address (6 bytes)
+    :param send: callable sending a frame through the UDP tunnel
+    :param write: callable writing text to the console
+    :param loop: event loop with call_later() and cancel_timer() (console hub)
+    """
+
+    __slots__ = ("name", "mac", "ip", "prefix", "gateway", "dns", "_arp_cache", "_pending",
+                 "_send", "_write", "_loop", "_ident", "_task", "_timer")
+
+    def __init__(self, name, mac, send, write, loop):
+
+        self.name = name
+        self.mac = mac
+        self.ip = ZERO_IP
+        self.prefix = 24
+        self.gateway = ZERO_IP
+        self.dns = ZERO_IP
+        self._arp_cache = None  # IP -> (MAC, expiration time)
+        self._pending = None  # IP -> packets waiting for an ARP reply
+        self._send = send
+        self._write = write
+        self._loop = loop
+        self._ident = 0
+        self._task = None  # running ping or DHCP: [kind, state..., done callback]
+        self._timer = None
+
+    @property
+    def busy(self):
+        """
+        Returns either a command (ping, DHCP) is still running.
+
+        :returns: boolean
+        """
+
+        return self._task is not None
+
+    def _print(self, text):
+
+        self._write(text.replace("\n", "\r\n"))
+
+    # Ethernet & ARP
+
+    def receive(self, frame):
+        """
+        Handles a frame received from the UDP tunnel.
+
+        :param frame: frame (bytes or memoryview)
+        """
+
+        if len(frame) < 14:
+            return
+        destination = bytes(frame[0:6])
+        if destination != self.mac and destination != BROADCAST_MAC:
+            return
+        ethertype = struct.unpack_from("!H", frame, 12)[0]
+        if ethertype == ETH_P_ARP:
+            self._receive_arp(frame[14:])
+        elif ethertype == ETH_P_IP:
+            self._receive_ip(frame[14:])
+
+    def _send_frame(self, destination, ethertype, payload):
+
+        self._send(destination + self.mac + struct.pack("!H", ethertype) + payload)
+
+    def _arp(self, operation, target_mac, target_ip, destination=BROADCAST_MAC):
+
+        self._send_frame(destination, ETH_P_ARP, struct.pack("!HHBBH6s4s6s4s", 1, ETH_P_IP, 6, 4, operation,
+                                                             self.mac, self.ip, target_mac, target_ip))
+
+    def _receive_arp(self, packet):
+
+        if len(packet) < 28:
+            return
+        _, _, _, _, operation, sender_mac, sender_ip, _, target_ip = struct.unpack_from("!HHBBH6s4s6s4s", packet)
+        if self.ip == ZERO_IP or target_ip != self.ip:
+            return
+        self._learn(sender_ip, sender_mac)
+        if operation == 1:
+            self._arp(2, sender_mac, sender_ip, sender_mac)
+
+    def _learn(self, ip, mac):
+        """
+        Adds an ARP cache entry and sends the packets waiting for it.
+        """
+
+        if self._arp_cache is None:
+            self._arp_cache = {}
+        self._arp_cache[ip] = (mac, time.monotonic() + ARP_CACHE_TIMEOUT)
+        if self._pending and ip in self._pending:
+            for packet in self._pending.pop(ip):
+                self._send_frame(mac, ETH_P_IP, packet)
+
+    def _lookup(self, ip):
+
+        if self._arp_cache:
+            entry = self._arp_cache.get(ip)
+            if entry:
+                if entry[1] > time.monotonic():
+                    return entry[0]
+                del self._arp_cache[ip]
+        return None
+
+    def _drop_pending(self, ip):
+
+        if self._pending:
+            self._pending.pop(ip, None)
+
+    # IPv4
+
+    def _same_subnet(self, ip):
+
+        mask = int.from_bytes(prefix_to_mask(self.prefix), "big")
+        return int.from_bytes(ip, "big") & mask == int.from_bytes(self.ip, "big") & mask
+
+    def _ip_packet(self, source, destination, protocol, payload):
+
+        self._ident = (self._ident + 1) & 0xffff
+        header = bytearray(struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), self._ident, 0, 64, protocol, 0,
+                                       source, destination))
+        struct.pack_into("!H", header, 10, checksum(header))
+        return bytes(header) + payload
+
+    def _send_ip(self, destination, protocol, payload):
+        """
+        Sends an IP packet (resolves the next hop with ARP).
+
+        :returns: False if there is no route
+        """
+
+        if destination == BROADCAST_IP:
+            self._send_frame(BROADCAST_MAC, ETH_P_IP, self._ip_packet(self.ip, destination, protocol, payload))
+            return True
+        if self._same_subnet(destination):
+            next_hop = destination
+        elif self.gateway != ZERO_IP:
+            next_hop = self.gateway
+        else:
+            return False
+
+        packet = self._ip_packet(self.ip, destination, protocol, payload)
+        mac = self._lookup(next_hop)
+        if mac:
+            self._send_frame(mac, ETH_P_IP, packet)
+            return True
+
+        if self._pending is None:
+            self._pending = {}
+        queue = self._pending.setdefault(next_hop, [])
+        if len(queue) < MAX_PENDING_PACKETS:
+            queue.append(packet)
+        if len(queue) == 1:
+            self._arp(1, b"\x00" * 6, next_hop)
+            self._loop.call_later(ARP_RESOLVE_TIMEOUT, self._drop_pending, next_hop)
+        return True
+
+    def _receive_ip(self, packet):
+
+        if len(packet) < 20 or packet[0] >> 4 != 4:
+            return
+        header_length = (packet[0] & 0x0f) * 4
+        total_length, _, _, ttl, protocol, _, source, destination = struct.unpack_from("!HHHBBH4s4s", packet, 2)
+        payload = packet[header_length:total_length]
+        if protocol == IPPROTO_UDP:
+            self._receive_udp(source, destination, payload)
+        elif protocol == IPPROTO_ICMP and destination == self.ip and self.ip != ZERO_IP:
+            self._receive_icmp(source, ttl, payload)
+
+    # ICMP echo (ping)
+
+    def _receive_icmp(self, source, ttl, message):
+
+        if len(message) < 8:
+            return
+        icmp_type, _, _, ident, sequence = struct.unpack_from("!BBHHH", message)
+        if icmp_type == ICMP_ECHO_REQUEST:
+            reply = bytearray(message)
+            reply[0] = ICMP_ECHO_REPLY
+            struct.pack_into("!H", reply, 2, 0)
+            struct.pack_into("!H", reply, 2, checksum(reply))
+            self._send_ip(source, IPPROTO_ICMP, bytes(reply))
+        elif icmp_type == ICMP_ECHO_REPLY:
+            task = self._task
+            if task and task[0] == "ping" and ident == task[2] and sequence in task[5]:
+                elapsed = (time.monotonic() - task[5].pop(sequence)) * 1000
+                self._print("{} bytes from {} icmp_seq={} ttl={} time={:.3f} ms\n".format(len(message) + 20,
+                                                                                        socket.inet_ntoa(source),
+                                                                                        sequence,
+                                                                                        ttl,
+                                                                                        elapsed))
+
+    def ping(self, target, count, done):
+        """
+        Sends ICMP echo requests (one per second) and prints the replies.
+
+        :param target: destination (4 bytes)
+        :param count: number of echo requests
+        :param done: callable called when finished
+        """
+
+        # [kind, target, ident, count, next sequence, {sequence: sent time}, done]
+        self._task = ["ping", target, random.getrandbits(16), count, 1, {}, done]
+        self._ping_next()
+
+    def _ping_next(self):
+
+        task = self._task
+        if not task or task[0] != "ping":
+            return
+        _, target, ident, count, sequence, sent, done = task
+        for lost in sorted(sent):
+            self._print("{} icmp_seq={} timeout\n".format(socket.inet_ntoa(target), lost))
+        sent.clear()
+        if sequence > count:
+            self._finish()
+            return
+
+        task[4] += 1
+        message = bytearray(struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, sequence) + bytes(range(56)))
+        struct.pack_into("!H", message, 2, checksum(message))
+        if not self._send_ip(target, IPPROTO_ICMP, bytes(message)):
+            self._print("No gateway found\n")
+            self._finish()
+            return
+        sent[sequence] = time.monotonic()
+        self._timer = self._loop.call_later(PING_INTERVAL, self._ping_next)
+
+    # DHCP client
+
+    def _dhcp_message(self, message_type, xid, options=b""):
+
+        message = struct.pack("!BBBBIHH4s4s4s4s16s64s128s", 1, 1, 6, 0, xid, 0, 0x8000, ZERO_IP, ZERO_IP, ZERO_IP,
+                              ZERO_IP, self.mac, b"", b"")
+        options = DHCP_MAGIC + bytes([53, 1, message_type]) + options
+        options += bytes([12, len(self.name)]) + self.name.encode("utf-8")[:255] + b"\xff"
+        return message + options
+
+    def _send_dhcp(self, message):
+
+        udp = struct.pack("!HHHH", DHCP_CLIENT_PORT, DHCP_SERVER_PORT, 8 + len(message), 0) + message
+        # sent from 0.0.0.0 while no address is configured
+        source, self.ip = self.ip, ZERO_IP
+        try:
+            self._send_ip(BROADCAST_IP, IPPROTO_UDP, udp)
+        finally:
+            self.ip = source
+
+    def dhcp(self, done):
+        """
+        Gets the IP settings with DHCP (prints DORA like VPCS).
+
+        :param done: callable called when finished
+        """
+
+        # [kind, xid, phase, attempts, offer, done]
+        self._task = ["dhcp", random.getrandbits(32), DHCPDISCOVER, 0, None, done]
+        self._dhcp_send()
+
+    def _dhcp_send(self):
+
+        task = self._task
+        if not task or task[0] != "dhcp":
+            return
+        if task[3] >= DHCP_RETRIES:
+            self._print("\nCan't find dhcp server\n")
+            self._finish()
+            return
+        task[3] += 1
+        if task[2] == DHCPDISCOVER:
+            self._print("D")
+            self._send_dhcp(self._dhcp_message(DHCPDISCOVER, task[1]))
+        else:
+            offered_ip, server_id = task[4]
+            self._print("R")
+            self._send_dhcp(self._dhcp_message(DHCPREQUEST, task[1], bytes([50, 4]) + offered_ip + bytes([54, 4]) + server_id))
+        self._timer = self._loop.call_later(DHCP_TIMEOUT * task[3], self._dhcp_send)
+
+    @staticmethod
+    def _dhcp_options(options):
+
+        parsed = {}
+        index = 0
+        while index < len(options):
+            code = options[index]
+            if code == 255:
+                break
+            if code == 0:
+                index += 1
+                continue
+            if index + 1 >= len(options):
+                break
+            length = options[index + 1]
+            parsed[code] = bytes(options[index + 2:index + 2 + length])
+            index += 2 + length
+        return parsed
+
+    def _receive_udp(self, source, destination, datagram):
+
+        if len(datagram) < 8:
+            return
+        source_port, destination_port = struct.unpack_from("!HH", datagram)
+        task = self._task
+        if destination_port != DHCP_CLIENT_PORT or source_port != DHCP_SERVER_PORT or not task or task[0] != "dhcp":
+            return
+        message = datagram[8:]
+        if len(message) < 240 or bytes(message[236:240]) != DHCP_MAGIC:
+            return
+        xid = struct.unpack_from("!I", message, 4)[0]
+        if xid != task[1] or bytes(message[28:34]) != self.mac:
+            return
+        your_ip = bytes(message[16:20])
+        options = self._dhcp_options(message[240:])
+        message_type = options.get(53, b"\x00")[0]
+
+        if message_type == DHCPOFFER and task[2] == DHCPDISCOVER:
+            self._print("O")
+            self._loop.cancel_timer(self._timer)
+            task[2] = DHCPREQUEST
+            task[3] = 0
+            task[4] = (your_ip, options.get(54, source))
+            self._dhcp_send()
+        elif message_type == DHCPACK and task[2] == DHCPREQUEST:
+            self._print("A")
+            self.ip = your_ip
+            mask = options.get(1)
+            self.prefix = mask_to_prefix(socket.inet_ntoa(mask)) if mask and len(mask) == 4 else 24
+            router = options.get(3)
+            self.gateway = router[:4] if router and len(router) >= 4 else ZERO_IP
+            dns = options.get(6)
+            self.dns = dns[:4] if dns and len(dns) >= 4 else ZERO_IP
+            self._print(" IP {}/{} GW {}\n".format(socket.inet_ntoa(self.ip), self.prefix, socket.inet_ntoa(self.gateway)))
+            self._finish()
+        elif message_type == DHCPNAK:
+            self._print("\nDHCP request refused by the server\n")
+            self._finish()
+
+    def _finish(self):
+        """
+        Ends the running command.
+        """
+
+        task, self._task = self._task, None
+        self._loop.cancel_timer(self._timer)
+        self._timer = None
+        if task:
+            task[-1]()
+
+    def cancel(self):
+        """
+        Interrupts the running command (Ctrl-C).
+        """
+
+        if self._task:
+            self._print("\n")
+            self._finish()
+
+    # console commands
+
+    def execute(self, line, done):
+        """
+        Executes a console command.
+
+        :param line: command line
+        :param done: callable called when the command has finished
+        """
+
+        words = line.split()
+        if not words:
+            done()
+            return
+        command = words[0].lower()
+        handler = getattr(self, "_command_{}".format(command), None)
+        if command in ("?", "help"):
+            handler = self._command_help
+        if handler is None:
+            self._print("Bad command: \"{}\". Use ? for help.\n".format(line.strip()))
+            done()
+            return
+        try:
+            if handler(words[1:], done) is not False:
+                done()
+        except VPCSError as e:
+            self._print("{}\n".format(e))
+            done()
+
+    def _command_help(self, args, done):
+
+        self._print(HELP)
+
+    def _command_version(self, args, done):
+
+        self._print("Welcome to Virtual PC Simulator, version {}\n".format(VERSION))
+
+    def _command_ip(self, args, done):
+
+        if not args:
+            raise VPCSError("Incomplete command.")
+        if args[0].lower() == "dhcp":
+            return self._command_dhcp(args[1:], done)
+
+        address, _, mask = args[0].partition("/")
+        ip = parse_ip(address)
+        if ip is None:
+            raise VPCSError("Invalid address: {}".format(address))
+        prefix = mask_to_prefix(mask) if mask else 24
+        gateway = ZERO_IP
+        for arg in args[1:]:
+            if gateway == ZERO_IP and not arg.isdigit() and parse_ip(arg) and not mask_to_prefix(arg):
+                gateway = parse_ip(arg)
+            elif mask_to_prefix(arg):
+                prefix = mask_to_prefix(arg)
+            else:
+                raise VPCSError("Invalid argument: {}".format(arg))
+        if prefix is None:
+            raise VPCSError("Invalid mask: {}".format(mask))
+
+        self.ip, self.prefix, self.gateway = ip, prefix, gateway
+        self._arp_cache = None
+        self._print("{} : {} {} gateway {}\n".format(self.name,
+                                                     socket.inet_ntoa(self.ip),
+                                                     socket.inet_ntoa(prefix_to_mask(self.prefix)),
+                                                     socket.inet_ntoa(self.gateway)))
+
+    def _command_dhcp(self, args, done):
+
+        self.dhcp(done)
+        return False
+
+    def _command_ping(self, args, done):
+
+        if not args:
+            raise VPCSError("Incomplete command.")
+        target = parse_ip(args[0])
+        if target is None:
+            raise VPCSError("Invalid address: {}".format(args[0]))
+        count = 5
+        if len(args) > 2 and args[1] == "-c":
+            if not args[2].isdigit() or not int(args[2]):
+                raise VPCSError("Invalid count: {}".format(args[2]))
+            count = int(args[2])
+        if self.ip == ZERO_IP:
+            raise VPCSError("No IP address, use the ip or dhcp command first")
+        self.ping(target, count, done)
+        return False
+
+    def _command_arp(self, args, done):
+
+        now = time.monotonic()
+        entries = [(ip, mac, expiration) for ip, (mac, expiration) in (self._arp_cache or {}).items() if expiration > now]
+        if not entries:
+            self._print("arp table is empty\n")
+        for ip, mac, expiration in sorted(entries):
+            self._print("{}  {} expires in {} seconds\n".format(format_mac(mac), socket.inet_ntoa(ip), int(expiration - now)))
+
+    def _command_show(self, args, done):
+
+        if args and args[0].lower() == "arp":
+            return self._command_arp(args[1:], done)
+        self._print("\nNAME        : {}\n".format(self.name))
+        self._print("IP/MASK     : {}/{}\n".format(socket.inet_ntoa(self.ip), self.prefix))
+        self._print("GATEWAY     : {}\n".format(socket.inet_ntoa(self.gateway)))
+        self._print("DNS         : {}\n".format(socket.inet_ntoa(self.dns) if self.dns != ZERO_IP else ""))
+        self._print("MAC         : {}\n\n".format(format_mac(self.mac)))
+
+    def _command_clear(self, args, done):
+
+        if not args or args[0].lower() not in ("ip", "arp"):
+            raise VPCSError("Incomplete command.")
+        if args[0].lower() == "ip":
+            self.ip = self.gateway = self.dns = ZERO_IP
+            self.prefix = 24
+            self._print("IPv4 address/mask, gateway, DNS, and DHCP cleared\n")
+        self._arp_cache = None
+
+    def _command_set(self, args, done):
+
+        if len(args) != 2 or args[0].lower() != "pcname":
+            raise VPCSError("Incomplete command.")
+        self.name = args[1]
+
+    def config(self):
+        """
+        Returns the commands restoring the current settings (startup file).
+
+        :returns: list of commands
+        """
+
+        commands = ["set pcname {}".format(self.name)]
+        if self.ip != ZERO_IP:
+            command = "ip {}/{}".format(socket.inet_ntoa(self.ip), self.prefix)
+            if self.gateway != ZERO_IP:
+                command += " {}".format(socket.inet_ntoa(self.gateway))
+            commands.append(command)
+        return commands
+
+
+class VirtualHostConsole(Console):
+    """
+    Virtual PC served by the console hub: the console device is the
+    VirtualHost and its UDP tunnel is polled by the hub.
+
+    :param name: virtual PC name
+    :param instance_id: instance ID (MAC address offset)
+    :param laddr: local address of the UDP tunnel
+    :param lport: local port of the UDP tunnel
+    :param rhost: remote host of the UDP tunnel
+    :param rport: remote port of the UDP tunnel
+    :param console_host: host/address to bind for Telnet connections
+    :param console: Telnet port
+    :param script_path: startup file (executed when the console starts, written by "save")
+    :param watcher: ConsoleWatcher instance (optional)
+    """
+
+    # frames are received in the hub thread only
+    _buffer = bytearray(MAX_FRAME_SIZE)
+
+    def __init__(self, name, instance_id, laddr, lport, rhost, rport, console_host, console, script_path=None, watcher=None):
+
+        Console.__init__(self, name, console_host, console,
+                         welcome="\r\nWelcome to Virtual PC Simulator, version {}\r\n\r\n".format(VERSION),
+                         watcher=watcher)
+        self._laddr = laddr
+        self._lport = lport
+        self._destination = (rhost, rport)
+        self._script_path = script_path
+        self._socket = None
+        self._line = bytearray()
+        self._last_char = None
+        self.host = None
+        self._instance_id = instance_id
+        self._capture = None
+        self._flush_timer = None
+
+    def start(self, hub=None):
+        """
+        Binds the UDP tunnel and the Telnet port and starts the virtual PC.
+        Bind errors are raised in the caller thread.
+
+        :param hub: ConsoleHub instance (default is the process hub)
+        """
+
+        family = socket.AF_INET6 if ":" in self._laddr else socket.AF_INET
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            self._socket.bind((self._laddr, self._lport))
+            self._socket.setblocking(False)
+            Console.start(self, hub)
+        except OSError as e:
+            self._socket.close()
+            self._socket = None
+            raise VPCSError("Could not start virtual PC {}: {}".format(self._name, e))
+
+    def start_capture(self, path, data_link_type="DLT_EN10MB"):
+        """
+        Starts capturing the frames of the virtual PC.
+
+        :param path: PCAP file path
+        :param data_link_type: PCAP data link type
+        """
+
+        try:
+            writer = PcapWriter(path, data_link_type)
+        except FabricError as e:
+            raise VPCSError(str(e))
+        self._hub.call_soon(self._set_capture, writer)
+
+    def stop_capture(self):
+        """
+        Stops capturing frames.
+        """
+
+        if self._hub:
+            self._hub.call_soon(self._set_capture, None)
+
+    def _set_capture(self, writer):
+
+        if self._capture:
+            self._capture.close()
+        self._capture = writer
+        self._hub.cancel_timer(self._flush_timer)
+        self._flush_timer = None
+        if writer and self._socket:
+            self._flush_timer = self._hub.call_later(FLUSH_INTERVAL, self._flush_capture)
+        elif writer:
+            # the virtual PC has already stopped
+            self._set_capture(None)
+
+    def _flush_capture(self):
+
+        if self._capture:
+            self._capture.flush()
+            self._flush_timer = self._hub.call_later(FLUSH_INTERVAL, self._flush_capture)
+
+    def _send_frame(self, frame):
+
+        if self._socket is None:
+            return
+        if self._capture:
+            self._capture.write(frame)
+        try:
+            self._socket.sendto(frame, self._destination)
+        except (BlockingIOError, InterruptedError):
+            pass  # the socket buffer is full, drop the frame like a real link would do
+        except OSError as e:
+            log.debug("{}: could not send to {}: {}".format(self._name, self._destination, e))
+
+    def _output(self, text):
+
+        self.broadcast(text.encode("utf-8"))
+
+    def _prompt(self):
+
+        self._output("\r\n{}> ".format(self.host.name))
+
+    def device_open(self):
+
+        self.host = VirtualHost(self._name, mac_address(self._instance_id), self._send_frame, self._output, self._hub)
+        self._hub.register(self._socket.fileno(), POLLIN, self._tunnel_event)
+        commands = []
+        if self._script_path and os.path.isfile(self._script_path):
+            try:
+                with open(self._script_path, errors="replace") as f:
+                    commands = [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+            except OSError as e:
+                log.warning("could not read {}: {}".format(self._script_path, e))
+        self._run_script(commands)
+
+    def _run_script(self, commands):
+        """
+        Executes the startup commands one after the other.
+        """
+
+        if not commands or self._socket is None:
+            self._prompt()
+            return
+        command = commands.pop(0)
+        self._execute(command, lambda: self._run_script(commands))
+
+    def _execute(self, command, done):
+
+        if command.split()[:1] == ["save"]:
+            self._save()
+            done()
+        else:
+            self.host.execute(command, done)
+
+    def _save(self):
+
+        if not self._script_path:
+            self._output("No startup file\r\n")
+            return
+        try:
+            with open(self._script_path, "w") as f:
+                f.write("\n".join(self.host.config()) + "\n")
+            self._output("Saving startup configuration to {}\r\n.  done\r\n".format(os.path.basename(self._script_path)))
+        except OSError as e:
+            self._output("Could not save {}: {}\r\n".format(self._script_path, e))
+
+    def client_connected(self, client):
+
+        if not self.host.busy:
+            client.send("{}> ".format(self.host.name).encode("utf-8"))
+
+    def device_close(self):
+
+        if self.host:
+            self.host.cancel()
+        self._set_capture(None)
+        if self._socket:
+            self._hub.unregister(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+
+    def _tunnel_event(self, events):
+
+        view = memoryview(self._buffer)
+        while self._socket:
+            try:
+                size = self._socket.recv_into(self._buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. ICMP port unreachable reported on the socket
+                log.debug("{}: {}".format(self._name, e))
+                continue
+            if self._capture:
+                self._capture.write(view[:size])
+            self.host.receive(view[:size])
+
+    def device_write(self, data):
+        """
+        Line editing of the Telnet input (the console echoes).
+        """
+
+        for char in data:
+            last_char, self._last_char = self._last_char, char
+            if char == 0x03:
+                # Ctrl-C
+                self._line.clear()
+                if self.host.busy:
+                    self.host.cancel()
+                else:
+                    self._prompt()
+                continue
+            if self.host.busy:
+                continue
+            if char in (0x0d, 0x0a):
+                if char == 0x0a and last_char == 0x0d:
+                    continue
+                line = self._line.decode("utf-8", errors="replace")
+                self._line.clear()
+                self._output("\r\n")
+                self._execute(line, self._prompt)
+            elif char in (0x08, 0x7f):
+                if self._line:
+                    del self._line[-1]
+                    self._output("\b \b")
+            elif char >= 0x20 and char != 0x7f:
+                self._line.append(char)
+                self.broadcast(bytes([char]))
@@ -33,6 +33,11 @@ from .adapters.ethernet_adapter import EthernetAdapter
 from .nios.nio_udp import NIO_UDP
 from .nios.nio_tap import NIO_TAP
 from ..attic import find_unused_port
+from ..cgroups import NodeResources, CgroupError
+from ..console_watcher import ConsoleWatcher
+from ..process_log import ProcessLog, MAX_PAGE_SIZE
+from ..sharding import owns
+from .virtual_host import VirtualHostConsole
 
 import logging
 log = logging.getLogger(__name__)
@@ -50,8 +55,13 @@ class VPCSDevice(object):
     :param console_host: IP address to bind for console connections
     :param console_start_port_range: TCP console port range start
     :param console_end_port_range: TCP console port range end
+    :param engine: "vpcs" (VPCS process) or "builtin" (virtual PC emulated in this process)
     """
 
+    # maximum instance ID for each engine: VPCS only accepts
+    # MAC address offsets up to 255 with the -m option
+    MAX_INSTANCE_IDS = {"vpcs": 255, "builtin": 65535}
+
     _instances = []
     _allocated_console_ports = []
 
@@ -63,16 +73,17 @@ class VPCSDevice(object):
                  console=None,
                  console_host="0.0.0.0",
                  console_start_port_range=4512,
-                 console_end_port_range=5000):
+                 console_end_port_range=5000,
+                 engine="vpcs"):
 
+        if engine not in self.MAX_INSTANCE_IDS:
+            raise VPCSError("Unknown VPCS engine: {}".format(engine))
 
         if not vpcs_id:
-            # find an instance identifier is none is provided (1 <= id <= 255)
-            # This 255 limit is due to a restriction on the number of possible
-            # MAC addresses given in VPCS using the -m option
+            # find an instance identifier is none is provided (1 <= id <= 255 for VPCS)
             self._id = 0
-            for identifier in range(1, 256):
-                if identifier not in self._instances:
+            for identifier in range(1, self.MAX_INSTANCE_IDS[engine] + 1):
+                if identifier not in self._instances and owns(identifier):
                     self._id = identifier
                     self._instances.append(self._id)
                     break
@@ -87,19 +98,26 @@ class VPCSDevice(object):
 
         self._name = name
         self._path = path
+        self._engine = engine
+        self._virtual_host = None
+        self._capture = None
         self._console = console
         self._working_dir = None
         self._console_host = console_host
         self._command = []
         self._process = None
-        self._vpcs_stdout_file = ""
+        self._vpcs_stdout_log = None
         self._started = False
+        # the built-in engine feeds the watcher, the VPCS console is read with a tap
+        self._console_watcher = ConsoleWatcher(name, self._console_matched, tapped=engine != "builtin")
+        self._console_match_callback = None
         self._console_start_port_range = console_start_port_range
         self._console_end_port_range = console_end_port_range
 
         # VPCS settings
         self._script_file = ""
         self._ethernet_adapter = EthernetAdapter()  # one adapter with 1 Ethernet interface
+        self._resources = NodeResources("vpcs-{}".format(self._id))
 
         working_dir_path = os.path.join(working_dir, "vpcs", "pc-{}".format(self._id))
 
@@ -135,10 +153,21 @@ class VPCSDevice(object):
 
         vpcs_defaults = {"name": self._name,
                          "script_file": self._script_file,
-                         "console": self._console}
+                         "console": self._console,
+                         "engine": self._engine}
 
         return vpcs_defaults
 
+    @property
+    def engine(self):
+        """
+        Returns the engine running this VPCS device.
+
+        :returns: "vpcs" or "builtin"
+        """
+
+        return self._engine
+
     @property
     def id(self):
         """
@@ -290,6 +319,7 @@ class VPCSDevice(object):
         """
 
         self.stop()
+        self._console_watcher.clear()
         if self._id in self._instances:
             self._instances.remove(self._id)
 
@@ -305,6 +335,7 @@ class VPCSDevice(object):
         """
 
         self.stop()
+        self._console_watcher.clear()
         if self._id in self._instances:
             self._instances.remove(self._id)
 
@@ -356,6 +387,10 @@ class VPCSDevice(object):
 
         if not self.is_running():
 
+            if self._engine == "builtin":
+                self._start_virtual_host()
+                return
+
             if not self._path:
                 raise VPCSError("No path to a VPCS executable has been set")
 
@@ -373,12 +408,12 @@ class VPCSDevice(object):
             self._command = self._build_command()
             try:
                 log.info("starting VPCS: {}".format(self._command))
-                self._vpcs_stdout_file = os.path.join(self._working_dir, "vpcs.log")
-                log.info("logging to {}".format(self._vpcs_stdout_file))
+                self._vpcs_stdout_log = ProcessLog(os.path.join(self._working_dir, "vpcs.log"))
+                log.info("logging to {}".format(self._vpcs_stdout_log.path))
                 flags = 0
                 if sys.platform.startswith("win32"):
                     flags = subprocess.CREATE_NEW_PROCESS_GROUP
-                with open(self._vpcs_stdout_file, "w") as fd:
+                with self._vpcs_stdout_log.open() as fd:
                     self._process = subprocess.Popen(self._command,
                                                      stdout=fd,
                                                      stderr=subprocess.STDOUT,
@@ -386,16 +421,57 @@ class VPCSDevice(object):
                                                      creationflags=flags)
                 log.info("VPCS instance {} started PID={}".format(self._id, self._process.pid))
                 self._started = True
+                self._resources.attach(self._process.pid)
+                # the console is served by VPCS, it is read only while patterns are watched
+                self._console_watcher.tap(self._console_host, self._console)
             except (OSError, subprocess.SubprocessError) as e:
                 vpcs_stdout = self.read_vpcs_stdout()
                 log.error("could not start VPCS {}: {}\n{}".format(self._path, e, vpcs_stdout))
                 raise VPCSError("could not start VPCS {}: {}\n{}".format(self._path, e, vpcs_stdout))
 
+    def _start_virtual_host(self):
+        """
+        Starts the virtual PC in the console hub of this process (built-in engine).
+        """
+
+        nio = self._ethernet_adapter.get_nio(0)
+        if not nio:
+            raise VPCSError("This VPCS instance must be connected in order to start")
+        if not isinstance(nio, NIO_UDP):
+            raise VPCSError("The built-in VPCS engine only supports UDP tunnels")
+
+        script_file = self._script_file or "startup.vpc"
+        if not os.path.isabs(script_file):
+            script_file = os.path.join(self._working_dir, script_file)
+        virtual_host = VirtualHostConsole(self._name,
+                                          self._id,
+                                          "0.0.0.0",
+                                          nio.lport,
+                                          nio.rhost,
+                                          nio.rport,
+                                          self._console_host,
+                                          self._console,
+                                          script_path=script_file,
+                                          watcher=self._console_watcher)
+        virtual_host.start()
+        if self._capture:
+            virtual_host.start_capture(*self._capture)
+        self._virtual_host = virtual_host
+        self._started = True
+        log.info("VPCS instance {} started (built-in engine)".format(self._id))
+
     def stop(self):
         """
         Stops the VPCS process.
         """
 
+        if self._virtual_host:
+            log.info("stopping VPCS instance {} (built-in engine)".format(self._id))
+            self._virtual_host.stop()
+            self._virtual_host = None
+            self._started = False
+            return
+
         # stop the VPCS process
         if self.is_running():
             log.info("stopping VPCS instance {} PID={}".format(self._id, self._process.pid))
@@ -408,21 +484,95 @@ class VPCSDevice(object):
 
         self._process = None
         self._started = False
+        self._console_watcher.untap()
+        self._resources.release()
+
+    def start_capture(self, output_file, data_link_type="DLT_EN10MB"):
+        """
+        Starts a packet capture (built-in engine only, the capture
+        is written by the virtual PC and kept across restarts).
+
+        :param output_file: PCAP destination file for the capture
+        :param data_link_type: PCAP data link type (DLT_*)
+        """
+
+        if self._engine != "builtin":
+            raise VPCSError("VPCS {} doesn't capture its own packets".format(self._name))
+        if self._virtual_host:
+            self._virtual_host.start_capture(output_file, data_link_type)
+        self._capture = (output_file, data_link_type)
+        log.info("VPCS {name} [id={id}]: starting packet capture to {file}".format(name=self._name,
+                                                                                  id=self._id,
+                                                                                  file=output_file))
+
+    def stop_capture(self):
+        """
+        Stops a packet capture (built-in engine only).
+        """
+
+        self._capture = None
+        if self._virtual_host:
+            self._virtual_host.stop_capture()
+        log.info("VPCS {name} [id={id}]: stopping packet capture".format(name=self._name, id=self._id))
+
+    @property
+    def capturing(self):
+        """
+        Returns either the built-in engine is capturing packets.
+
+        :returns: boolean
+        """
+
+        return self._capture is not None
+
+    @property
+    def console_watcher(self):
+        """
+        Returns the patterns watched in the console output.
+
+        :returns: ConsoleWatcher instance
+        """
+
+        return self._console_watcher
+
+    def set_console_match_callback(self, callback):
+        """
+        Sets a callback to be called when a watched pattern is found in the console output.
+        The callback is called from the console hub thread.
+
+        :param callback: callable receiving this device, the watch ID, the pattern and the watch context
+        """
+
+        self._console_match_callback = callback
+
+    def _console_matched(self, watch_id, pattern, context):
+
+        if self._console_match_callback:
+            self._console_match_callback(self, watch_id, pattern, context)
 
     def read_vpcs_stdout(self):
         """
-        Reads the standard output of the VPCS process.
+        Reads the end of the standard output of the VPCS process.
         Only use when the process has been stopped or has crashed.
         """
 
-        output = ""
-        if self._vpcs_stdout_file:
-            try:
-                with open(self._vpcs_stdout_file, errors="replace") as file:
-                    output = file.read()
-            except OSError as e:
-                log.warn("could not read {}: {}".format(self._vpcs_stdout_file, e))
-        return output
+        if self._vpcs_stdout_log:
+            return self._vpcs_stdout_log.tail()
+        return ""
+
+    def read_log(self, offset=None, size=MAX_PAGE_SIZE):
+        """
+        Reads a page of the output of the VPCS process.
+
+        :param offset: position in the log, from the end if negative (the last page by default)
+        :param size: maximum number of bytes
+
+        :returns: tuple (text, offset of the page, offset of the end of the log)
+        """
+
+        if self._vpcs_stdout_log:
+            return self._vpcs_stdout_log.read(offset, size)
+        return "", 0, 0
 
     def is_running(self):
         """
@@ -431,6 +581,8 @@ class VPCSDevice(object):
         :returns: True or False
         """
 
+        if self._virtual_host:
+            return True
         if self._process and self._process.poll() is None:
             return True
         return False
@@ -453,6 +605,20 @@ class VPCSDevice(object):
                                                                                nio=nio,
                                                                                port_id=port_id))
 
+    def get_nio(self, port_id):
+        """
+        Returns the NIO of a port.
+
+        :param port_id: port ID
+
+        :returns: NIO instance or None
+        """
+
+        if not self._ethernet_adapter.port_exists(port_id):
+            raise VPCSError("Port {port_id} doesn't exist in adapter {adapter}".format(adapter=self._ethernet_adapter,
+                                                                                       port_id=port_id))
+        return self._ethernet_adapter.get_nio(port_id)
+
     def port_remove_nio_binding(self, port_id):
         """
         Removes a port NIO binding.
@@ -555,3 +721,48 @@ class VPCSDevice(object):
         log.info("VPCS {name} [id={id}]: script_file set to {config}".format(name=self._name,
                                                                              id=self._id,
                                                                              config=self._script_file))
+
+    @property
+    def resources(self):
+        """
+        Returns the resource limits of the VPCS process.
+
+        :returns: dictionary (cpu_limit, cpu_weight, memory_limit, cpuset)
+        """
+
+        return self._resources.settings
+
+    @resources.setter
+    def resources(self, resources):
+        """
+        Sets the resource limits of the VPCS process (enforced with cgroups v2).
+
+        :param resources: dictionary (cpu_limit, cpu_weight, memory_limit, cpuset)
+        """
+
+        try:
+            self._resources.update(resources)
+        except CgroupError as e:
+            raise VPCSError(str(e))
+        log.info("VPCS {name} [id={id}]: resource limits set to {resources}".format(name=self._name,
+                                                                                  id=self._id,
+                                                                                  resources=resources))
+
+    @property
+    def resources_controlled(self):
+        """
+        Returns either the VPCS process is in a cgroup.
+
+        :returns: boolean
+        """
+
+        return self._resources.attached
+
+    def resource_usage(self):
+        """
+        Returns the resource usage of the VPCS process.
+
+        :returns: dictionary (empty if the process is not in a cgroup)
+        """
+
+        return self._resources.usage()
@@ -0,0 +1,699 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Incremental index of the PCAP capture files, used to retrieve the packets
+of a time range or of a flow without transferring the whole capture.
+
+The index is saved next to the capture (<capture>.idx) and only grows:
+when the capture grows, only the new packets are read and appended to it.
+Sidecar format: magic, PCAP file header, then "P" records (offset, time,
+flow number) for the packets and "F" records for the flows (5-tuples,
+numbered in order of appearance).
+"""
+
+import os
+import array
+import bisect
+import heapq
+import socket
+import struct
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import Config
+
+import logging
+log = logging.getLogger(__name__)
+
+PCAP_HEADER_SIZE = 24
+PCAP_RECORD_HEADER_SIZE = 16
+
+# (byte order, timestamp fraction divisor) by magic number
+PCAP_FORMATS = {b"\xd4\xc3\xb2\xa1": ("<", 1000000),
+                b"\xa1\xb2\xc3\xd4": (">", 1000000),
+                b"\x4d\x3c\xb2\xa1": ("<", 1000000000),
+                b"\xa1\xb2\x3c\x4d": (">", 1000000000)}
+
+# data link types with a flow key (other captures are indexed by time only)
+DLT_PPP = 9
+DLT_EN10MB = 1
+DLT_PPP_SERIAL = 50
+DLT_RAW = 101
+DLT_C_HDLC = 104
+DLT_IPV4 = 228
+DLT_IPV6 = 229
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+PPP_PROTOCOLS = {0x0021: ETHERTYPE_IPV4, 0x0057: ETHERTYPE_IPV6}
+
+# protocols with ports
+PORT_PROTOCOLS = (6, 17, 132)  # TCP, UDP, SCTP
+PROTOCOL_NAMES = {"icmp": 1, "tcp": 6, "udp": 17, "icmpv6": 58, "sctp": 132}
+
+# bytes of each packet read to find the flow (link, IPv6 and transport headers)
+FLOW_HEADERS_SIZE = 128
+
+# records larger than this are considered as a corrupted capture
+MAX_RECORD_SIZE = 262144
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"GNS3PIX1"
+INDEX_PACKET = struct.Struct("<cQdI")
+INDEX_FLOW = struct.Struct("<cBB16sH16sH")
+NO_FLOW = 0xffffffff
+
+# one timestamp is kept in memory every TIME_STEP packets
+TIME_STEP = 64
+
+# the capture is read by blocks of this size when indexing
+INDEX_READ_SIZE = 1024 * 1024
+
+# number of indexes kept in memory
+MAX_INDEXES = 16
+
+
+class PcapIndexError(Exception):
+
+    def __init__(self, message, original_exception=None):
+
+        Exception.__init__(self, message)
+        if isinstance(message, Exception):
+            message = str(message)
+        self._message = message
+        self._original_exception = original_exception
+
+    def __repr__(self):
+
+        return self._message
+
+    def __str__(self):
+
+        return self._message
+
+
+def _ip_flow_key(data, offset, ethertype):
+    """
+    Returns the flow key of an IP packet.
+
+    :param data: start of the frame (bytes)
+    :param offset: offset of the IP header
+    :param ethertype: IP version (ethertype)
+
+    :returns: (protocol, address, port, peer address, peer port) or None
+    """
+
+    ports_offset = None
+    if ethertype == ETHERTYPE_IPV4:
+        if len(data) < offset + 20:
+            return None
+        header_length = (data[offset] & 0x0f) * 4
+        protocol = data[offset + 9]
+        source = data[offset + 12:offset + 16]
+        destination = data[offset + 16:offset + 20]
+        # only the first fragment has the ports
+        if not struct.unpack_from("!H", data, offset + 6)[0] & 0x1fff:
+            ports_offset = offset + header_length
+    elif ethertype == ETHERTYPE_IPV6:
+        if len(data) < offset + 40:
+            return None
+        protocol = data[offset + 6]
+        source = data[offset + 8:offset + 24]
+        destination = data[offset + 24:offset + 40]
+        ports_offset = offset + 40
+    else:
+        return None
+
+    source_port = destination_port = 0
+    if protocol in PORT_PROTOCOLS and ports_offset is not None and len(data) >= ports_offset + 4:
+        source_port, destination_port = struct.unpack_from("!HH", data, ports_offset)
+
+    # both directions are the same flow
+    if (source, source_port) <= (destination, destination_port):
+        return protocol, source, source_port, destination, destination_port
+    return protocol, destination, destination_port, source, source_port
+
+
+def flow_key(data, link_type):
+    """
+    Returns the flow key (5-tuple) of a packet.
+
+    :param data: start of the packet (bytes)
+    :param link_type: PCAP data link type
+
+    :returns: (protocol, address, port, peer address, peer port) or None
+    """
+
+    if link_type == DLT_EN10MB:
+        if len(data) < 14:
+            return None
+        ethertype = struct.unpack_from("!H", data, 12)[0]
+        offset = 14
+        while ethertype in ETHERTYPE_VLAN and len(data) >= offset + 4:
+            ethertype = struct.unpack_from("!H", data, offset + 2)[0]
+            offset += 4
+    elif link_type == DLT_C_HDLC:
+        if len(data) < 4:
+            return None
+        ethertype = struct.unpack_from("!H", data, 2)[0]
+        offset = 4
+    elif link_type in (DLT_PPP_SERIAL, DLT_PPP):
+        if len(data) < 4:
+            return None
+        ethertype = PPP_PROTOCOLS.get(struct.unpack_from("!H", data, 2)[0])
+        offset = 4
+    elif link_type in (DLT_RAW, DLT_IPV4, DLT_IPV6):
+        if not data:
+            return None
+        ethertype = ETHERTYPE_IPV6 if data[0] >> 4 == 6 else ETHERTYPE_IPV4
+        offset = 0
+    else:
+        return None
+    return _ip_flow_key(data, offset, ethertype)
+
+
+def _address(address):
+
+    return socket.inet_ntop(socket.AF_INET if len(address) == 4 else socket.AF_INET6, address)
+
+
+def _parse_address(address):
+
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, address)
+        except (OSError, ValueError):
+            continue
+    raise PcapIndexError("Invalid address {}".format(address))
+
+
+class FlowFilter(object):
+    """
+    Matches the flows of a 5-tuple, any field can be omitted. A flow
+    matches whatever the direction (host can be the source or the destination).
+
+    :param protocol: IP protocol number or name (tcp, udp, icmp...)
+    :param host: address of one end
+    :param port: port of one end
+    :param peer_host: address of the other end
+    :param peer_port: port of the other end
+    """
+
+    def __init__(self, protocol=None, host=None, port=None, peer_host=None, peer_port=None):
+
+        if isinstance(protocol, str):
+            if protocol.lower() not in PROTOCOL_NAMES:
+                raise PcapIndexError("Unknown protocol {}".format(protocol))
+            protocol = PROTOCOL_NAMES[protocol.lower()]
+        self._protocol = protocol
+        self._host = _parse_address(host) if host else None
+        self._port = port
+        self._peer_host = _parse_address(peer_host) if peer_host else None
+        self._peer_port = peer_port
+
+    @staticmethod
+    def _match_end(address, port, host, host_port):
+
+        return (host is None or address == host) and (host_port is None or port == host_port)
+
+    def match(self, key):
+        """
+        Returns either a flow matches.
+
+        :param key: flow key (see flow_key())
+
+        :returns: boolean
+        """
+
+        protocol, address, port, peer_address, peer_port = key
+        if self._protocol is not None and protocol != self._protocol:
+            return False
+        if self._match_end(address, port, self._host, self._port) and \
+                self._match_end(peer_address, peer_port, self._peer_host, self._peer_port):
+            return True
+        return self._match_end(peer_address, peer_port, self._host, self._port) and \
+            self._match_end(address, port, self._peer_host, self._peer_port)
+
+
+class PcapIndex(object):
+    """
+    Index of a PCAP file (thread-safe).
+
+    :param path: path to the PCAP file
+    """
+
+    def __init__(self, path):
+
+        self._path = path
+        self._index_path = path + INDEX_SUFFIX
+        self._lock = threading.Lock()
+        self._reset()
+        try:
+            self._load()
+        except (OSError, PcapIndexError, struct.error) as e:
+            log.warning("discarding the index of {}: {}".format(path, e))
+            self._discard()
+
+    @property
+    def path(self):
+        """
+        Returns the path to the PCAP file.
+
+        :returns: path
+        """
+
+        return self._path
+
+    def _reset(self):
+
+        self._header = None       # PCAP file header
+        self._record = None       # record header struct
+        self._divisor = 1000000   # timestamp fraction divisor
+        self._link_type = None
+        self._end = 0             # offset after the last indexed packet
+        self._last_record = None  # header of the last indexed packet (to detect a new capture)
+        self._offsets = array.array("Q")
+        self._times = array.array("d")  # time of every TIME_STEP packet
+        self._first_time = self._last_time = None
+        self._flow_keys = []      # flow number -> flow key
+        self._flow_numbers = {}   # flow key -> flow number
+        self._flow_packets = []   # flow number -> packet numbers
+
+    def _discard(self):
+        """
+        Forgets the index (e.g. the capture has been restarted).
+        """
+
+        self._reset()
+        try:
+            os.remove(self._index_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning("could not delete {}: {}".format(self._index_path, e))
+
+    def _set_header(self, header):
+
+        if len(header) < PCAP_HEADER_SIZE or header[:4] not in PCAP_FORMATS:
+            raise PcapIndexError("{} is not a PCAP file".format(self._path))
+        self._header = header
+        byte_order, self._divisor = PCAP_FORMATS[header[:4]]
+        self._record = struct.Struct(byte_order + "IIII")
+        self._link_type = struct.unpack_from(byte_order + "I", header, 20)[0]
+
+    def _add_flow(self, key):
+
+        number = len(self._flow_keys)
+        self._flow_keys.append(key)
+        self._flow_numbers[key] = number
+        self._flow_packets.append(array.array("I"))
+        return number
+
+    def _add_packet(self, offset, timestamp, flow):
+
+        number = len(self._offsets)
+        if number % TIME_STEP == 0:
+            self._times.append(timestamp)
+        if self._first_time is None:
+            self._first_time = timestamp
+        self._last_time = timestamp
+        self._offsets.append(offset)
+        if flow != NO_FLOW:
+            self._flow_packets[flow].append(number)
+
+    def _load(self):
+        """
+        Loads the saved index.
+        """
+
+        try:
+            with open(self._index_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise PcapIndexError("invalid index file")
+        position = len(INDEX_MAGIC)
+        self._set_header(data[position:position + PCAP_HEADER_SIZE])
+        position += PCAP_HEADER_SIZE
+        while position < len(data):
+            tag = data[position:position + 1]
+            if tag == b"P" and position + INDEX_PACKET.size <= len(data):
+                _, offset, timestamp, flow = INDEX_PACKET.unpack_from(data, position)
+                self._add_packet(offset, timestamp, flow)
+                position += INDEX_PACKET.size
+            elif tag == b"F" and position + INDEX_FLOW.size <= len(data):
+                _, protocol, version, address, port, peer_address, peer_port = INDEX_FLOW.unpack_from(data, position)
+                size = 4 if version == 4 else 16
+                self._add_flow((protocol, address[:size], port, peer_address[:size], peer_port))
+                position += INDEX_FLOW.size
+            else:
+                break
+
+        if position < len(data):
+            # interrupted while saving, the next records are appended after the last complete one
+            log.info("truncating the index of {} to {} bytes".format(self._path, position))
+            with open(self._index_path, "r+b") as f:
+                f.truncate(position)
+
+        with open(self._path, "rb") as f:
+            if f.read(PCAP_HEADER_SIZE) != self._header:
+                raise PcapIndexError("the capture has been restarted")
+            self._end = PCAP_HEADER_SIZE
+            if self._offsets:
+                f.seek(self._offsets[-1])
+                self._last_record = f.read(PCAP_RECORD_HEADER_SIZE)
+                if len(self._last_record) < PCAP_RECORD_HEADER_SIZE:
+                    raise PcapIndexError("the capture has been restarted")
+                self._end = self._offsets[-1] + PCAP_RECORD_HEADER_SIZE + self._record.unpack(self._last_record)[2]
+        log.info("index of {} loaded: {} packets, {} flows".format(self._path, len(self._offsets), len(self._flow_keys)))
+
+    def _restarted(self, f, size):
+        """
+        Returns either the capture file has been replaced since the last update.
+        """
+
+        if size < self._end:
+            return True
+        f.seek(0)
+        if self._header is not None and f.read(PCAP_HEADER_SIZE) != self._header:
+            return True
+        if self._last_record is not None:
+            f.seek(self._offsets[-1])
+            return f.read(PCAP_RECORD_HEADER_SIZE) != self._last_record
+        return False
+
+    def _index(self, f, size):
+        """
+        Indexes the packets written since the last update.
+
+        :returns: sidecar records (bytearray)
+        """
+
+        records = bytearray()
+        record = self._record
+        divisor = self._divisor
+        link_type = self._link_type
+        offset = self._end
+        f.seek(offset)
+        buffer = b""
+        position = 0
+        last_record = None
+        while offset < size:
+            data = f.read(INDEX_READ_SIZE)
+            if not data:
+                break
+            buffer = buffer[position:] + data
+            position = 0
+            while position + PCAP_RECORD_HEADER_SIZE <= len(buffer):
+                seconds, fraction, captured, _ = record.unpack_from(buffer, position)
+                if captured > MAX_RECORD_SIZE:
+                    raise PcapIndexError("{} is corrupted at offset {}".format(self._path, offset))
+                end = position + PCAP_RECORD_HEADER_SIZE + captured
+                if end > len(buffer):
+                    break  # the rest of the packet is in the next block (or not written yet)
+
+                key = flow_key(buffer[position + PCAP_RECORD_HEADER_SIZE:min(end, position + PCAP_RECORD_HEADER_SIZE + FLOW_HEADERS_SIZE)], link_type)
+                flow = NO_FLOW
+                if key is not None:
+                    flow = self._flow_numbers.get(key)
+                    if flow is None:
+                        flow = self._add_flow(key)
+                        protocol, address, port, peer_address, peer_port = key
+                        records += INDEX_FLOW.pack(b"F", protocol, 4 if len(address) == 4 else 6, address, port, peer_address, peer_port)
+                timestamp = seconds + fraction / divisor
+                self._add_packet(offset, timestamp, flow)
+                records += INDEX_PACKET.pack(b"P", offset, timestamp, flow)
+                last_record = buffer[position:position + PCAP_RECORD_HEADER_SIZE]
+                offset += end - position
+                position = end
+
+        self._end = offset
+        if last_record is not None:
+            self._last_record = last_record
+        return records
+
+    def update(self):
+        """
+        Indexes the new packets of the capture.
+
+        :returns: number of packets in the index
+        """
+
+        with self._lock:
+            try:
+                with open(self._path, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if self._restarted(f, size):
+                        log.info("{} has been restarted, indexing again".format(self._path))
+                        self._discard()
+                    if self._header is None:
+                        if size < PCAP_HEADER_SIZE:
+                            return 0
+                        f.seek(0)
+                        self._set_header(f.read(PCAP_HEADER_SIZE))
+                        self._end = PCAP_HEADER_SIZE
+                        with open(self._index_path, "wb") as index_file:
+                            index_file.write(INDEX_MAGIC + self._header)
+                    if size <= self._end:
+                        return len(self._offsets)
+                    records = self._index(f, size)
+            except OSError as e:
+                raise PcapIndexError("Could not index {}: {}".format(self._path, e))
+
+            if records:
+                try:
+                    with open(self._index_path, "ab") as index_file:
+                        index_file.write(records)
+                except OSError as e:
+                    # the index is still valid in memory
+                    log.warning("could not save the index of {}: {}".format(self._path, e))
+            return len(self._offsets)
+
+    def _timestamp(self, f, number):
+
+        f.seek(self._offsets[number])
+        seconds, fraction, _, _ = self._record.unpack(f.read(PCAP_RECORD_HEADER_SIZE))
+        return seconds + fraction / self._divisor
+
+    def _find(self, f, timestamp, after):
+        """
+        Returns the number of the first packet at or after a time
+        (strictly after if after is True).
+        """
+
+        if after:
+            step = bisect.bisect_right(self._times, timestamp)
+        else:
+            step = bisect.bisect_left(self._times, timestamp)
+        number = max(0, (step - 1) * TIME_STEP)
+        last = min(len(self._offsets), step * TIME_STEP)
+        while number < last:
+            packet_time = self._timestamp(f, number)
+            if packet_time > timestamp or (not after and packet_time == timestamp):
+                break
+            number += 1
+        return number
+
+    def _packet_range(self, number):
+
+        start = self._offsets[number]
+        end = self._offsets[number + 1] if number + 1 < len(self._offsets) else self._end
+        return start, end
+
+    def select(self, start=None, end=None, last=None, flow=None, limit=None):
+        """
+        Selects the packets of a time range and/or flow.
+
+        :param start: first packet time (seconds since the epoch)
+        :param end: last packet time (seconds since the epoch)
+        :param last: only the last seconds of the capture
+        :param flow: FlowFilter instance
+        :param limit: maximum number of packets
+
+        :returns: tuple (PCAP file header, byte ranges [(start, end), ...], number of packets)
+        """
+
+        with self._lock:
+            if self._header is None:
+                raise PcapIndexError("{} is empty".format(self._path))
+            if last is not None and self._last_time is not None:
+                start = max(start or 0, self._last_time - last)
+
+            with open(self._path, "rb") as f:
+                first = self._find(f, start, False) if start is not None else 0
+                stop = self._find(f, end, True) if end is not None else len(self._offsets)
+
+            if flow is None:
+                numbers = range(first, stop)
+            else:
+                selected = []
+                for number, key in enumerate(self._flow_keys):
+                    if flow.match(key):
+                        packets = self._flow_packets[number]
+                        selected.append(packets[bisect.bisect_left(packets, first):bisect.bisect_left(packets, stop)])
+                numbers = heapq.merge(*selected)
+
+            ranges = []
+            count = 0
+            for number in numbers:
+                if limit is not None and count >= limit:
+                    break
+                packet_start, packet_end = self._packet_range(number)
+                if ranges and ranges[-1][1] == packet_start:
+                    # contiguous packets are read at once
+                    ranges[-1][1] = packet_end
+                else:
+                    ranges.append([packet_start, packet_end])
+                count += 1
+            return self._header, ranges, count
+
+    def summary(self, max_flows=100):
+        """
+        Returns a summary of the capture.
+
+        :param max_flows: maximum number of flows (the largest ones)
+
+        :returns: dictionary
+        """
+
+        with self._lock:
+            flows = heapq.nlargest(max_flows, range(len(self._flow_keys)), key=lambda number: len(self._flow_packets[number]))
+            summary = {"path": self._path,
+                       "packets": len(self._offsets),
+                       "size": self._end,
+                       "data_link_type": self._link_type,
+                       "first_time": self._first_time,
+                       "last_time": self._last_time,
+                       "flow_count": len(self._flow_keys),
+                       "flows": []}
+            for number in flows:
+                protocol, address, port, peer_address, peer_port = self._flow_keys[number]
+                summary["flows"].append({"protocol": protocol,
+                                         "host": _address(address),
+                                         "port": port,
+                                         "peer_host": _address(peer_address),
+                                         "peer_port": peer_port,
+                                         "packets": len(self._flow_packets[number])})
+            return summary
+
+
+class PcapIndexes(object):
+    """
+    Indexes of the captures of the projects, updated in worker threads.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+
+        self._indexes = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2)
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the indexes of this process (created on first use).
+
+        :returns: PcapIndexes instance
+        """
+
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @staticmethod
+    def capture_path(path):
+        """
+        Checks a capture is in the projects directory.
+
+        :param path: path to the capture file
+
+        :returns: real path to the capture file
+        """
+
+        server_config = Config.instance().get_default_section()
+        projects_dir = os.path.expandvars(os.path.expanduser(server_config.get("projects_directory", "~/GNS3/projects")))
+        projects_dir = os.path.realpath(projects_dir)
+        real_path = os.path.realpath(os.path.join(projects_dir, path))
+        if not real_path.startswith(projects_dir + os.sep):
+            raise PcapIndexError("{} is not in the projects directory".format(path))
+        if not os.path.isfile(real_path):
+            raise PcapIndexError("Capture {} doesn't exist".format(path))
+        return real_path
+
+    def get(self, path):
+        """
+        Returns the up-to-date index of a capture.
+
+        :param path: path to the capture file (absolute or relative to the projects directory)
+
+        :returns: PcapIndex instance
+        """
+
+        path = self.capture_path(path)
+        with self._lock:
+            index = self._indexes.pop(path, None)
+            if index is None:
+                index = PcapIndex(path)
+            self._indexes[path] = index
+            while len(self._indexes) > MAX_INDEXES:
+                self._indexes.popitem(last=False)
+        index.update()
+        return index
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Runs an index operation in a worker thread (indexing a large
+        capture for the first time can take a while).
+
+        :param function: callable
+
+        :returns: concurrent.futures.Future instance
+        """
+
+        return self._executor.submit(function, *args, **kwargs)
+
+    def select(self, path, **kwargs):
+        """
+        Selects packets of a capture (see PcapIndex.select()).
+
+        :param path: path to the capture file
+
+        :returns: concurrent.futures.Future instance
+        """
+
+        return self.submit(lambda: self.get(path).select(**kwargs))
+
+    def summary(self, path, max_flows=100):
+        """
+        Returns the summary of a capture (see PcapIndex.summary()).
+
+        :param path: path to the capture file
+        :param max_flows: maximum number of flows
+
+        :returns: concurrent.futures.Future instance
+        """
+
+        return self.submit(lambda: self.get(path).summary(max_flows))
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Privileged helper relaying frames between TAP or host Ethernet interfaces
+and UDP tunnels on the loopback interface. Only this small program needs
+access to the raw devices (root, sudo or CAP_NET_RAW/CAP_NET_ADMIN), the
+server itself runs unprivileged and talks to it with its standard input
+and output, one command per line:
+
+    open <link ID> tap|ethernet <device> <UDP port>
+        -> ok <link ID> <UDP port of the helper> or error <link ID> <message>
+    close <link ID>
+        -> ok <link ID>
+
+The helper exits when its standard input is closed. It only depends on
+the standard library so it can be installed and audited on its own.
+"""
+
+import os
+import sys
+import errno
+import socket
+import select
+import struct
+
+# Maximum size of a frame
+MAX_FRAME_SIZE = 65535
+
+# from linux/if_tun.h
+TUNSETIFF = 0x400454ca
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+
+# from linux/if_ether.h and linux/if_packet.h
+ETH_P_ALL = 0x0003
+PACKET_OUTGOING = 4
+
+
+class RawRelayError(Exception):
+    pass
+
+
+class TAPDevice(object):
+    """
+    TAP interface (Linux only).
+
+    :param tap_device: TAP device name (e.g. tap0)
+    """
+
+    def __init__(self, tap_device):
+
+        if not sys.platform.startswith("linux"):
+            raise RawRelayError("TAP interfaces are not supported on this platform")
+
+        import fcntl
+        try:
+            self._fd = os.open("/dev/net/tun", os.O_RDWR | os.O_NONBLOCK)
+        except OSError as e:
+            raise RawRelayError("Could not open /dev/net/tun: {}".format(e))
+        try:
+            fcntl.ioctl(self._fd, TUNSETIFF, struct.pack("16sH", tap_device.encode("utf-8"), IFF_TAP | IFF_NO_PI))
+        except OSError as e:
+            os.close(self._fd)
+            raise RawRelayError("Could not attach to TAP device {}: {}".format(tap_device, e))
+
+    def fileno(self):
+
+        return self._fd
+
+    def read(self):
+
+        return os.read(self._fd, MAX_FRAME_SIZE)
+
+    def write(self, frame):
+
+        os.write(self._fd, frame)
+
+    def close(self):
+
+        os.close(self._fd)
+
+
+class EthernetDevice(object):
+    """
+    Host Ethernet interface using a raw packet socket (Linux only).
+
+    :param ethernet_device: Ethernet device name (e.g. eth0)
+    """
+
+    def __init__(self, ethernet_device):
+
+        if not hasattr(socket, "AF_PACKET"):
+            raise RawRelayError("Raw Ethernet access is not supported on this platform")
+        try:
+            self._socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        except OSError as e:
+            raise RawRelayError("Could not create a raw socket: {}".format(e))
+        try:
+            self._socket.bind((ethernet_device, 0))
+        except OSError as e:
+            self._socket.close()
+            raise RawRelayError("Could not bind to Ethernet device {}: {}".format(ethernet_device, e))
+        self._socket.setblocking(False)
+
+    def fileno(self):
+
+        return self._socket.fileno()
+
+    def read(self):
+
+        frame, address = self._socket.recvfrom(MAX_FRAME_SIZE)
+        if address[2] == PACKET_OUTGOING:
+            return None  # sent by the host
+        return frame
+
+    def write(self, frame):
+
+        self._socket.send(frame)
+
+    def close(self):
+
+        self._socket.close()
+
+
+DEVICES = {"tap": TAPDevice, "ethernet": EthernetDevice}
+
+
+class Link(object):
+    """
+    Relays the frames between a device and an UDP tunnel to the server.
+
+    :param device: TAPDevice or EthernetDevice instance
+    :param port: UDP port of the server on the loopback interface
+    """
+
+    def __init__(self, device, port):
+
+        self.device = device
+        self.tunnel = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.tunnel.bind(("127.0.0.1", 0))
+        self.tunnel.connect(("127.0.0.1", port))
+        self.tunnel.setblocking(False)
+
+    @property
+    def port(self):
+
+        return self.tunnel.getsockname()[1]
+
+    def from_device(self):
+
+        frame = self.device.read()
+        if frame:
+            self.tunnel.send(frame)
+
+    def from_tunnel(self):
+
+        self.device.write(self.tunnel.recv(MAX_FRAME_SIZE))
+
+    def close(self):
+
+        self.tunnel.close()
+        self.device.close()
+
+
+class RawRelay(object):
+    """
+    Command loop of the helper.
+
+    :param control_in: file descriptor of the commands
+    :param control_out: file object for the replies
+    """
+
+    def __init__(self, control_in, control_out):
+
+        self._control_in = control_in
+        self._control_out = control_out
+        self._pending = b""
+        self._links = {}
+        self._poller = select.poll()
+        self._handlers = {}
+
+    def _reply(self, *args):
+
+        self._control_out.write(" ".join(str(arg) for arg in args) + "\n")
+        self._control_out.flush()
+
+    def _open(self, link_id, kind, device, port):
+
+        if link_id in self._links:
+            self._close(link_id)
+        if kind not in DEVICES:
+            raise RawRelayError("Unknown device type {}".format(kind))
+        device = DEVICES[kind](device)
+        try:
+            link = Link(device, int(port))
+        except (OSError, ValueError) as e:
+            device.close()
+            raise RawRelayError("Could not create the UDP tunnel: {}".format(e))
+        self._links[link_id] = link
+        self._register(device.fileno(), link.from_device)
+        self._register(link.tunnel.fileno(), link.from_tunnel)
+        return link.port
+
+    def _register(self, fd, handler):
+
+        self._handlers[fd] = handler
+        self._poller.register(fd, select.POLLIN)
+
+    def _unregister(self, fd):
+
+        del self._handlers[fd]
+        self._poller.unregister(fd)
+
+    def _close(self, link_id):
+
+        link = self._links.pop(link_id, None)
+        if link:
+            self._unregister(link.device.fileno())
+            self._unregister(link.tunnel.fileno())
+            link.close()
+
+    def _command(self, line):
+
+        args = line.split()
+        if len(args) < 2:
+            return
+        command, link_id = args[0], args[1]
+        try:
+            if command == "open" and len(args) == 5:
+                self._reply("ok", link_id, self._open(link_id, *args[2:]))
+            elif command == "close":
+                self._close(link_id)
+                self._reply("ok", link_id)
+            else:
+                raise RawRelayError("Invalid command: {}".format(line))
+        except RawRelayError as e:
+            self._reply("error", link_id, e)
+
+    def _read_commands(self):
+
+        data = os.read(self._control_in, 4096)
+        if not data:
+            return False
+        self._pending += data
+        while b"\n" in self._pending:
+            line, self._pending = self._pending.split(b"\n", 1)
+            self._command(line.decode("utf-8", errors="replace"))
+        return True
+
+    def run(self):
+        """
+        Relays the frames until the standard input is closed.
+        """
+
+        self._poller.register(self._control_in, select.POLLIN)
+        try:
+            while True:
+                try:
+                    events = self._poller.poll()
+                except InterruptedError:
+                    continue
+                for fd, event in events:
+                    if fd == self._control_in:
+                        if not self._read_commands():
+                            return
+                        continue
+                    handler = self._handlers.get(fd)
+                    if handler is None:
+                        continue  # closed by a command of the same batch
+                    try:
+                        handler()
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    except OSError as e:
+                        # e.g. the server is not listening yet or the interface is down
+                        if e.errno not in (errno.ECONNREFUSED, errno.ENETDOWN, errno.ENXIO, errno.EIO):
+                            sys.stderr.write("gns3-raw-relay: {}\n".format(e))
+        finally:
+            for link_id in list(self._links):
+                self._close(link_id)
+
+
+def main():
+    """
+    Entry point of the helper.
+    """
+
+    RawRelay(sys.stdin.fileno(), sys.stdout).run()
+
+
+if __name__ == "__main__":
+    main()
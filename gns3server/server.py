@@ -43,8 +43,14 @@ from .handlers.jsonrpc_websocket import JSONRPCWebSocket
 from .handlers.version_handler import VersionHandler
 from .handlers.file_upload_handler import FileUploadHandler
 from .handlers.auth_handler import LoginHandler
+from .handlers.capture_handler import CaptureHandler
 from .builtins.server_version import server_version
 from .builtins.interfaces import interfaces
+from .builtins.project import project_start_all
+from .builtins.project import project_stop_all
+from .builtins.queues import module_queues
+from .module_queue import CHECK_INTERVAL
+from .builtins.captures import capture_index
 from .modules import MODULES
 
 import logging
@@ -56,6 +62,7 @@ class Server(object):
     # built-in handlers
     handlers = [(r"/version", VersionHandler),
                 (r"/upload", FileUploadHandler),
+                (r"/capture", CaptureHandler),
                 (r"/login", LoginHandler)]
 
     def __init__(self, host, port, ipc, console_bind_to_any):
@@ -134,21 +141,41 @@ class Server(object):
         JSONRPCWebSocket.register_destination("builtin.version", server_version)
         # special built-in to return the available interfaces on this host
         JSONRPCWebSocket.register_destination("builtin.interfaces", interfaces)
+        # special built-ins to start or stop many nodes in parallel
+        JSONRPCWebSocket.register_destination("builtin.project.start_all", project_start_all)
+        JSONRPCWebSocket.register_destination("builtin.project.stop_all", project_stop_all)
+        # special built-in to return the state of the module queues
+        JSONRPCWebSocket.register_destination("builtin.queues", module_queues)
+        # special built-in to return the summary of a packet capture (packets are retrieved with /capture)
+        JSONRPCWebSocket.register_destination("builtin.capture_index", capture_index)
 
+        config = Config.instance()
         for module in MODULES:
-            instance = module(module.__name__.lower(),
-                              "127.0.0.1",  # ZeroMQ server address
-                              self._zmq_port,  # ZeroMQ server port
-                              host=self._host,  # server host address
-                              console_host=self._console_host,
-                              projects_dir=self._projects_dir,
-                              temp_dir=self._temp_dir)
-
-            self._modules.append(instance)
-            destinations = instance.destinations()
-            for destination in destinations:
-                JSONRPCWebSocket.register_destination(destination, instance.name)
-            instance.start()  # starts the new process
+            name = module.__name__.lower()
+            # a module can run in several processes (shards) to use more CPU cores
+            shards = max(1, int(config.get_section_config(name.upper()).get("shards", 1)))
+            identities = []
+            for shard in range(shards):
+                instance = module(name,
+                                  "127.0.0.1",  # ZeroMQ server address
+                                  self._zmq_port,  # ZeroMQ server port
+                                  host=self._host,  # server host address
+                                  console_host=self._console_host,
+                                  projects_dir=self._projects_dir,
+                                  temp_dir=self._temp_dir,
+                                  shard=shard,
+                                  shards=shards)
+
+                self._modules.append(instance)
+                identities.append(instance.identity)
+                if shard == 0:
+                    destinations = instance.destinations()
+                    for destination in destinations:
+                        JSONRPCWebSocket.register_destination(destination, instance.name)
+                instance.start()  # starts the new process
+            JSONRPCWebSocket.register_shards(name, identities)
+            if shards > 1:
+                log.info("{} module running in {} processes".format(name, shards))
 
     def run(self):
         """
@@ -218,6 +245,8 @@ class Server(object):
         self._stream = zmqstream.ZMQStream(router, ioloop)
         self._stream.on_recv_stream(JSONRPCWebSocket.dispatch_message)
         tornado.autoreload.add_reload_hook(self._reload_callback)
+        queue_check = tornado.ioloop.PeriodicCallback(JSONRPCWebSocket.check_queues, CHECK_INTERVAL * 1000)
+        queue_check.start()
 
         def signal_handler(signum=None, frame=None):
             try:
@@ -252,6 +281,11 @@ class Server(object):
         context = zmq.Context()
         context.linger = 0
         self._router = context.socket(zmq.ROUTER)
+        # requests are queued by the server (see ModuleQueue), the high-water
+        # marks only bound the messages in transit
+        hwm = int(Config.instance().get_default_section().get("zmq_hwm", 1000))
+        self._router.setsockopt(zmq.SNDHWM, hwm)
+        self._router.setsockopt(zmq.RCVHWM, hwm)
         if self._ipc:
             try:
                 self._router.bind("ipc:///tmp/gns3.ipc")
@@ -274,7 +308,7 @@ class Server(object):
         """
         Stop a given module.
 
-        :param module: module name
+        :param module: module identity (one per shard)
         """
 
         if not self._router.closed:
@@ -319,12 +353,12 @@ class Server(object):
         # terminate all modules
         for module in self._modules:
             if module.is_alive() and graceful:
-                log.info("stopping {}".format(module.name))
-                self.stop_module(module.name)
+                log.info("stopping {}".format(module.identity))
+                self.stop_module(module.identity)
                 module.join(timeout=3)
             if module.is_alive():
                 # just kill the module if it is still alive.
-                log.info("terminating {}".format(module.name))
+                log.info("terminating {}".format(module.identity))
                 module.terminate()
                 module.join(timeout=1)
 
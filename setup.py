@@ -55,6 +55,7 @@ setup(
         "console_scripts": [
             "gns3server = gns3server.main:main",
             "gns3dms = gns3dms.main:main",
+            "gns3-raw-relay = gns3server.raw_relay:main",
         ]
     },
     packages=find_packages(),
@@ -77,6 +77,23 @@ def test_set_qinq_port(ethsw):
     nio.delete()
 
 
+def test_update_mapping(ethsw):
+
+    nio1 = NIO_Null(ethsw.hypervisor)
+    nio2 = NIO_Null(ethsw.hypervisor)
+    ethsw.add_nio(nio1, 0)  # add NIO on port 0
+    ethsw.add_nio(nio2, 1)  # add NIO on port 1
+    ethsw.set_access_port(0, 1)
+    ethsw.set_access_port(1, 1)
+    assert ethsw.update_mapping({0: ("access", 1), 1: ("dot1q", 1)}) == [1]  # only port 1 has changed
+    assert ethsw.mapping[1] == ("dot1q", 1)
+    assert ethsw.update_mapping({0: ("access", 1), 1: ("dot1q", 1)}) == []
+    ethsw.remove_nio(0)
+    ethsw.remove_nio(1)
+    nio1.delete()
+    nio2.delete()
+
+
 def test_get_mac_addr_table(ethsw):
 
     assert not ethsw.get_mac_addr_table()  # MAC address table should be empty
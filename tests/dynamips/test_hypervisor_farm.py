@@ -0,0 +1,173 @@
+from gns3server.modules.dynamips import HypervisorManager
+from gns3server.modules.dynamips import DynamipsError
+import threading
+import socket
+import time
+import pytest
+
+
+class FakeHypervisor(object):
+    """
+    Stand-in for a Dynamips hypervisor: answers the commands with OK.
+    """
+
+    def __init__(self, host, port=0):
+
+        self.commands = []
+        self._next_udp_port = 0
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(5)
+        self.host, self.port = self._server.getsockname()
+        self._clients = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+
+        while True:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return
+            self._clients.append(client)
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _reply(self, command):
+
+        if command == "hypervisor version":
+            return "100-0.2.14"
+        if command.startswith("nio create_udp_auto"):
+            port = int(command.split()[4]) + self._next_udp_port
+            self._next_udp_port += 1
+            return "100-{}".format(port)
+        return "100-OK"
+
+    def _serve(self, client):
+
+        buf = b""
+        while True:
+            try:
+                data = client.recv(1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while b"\n" in buf:
+                line, buf = buf.split(b"\n", 1)
+                command = line.decode().strip()
+                self.commands.append(command)
+                client.sendall((self._reply(command) + "\r\n").encode())
+
+    def close(self):
+
+        try:
+            # wakes up the thread waiting in accept()
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        for client in self._clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+
+
+@pytest.fixture
+def farm(request):
+
+    hypervisors = [FakeHypervisor("127.0.0.2"), FakeHypervisor("127.0.0.3"), FakeHypervisor("127.0.0.4")]
+    request.addfinalizer(lambda: [hypervisor.close() for hypervisor in hypervisors])
+    return hypervisors
+
+
+@pytest.fixture
+def manager(request, tmpdir):
+
+    manager = HypervisorManager("/nonexistent/dynamips", str(tmpdir), "127.0.0.1")
+    request.addfinalizer(manager.stop_all_hypervisors)
+    return manager
+
+
+def test_placement(farm, manager):
+
+    small = manager.add_remote_hypervisor(farm[0].host, farm[0].port, ram=512, cpus=4)
+    large = manager.add_remote_hypervisor(farm[1].host, farm[1].port, ram=2048, cpus=4)
+    assert small.healthy and large.healthy
+    assert "hypervisor working_dir \"{}\"".format(manager.working_dir) in farm[0].commands
+
+    # the least loaded hypervisor (RAM or CPU) is chosen
+    assert manager.allocate_hypervisor_for_router("c3725.image", 256) is large
+    assert manager.allocate_hypervisor_for_router("c3725.image", 1024) is large
+    assert manager.allocate_hypervisor_for_router("c3725.image", 256) is small
+    # does not fit on the small one
+    assert manager.allocate_hypervisor_for_router("c3725.image", 512) is large
+    assert small.memory_load == 256 and large.memory_load == 1792
+    assert manager.hypervisors == [large, small]
+
+    # no local Dynamips to fall back to
+    with pytest.raises(DynamipsError):
+        manager.allocate_hypervisor_for_router("c3725.image", 512)
+
+    status = {(report["host"], report["port"]): report for report in manager.farm_status()}
+    assert status[(farm[1].host, farm[1].port)]["memory_load"] == 1792
+    assert status[(farm[0].host, farm[0].port)]["in_use"]
+
+    # stopping resets the remote hypervisor which keeps running
+    manager.stop_all_hypervisors()
+    assert "hypervisor reset" in farm[1].commands
+    assert "hypervisor stop" not in farm[1].commands
+    assert large.memory_load == 0 and not large.started
+
+
+def check_farm(manager):
+
+    # the module loop: the callbacks run once the probes are done
+    callbacks = []
+    manager.check_farm(lambda future, callback: callbacks.append((future, callback)))
+    for future, callback in callbacks:
+        future.exception(timeout=10)
+        callback(future)
+    return manager.unhealthy_hypervisors()
+
+
+def test_health_check(farm, manager):
+
+    hypervisor = manager.add_remote_hypervisor(farm[2].host, farm[2].port, ram=1024)
+    assert check_farm(manager) == []
+    # the probes use a connection of their own
+    assert farm[2].commands.count("hypervisor version") == 2
+
+    host, port = farm[2].host, farm[2].port
+    farm[2].close()
+    assert check_farm(manager) == [hypervisor]
+    assert not hypervisor.is_running()
+    assert "unreachable" in hypervisor.read_stdout()
+    # unhealthy hypervisors are not used
+    assert manager._allocate_remote_hypervisor(128) is None
+
+    # the connection is opened again once the hypervisor is back
+    farm[2] = FakeHypervisor(host, port)
+    time.sleep(1.1)
+    assert check_farm(manager) == []
+    assert manager.allocate_hypervisor_for_router("c3725.image", 128) is hypervisor
+
+
+def test_udp_peer_address(farm, manager):
+
+    first = manager.add_remote_hypervisor(farm[0].host, farm[0].port)
+    second = manager.add_remote_hypervisor(farm[1].host, farm[1].port)
+    first.start()
+    second.start()
+    port = first.allocate_udp_port()
+
+    # the client only knows this server, the port is on the first remote hypervisor
+    assert manager.udp_peer_address(second, "127.0.0.1", port) == farm[0].host
+    assert manager.udp_peer_address(second, farm[0].host, port) == farm[0].host
+    # the other end is on this server
+    assert manager.udp_peer_address(second, "127.0.0.1", 30000) not in (farm[0].host, farm[1].host)
+    # other hosts are left alone
+    assert manager.udp_peer_address(second, "192.168.1.1", 30000) == "192.168.1.1"
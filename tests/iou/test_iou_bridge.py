@@ -0,0 +1,51 @@
+from gns3server.modules.iou.iou_bridge import IOUBridge, IOU_HEADER, iou_port_number
+from gns3server.modules.iou.nios.nio_udp import NIO_UDP
+import os
+import socket
+
+
+def test_relay(tmpdir):
+
+    bridge = IOUBridge(shards=1)
+    netio = "/tmp/netio{}".format(os.getuid())
+    os.makedirs(netio, exist_ok=True)
+    iou_path = os.path.join(netio, "500")
+    if os.path.exists(iou_path):
+        os.unlink(iou_path)
+
+    # fake IOU instance 500 and remote end of the UDP tunnel
+    iou = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    iou.bind(iou_path)
+    iou.settimeout(2)
+    peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    peer.bind(("127.0.0.1", 0))
+    peer.settimeout(2)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        lport = sock.getsockname()[1]
+
+    try:
+        bridge.add_instance(500)
+        bridge.add_link(500, 1, 2, NIO_UDP(lport, "127.0.0.1", peer.getsockname()[1]))
+        capture = str(tmpdir / "test.pcap")
+        bridge.start_capture(500, 1, 2, capture)
+
+        port = iou_port_number(1, 2)
+        iou.sendto(IOU_HEADER.pack(1012, 500, port, port, 1, 0) + b"frame1", os.path.join(netio, "1012"))
+        assert peer.recv(100) == b"frame1"
+
+        peer.sendto(b"frame2", ("127.0.0.1", lport))
+        data = iou.recv(100)
+        assert IOU_HEADER.unpack(data[:8]) == (500, 1012, port, port, 1, 0)
+        assert data[8:] == b"frame2"
+
+        bridge.stop_capture(500, 1, 2)
+        assert os.path.getsize(capture) == 24 + 2 * (16 + 6)
+
+        bridge.remove_instance(500)
+        assert not os.path.exists(os.path.join(netio, "1012"))
+    finally:
+        bridge.stop()
+        iou.close()
+        peer.close()
+        os.unlink(iou_path)
@@ -0,0 +1,31 @@
+from gns3server.modules.iou.iou_image_cache import IOUImageCache
+import os
+
+
+def test_options_cache(tmpdir):
+
+    runs = str(tmpdir / "runs")
+    image = str(tmpdir / "image")
+    with open(image, "w") as f:
+        f.write("#!/bin/sh\n")
+        f.write("echo run >> {}\n".format(runs))
+        f.write("echo '-l            Enable Layer 1 keepalive messages'\n")
+    os.chmod(image, 0o755)
+
+    cache_path = str(tmpdir / "cache.json")
+    cache = IOUImageCache(cache_path)
+    assert not cache.elf_header_valid(image)
+    assert cache.options(image)["-l"] == "Enable Layer 1 keepalive messages"
+    cache.options(image)
+
+    # persisted across restarts
+    cache = IOUImageCache(cache_path)
+    assert "-l" in cache.options(image)
+    with open(runs) as f:
+        assert f.read().count("run") == 1
+
+    # invalidated when the image changes
+    os.utime(image, ns=(0, 0))
+    cache.options(image)
+    with open(runs) as f:
+        assert f.read().count("run") == 2
@@ -0,0 +1,23 @@
+from gns3server.admission import AdmissionController
+from gns3server.modules.attic import call_in_parallel
+import time
+
+
+def test_concurrency_cap():
+
+    admission = AdmissionController(max_concurrency=2, max_cpu_usage=100, min_available_memory=0)
+    assert admission.admit(1)[0]
+    assert not admission.admit(2)[0]
+
+
+def test_call_in_parallel():
+
+    def function(item):
+        if item == 2:
+            raise ValueError("failed")
+        time.sleep(item)
+
+    start = time.time()
+    failures = call_in_parallel(function, [0.5, 0.5, 2, 5], timeout=1)
+    assert time.time() - start < 2
+    assert sorted(item for item, _ in failures) == [2, 5]
@@ -0,0 +1,70 @@
+from gns3server.modules.cgroups import CgroupManager, NodeResources
+import os
+import pytest
+
+
+@pytest.fixture
+def cgroupfs(tmpdir):
+
+    tmpdir.join("cgroup.controllers").write("cpuset cpu io memory pids")
+    return tmpdir
+
+
+def read(path):
+
+    with open(str(path)) as f:
+        return f.read()
+
+
+def test_attach(cgroupfs):
+
+    resources = NodeResources("vpcs-1", CgroupManager(str(cgroupfs)))
+    resources.update({"cpu_limit": 50, "memory_limit": 64})
+    assert resources.attach(1234)
+    assert resources.attached
+    assert cgroupfs.join("gns3", "cgroup.subtree_control").check()
+    node = cgroupfs.join("gns3", "vpcs-1")
+    assert read(node.join("cgroup.procs")) == "1234"
+    assert read(node.join("cpu.max")) == "50000 100000"
+    assert read(node.join("memory.max")) == str(64 * 1024 * 1024)
+
+    # applied immediately while the process is running
+    resources.update({"cpu_limit": 0})
+    assert read(node.join("cpu.max")) == "max 100000"
+
+    node.join("cpu.stat").write("usage_usec 1500\nuser_usec 1000\nsystem_usec 500\nnr_periods 3\nnr_throttled 2\nthrottled_usec 42\n")
+    node.join("memory.current").write("4096\n")
+    usage = resources.usage()
+    assert usage["usage_usec"] == 1500
+    assert usage["throttled_usec"] == 42
+    assert usage["memory_current"] == 4096
+    assert "nr_periods" not in usage
+
+    resources.release()
+    assert not resources.attached
+    assert not os.path.exists(str(node))
+
+
+def test_defaults(cgroupfs):
+
+    resources = NodeResources("qemu-vm-1", CgroupManager(str(cgroupfs)))
+    resources.set_defaults({"cpu_limit": 20, "cpu_weight": 50})
+    resources.update({"cpu_weight": 500})
+    assert resources.settings == {"cpu_weight": 500}
+    assert resources.attach(1234)
+    node = cgroupfs.join("gns3", "qemu-vm-1")
+    assert read(node.join("cpu.max")) == "20000 100000"
+    assert read(node.join("cpu.weight")) == "500"
+
+    # explicit settings take precedence over the defaults
+    resources.set_defaults({"cpu_limit": 30, "cpu_weight": 10})
+    assert read(node.join("cpu.max")) == "30000 100000"
+    assert read(node.join("cpu.weight")) == "500"
+
+
+def test_not_available(tmpdir):
+
+    resources = NodeResources("iou-1", CgroupManager(str(tmpdir)))
+    resources.update({"cpu_limit": 50})
+    assert not resources.attach(1234)
+    assert resources.usage() == {}
@@ -0,0 +1,92 @@
+from gns3server.modules.console_hub import ConsoleBuffer, ConsoleHub, SocketConsole
+from gns3server.modules.console_hub import IAC, WILL, DO, NOP, ECHO, BINARY
+import select
+import socket
+import time
+import pytest
+
+
+def test_console_buffer():
+
+    buffer = ConsoleBuffer(8)
+    assert buffer.read() == b""
+    buffer.write(b"abc")
+    assert buffer.read() == b"abc"
+    buffer.write(b"defgh")
+    assert buffer.read() == b"abcdefgh"
+    buffer.write(b"ij")
+    assert buffer.read() == b"cdefghij"
+    assert buffer.read(3) == b"hij"
+    buffer.write(memoryview(b"0123456789"))
+    assert buffer.read() == b"23456789"
+    buffer.clear()
+    assert len(buffer) == 0
+
+
+def test_console_replay():
+
+    scrollback = ConsoleBuffer(1024)
+    pipe, vm = socket.socketpair()
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    server.close()
+
+    console = SocketConsole("VM1", pipe, "127.0.0.1", port, scrollback=scrollback)
+    console.start()
+    try:
+        vm.send(b"booting...")
+        time.sleep(0.2)
+        assert scrollback.read() == b"booting..."
+
+        client = socket.create_connection(("127.0.0.1", port))
+        client.settimeout(2)
+        data = b""
+        while not data.endswith(b"booting..."):
+            data += client.recv(1024)
+        client.close()
+    finally:
+        console.stop()
+        vm.close()
+
+
+def read_until(sock, end):
+
+    data = b""
+    while not data.endswith(end):
+        data += sock.recv(1024)
+    return data
+
+
+@pytest.mark.skipif(not hasattr(select, "epoll"), reason="epoll is only available on Linux")
+def test_console_round_trip():
+
+    hub = ConsoleHub()
+    hub.start()
+    assert isinstance(hub._poller, select.epoll)
+    pipe, vm = socket.socketpair()
+    vm.settimeout(2)
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    server.close()
+
+    console = SocketConsole("VM1", pipe, "127.0.0.1", port, crlf_to_lf=True)
+    console.start(hub)
+    try:
+        client = socket.create_connection(("127.0.0.1", port))
+        client.settimeout(2)
+        # wait for the Telnet negotiation: the client is registered with the hub
+        assert read_until(client, bytes([IAC, DO, BINARY])).startswith(bytes([IAC, WILL, ECHO]))
+
+        # device to Telnet client
+        vm.sendall(b"Router>")
+        assert read_until(client, b"Router>") == b"Router>"
+
+        # Telnet client to device, without the Telnet commands
+        client.sendall(bytes([IAC, NOP]) + b"show version\r\n")
+        assert read_until(vm, b"\n") == b"show version\n"
+        client.close()
+    finally:
+        console.stop()
+        vm.close()
@@ -0,0 +1,88 @@
+from gns3server.modules.console_hub import ConsoleBuffer, IAC, WILL, ECHO
+from gns3server.modules.console_watcher import PatternMatcher, ConsoleWatcher, ConsoleWatchError
+import threading
+import socket
+import pytest
+
+
+def test_pattern_matcher():
+
+    matcher = PatternMatcher({1: b"he", 2: b"she", 3: b"hers"})
+    assert matcher.feed(b"ushe") == [2, 1]
+    # a pattern split across two reads
+    assert matcher.feed(memoryview(b"rs")) == [3]
+    assert matcher.feed(b"xyz") == []
+
+
+def test_console_watcher():
+
+    matches = []
+    scrollback = ConsoleBuffer(1024)
+    watcher = ConsoleWatcher("R1", lambda watch_id, pattern, context: matches.append((watch_id, pattern, context)), scrollback)
+
+    scrollback.write(b"Router>")
+    watch_id = watcher.add("Router>", context="session")
+    assert matches == [(watch_id, "Router>", "session")]
+    assert not watcher.armed
+
+    boot_id = watcher.add("Press RETURN to get started")
+    login_id = watcher.add("login:", once=False)
+    watcher.feed(b"...Press RETURN to ")
+    watcher.feed(b"get started\r\nlogin: login:")
+    assert matches[1:] == [(boot_id, "Press RETURN to get started", None),
+                           (login_id, "login:", None),
+                           (login_id, "login:", None)]
+    assert watcher.watches == {login_id: "login:"}
+    assert watcher.remove(login_id)
+    assert not watcher.remove(login_id)
+    assert not watcher.armed
+
+
+def test_pending_pattern():
+
+    matches = []
+    watcher = ConsoleWatcher("R1", lambda watch_id, pattern, context: matches.append(watch_id))
+    login_id = watcher.add("login:")
+    boot_id = watcher.add("started")
+
+    # "login:" is split across the reads while "started" matches
+    watcher.feed(b"started\r\nlog")
+    watcher.feed(b"in:")
+    assert matches == [boot_id, login_id]
+
+    # a pattern is registered while "Password:" is split across the reads
+    password_id = watcher.add("Password:")
+    watcher.feed(b"Pass")
+    prompt_id = watcher.add("Router#")
+    watcher.feed(b"word:")
+    assert matches[2:] == [password_id]
+    assert watcher.watches == {prompt_id: "Router#"}
+
+
+def test_console_tap():
+
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    matched = threading.Event()
+    watcher = ConsoleWatcher("VM1", lambda watch_id, pattern, context: matched.set(), tapped=True)
+    watcher.tap("0.0.0.0", port)
+    # the only client slot of the console is not taken implicitly
+    with pytest.raises(ConsoleWatchError):
+        watcher.add("login:")
+    watcher.add("login:", take_console=True)
+    try:
+        server.settimeout(2)
+        client, _ = server.accept()
+        # Telnet negotiation in the middle of the pattern
+        client.sendall(b"log" + bytes([IAC, WILL, ECHO]) + b"in:")
+        assert matched.wait(2)
+        client.settimeout(2)
+        # the tap is disconnected once nothing is watched
+        assert client.recv(1024) == b""
+        client.close()
+    finally:
+        watcher.untap()
+        server.close()
@@ -0,0 +1,96 @@
+from gns3server.modules.fabric import EthernetSwitch, Hub
+from gns3server.modules.fabric.ports import Port
+from gns3server.modules.dynamips import DynamipsError, NIO_TAP, NIO_GenericEthernet, NIO_LinuxEthernet, NIO_UNIX
+from gns3server.modules.dynamips.native_hypervisor import NativeHypervisor
+import pytest
+import struct
+
+
+class FakePort(Port):
+
+    def __init__(self, name):
+
+        Port.__init__(self, name)
+        self.frames = []
+
+    def send(self, frame):
+
+        Port.send(self, frame)
+        self.frames.append(bytes(frame))
+
+
+def mac(n):
+
+    return bytes([0, 0, 0, 0, 0, n])
+
+
+def frame(dst, src):
+
+    return memoryview(dst + src + b"\x08\x00" + b"\x00" * 46)
+
+
+def test_ethernet_switch():
+
+    switch = EthernetSwitch("SW1")
+    ports = [FakePort("p{}".format(i)) for i in range(4)]
+    for port in ports:
+        switch.add_port(port)
+    switch.set_port(ports[0], "access", 10)
+    switch.set_port(ports[1], "access", 10)
+    switch.set_port(ports[2], "access", 20)
+    switch.set_port(ports[3], "dot1q", 1)
+
+    # unknown destination: flooded in VLAN 10, tagged on the trunk
+    switch.receive(ports[0], frame(mac(2), mac(1)))
+    assert len(ports[1].frames) == 1
+    assert not ports[2].frames
+    assert ports[3].frames[0][12:16] == struct.pack("!HH", 0x8100, 10)
+
+    # learned destination: only sent to port 0
+    switch.receive(ports[1], frame(mac(1), mac(2)))
+    assert len(ports[0].frames) == 1
+    assert len(ports[3].frames) == 1
+
+    # tagged frame from the trunk is untagged on the access port
+    tagged = mac(1) + mac(3) + struct.pack("!HH", 0x8100, 10) + b"\x08\x00" + b"\x00" * 46
+    switch.receive(ports[3], memoryview(tagged))
+    assert ports[0].frames[-1] == bytes(frame(mac(1), mac(3)))
+
+    assert len(switch.mac_address_table()) == 3
+    switch.expire(float("inf"))
+    assert not switch.mac_address_table()
+
+
+def test_hub():
+
+    hub = Hub("HUB1")
+    ports = [FakePort("p{}".format(i)) for i in range(3)]
+    for port in ports:
+        hub.add_port(port)
+    hub.receive(ports[0], frame(mac(2), mac(1)))
+    assert not ports[0].frames
+    assert len(ports[1].frames) == 1
+    assert len(ports[2].frames) == 1
+
+
+def test_native_hypervisor_nios(tmpdir, monkeypatch):
+
+    hypervisor = NativeHypervisor(str(tmpdir), "127.0.0.1", shards=1)
+    ports = []
+    monkeypatch.setattr(hypervisor.fabric, "create_tap_port", lambda name, device: ports.append(("tap", device)))
+    monkeypatch.setattr(hypervisor.fabric, "create_ethernet_port", lambda name, device: ports.append(("ethernet", device)))
+    try:
+        NIO_TAP(hypervisor, "tap0")
+        NIO_GenericEthernet(hypervisor, "eth0")
+        NIO_LinuxEthernet(hypervisor, "eth1")
+        assert ports == [("tap", "tap0"), ("ethernet", "eth0"), ("ethernet", "eth1")]
+        monkeypatch.undo()
+
+        # errors from the fabric, not an unsupported command
+        with pytest.raises(DynamipsError) as e:
+            NIO_LinuxEthernet(hypervisor, "nonexistent0")
+        assert "not supported by the native switching engine" not in str(e.value)
+        with pytest.raises(DynamipsError):
+            NIO_UNIX(hypervisor, str(tmpdir / "local"), str(tmpdir / "remote"))
+    finally:
+        hypervisor.stop()
@@ -0,0 +1,69 @@
+from gns3server.modules.image_cache import ImageCache, ImageCacheError, LocalStorage, gather
+import hashlib
+import threading
+import os
+import pytest
+
+
+class SlowStorage(LocalStorage):
+
+    def __init__(self, root):
+
+        LocalStorage.__init__(self, root)
+        self.downloads = []
+        self.release = threading.Event()
+
+    def iter_file(self, file_name, chunk_size):
+
+        self.downloads.append(file_name)
+        self.release.wait(5)
+        return LocalStorage.iter_file(self, file_name, 3)
+
+
+@pytest.fixture
+def storage(tmpdir):
+
+    images = tmpdir.mkdir("storage").mkdir("images")
+    content = b"IOS image content"
+    images.join("c7200.image").write(content, mode="wb")
+    images.join("c7200.image.md5").write(hashlib.md5(content).hexdigest())
+    # same content with another name and no hash
+    images.join("copy.image").write(content, mode="wb")
+    return SlowStorage(str(tmpdir.join("storage")))
+
+
+def test_fetch(tmpdir, storage):
+
+    cache = ImageCache(str(tmpdir.join("images", ".objects")), lambda: storage)
+    destination = str(tmpdir.join("images", "c7200.image"))
+    future = cache.fetch("images/c7200.image", destination, executable=True)
+    # concurrent requests are coalesced
+    assert cache.fetch("images/c7200.image", destination) is future
+    other = cache.fetch("images/c7200.image", str(tmpdir.join("project", "c7200.image")))
+    copy = cache.fetch("images/copy.image", str(tmpdir.join("images", "copy.image")))
+    storage.release.set()
+    assert gather([future, other, copy]).result(5) == [destination,
+                                                       str(tmpdir.join("project", "c7200.image")),
+                                                       str(tmpdir.join("images", "copy.image"))]
+
+    # downloaded once, stored once
+    assert storage.downloads == ["images/c7200.image", "images/copy.image"]
+    assert os.listdir(str(tmpdir.join("images", ".objects"))) == [hashlib.md5(b"IOS image content").hexdigest()]
+    assert os.path.samefile(destination, str(tmpdir.join("project", "c7200.image")))
+    assert os.access(destination, os.X_OK)
+    assert tmpdir.join("images", "copy.image").read(mode="rb") == b"IOS image content"
+
+    # already cached
+    cache.fetch("images/c7200.image", str(tmpdir.join("other", "c7200.image"))).result(5)
+    assert len(storage.downloads) == 2
+
+
+def test_fetch_corrupted(tmpdir, storage):
+
+    tmpdir.join("storage", "images", "c7200.image.md5").write("0" * 32)
+    storage.release.set()
+    cache = ImageCache(str(tmpdir.join("images", ".objects")), lambda: storage)
+    with pytest.raises(ImageCacheError):
+        cache.fetch("images/c7200.image", str(tmpdir.join("images", "c7200.image"))).result(5)
+    assert not tmpdir.join("images", "c7200.image").check()
+    assert os.listdir(str(tmpdir.join("images", ".objects"))) == []
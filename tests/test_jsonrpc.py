@@ -1,8 +1,14 @@
 import uuid
+import base64
+import timeit
+import pytest
+from concurrent.futures import Future
 from tornado.testing import AsyncTestCase
 from tornado.escape import json_encode, json_decode
 from ws4py.client.tornadoclient import TornadoWebSocketClient
 import gns3server.jsonrpc as jsonrpc
+from gns3server.modules.base import IModule
+from gns3server.handlers.jsonrpc_websocket import JSONRPCWebSocket
 
 """
 Tests for JSON-RPC protocol over Websockets
@@ -70,6 +76,170 @@ class JSONRPC(AsyncTestCase):
         assert json_response["id"] == request.id
         assert json_response["error"].get("code") == -32602
 
+    def test_batch_request(self):
+
+        echo = jsonrpc.JSONRPCRequest("dynamips.echo", {"echo": "test"})
+        invalid = jsonrpc.JSONRPCRequest("dynamips.non_existent")
+        batch = [echo(), invalid(), {"jsonrpc": 2.0, "method": "dynamips.echo"}]
+        AsyncWSRequest(self.URL, self.io_loop, self.stop, json_encode(batch))
+        response = self.wait()
+        json_response = {message["id"]: message for message in json_decode(response)}
+        assert len(json_response) == 2
+        assert json_response[echo.id]["result"] == {"echo": "test"}
+        assert json_response[invalid.id]["error"].get("code") == -32601
+
+
+class ReflectionResponse(object):
+    """
+    Response built like the original JSON-RPC objects (reflection on the
+    attributes), the reference for the benchmark.
+    """
+
+    def __init__(self, result, request_id):
+        self._encode()
+        self.id = request_id
+        self.result = result
+
+    def _encode(self):
+        message = {"jsonrpc": 2.0}
+        for field in dir(self):
+            if not field.startswith('_'):
+                message[field] = getattr(self, field)
+        return message
+
+    def __call__(self):
+        return self._encode()
+
+
+def test_messages():
+
+    assert jsonrpc.JSONRPCResponse({"id": 1}, 42)() == {"jsonrpc": 2.0, "id": 42, "result": {"id": 1}}
+    assert jsonrpc.JSONRPCCustomError(-3200, "error", 42)() == {"jsonrpc": 2.0, "id": 42, "error": {"code": -3200, "message": "error"}}
+    assert jsonrpc.JSONRPCParseError()() == {"jsonrpc": 2.0, "id": None, "error": {"code": -32700, "message": "Parse error"}}
+    assert jsonrpc.JSONRPCNotification("vpcs.reset")() == {"jsonrpc": 2.0, "method": "vpcs.reset"}
+    request = jsonrpc.JSONRPCRequest("dynamips.echo", {"echo": "test"})
+    assert jsonrpc.loads(str(request)) == {"jsonrpc": 2.0, "id": request.id, "method": "dynamips.echo", "params": {"echo": "test"}}
+    assert jsonrpc.loads(jsonrpc.dumps(request()).encode("utf-8")) == request()
+    assert ReflectionResponse({"id": 1}, 42)() == jsonrpc.JSONRPCResponse({"id": 1}, 42)()
+
+
+def test_response_construction_benchmark():
+
+    result = {"id": 1, "name": "R1", "console": 2001}
+    reference = min(timeit.repeat(lambda: ReflectionResponse(result, 42)(), number=2000, repeat=5))
+    fast = min(timeit.repeat(lambda: jsonrpc.JSONRPCResponse(result, 42)(), number=2000, repeat=5))
+    print("response construction: {:.1f}x faster".format(reference / fast))
+    assert reference / fast >= 5
+
+
+class ZMQStream(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def send_multipart(self, frames):
+        self.messages.append([frames[0].decode("utf-8"), frames[1].decode("utf-8"), frames[2]])
+
+
+def test_module_batch():
+
+    def echo(module, params):
+        if params is None:
+            module.send_param_error()
+        else:
+            module.send_response(params)
+            module.send_notification("test.event", params)
+
+    IModule.modules["test"] = {"test.echo": echo}
+    module = IModule("test", "127.0.0.1", 0)
+    module._stream = ZMQStream()
+    batch = ["session", [jsonrpc.JSONRPCRequest("test.echo", {"echo": 1}, 1)(),
+                         jsonrpc.JSONRPCRequest("test.echo", request_id=2)(),
+                         jsonrpc.JSONRPCRequest("test.unknown", request_id=3)()], "batch"]
+    module._decode_request([jsonrpc.dumps(batch).encode("utf-8")])
+
+    # notifications are sent right away, responses are aggregated
+    assert module._stream.messages[0][:2] == ["session", ""]
+    session, call_id, responses = module._stream.messages[1]
+    assert (session, call_id) == ("session", "batch")
+    responses = jsonrpc.loads(responses)
+    assert responses[0] == jsonrpc.JSONRPCResponse({"echo": 1}, 1)()
+    assert responses[1]["id"] == 2 and responses[1]["error"]["code"] == -32602
+    assert responses[2]["id"] == 3 and responses[2]["error"]["code"] == -32603
+    assert len(module._stream.messages) == 2
+
+    # single requests are not affected
+    module._decode_request([jsonrpc.dumps(["session", jsonrpc.JSONRPCRequest("test.echo", {"echo": 2}, 3)()]).encode("utf-8")])
+    assert module._stream.messages[2] == ["session", "3", str(jsonrpc.JSONRPCResponse({"echo": 2}, 3)).encode("utf-8")]
+
+
+def test_module_batch_deferred():
+
+    class IOLoop(object):
+        callbacks = []
+
+        def add_callback(self, callback, *args):
+            self.callbacks.append((callback, args))
+
+    futures = []
+
+    def fetch(module, params):
+        future = Future()
+        futures.append(future)
+        module.add_future(future, lambda future: module.send_response(future.result()))
+
+    def echo(module, params):
+        module.send_response(params)
+
+    IModule.modules["test"] = {"test.fetch": fetch, "test.echo": echo}
+    module = IModule("test", "127.0.0.1", 0)
+    module._stream = ZMQStream()
+    module._ioloop = IOLoop()
+    batch = ["session", [jsonrpc.JSONRPCRequest("test.fetch", {}, 1)(),
+                         jsonrpc.JSONRPCRequest("test.echo", {"echo": 2}, 2)()], "batch"]
+    module._decode_request([jsonrpc.dumps(batch).encode("utf-8")])
+
+    # the batch response waits for the deferred response
+    assert module._stream.messages == []
+    module._decode_request([jsonrpc.dumps(["session", jsonrpc.JSONRPCRequest("test.echo", {"echo": 3}, 3)()]).encode("utf-8")])
+    assert [message[1] for message in module._stream.messages] == ["3"]
+
+    futures[0].set_result({"fetched": 1})
+    for callback, args in IOLoop.callbacks:
+        callback(*args)
+    session, call_id, responses = module._stream.messages[1]
+    assert (session, call_id) == ("session", "batch")
+    responses = jsonrpc.loads(responses)
+    assert responses == [jsonrpc.JSONRPCResponse({"echo": 2}, 2)(), jsonrpc.JSONRPCResponse({"fetched": 1}, 1)()]
+
+
+def test_binary_encoding():
+
+    pytest.importorskip("msgpack")
+
+    def save_config(module, params):
+        config = base64.decodebytes(params["startup_config_base64"].encode("utf-8"))
+        module.send_response({"id": params["id"], "startup_config_base64": base64.encodebytes(config).decode("utf-8")})
+
+    IModule.modules["test"] = {"test.save_config": save_config}
+    module = IModule("test", "127.0.0.1", 0)
+    module._stream = ZMQStream()
+    config = bytes(range(256)) * 16
+    request = jsonrpc.JSONRPCRequest("test.save_config", {"id": 1, "startup_config_base64": config}, 1)()
+    module._decode_request([jsonrpc.packb(["session", request])])
+
+    # the response is encoded like the request, with raw bytes
+    response = module._stream.messages[0][2]
+    assert jsonrpc.is_binary(response)
+    assert jsonrpc.decode(response)["result"]["startup_config_base64"] == config
+    json_response = str(jsonrpc.JSONRPCResponse({"id": 1, "startup_config_base64": base64.encodebytes(config).decode("utf-8")}, 1))
+    assert len(response) < len(json_response) * 0.75
+
+    # JSON requests of the same session switch back to JSON
+    request["params"]["startup_config_base64"] = base64.encodebytes(config).decode("utf-8")
+    module._decode_request([jsonrpc.dumps(["session", request]).encode("utf-8")])
+    assert module._stream.messages[1][2] == json_response.encode("utf-8")
+
 
 class AsyncWSRequest(TornadoWebSocketClient):
     """
@@ -89,3 +259,59 @@ class AsyncWSRequest(TornadoWebSocketClient):
         self.close()
         if self._callback:
             self._callback(message.data)
+
+
+class ZMQRouter(object):
+
+    closed = False
+
+    def __init__(self):
+        self.messages = []
+
+    def send_string(self, data, flags=0):
+        self.messages.append(data)
+
+    def send(self, data, flags=0):
+        self.messages.append(data)
+
+
+def test_websocket_batch():
+
+    def builtin_echo(handler, request_id, params):
+        handler.write_message(jsonrpc.JSONRPCNotification("builtin.event", params)())
+        handler.write_message(jsonrpc.JSONRPCResponse(params, request_id)())
+
+    client = JSONRPCWebSocket.__new__(JSONRPCWebSocket)
+    client._session_id = "session"
+    client._binary = False
+    client.zmq_router = ZMQRouter()
+    messages = []
+    client.write_message = lambda message, binary=False: messages.append(message)
+    JSONRPCWebSocket.destinations.update({"builtin.test_echo": builtin_echo, "test.echo": "test"})
+    JSONRPCWebSocket.clients.add(client)
+    try:
+        client.on_message(json_encode([jsonrpc.JSONRPCRequest("test.echo", {"echo": 1}, 1)(),
+                                       jsonrpc.JSONRPCRequest("builtin.test_echo", {"echo": 2}, 2)(),
+                                       jsonrpc.JSONRPCRequest("test.unknown", request_id=3)()]))
+        # the notification of the built-in method is sent right away
+        assert messages == [jsonrpc.JSONRPCNotification("builtin.event", {"echo": 2})()]
+
+        module, request = client.zmq_router.messages
+        assert module == "test"
+        _, requests, batch_id = jsonrpc.loads(request)
+        assert len(requests) == 1
+        response = jsonrpc.dumps([jsonrpc.JSONRPCResponse({"echo": 1}, 1)()])
+        JSONRPCWebSocket.dispatch_message(None, [b"test", b"session", batch_id.encode("utf-8"), response.encode("utf-8")])
+
+        assert len(messages) == 2
+        responses = sorted(messages[1], key=lambda response: response["id"])
+        assert [response["id"] for response in responses] == [1, 2, 3]
+        assert responses[0]["result"] == {"echo": 1}
+        assert responses[1]["result"] == {"echo": 2}
+        assert responses[2]["error"]["code"] == -32601
+        assert not JSONRPCWebSocket.batches
+    finally:
+        JSONRPCWebSocket.clients.discard(client)
+        del JSONRPCWebSocket.destinations["builtin.test_echo"]
+        del JSONRPCWebSocket.destinations["test.echo"]
+        JSONRPCWebSocket.queues.pop("test", None)
@@ -0,0 +1,117 @@
+from gns3server.modules.fabric import UDPRelay, LinkConditions
+from gns3server.modules.fabric.timer_wheel import TimerWheel
+import socket
+import time
+
+
+def test_timer_wheel():
+
+    wheel = TimerWheel(tick=0.001)
+    start = time.monotonic()
+    wheel.advance(start)
+    fired = []
+    # level 0, level 1 and level 2 timers
+    for delay in (0.3, 0.005, 70.0, 0.0005, 2.5):
+        wheel.schedule(start + delay, fired.append, delay)
+    assert len(wheel) == 5
+    assert wheel.timeout() == 0.001
+
+    assert wheel.advance(start + 0.004) == 1
+    assert fired == [0.0005]
+    wheel.advance(start + 1)
+    assert fired == [0.0005, 0.005, 0.3]
+    wheel.advance(start + 69.99)
+    assert fired == [0.0005, 0.005, 0.3, 2.5]
+    wheel.advance(start + 70.001)
+    assert fired == [0.0005, 0.005, 0.3, 2.5, 70.0]
+    assert not len(wheel) and wheel.timeout() is None
+
+
+class FakeWheel(object):
+
+    def __init__(self):
+
+        self.timers = []
+
+    def schedule(self, when, callback, *args):
+
+        self.timers.append((when, callback, args))
+
+
+def test_conditions():
+
+    assert LinkConditions.from_settings({"delay": 0, "loss": 0}) is None
+
+    frames = []
+    wheel = FakeWheel()
+    conditions = LinkConditions.from_settings({"loss": 100})
+    for _ in range(10):
+        conditions.submit(b"frame", frames.append, wheel)
+    assert not frames and conditions.dropped == 10
+
+    conditions = LinkConditions(duplicate=100)
+    conditions.submit(b"frame", frames.append, wheel)
+    assert frames == [b"frame", b"frame"]
+
+    # 1514 bytes leave at once, the next frame waits 1514 * 8 / 100000 seconds
+    frames = []
+    conditions = LinkConditions(rate=100)
+    now = time.monotonic()
+    conditions.submit(bytes(1514), frames.append, wheel)
+    conditions.submit(bytes(1514), frames.append, wheel)
+    assert len(frames) == 1 and len(wheel.timers) == 1
+    assert 0.1 < wheel.timers[0][0] - now < 0.2
+    assert conditions.settings()["pending"] == 1
+
+    # the frame buffer is copied
+    buffer = bytearray(b"frame")
+    conditions = LinkConditions(delay=50)
+    conditions.submit(memoryview(buffer), frames.append, wheel)
+    buffer[:] = b"xxxxx"
+    when, callback, args = wheel.timers[-1]
+    callback(*args)
+    assert frames[-1] == b"frame" and conditions.settings()["delayed"] == 1
+
+
+def test_relay_delay():
+
+    relay = UDPRelay(shards=1)
+    sockets = []
+    for _ in range(2):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.settimeout(2)
+        sockets.append(sock)
+    peer, node = sockets
+    ports = []
+    for _ in range(2):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        ports.append(sock.getsockname()[1])
+        sock.close()
+    inner_port, lport = ports
+
+    try:
+        # the node already uses the loopback tunnel towards the relay
+        relay.insert("R1", "127.0.0.1", lport, "127.0.0.1", peer.getsockname()[1],
+                     "127.0.0.1", inner_port, node.getsockname()[1], lambda lport, rhost, rport: None)
+        relay.set_conditions("R1", LinkConditions(delay=100), None)
+        assert not relay.is_idle("R1")
+
+        start = time.monotonic()
+        peer.sendto(b"frame1", ("127.0.0.1", lport))
+        assert node.recv(100) == b"frame1"
+        assert time.monotonic() - start >= 0.09
+        assert relay.get_conditions("R1")["in"]["delayed"] == 1
+
+        start = time.monotonic()
+        node.sendto(b"frame2", ("127.0.0.1", inner_port))
+        assert peer.recv(100) == b"frame2"
+        assert time.monotonic() - start < 0.09
+
+        relay.set_conditions("R1", None, None)
+        assert relay.is_idle("R1")
+    finally:
+        relay.stop()
+        for sock in sockets:
+            sock.close()
@@ -0,0 +1,109 @@
+from gns3server.module_queue import ModuleQueue, is_control, request_nodes
+import time
+
+
+def test_is_control():
+
+    assert is_control("vpcs.stop")
+    assert is_control("dynamips.vm.reload")
+    assert not is_control("dynamips.vm.create")
+
+
+def test_in_flight_limit():
+
+    sent = []
+    queue = ModuleQueue("dynamips", max_in_flight=2, max_queued=2, control_reserve=1)
+    for call_id in range(6):
+        queue.submit(("session", str(call_id)), lambda call_id=call_id: sent.append(call_id), nodes=frozenset([str(call_id)]))
+    assert sent == [0, 1]
+    assert queue.status()["queued_bulk"] == 2
+    # too many requests waiting
+    assert not queue.submit(("session", "6"), lambda: sent.append(6))
+    assert queue.retry_after() >= 1
+
+    # control operations use the reserve then overtake the waiting requests of the other nodes
+    queue.submit(("session", "stop1"), lambda: sent.append("stop1"), control=True, nodes=frozenset(["10"]))
+    queue.submit(("session", "stop2"), lambda: sent.append("stop2"), control=True, nodes=frozenset(["11"]))
+    assert sent == [0, 1, "stop1"]
+    assert queue.done(("session", "0"))
+    assert sent == [0, 1, "stop1", "stop2"]
+    assert not queue.done(("session", "0"))
+
+    queue.done(("session", "1"))
+    queue.done(("session", "stop1"))
+    assert sent == [0, 1, "stop1", "stop2", 2]
+    assert queue.in_flight == 2
+
+    # notifications are not counted, the module wide ones wait for all the requests
+    queue.submit(None, lambda: sent.append("notify"), nodes=frozenset(["9"]))
+    assert sent[-1] == "notify"
+    queue.submit(None, lambda: sent.append("reset"))
+    assert sent[-1] == "notify"
+    queue.done(("session", "2"))
+    assert sent[-2:] == [3, "reset"]
+
+
+def test_node_order():
+
+    assert request_nodes([{"method": "vpcs.start", "params": {"id": 1}}]) == frozenset(["1"])
+    assert request_nodes([{"method": "vpcs.reset"}]) is None
+
+    sent = []
+    queue = ModuleQueue("vpcs", max_in_flight=1, control_reserve=1)
+    queue.submit(("session", "create"), lambda: sent.append("create"), nodes=frozenset(["2"]))
+    queue.submit(("session", "start1"), lambda: sent.append("start1"), nodes=frozenset(["1"]))
+    queue.submit(("session", "start2"), lambda: sent.append("start2"), nodes=frozenset(["2"]))
+    queue.submit(("session", "start3"), lambda: sent.append("start3"), nodes=frozenset(["3"]))
+    assert sent == ["create"]
+
+    # the stop of node 1 cannot overtake its start but overtakes node 2 and 3
+    queue.submit(("session", "stop1"), lambda: sent.append("stop1"), control=True, nodes=frozenset(["1"]))
+    assert sent == ["create"]
+    # node 5 has nothing waiting before its stop, it uses the reserve
+    queue.submit(("session", "stop5"), lambda: sent.append("stop5"), control=True, nodes=frozenset(["5"]))
+    assert sent == ["create", "stop5"]
+
+    # notifications wait for the requests of their node
+    queue.submit(None, lambda: sent.append("notify1"), nodes=frozenset(["1"]))
+    queue.submit(None, lambda: sent.append("notify4"), nodes=frozenset(["4"]))
+    assert sent == ["create", "stop5", "notify4"]
+
+    for call_id in ["create", "stop5", "start1", "stop1", "start2", "start3"]:
+        queue.done(("session", call_id))
+    assert sent == ["create", "stop5", "notify4", "start1", "stop1", "notify1", "start2", "start3"]
+    assert queue.queued == 0
+
+
+def test_batch_weight():
+
+    sent = []
+    queue = ModuleQueue("vpcs", max_in_flight=4)
+    queue.submit(("session", "batch"), lambda: sent.append("batch"), weight=4)
+    queue.submit(("session", "1"), lambda: sent.append(1))
+    assert sent == ["batch"]
+    queue.cancel("session")
+    queue.done(("session", "batch"))
+    assert sent == ["batch"]
+    assert queue.in_flight == 0
+
+
+def test_expire_with_waiting_requests():
+
+    sent = []
+    queue = ModuleQueue("qemu", max_in_flight=1, timeout=0.1)
+    queue.submit(("session", "1"), lambda: sent.append(1))
+    queue.submit(("session", "2"), lambda: sent.append(2))
+    assert sent == [1]
+    time.sleep(0.3)
+
+    # the module never answered request 1, the waiting request is sent
+    queue.submit(("session", "3"), lambda: sent.append(3))
+    assert sent == [1, 2]
+    assert queue.status()["queued_bulk"] == 1
+
+    # periodic check
+    time.sleep(0.3)
+    queue.check()
+    assert sent == [1, 2, 3]
+    assert queue.status()["queued_bulk"] == 0
+    assert not queue.done(("session", "1"))
@@ -0,0 +1,138 @@
+from tornado.testing import AsyncHTTPTestCase
+from gns3server.config import Config
+from gns3server.pcap_index import PcapIndex, FlowFilter, INDEX_SUFFIX
+from gns3server.handlers.capture_handler import CaptureHandler
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import tornado.web
+
+
+def udp_frame(source, destination, source_port, destination_port, payload=b"data"):
+
+    udp = struct.pack("!HHHH", source_port, destination_port, 8 + len(payload), 0) + payload
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0,
+                     socket.inet_aton(source), socket.inet_aton(destination))
+    return b"\x00\x50\x79\x66\x68\x01" + b"\x00\x50\x79\x66\x68\x02" + b"\x08\x00" + ip + udp
+
+
+def write_capture(path, packets, mode="wb"):
+    """
+    Writes packets (timestamp, frame) to a PCAP file.
+    """
+
+    with open(path, mode) as f:
+        if mode == "wb":
+            f.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for timestamp, frame in packets:
+            f.write(struct.pack("<IIII", int(timestamp), int(round((timestamp % 1) * 1000000)), len(frame), len(frame)))
+            f.write(frame)
+
+
+def read_capture(data):
+
+    packets = []
+    position = 24
+    while position < len(data):
+        seconds, fraction, captured, _ = struct.unpack_from("<IIII", data, position)
+        packets.append((seconds + fraction / 1000000, data[position + 16:position + 16 + captured]))
+        position += 16 + captured
+    return packets
+
+
+PACKETS = [(1000.0, udp_frame("10.0.0.1", "10.0.0.2", 1024, 53)),
+           (1000.5, udp_frame("10.0.0.2", "10.0.0.1", 53, 1024)),
+           (1001.0, udp_frame("10.0.0.3", "10.0.0.4", 5000, 5001)),
+           (1002.0, udp_frame("10.0.0.1", "10.0.0.2", 1024, 53, b"more data"))]
+
+
+def test_index(tmpdir):
+
+    path = str(tmpdir / "test.pcap")
+    write_capture(path, PACKETS[:2])
+    index = PcapIndex(path)
+    assert index.update() == 2
+
+    # the capture grows, the last packet is still being written
+    write_capture(path, PACKETS[2:], mode="ab")
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+    assert index.update() == 3
+    write_capture(path, PACKETS, mode="wb")
+    # same content up to the last indexed packet
+    assert index.update() == 4
+
+    header, ranges, count = index.select(flow=FlowFilter("udp", "10.0.0.2", 53))
+    assert count == 3 and len(ranges) == 2
+    header, ranges, count = index.select(start=1000.5, end=1001.0)
+    assert count == 2 and len(ranges) == 1
+    header, ranges, count = index.select(last=1)
+    assert count == 2
+    header, ranges, count = index.select(flow=FlowFilter(host="10.0.0.1", peer_port=53), limit=1)
+    assert count == 1
+
+    summary = index.summary()
+    assert summary["packets"] == 4 and summary["flow_count"] == 2
+    assert summary["flows"][0] == {"protocol": 17, "host": "10.0.0.1", "port": 1024,
+                                   "peer_host": "10.0.0.2", "peer_port": 53, "packets": 3}
+
+    # the sidecar is loaded instead of indexing the capture again
+    assert os.path.exists(path + INDEX_SUFFIX)
+    assert PcapIndex(path).summary() == summary
+
+    # new capture with the same name
+    write_capture(path, PACKETS[2:3])
+    assert index.update() == 1
+    assert index.summary()["flows"][0]["host"] == "10.0.0.3"
+
+
+class TestCaptureHandler(AsyncHTTPTestCase):
+
+    URL = "/capture"
+
+    def setUp(self):
+
+        self._projects_dir = tempfile.mkdtemp()
+        self._config = Config.instance().get_default_section()
+        self._previous = self._config.get("projects_directory")
+        self._config["projects_directory"] = self._projects_dir
+        os.makedirs(os.path.join(self._projects_dir, "captures"))
+        write_capture(os.path.join(self._projects_dir, "captures", "test.pcap"), PACKETS)
+        AsyncHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+
+        AsyncHTTPTestCase.tearDown(self)
+        if self._previous is None:
+            del self._config["projects_directory"]
+        else:
+            self._config["projects_directory"] = self._previous
+        shutil.rmtree(self._projects_dir)
+
+    def get_app(self):
+
+        return tornado.web.Application([(self.URL, CaptureHandler)])
+
+    def fetch_capture(self, query):
+
+        self.http_client.fetch(self.get_url(self.URL + "?" + query), self.stop)
+        return self.wait()
+
+    def test_flow(self):
+
+        response = self.fetch_capture("path=captures/test.pcap&protocol=udp&host=10.0.0.3")
+        assert response.code == 200
+        assert response.headers["Content-Type"] == "application/vnd.tcpdump.pcap"
+        assert read_capture(response.body) == [PACKETS[2]]
+
+    def test_time_range(self):
+
+        response = self.fetch_capture("path=captures/test.pcap&start=1000.5&end=1002")
+        assert read_capture(response.body) == PACKETS[1:]
+
+    def test_outside_projects(self):
+
+        response = self.fetch_capture("path=../test.pcap")
+        assert response.code == 404
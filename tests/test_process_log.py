@@ -0,0 +1,43 @@
+from gns3server.modules.process_log import ProcessLog
+import os
+
+
+def test_rotate(tmpdir):
+
+    path = str(tmpdir / "test.log")
+    process_log = ProcessLog(path, max_size=1, backups=2)
+    fd = process_log.open()
+    fd.write(b"a" * 1024 + b"\n")
+    fd.flush()
+    assert process_log.rotate()
+    assert not process_log.rotate()
+
+    # the process keeps writing at the beginning of the truncated log
+    fd.write(b"b" * 1024 + b"\n")
+    fd.flush()
+    assert os.path.getsize(path) == 1025
+    assert process_log.rotate()
+    fd.write(b"c" * 1024 + b"\n")
+    fd.flush()
+    before = process_log.read(2045, 10)
+    assert process_log.rotate()
+    fd.write(b"end\n")
+    fd.flush()
+    fd.close()
+
+    # only 2 rotated logs are kept, the offsets are not changed by the rotation
+    assert not os.path.exists(path + ".3")
+    text, offset, total = process_log.read(0)
+    assert offset == 1025 and total == 3 * 1025 + 4
+    assert text.startswith("b" * 1024 + "\n" + "c")
+
+    # the page spans the 2 rotated logs
+    text, offset, total = process_log.read(2045, 10)
+    assert text == "bbbb\nccccc" and offset == 2045
+    assert before[:2] == (text, offset)
+    text, offset, total = process_log.read(-6)
+    assert text == "c\nend\n" and offset == total - 6
+
+    assert process_log.tail(10) == "end\n"
+    process_log.delete()
+    assert not os.path.exists(path) and not os.path.exists(path + ".1")
@@ -0,0 +1,115 @@
+from gns3server.builtins import project
+from gns3server.builtins.project import ProjectOrchestrator
+import tornado.ioloop
+import itertools
+import pytest
+
+
+class FakeModule(object):
+    """
+    Stand-in for the client handler and the modules: node 1 starts,
+    node 2 fails and node 3 never answers.
+    """
+
+    destinations = {"vpcs.start": None, "vpcs.stop": None}
+
+    def __init__(self, ioloop):
+
+        self.clients = [self]
+        self.messages = []
+        self.requests = []
+        self.cancelled = []
+        self._ioloop = ioloop
+        self._ids = itertools.count(1)
+
+    def write_message(self, message):
+
+        self.messages.append(message)
+        if message.get("id") == "project":
+            self._ioloop.stop()
+
+    def send_internal_request(self, method, params, callback):
+
+        request_id = str(next(self._ids))
+        self.requests.append((method, params["id"]))
+        if params["id"] == 1:
+            self._ioloop.add_callback(callback, {"jsonrpc": "2.0", "id": request_id, "result": {}})
+        elif params["id"] == 2:
+            self._ioloop.add_callback(callback, {"jsonrpc": "2.0", "id": request_id, "error": {"code": -3200, "message": "boom"}})
+        return request_id
+
+    def cancel_internal_request(self, request_id):
+
+        self.cancelled.append(request_id)
+
+
+class Overloaded(object):
+
+    def admit(self, in_progress):
+
+        return False, "host overloaded"
+
+
+@pytest.fixture
+def ioloop():
+
+    ioloop = tornado.ioloop.IOLoop.instance()
+    # never hang the tests
+    timeout = ioloop.add_timeout(ioloop.time() + 10, ioloop.stop)
+    yield ioloop
+    ioloop.remove_timeout(timeout)
+
+
+def run(ioloop, module, action, nodes, admission=None):
+
+    ProjectOrchestrator(module, "project", action, nodes, 0.3, admission).run()
+    ioloop.start()
+    response = module.messages[-1]
+    progress = [message["params"] for message in module.messages[:-1]]
+    return response["result"], progress
+
+
+def test_start_all(ioloop):
+
+    module = FakeModule(ioloop)
+    nodes = [{"module": "vpcs", "id": node_id} for node_id in (1, 2, 3)] + [{"module": "qemu", "id": 4}]
+    result, progress = run(ioloop, module, "start", nodes)
+
+    assert result["action"] == "start"
+    assert result["succeeded"] == [{"module": "vpcs", "id": 1}]
+    failed = {node["id"]: node["message"] for node in result["failed"]}
+    assert failed[2] == "boom"
+    assert failed[3] == "No response after 0.3 seconds"
+    assert failed[4] == "Unknown destination qemu.start"
+    # the request without response is forgotten
+    assert module.cancelled == ["3"]
+
+    # one progress notification per node
+    assert [p["completed"] for p in progress] == [1, 2, 3, 4]
+    assert all(p["total"] == 4 for p in progress)
+    assert {p["id"]: p["status"] for p in progress} == {1: "done", 2: "failed", 3: "failed", 4: "failed"}
+
+
+def test_stop_all(ioloop):
+
+    module = FakeModule(ioloop)
+    result, progress = run(ioloop, module, "stop", [{"module": "vpcs", "id": 1}, {"module": "vpcs", "id": 2}])
+    assert module.requests == [("vpcs.stop", 1), ("vpcs.stop", 2)]
+    assert result["succeeded"] == [{"module": "vpcs", "id": 1}]
+    assert [node["id"] for node in result["failed"]] == [2]
+    assert len(progress) == 2
+
+
+def test_admit_anyway(ioloop, monkeypatch):
+
+    monkeypatch.setattr(project, "ADMISSION_MAX_WAIT", 0.2)
+    monkeypatch.setattr(project, "ADMISSION_RETRY_DELAY", 0.05)
+    module = FakeModule(ioloop)
+    start = ioloop.time()
+    result, progress = run(ioloop, module, "start", [{"module": "vpcs", "id": 1}, {"module": "vpcs", "id": 2}], Overloaded())
+
+    # nothing in progress for too long: each node is started anyway, one at a time
+    assert module.requests == [("vpcs.start", 1), ("vpcs.start", 2)]
+    assert ioloop.time() - start >= 0.4
+    assert result["succeeded"] == [{"module": "vpcs", "id": 1}]
+    assert [p["id"] for p in progress] == [1, 2]
@@ -0,0 +1,106 @@
+from gns3server.modules.qemu import qemu_vm
+from gns3server.modules.qemu.qemu_vm import QemuVM
+from gns3server.modules.qemu.qemu_error import QemuError
+import pytest
+
+
+INFO_SNAPSHOTS = """List of snapshots present on all disks:
+ID        TAG                 VM SIZE                DATE       VM CLOCK
+--        base                   274M 2014-10-01 10:00:00   00:01:02.345
+--        configured             280M 2014-10-02 11:00:00   00:10:00.000
+"""
+
+
+class FakeProcess(object):
+
+    def __init__(self):
+
+        self.returncode = None
+        self.pid = 1
+
+    def poll(self):
+
+        return self.returncode
+
+    def wait(self, timeout=None):
+
+        return self.returncode
+
+    def terminate(self):
+
+        self.returncode = 0
+
+
+class FakeQMP(object):
+    """
+    Stand-in for the QMP connection of a running QEMU process.
+    """
+
+    connected = True
+    process = None
+
+    def __init__(self, statuses=()):
+
+        self.commands = []
+        self.errors = {}
+        self._statuses = list(statuses)
+
+    def human_monitor_command(self, command, timeout=30):
+
+        self.commands.append(command)
+        if command == "info snapshots":
+            return INFO_SNAPSHOTS
+        return self.errors.get(command, "")
+
+    def execute(self, command, arguments=None, timeout=30):
+
+        assert command == "query-status"
+        status = self._statuses.pop(0)
+        if isinstance(status, Exception):
+            self.process.returncode = 1
+            raise status
+        return {"status": status, "running": status == "running"}
+
+    def close(self):
+
+        self.connected = False
+
+
+@pytest.fixture
+def vm(request, tmpdir):
+
+    vm = QemuVM("test", "/nonexistent/qemu-system-x86_64", str(tmpdir))
+    vm._process = FakeProcess()
+    vm._qmp_client = FakeQMP()
+    request.addfinalizer(vm.delete)
+    return vm
+
+
+def test_snapshot_list_save_restore(vm):
+
+    assert vm.snapshots() == ["base", "configured"]
+
+    vm.snapshot_save("configured")
+    vm.snapshot_restore("base")
+    assert vm._qmp_client.commands[-3:] == ["savevm configured", "info snapshots", "loadvm base"]
+
+    with pytest.raises(QemuError):
+        vm.snapshot_restore("missing")
+
+    # the snapshot commands only output something on error
+    vm._qmp_client.errors["loadvm base"] = "Error: Device 'drive0' does not have the requested snapshot"
+    with pytest.raises(QemuError):
+        vm.snapshot_restore("base")
+
+
+def test_wait_snapshot_loaded(vm, monkeypatch):
+
+    monkeypatch.setattr(qemu_vm.time, "sleep", lambda delay: None)
+    vm._qmp_client = FakeQMP(["inmigrate", "restore-vm", "paused"])
+    assert vm._wait_snapshot_loaded()
+    assert vm._vm_status == "paused"
+
+    # QEMU exits when the snapshot cannot be loaded, closing the connection
+    vm._qmp_client = FakeQMP(["inmigrate", QemuError("connection closed")])
+    vm._qmp_client.process = vm._process
+    assert not vm._wait_snapshot_loaded()
@@ -0,0 +1,156 @@
+from gns3server.modules.qemu.qmp import QMPClient
+from gns3server.modules.qemu.qemu_error import QemuError
+import json
+import socket
+import threading
+import pytest
+
+
+GREETING = {"QMP": {"version": {"qemu": {"major": 2, "minor": 1, "micro": 0}}, "capabilities": []}}
+
+
+class FakeQMPServer(threading.Thread):
+    """
+    Stand-in for the QMP server of QEMU: sends the greeting and hands
+    every command received to the test through handle().
+    """
+
+    def __init__(self, greeting=GREETING):
+
+        super().__init__(daemon=True)
+        self._greeting = greeting
+        self._listener = socket.socket()
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(1)
+        self.port = self._listener.getsockname()[1]
+        self.commands = []
+        self.connection = None
+
+    def send(self, message):
+
+        self.connection.sendall(json.dumps(message).encode("utf-8") + b"\r\n")
+
+    def handle(self, command):
+
+        # QEMU answers every command by default
+        self.send({"return": {}, "id": command["id"]})
+
+    def run(self):
+
+        self.connection, _ = self._listener.accept()
+        self._listener.close()
+        self.send(self._greeting)
+        buffer = b""
+        while True:
+            data = self.connection.recv(4096)
+            if not data:
+                break
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                command = json.loads(line.decode("utf-8"))
+                self.commands.append(command)
+                self.handle(command)
+        self.connection.close()
+
+
+def connect(server):
+
+    server.start()
+    client = QMPClient("test", "0.0.0.0", server.port)
+    client.connect(timeout=5)
+    return client
+
+
+def test_handshake():
+
+    server = FakeQMPServer()
+    client = connect(server)
+    assert client.connected
+    assert server.commands[0]["execute"] == "qmp_capabilities"
+    client.close()
+    assert not client.connected
+    server.join(5)
+
+    server = FakeQMPServer(greeting={"error": "not QMP"})
+    server.start()
+    with pytest.raises(QemuError):
+        QMPClient("test", "127.0.0.1", server.port).connect(timeout=5)
+    server.join(5)
+
+
+def test_interleaved_events():
+
+    class Server(FakeQMPServer):
+
+        def handle(self, command):
+
+            if command["execute"] == "query-status":
+                # hold the response until the next command
+                self.held = command
+            elif command["execute"] == "stop":
+                self.send({"event": "STOP", "data": {}, "timestamp": {"seconds": 1, "microseconds": 0}})
+                self.send({"return": {}, "id": command["id"]})
+                self.send({"event": "RESUME", "data": {}})
+                self.send({"return": {"status": "paused", "running": False}, "id": self.held["id"]})
+            else:
+                super().handle(command)
+
+    server = Server()
+    client = connect(server)
+    events = []
+    client.subscribe("STOP", lambda event, data: events.append(event))
+    client.subscribe(None, lambda event, data: events.append("any " + event))
+
+    status = []
+    thread = threading.Thread(target=lambda: status.append(client.execute("query-status", timeout=5)))
+    thread.start()
+    while len(server.commands) < 2:
+        thread.join(0.01)
+    assert client.execute("stop", timeout=5) == {}
+    thread.join(5)
+    assert status == [{"status": "paused", "running": False}]
+    assert events == ["STOP", "any STOP", "any RESUME"]
+    client.close()
+    server.join(5)
+
+
+def test_connection_lost():
+
+    class Server(FakeQMPServer):
+
+        def handle(self, command):
+
+            if command["execute"] == "quit":
+                # QEMU exits without answering
+                self.connection.shutdown(socket.SHUT_RDWR)
+            elif command["execute"] != "query-status":
+                super().handle(command)
+
+    server = Server()
+    client = connect(server)
+    with pytest.raises(QemuError):
+        client.execute("quit", timeout=5)
+    assert not client.connected
+    with pytest.raises(QemuError):
+        client.execute("query-status")
+    server.join(5)
+
+    # a command waiting for its response when the client is closed
+    server = Server()
+    client = connect(server)
+    errors = []
+
+    def execute():
+        try:
+            client.execute("query-status", timeout=5)
+        except QemuError as e:
+            errors.append(str(e))
+    thread = threading.Thread(target=execute)
+    thread.start()
+    while len(server.commands) < 2:
+        thread.join(0.01)
+    client.close()
+    thread.join(5)
+    assert errors == ["QMP connection lost while executing query-status"]
+    server.join(5)
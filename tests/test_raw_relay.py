@@ -0,0 +1,41 @@
+from gns3server.modules.fabric import FabricError
+from gns3server.modules.fabric.fabric import Fabric
+from gns3server.modules.fabric.raw_relay_client import RawRelayClient
+import os
+import sys
+import pytest
+
+
+@pytest.fixture
+def relay():
+
+    client = RawRelayClient([sys.executable, "-m", "gns3server.raw_relay"])
+    RawRelayClient._instance = client
+    yield client
+    client.stop()
+    RawRelayClient._instance = None
+
+
+def test_unknown_ethernet_device(relay):
+
+    fabric = Fabric(1)
+    with pytest.raises(FabricError):
+        fabric.create_ethernet_port("eth", "gns3-no-such-if")
+    assert "eth" not in fabric.ports
+
+    # the helper is still running after an error
+    with pytest.raises(FabricError):
+        relay.open("tap", "bad device", 1)
+    with pytest.raises(FabricError):
+        fabric.create_ethernet_port("eth", "gns3-no-such-if")
+    fabric.stop()
+
+
+@pytest.mark.skipif(not os.path.exists("/dev/net/tun") or os.geteuid() != 0, reason="needs access to /dev/net/tun")
+def test_tap_port(relay):
+
+    fabric = Fabric(1)
+    port = fabric.create_tap_port("tap", "gns3test0")
+    assert port.lport
+    fabric.delete_port("tap")
+    fabric.stop()
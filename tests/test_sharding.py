@@ -0,0 +1,42 @@
+from gns3server.modules import sharding
+from gns3server.modules.sharding import ShardRing, ModuleShards
+from gns3server.modules.attic import find_unused_port
+
+
+def test_ring():
+
+    ring = ShardRing(4)
+    owners = [ring.owner(node_id) for node_id in range(1, 1025)]
+    assert set(owners) == {0, 1, 2, 3}
+    assert min(owners.count(shard) for shard in range(4)) > 100
+
+    # adding a shard only moves the identifiers it takes over
+    bigger = ShardRing(5)
+    moved = [node_id for node_id in range(1, 1025) if bigger.owner(node_id) != owners[node_id - 1]]
+    assert all(bigger.owner(node_id) == 4 for node_id in moved)
+    assert len(moved) < 1024 * 0.35
+
+
+def test_route():
+
+    shards = ModuleShards(["iou-0", "iou-1", "iou-2"])
+    ring = ShardRing(3)
+    assert shards.route("iou.start", {"id": 42}) == ["iou-{}".format(ring.owner(42))]
+    assert shards.route("iou.create", {"iou_id": 42, "name": "IOU1"}) == ["iou-{}".format(ring.owner(42))]
+    assert [shards.route("iou.create", {"name": "IOU1"})[0] for _ in range(3)] == ["iou-0", "iou-1", "iou-2"]
+    assert shards.route("iou.settings", {"working_dir": "/tmp"}) == ["iou-0", "iou-1", "iou-2"]
+    assert shards.route("iou.echo", {}) == ["iou-0"]
+    assert ModuleShards(["vpcs"]).route("vpcs.reset", None) == ["vpcs"]
+
+
+def test_local_shard():
+
+    ring = ShardRing(2)
+    sharding.set_local_shard(1, 2)
+    try:
+        assert sharding.owns(7) == (ring.owner(7) == 1)
+        assert [port for port in range(5000, 5004) if sharding.owns_port(port)] == [5001, 5003]
+        assert find_unused_port(30000, 30100) % 2 == 1
+    finally:
+        sharding.set_local_shard(0, 1)
+    assert sharding.owns(7) and sharding.owns_port(5000)
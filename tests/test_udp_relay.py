@@ -0,0 +1,71 @@
+from gns3server.modules.fabric import UDPRelay
+from gns3server.modules.fabric.pcap import PcapWriter
+import os
+import socket
+
+
+def udp_socket(port=0):
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", port))
+    sock.settimeout(2)
+    return sock
+
+
+def free_ports(count):
+
+    sockets = [udp_socket() for _ in range(count)]
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def test_pcap_writer_flush(tmpdir):
+
+    path = str(tmpdir / "test.pcap")
+    writer = PcapWriter(path)
+    writer.write(b"frame")
+    # only the file header until the flush interval
+    assert os.path.getsize(path) == 24
+    writer.flush()
+    assert os.path.getsize(path) == 24 + 16 + 5
+    writer.close()
+
+
+def test_relay(tmpdir):
+
+    relay = UDPRelay(shards=1)
+    peer = udp_socket()
+    lport, inner_port, node_port = free_ports(3)
+    node = {"socket": udp_socket(lport), "destination": ("127.0.0.1", peer.getsockname()[1])}
+
+    def rebind(port, rhost, rport):
+        # the node moves to another tunnel, like QEMU with host_net_remove/host_net_add
+        node["socket"].close()
+        node["socket"] = udp_socket(port)
+        node["destination"] = (rhost, rport)
+
+    try:
+        relay.insert("R1", "127.0.0.1", lport, "127.0.0.1", peer.getsockname()[1], "127.0.0.1", inner_port, node_port, rebind)
+        assert node["destination"] == ("127.0.0.1", inner_port)
+        capture = str(tmpdir / "test.pcap")
+        relay.start_capture("R1", capture)
+
+        node["socket"].sendto(b"frame1", node["destination"])
+        assert peer.recv(100) == b"frame1"
+        peer.sendto(b"frame2", ("127.0.0.1", lport))
+        assert node["socket"].recv(100) == b"frame2"
+
+        relay.stop_capture("R1")
+        assert os.path.getsize(capture) == 24 + 2 * (16 + 6)
+
+        # the node gets its tunnel back
+        assert relay.remove("R1", rebind) == (lport, "127.0.0.1", peer.getsockname()[1])
+        assert not relay.has_relay("R1")
+        peer.sendto(b"frame3", ("127.0.0.1", lport))
+        assert node["socket"].recv(100) == b"frame3"
+    finally:
+        relay.stop()
+        peer.close()
+        node["socket"].close()
@@ -0,0 +1,53 @@
+from gns3server.modules.virtualbox.inventory import VirtualBoxInventory
+import os
+import stat
+
+VIRTUALBOX_XML = """<?xml version="1.0"?>
+<VirtualBox xmlns="http://www.virtualbox.org/">
+  <Global>
+    <MachineRegistry>
+{}
+    </MachineRegistry>
+  </Global>
+</VirtualBox>
+"""
+
+
+def test_inventory(tmpdir):
+
+    vms = ["VM{}".format(number) for number in range(10)]
+    entries = []
+    for number, vmname in enumerate(vms):
+        vbox_file = tmpdir / "{}.vbox".format(vmname)
+        vbox_file.write("")
+        entries.append('      <MachineEntry uuid="{{{}}}" src="{}"/>'.format(number, vbox_file))
+    (tmpdir / "VirtualBox.xml").write(VIRTUALBOX_XML.format("\n".join(entries)))
+
+    # fake VBoxManage logging its commands
+    calls = tmpdir / "calls"
+    vboxmanage = tmpdir / "VBoxManage"
+    vboxmanage.write("#!/bin/sh\n"
+                     "echo \"$2\" >> {}\n".format(calls) +
+                     "if [ \"$2\" = list ] && [ \"$3\" = vms ]; then\n" +
+                     "".join("  echo '\"{}\" {{{}}}'\n".format(vmname, number) for number, vmname in enumerate(vms)) +
+                     "elif [ \"$2\" = getextradata ] && [ \"$3\" = VM1 ]; then\n"
+                     "  echo 'Value: yes'\n"
+                     "fi\n")
+    os.chmod(str(vboxmanage), stat.S_IRWXU)
+
+    inventory = VirtualBoxInventory(str(vboxmanage), str(tmpdir))
+    parses = []
+    parse_machine_files = inventory._parse_machine_files
+    inventory._parse_machine_files = lambda: parses.append(1) or parse_machine_files()
+
+    for _ in range(2):
+        clones = [vmname for vmname, uuid in inventory.vms() if inventory.is_gns3_clone(vmname, uuid)]
+        assert clones == ["VM1"]
+        inventory.hdds()
+    # VirtualBox.xml is parsed once and VBoxManage is executed once per VM
+    assert len(parses) == 1
+    assert calls.read().split().count("getextradata") == len(vms)
+
+    inventory.invalidate()
+    inventory.vms()
+    assert calls.read().split().count("list") == 3
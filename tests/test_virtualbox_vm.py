@@ -0,0 +1,157 @@
+from gns3server.modules.base import IModule
+from gns3server.modules.virtualbox import VirtualBox
+from gns3server.modules.virtualbox import virtualbox_vm
+from gns3server.modules.virtualbox.virtualbox_vm import VirtualBoxVM
+import pytest
+
+
+class FakeVBoxManage(object):
+    """
+    Stand-in for VBoxManage managing one VM.
+    """
+
+    def __init__(self):
+
+        self.state = "poweroff"
+        self.snapshots = []
+        self.commands = []
+
+    def __call__(self, command, stderr=None, timeout=None):
+
+        subcommand, args = command[2], command[3:]
+        self.commands.append([subcommand] + args)
+        output = []
+        if subcommand == "list":
+            output = ["Maximum ICH9 Network Adapter count: 36"]
+        elif subcommand == "showvminfo":
+            output = ['VMState="{}"'.format(self.state), 'chipset="piix3"']
+            for index, (name, _) in enumerate(self.snapshots):
+                output.append('SnapshotName{}="{}"'.format("-1" * index, name))
+        elif subcommand == "snapshot":
+            action, name = args[1], args[2]
+            if action == "take":
+                # a snapshot of a running VM includes its state
+                self.snapshots.append((name, self.state == "running"))
+            elif action == "delete":
+                self.snapshots.remove([snapshot for snapshot in self.snapshots if snapshot[0] == name][0])
+            elif action == "restore":
+                saved = dict(self.snapshots)[name]
+                self.state = "saved" if saved else "poweroff"
+        elif subcommand == "startvm":
+            self.state = "running"
+        elif subcommand == "controlvm" and args[1] == "poweroff":
+            self.state = "poweroff"
+        return "\n".join(output).encode("utf-8")
+
+
+class FakeModule(object):
+    """
+    Stand-in for the VirtualBox module to call its routes.
+    """
+
+    validate_request = IModule.validate_request
+    get_vbox_instance = VirtualBox.get_vbox_instance
+
+    def __init__(self, vm):
+
+        self._vbox_instances = {vm.id: vm}
+        self.responses = []
+        self.errors = []
+
+    def send_response(self, response):
+
+        self.responses.append(response)
+
+    def send_custom_error(self, message):
+
+        self.errors.append(message)
+
+
+@pytest.fixture
+def vboxmanage(monkeypatch):
+
+    vboxmanage = FakeVBoxManage()
+    monkeypatch.setattr(virtualbox_vm.subprocess, "check_output", vboxmanage)
+    monkeypatch.setattr(virtualbox_vm.time, "sleep", lambda delay: None)
+    return vboxmanage
+
+
+@pytest.fixture
+def vm(request, tmpdir, vboxmanage):
+
+    vm = VirtualBoxVM("VBoxManage", "test", "test", False, str(tmpdir))
+    vm.enable_remote_console = False
+    request.addfinalizer(vm.delete)
+    return vm
+
+
+def test_snapshot_routes(vm, vboxmanage):
+
+    module = FakeModule(vm)
+    VirtualBox.vbox_snapshot_save(module, {"id": vm.id, "name": "base"})
+    VirtualBox.vbox_snapshot_list(module, {"id": vm.id})
+    assert module.responses == [True, {"id": vm.id, "snapshots": ["base"], "boot_snapshot": ""}]
+
+    # the snapshot of a running VM is restored in the saved state, the VM is started again
+    vboxmanage.state = "running"
+    VirtualBox.vbox_snapshot_save(module, {"id": vm.id, "name": "running"})
+    vboxmanage.commands.clear()
+    VirtualBox.vbox_snapshot_restore(module, {"id": vm.id, "name": "running"})
+    assert not module.errors
+    commands = [command[:3] for command in vboxmanage.commands if command[0] in ("controlvm", "snapshot", "startvm")]
+    assert commands[:3] == [["controlvm", "test", "poweroff"], ["snapshot", "test", "restore"], ["startvm", "test"]]
+    # the settings of the saved VM are not modified, the network is configured once it runs
+    restored = vboxmanage.commands.index(["snapshot", "test", "restore", "running"])
+    assert not [command for command in vboxmanage.commands[restored:] if command[0] == "modifyvm"]
+    assert ["controlvm", "test", "setlinkstate1", "off"] in vboxmanage.commands
+    assert vboxmanage.state == "running"
+
+    # an existing snapshot is replaced
+    vboxmanage.commands.clear()
+    VirtualBox.vbox_snapshot_save(module, {"id": vm.id, "name": "base"})
+    assert [command[2:] for command in vboxmanage.commands if command[0] == "snapshot"] == [["delete", "base"], ["take", "base"]]
+
+    VirtualBox.vbox_snapshot_delete(module, {"id": vm.id, "name": "running"})
+    VirtualBox.vbox_snapshot_delete(module, {"id": vm.id, "name": "running"})
+    assert module.errors == ["Snapshot running doesn't exist"]
+    VirtualBox.vbox_snapshot_restore(module, {"id": vm.id})
+    assert module.errors[-1].startswith("request validation error")
+
+
+def test_start_modifies_once(vm, vboxmanage):
+
+    vboxmanage.commands.clear()
+    vm.start()
+    vm.stop()
+    modifyvm = [command for command in vboxmanage.commands if command[0] == "modifyvm"]
+    # network and serial console on start, serial port and adapters on stop
+    assert len(modifyvm) == 3
+    assert "--uart1" in modifyvm[0] and "--nictype1" in modifyvm[0] and "--nictype2" in modifyvm[0]
+    assert modifyvm[1][2:] == ["--uart1", "off"]
+
+    vm._modify_vm_options([])
+    assert len([command for command in vboxmanage.commands if command[0] == "modifyvm"]) == 3
+
+
+def test_vm_info_cache(vm, vboxmanage):
+
+    def showvminfo():
+        return len([command for command in vboxmanage.commands if command[0] == "showvminfo"])
+
+    vm.snapshots()
+    count = showvminfo()
+    vm.snapshots()
+    assert showvminfo() == count
+
+    # any other command may change the VM
+    vm._modify_vm("--memory 512")
+    vm.snapshots()
+    assert showvminfo() == count + 1
+    vm._execute("list", ["vms"])
+    vm.snapshots()
+    assert showvminfo() == count + 1
+
+    # the state is always queried
+    vboxmanage.state = "running"
+    assert vm._get_vm_state() == "running"
+    assert showvminfo() == count + 2
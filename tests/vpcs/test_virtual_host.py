@@ -0,0 +1,143 @@
+from gns3server.modules.vpcs import VPCSDevice
+from gns3server.modules.vpcs.nios.nio_udp import NIO_UDP
+from gns3server.modules.vpcs.virtual_host import VirtualHost, mac_address, DHCP_MAGIC
+import os
+import socket
+import struct
+import time
+import pytest
+
+
+def free_port(kind=socket.SOCK_STREAM):
+
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ConsoleClient(object):
+
+    def __init__(self, port):
+
+        self._sock = socket.create_connection(("127.0.0.1", port))
+        self._sock.settimeout(10)
+        self.output = b""
+
+    def read_until(self, text):
+
+        while text.encode() not in self.output:
+            data = self._sock.recv(4096)
+            assert data, self.output
+            self.output += data
+        output, _, self.output = self.output.partition(text.encode())
+        return output.decode(errors="replace")
+
+    def command(self, command, prompt):
+
+        self._sock.sendall(command.encode() + b"\r\n")
+        return self.read_until(prompt)
+
+    def close(self):
+
+        self._sock.close()
+
+
+@pytest.fixture
+def pcs(request, tmpdir):
+
+    ports = (free_port(socket.SOCK_DGRAM), free_port(socket.SOCK_DGRAM))
+    devices = []
+    for index in range(2):
+        device = VPCSDevice("PC{}".format(index + 1), None, str(tmpdir), console=free_port(), console_host="127.0.0.1", engine="builtin")
+        device.port_add_nio_binding(0, NIO_UDP(ports[index], "127.0.0.1", ports[1 - index]))
+        device.start()
+        request.addfinalizer(device.clean_delete)
+        devices.append(device)
+    return devices
+
+
+def test_ping(pcs):
+
+    clients = [ConsoleClient(pc.console) for pc in pcs]
+    try:
+        clients[0].read_until("PC1> ")
+        clients[1].read_until("PC2> ")
+        assert "10.0.0.1 255.255.255.0" in clients[0].command("ip 10.0.0.1/24 10.0.0.254", "PC1> ")
+        assert "10.0.0.2 255.255.255.0" in clients[1].command("ip 10.0.0.2 24", "PC2> ")
+
+        capture = pcs[0].working_dir + "/test.pcap"
+        pcs[0].start_capture(capture)
+        output = clients[0].command("ping 10.0.0.2 -c 2", "PC1> ")
+        assert "84 bytes from 10.0.0.2 icmp_seq=1 ttl=64" in output
+        assert "icmp_seq=2" in output
+        pcs[0].stop_capture()
+        time.sleep(0.2)
+        # ARP request/reply + 2 echo requests/replies
+        assert os.path.getsize(capture) == 24 + 2 * (16 + 42) + 4 * (16 + 98)
+        assert "00:50:79:66:68:{:02x}  10.0.0.2".format(pcs[1].id) in clients[0].command("arp", "PC1> ")
+        # learned from the ARP request
+        assert "10.0.0.1" in clients[1].command("show arp", "PC2> ")
+
+        assert "10.0.0.3 icmp_seq=1 timeout" in clients[0].command("ping 10.0.0.3 -c 1", "PC1> ")
+
+        clients[0].command("save", "PC1> ")
+        with open(pcs[0].working_dir + "/startup.vpc") as f:
+            assert f.read() == "set pcname PC1\nip 10.0.0.1/24 10.0.0.254\n"
+    finally:
+        for client in clients:
+            client.close()
+
+    # the startup file is executed when starting
+    pcs[0].stop()
+    assert not pcs[0].is_running()
+    pcs[0].start()
+    client = ConsoleClient(pcs[0].console)
+    try:
+        client.read_until("PC1> ")
+        assert "IP/MASK     : 10.0.0.1/24" in client.command("show ip", "PC1> ")
+    finally:
+        client.close()
+
+
+class FakeLoop(object):
+
+    def call_later(self, delay, callback, *args):
+
+        return [delay, callback, args]
+
+    @staticmethod
+    def cancel_timer(timer):
+
+        pass
+
+
+def dhcp_reply(request, message_type, your_ip):
+
+    xid = struct.unpack_from("!I", request, 14 + 20 + 8 + 4)[0]
+    message = struct.pack("!BBBBIHH4s4s4s4s16s64s128s", 2, 1, 6, 0, xid, 0, 0, b"\x00" * 4, your_ip, b"\x00" * 4,
+                          b"\x00" * 4, request[6:12], b"", b"")
+    message += DHCP_MAGIC + bytes([53, 1, message_type, 54, 4, 10, 0, 0, 254, 1, 4, 255, 255, 0, 0, 3, 4, 10, 0, 0, 254, 255])
+    udp = struct.pack("!HHHH", 67, 68, 8 + len(message), 0) + message
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0, bytes([10, 0, 0, 254]), b"\xff" * 4)
+    return request[6:12] + b"\x00\x11\x22\x33\x44\x55" + b"\x08\x00" + ip + udp
+
+
+def test_dhcp():
+
+    frames = []
+    output = []
+    done = []
+    host = VirtualHost("PC1", mac_address(1), frames.append, output.append, FakeLoop())
+    host.execute("ip dhcp", lambda: done.append(True))
+    assert host.busy and len(frames) == 1
+    # broadcast DHCP discover
+    assert frames[0][:6] == b"\xff" * 6 and frames[0][6:12] == mac_address(1)
+
+    host.receive(dhcp_reply(frames[0], 2, bytes([10, 0, 0, 5])))
+    assert len(frames) == 2
+    host.receive(dhcp_reply(frames[1], 5, bytes([10, 0, 0, 5])))
+    assert done and not host.busy
+    assert "".join(output) == "DORA IP 10.0.0.5/16 GW 10.0.0.254\r\n"
+    assert host.config() == ["set pcname PC1", "ip 10.0.0.5/16 10.0.0.254"]